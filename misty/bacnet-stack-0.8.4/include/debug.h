@@ -54,7 +54,33 @@ extern "C" {
 #ifdef __cplusplus
 }
 #endif /* __cplusplus */
+
+/* categories of the trace, the ones in the category mask are kept */
+#define DEBUG_CATEGORY_GENERAL 0x01
+#define DEBUG_CATEGORY_RECEIVE 0x02
+#define DEBUG_CATEGORY_RECEIVE_DATA 0x04
+#define DEBUG_CATEGORY_MASTER 0x08
+#define DEBUG_CATEGORY_ALL 0x0F
+
+/* a record is kept when its level is at or below the trace level */
+#define DEBUG_LEVEL_ERROR 1
+#define DEBUG_LEVEL_INFO 2
+#define DEBUG_LEVEL_DEBUG 3
+
+/* records that can wait for the writer, a power of two */
+#define DEBUG_TRACE_SLOTS 8192
+/* arguments and octets of %s strings kept with a record */
+#define DEBUG_TRACE_ARGS 12
+#define DEBUG_TRACE_TEXT 48
+/* milliseconds the writer sleeps between passes over the ring */
+#define DEBUG_TRACE_FLUSH_MS 50
+
+void debug_trace(unsigned category, unsigned level, const char *format, ...);
 void enable_debug_flag(char *fname);
 void status_debug_flag(void);
 void disable_debug_flag(void);
+void set_debug_level(unsigned level);
+void set_debug_categories(unsigned mask);
+unsigned get_debug_level(void);
+unsigned get_debug_categories(void);
 #endif
@@ -30,6 +30,12 @@
 #include <stdbool.h>
 #include "mstpdef.h"
 
+/* frame types counted one by one, the proprietary ones together after them */
+#define MSTP_STAT_FRAME_TYPES (FRAME_TYPE_REPLY_POSTPONED + 2)
+#define MSTP_STAT_FRAME_INDEX(type) \
+    (((type) <= FRAME_TYPE_REPLY_POSTPONED) ? \
+    (type) : (FRAME_TYPE_REPLY_POSTPONED + 1))
+
 struct mstp_port_struct_t {
     MSTP_RECEIVE_STATE receive_state;
     /* When a master node is powered up or reset, */
@@ -172,6 +178,13 @@ struct mstp_port_struct_t {
     unsigned int rt_invalid_frames;
     unsigned int bytes_xmit;
     unsigned int bytes_rcvd;
+    /* valid frames for this station and frames sent, by frame type */
+    unsigned int rt_frames_rcvd[MSTP_STAT_FRAME_TYPES];
+    unsigned int rt_frames_sent[MSTP_STAT_FRAME_TYPES];
+    /* tokens sent again, tokens lost and replies that never came */
+    unsigned int rt_token_retries;
+    unsigned int rt_lost_tokens;
+    unsigned int rt_reply_timeouts;
 
 };
 
@@ -29,6 +29,8 @@
 #include <string.h>
 #include <stdio.h>
 #include <time.h>
+#include <fcntl.h>
+#include <unistd.h>
 #include "bacdef.h"
 #include "bacaddr.h"
 #include "mstp.h"
@@ -37,6 +39,7 @@
 #include "rs485.h"
 #include "npdu.h"
 #include "bits.h"
+#include "bytes.h"
 /* OS Specific include */
 #include "net.h"
 #include "ringbuf.h"
@@ -51,6 +54,12 @@
 #define BACNET_DATA_EXPECTING_REPLY(control) ( (control & (1 << BACNET_DATA_EXPECTING_REPLY_BIT) ) > 0 )
 
 #define INCREMENT_AND_LIMIT_UINT16(x) {if (x < 0xFFFF) x++;}
+
+/* the silence timeouts that the state machines in src/mstp.c run on */
+#define DLMSTP_TFRAME_ABORT 95
+#define DLMSTP_TREPLY_DELAY 250
+#define DLMSTP_TREPLY_TIMEOUT 295
+#define DLMSTP_TUSAGE_TIMEOUT 95
 uint32_t Timer_Silence(
     void *poPort)
 {
@@ -135,6 +144,151 @@ void dlmstp_cleanup(
     pthread_cond_destroy(&poSharedData->Master_Done_Flag);
     pthread_mutex_destroy(&poSharedData->Received_Frame_Mutex);
     pthread_mutex_destroy(&poSharedData->Master_Done_Mutex);
+    close(poSharedData->Wakeup_Pipe[0]);
+    close(poSharedData->Wakeup_Pipe[1]);
+    close(poSharedData->Room_Pipe[0]);
+    close(poSharedData->Room_Pipe[1]);
+}
+
+/* wake up the state machines, a PDU may be the reply they are waiting for */
+static void dlmstp_wakeup(
+    SHARED_MSTP_DATA * poSharedData)
+{
+    uint8_t one = 1;
+
+    if (write(poSharedData->Wakeup_Pipe[1], &one, sizeof(one)) < 0) {
+        /* the pipe is full, so a wakeup is already pending */
+    }
+}
+
+/* take the PDU at the head of the lane, a sender waiting for room is told
+   there is some */
+static void dlmstp_pdu_queue_pop(
+    SHARED_MSTP_DATA * poSharedData,
+    unsigned lane)
+{
+    uint8_t one = 1;
+
+    (void) Ringbuf_Pop(&poSharedData->PDU_Queue[lane], NULL);
+    poSharedData->PDU_Lane_Sent[lane]++;
+    if (poSharedData->Room_Wanted) {
+        poSharedData->Room_Wanted = false;
+        if (write(poSharedData->Room_Pipe[1], &one, sizeof(one)) < 0) {
+            /* the pipe is full, so a wakeup is already pending */
+        }
+    }
+}
+
+/* milliseconds from silence until timeout, at least one so that a state
+   machine that is not quite ready yet is not spun on */
+static int dlmstp_deadline(
+    uint32_t silence,
+    uint32_t timeout)
+{
+    return (timeout > silence) ? (int) (timeout - silence) : 1;
+}
+
+/* milliseconds the state machines can sleep when nothing arrives, the
+   next silence deadline of the state they are in */
+static int dlmstp_fsm_timeout(
+    struct mstp_port_struct_t *mstp_port)
+{
+    uint32_t silence;
+    uint32_t my_timeout;
+    int timeout;
+    int frame_timeout;
+
+    silence = mstp_port->SilenceTimer((void *) mstp_port);
+    switch (mstp_port->master_state) {
+        case MSTP_MASTER_STATE_IDLE:
+            timeout = dlmstp_deadline(silence, Tno_token);
+            break;
+        case MSTP_MASTER_STATE_WAIT_FOR_REPLY:
+            timeout = dlmstp_deadline(silence, DLMSTP_TREPLY_TIMEOUT);
+            break;
+        case MSTP_MASTER_STATE_PASS_TOKEN:
+        case MSTP_MASTER_STATE_POLL_FOR_MASTER:
+            timeout = dlmstp_deadline(silence, DLMSTP_TUSAGE_TIMEOUT);
+            break;
+        case MSTP_MASTER_STATE_NO_TOKEN:
+            my_timeout = Tno_token + (Tslot * mstp_port->This_Station);
+            if (silence < my_timeout) {
+                timeout = my_timeout - silence;
+            } else {
+                timeout = dlmstp_deadline(silence, my_timeout + Tslot);
+            }
+            break;
+        case MSTP_MASTER_STATE_ANSWER_DATA_REQUEST:
+            /* a reply queued by the application wakes us up sooner */
+            timeout = dlmstp_deadline(silence, DLMSTP_TREPLY_DELAY);
+            break;
+        default:
+            /* states that transition without waiting */
+            timeout = 0;
+            break;
+    }
+    /* a frame that stops arriving part way through is aborted */
+    if (mstp_port->receive_state != MSTP_RECEIVE_STATE_IDLE) {
+        frame_timeout = dlmstp_deadline(silence, DLMSTP_TFRAME_ABORT + 1);
+        if (frame_timeout < timeout) {
+            timeout = frame_timeout;
+        }
+    }
+
+    return timeout;
+}
+
+/* PDUs waiting in all the lanes */
+unsigned dlmstp_pdu_queue_count(
+    SHARED_MSTP_DATA * poSharedData)
+{
+    unsigned count = 0;
+    unsigned lane;
+
+    for (lane = 0; lane < MSTP_PDU_LANES; lane++) {
+        count += Ringbuf_Count(&poSharedData->PDU_Queue[lane]);
+    }
+
+    return count;
+}
+
+/* the lanes share the depth of the queue, any lane has room until the
+   PDUs in all of them add up to it */
+bool dlmstp_pdu_queue_full(
+    SHARED_MSTP_DATA * poSharedData)
+{
+    return dlmstp_pdu_queue_count(poSharedData) >=
+        poSharedData->PDU_Queue_Depth;
+}
+
+/* the lanes after the first leave the last slot of the queue to it, so a
+   queue full of PDUs that are not urgent still takes one that is */
+bool dlmstp_pdu_lane_full(
+    SHARED_MSTP_DATA * poSharedData,
+    unsigned lane)
+{
+    unsigned depth = poSharedData->PDU_Queue_Depth;
+
+    if (lane > 0 && depth > 1) {
+        depth -= 1;
+    }
+
+    return dlmstp_pdu_queue_count(poSharedData) >= depth;
+}
+
+/* the first lane with a PDU waiting, or -1 when they are all empty */
+static int dlmstp_pdu_queue_lane(
+    SHARED_MSTP_DATA * poSharedData)
+{
+    int lane;
+
+    for (lane = 0; lane < MSTP_PDU_LANES; lane++) {
+        if (!Ringbuf_Empty(&poSharedData->PDU_Queue[lane])) {
+            return lane;
+        }
+    }
+
+    return -1;
 }
 
 /* returns number of bytes sent on success, zero on failure */
@@ -144,8 +298,20 @@ int dlmstp_send_pdu(
     uint8_t * pdu,      /* any data to be sent - may be null */
     unsigned pdu_len)
 {       /* number of bytes of data */
+    return dlmstp_send_pdu_lane(poPort, dest, pdu, pdu_len,
+        MSTP_PDU_LANE_DEFAULT);
+}
+
+/* returns number of bytes sent on success, zero on failure */
+int dlmstp_send_pdu_lane(
+    void *poPort,
+    BACNET_ADDRESS * dest,      /* destination address */
+    uint8_t * pdu,      /* any data to be sent - may be null */
+    unsigned pdu_len,   /* number of bytes of data */
+    unsigned lane)
+{
     int bytes_sent = 0;
-    struct mstp_pdu_packet *pkt;
+    struct mstp_pdu_packet *pkt = NULL;
     unsigned i = 0;
     SHARED_MSTP_DATA *poSharedData;
     struct mstp_port_struct_t *mstp_port =
@@ -157,8 +323,14 @@ int dlmstp_send_pdu(
     if (!poSharedData) {
         return 0;
     }
+    if (lane >= MSTP_PDU_LANES) {
+        lane = MSTP_PDU_LANES - 1;
+    }
 
-    pkt = (struct mstp_pdu_packet *) Ringbuf_Data_Peek(&poSharedData->PDU_Queue);
+    if (!dlmstp_pdu_lane_full(poSharedData, lane)) {
+        pkt = (struct mstp_pdu_packet *)
+            Ringbuf_Data_Peek(&poSharedData->PDU_Queue[lane]);
+    }
     if (pkt) {
         pkt->data_expecting_reply =
             BACNET_DATA_EXPECTING_REPLY(pdu[BACNET_PDU_CONTROL_BYTE_OFFSET]);
@@ -167,9 +339,16 @@ int dlmstp_send_pdu(
         }
         pkt->length = pdu_len;
         pkt->destination_mac = dest->mac[0];
-        if (Ringbuf_Data_Put(&poSharedData->PDU_Queue, (uint8_t *)pkt)) {
+        if (Ringbuf_Data_Put(&poSharedData->PDU_Queue[lane], (uint8_t *)pkt)) {
             bytes_sent = pdu_len;
+            dlmstp_wakeup(poSharedData);
+            i = dlmstp_pdu_queue_count(poSharedData);
+            if (i > poSharedData->PDU_Queue_High_Water) {
+                poSharedData->PDU_Queue_High_Water = i;
+            }
         }
+    } else {
+        poSharedData->PDU_Queue_Full++;
     }
 
     return bytes_sent;
@@ -232,6 +411,74 @@ uint16_t dlmstp_receive(
     return pdu_len;
 }
 
+/* pass the frame the receive state machine just finished with to the
+   capture, whether it was valid, for another station or broken off */
+static void dlmstp_capture_received(
+    struct mstp_port_struct_t *mstp_port,
+    SHARED_MSTP_DATA * poSharedData,
+    MSTP_RECEIVE_STATE receive_state)
+{
+    uint8_t frame[MAX_HEADER + MAX_MPDU];
+    unsigned length = 8;
+    unsigned original_length;
+    unsigned data_length = 0;
+
+    frame[0] = 0x55;
+    frame[1] = 0xFF;
+    frame[2] = mstp_port->FrameType;
+    frame[3] = mstp_port->DestinationAddress;
+    frame[4] = mstp_port->SourceAddress;
+    frame[5] = HI_BYTE(mstp_port->DataLength);
+    frame[6] = LO_BYTE(mstp_port->DataLength);
+    frame[7] = mstp_port->HeaderCRCActual;
+
+    if ((receive_state == MSTP_RECEIVE_STATE_HEADER) &&
+        (mstp_port->Index < 5)) {
+        /* the octets of the header that came before the error */
+        length = 2 + mstp_port->Index;
+        original_length = length;
+    } else if (receive_state == MSTP_RECEIVE_STATE_DATA) {
+        data_length = mstp_port->DataLength;
+        if (mstp_port->ReceivedInvalidFrame &&
+            (mstp_port->Index < data_length)) {
+            data_length = mstp_port->Index;
+        }
+        if (data_length > mstp_port->InputBufferSize) {
+            data_length = mstp_port->InputBufferSize;
+        }
+        memcpy(&frame[length], mstp_port->InputBuffer, data_length);
+        length += data_length;
+        frame[length++] = mstp_port->DataCRCActualMSB;
+        frame[length++] = mstp_port->DataCRCActualLSB;
+        original_length = length;
+    } else {
+        /* the data of a frame for another station is not kept */
+        original_length = length;
+        if (mstp_port->DataLength) {
+            original_length += mstp_port->DataLength + 2;
+        }
+    }
+
+    poSharedData->Capture_Frame(poSharedData->Capture_Context, frame, length,
+        original_length);
+}
+
+/* one step of the receive state machine, a frame that is done goes to the
+   capture when there is one */
+static void dlmstp_receive_fsm_step(
+    struct mstp_port_struct_t *mstp_port,
+    SHARED_MSTP_DATA * poSharedData)
+{
+    MSTP_RECEIVE_STATE receive_state = mstp_port->receive_state;
+
+    MSTP_Receive_Frame_FSM(mstp_port);
+    if (poSharedData->Capture_Frame &&
+        (receive_state > MSTP_RECEIVE_STATE_PREAMBLE) &&
+        (mstp_port->receive_state == MSTP_RECEIVE_STATE_IDLE)) {
+        dlmstp_capture_received(mstp_port, poSharedData, receive_state);
+    }
+}
+
 void *dlmstp_receive_fsm_task(
     void *pArg)
 {
@@ -253,9 +500,12 @@ void *dlmstp_receive_fsm_task(
         if ((mstp_port->ReceivedValidFrame == false) &&
             (mstp_port->ReceivedInvalidFrame == false)) {
             do {
-                RS485_Check_UART_Data(mstp_port);
-                MSTP_Receive_Frame_FSM((volatile struct mstp_port_struct_t *)
-                    pArg);
+                /* sleep until a byte arrives or a frame is abandoned */
+                RS485_Wait_UART_Data(mstp_port,
+                    (mstp_port->receive_state == MSTP_RECEIVE_STATE_IDLE) ?
+                    -1 : dlmstp_deadline(mstp_port->SilenceTimer(pArg),
+                        DLMSTP_TFRAME_ABORT + 1), -1);
+                dlmstp_receive_fsm_step(mstp_port, poSharedData);
                 received_frame = mstp_port->ReceivedValidFrame ||
                     mstp_port->ReceivedInvalidFrame;
                 if (received_frame) {
@@ -269,11 +519,167 @@ void *dlmstp_receive_fsm_task(
     return NULL;
 }
 
+static uint64_t dlmstp_clock_usec(
+    void)
+{
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return ((uint64_t) now.tv_sec * 1000000) + (now.tv_nsec / 1000);
+}
+
+static unsigned dlmstp_histogram_bucket(
+    uint32_t usec)
+{
+    unsigned msb;
+    unsigned bucket;
+
+    if (usec < (1U << MSTP_HISTOGRAM_SUB_BITS)) {
+        return usec;
+    }
+    /* the power of two picks the group, the next bits the bucket in it */
+    msb = 31 - __builtin_clz(usec);
+    bucket = ((msb - MSTP_HISTOGRAM_SUB_BITS + 1) << MSTP_HISTOGRAM_SUB_BITS) +
+        ((usec >> (msb - MSTP_HISTOGRAM_SUB_BITS)) &
+        ((1U << MSTP_HISTOGRAM_SUB_BITS) - 1));
+
+    return (bucket < MSTP_HISTOGRAM_BUCKETS ?
+        bucket : MSTP_HISTOGRAM_BUCKETS - 1);
+}
+
+/* the first time past the bucket */
+static uint32_t dlmstp_histogram_bound(
+    unsigned bucket)
+{
+    unsigned group;
+    unsigned sub;
+
+    bucket++;
+    if (bucket < (1U << MSTP_HISTOGRAM_SUB_BITS)) {
+        return bucket;
+    }
+    group = bucket >> MSTP_HISTOGRAM_SUB_BITS;
+    sub = bucket & ((1U << MSTP_HISTOGRAM_SUB_BITS) - 1);
+
+    return ((1U << MSTP_HISTOGRAM_SUB_BITS) + sub) << (group - 1);
+}
+
+void dlmstp_histogram_record(
+    MSTP_HISTOGRAM * histogram,
+    uint64_t usec)
+{
+    if (usec > UINT32_MAX) {
+        usec = UINT32_MAX;
+    }
+    histogram->buckets[dlmstp_histogram_bucket((uint32_t) usec)]++;
+    histogram->sum += usec;
+    if (usec > histogram->max) {
+        histogram->max = (uint32_t) usec;
+    }
+    histogram->count++;
+}
+
+uint32_t dlmstp_histogram_percentile(
+    MSTP_HISTOGRAM * histogram,
+    unsigned percent)
+{
+    uint64_t wanted;
+    uint64_t seen = 0;
+    unsigned bucket;
+
+    if (histogram->count == 0) {
+        return 0;
+    }
+    wanted = ((uint64_t) histogram->count * percent + 99) / 100;
+    for (bucket = 0; bucket < MSTP_HISTOGRAM_BUCKETS; bucket++) {
+        seen += histogram->buckets[bucket];
+        if (seen >= wanted) {
+            break;
+        }
+    }
+    if (bucket >= MSTP_HISTOGRAM_BUCKETS - 1 ||
+        dlmstp_histogram_bound(bucket) > histogram->max) {
+        return histogram->max;
+    }
+
+    return dlmstp_histogram_bound(bucket);
+}
+
+/* one step of the master node state machine, the times of the token and
+   of the replies are taken when the state changes, never in between */
+static bool dlmstp_master_fsm_step(
+    struct mstp_port_struct_t *mstp_port,
+    SHARED_MSTP_DATA * poSharedData)
+{
+    MSTP_MASTER_STATE before = mstp_port->master_state;
+    MSTP_MASTER_STATE after;
+    unsigned reply_timeouts = mstp_port->rt_reply_timeouts;
+    bool transition_now;
+    uint64_t now;
+
+    transition_now = MSTP_Master_Node_FSM(mstp_port);
+    after = mstp_port->master_state;
+    if (after == before) {
+        return transition_now;
+    }
+    now = dlmstp_clock_usec();
+
+    switch (after) {
+        case MSTP_MASTER_STATE_USE_TOKEN:
+            /* ReceivedToken, not another frame or a sole master loop */
+            if (before != MSTP_MASTER_STATE_IDLE) {
+                break;
+            }
+            if (poSharedData->Token_Received_Time) {
+                dlmstp_histogram_record(&poSharedData->Token_Rotation,
+                    now - poSharedData->Token_Received_Time);
+            }
+            poSharedData->Token_Received_Time = now;
+            poSharedData->Token_Held = true;
+            break;
+        case MSTP_MASTER_STATE_PASS_TOKEN:
+            if (poSharedData->Token_Held) {
+                dlmstp_histogram_record(&poSharedData->Token_Hold,
+                    now - poSharedData->Token_Received_Time);
+                poSharedData->Token_Held = false;
+            }
+            break;
+        case MSTP_MASTER_STATE_WAIT_FOR_REPLY:
+            if (mstp_port->OutputBuffer[2] ==
+                FRAME_TYPE_BACNET_DATA_EXPECTING_REPLY) {
+                poSharedData->Reply_Wait_Time = now;
+                poSharedData->Reply_Station = mstp_port->OutputBuffer[3];
+            }
+            break;
+        case MSTP_MASTER_STATE_NO_TOKEN:
+            /* a rotation across a lost token says nothing about the loop */
+            poSharedData->Token_Received_Time = 0;
+            poSharedData->Token_Held = false;
+            break;
+        default:
+            break;
+    }
+
+    /* ReceivedReply or ReceivedReplyPostponed from the station asked */
+    if (before == MSTP_MASTER_STATE_WAIT_FOR_REPLY &&
+        poSharedData->Reply_Wait_Time) {
+        if (mstp_port->rt_reply_timeouts == reply_timeouts &&
+            mstp_port->SourceAddress == poSharedData->Reply_Station &&
+            (mstp_port->FrameType == FRAME_TYPE_BACNET_DATA_NOT_EXPECTING_REPLY
+                || mstp_port->FrameType == FRAME_TYPE_REPLY_POSTPONED)) {
+            dlmstp_histogram_record(&poSharedData->
+                Reply_Latency[poSharedData->Reply_Station],
+                now - poSharedData->Reply_Wait_Time);
+        }
+        poSharedData->Reply_Wait_Time = 0;
+    }
+
+    return transition_now;
+}
+
 void *dlmstp_master_fsm_task(
     void *pArg)
 {
-    uint32_t silence = 0;
-    bool run_master = false;
     SHARED_MSTP_DATA *poSharedData;
     struct mstp_port_struct_t *mstp_port = (struct mstp_port_struct_t *) pArg;
     if (!mstp_port) {
@@ -286,42 +692,28 @@ void *dlmstp_master_fsm_task(
         return NULL;
     }
 
+    /* flush any data waiting, the settling time is spent here rather than
+       in dlmstp_init so that the ports of an agent start in parallel */
+    usleep(200000);
+    tcflush(poSharedData->RS485_Handle, TCIOFLUSH);
+
     for (;;) {
+        /* sleep on the serial port and the PDU queue until the next
+           silence deadline of the state machines instead of spinning,
+           a frame can be pending while a reply is waited for */
+        RS485_Wait_UART_Data(mstp_port, dlmstp_fsm_timeout(mstp_port),
+            poSharedData->Wakeup_Pipe[0]);
         if (mstp_port->ReceivedValidFrame == false &&
             mstp_port->ReceivedInvalidFrame == false) {
-            RS485_Check_UART_Data(mstp_port);
-            MSTP_Receive_Frame_FSM(mstp_port);
-        }
-        if (mstp_port->ReceivedValidFrame || mstp_port->ReceivedInvalidFrame) {
-            run_master = true;
-        } else {
-            silence = mstp_port->SilenceTimer(NULL);
-            switch (mstp_port->master_state) {
-                case MSTP_MASTER_STATE_IDLE:
-                    if (silence >= Tno_token)
-                        run_master = true;
-                    break;
-                case MSTP_MASTER_STATE_WAIT_FOR_REPLY:
-                    if (silence >= poSharedData->Treply_timeout)
-                        run_master = true;
-                    break;
-                case MSTP_MASTER_STATE_POLL_FOR_MASTER:
-                    if (silence >= poSharedData->Tusage_timeout)
-                        run_master = true;
-                    break;
-                default:
-                    run_master = true;
-                    break;
-            }
+            dlmstp_receive_fsm_step(mstp_port, poSharedData);
         }
-        if (run_master) {
-            if (mstp_port->This_Station <= DEFAULT_MAX_MASTER) {
-                while (MSTP_Master_Node_FSM(mstp_port)) {
-                    /* do nothing while immediate transitioning */
-                }
-            } else if (mstp_port->This_Station < 255) {
-                MSTP_Slave_Node_FSM(mstp_port);
+        /* the state machines check their own timers */
+        if (mstp_port->This_Station <= DEFAULT_MAX_MASTER) {
+            while (dlmstp_master_fsm_step(mstp_port, poSharedData)) {
+                /* do nothing while immediate transitioning */
             }
+        } else if (mstp_port->This_Station < 255) {
+            MSTP_Slave_Node_FSM(mstp_port);
         }
     }
 
@@ -395,6 +787,7 @@ uint16_t MSTP_Get_Send(
     uint16_t pdu_len = 0;
     uint8_t frame_type = 0;
     struct mstp_pdu_packet *pkt;
+    int lane;
     SHARED_MSTP_DATA *poSharedData = (SHARED_MSTP_DATA *) mstp_port->UserData;
 
     if (!poSharedData) {
@@ -402,10 +795,13 @@ uint16_t MSTP_Get_Send(
     }
 
     (void) timeout;
-    if (Ringbuf_Empty(&poSharedData->PDU_Queue)) {
+    /* every frame of the token hold comes from the first lane with one */
+    lane = dlmstp_pdu_queue_lane(poSharedData);
+    if (lane < 0) {
         return 0;
     }
-    pkt = (struct mstp_pdu_packet *) Ringbuf_Peek(&poSharedData->PDU_Queue);
+    pkt = (struct mstp_pdu_packet *)
+        Ringbuf_Peek(&poSharedData->PDU_Queue[lane]);
     if (pkt->data_expecting_reply) {
         frame_type = FRAME_TYPE_BACNET_DATA_EXPECTING_REPLY;
     } else {
@@ -415,7 +811,7 @@ uint16_t MSTP_Get_Send(
     pdu_len = MSTP_Create_Frame(&mstp_port->OutputBuffer[0],    /* <-- loading this */
         mstp_port->OutputBufferSize, frame_type, pkt->destination_mac,
         mstp_port->This_Station, (uint8_t *) & pkt->buffer[0], pkt->length);
-    (void) Ringbuf_Pop(&poSharedData->PDU_Queue, NULL);
+    dlmstp_pdu_queue_pop(poSharedData, lane);
 
     return pdu_len;
 }
@@ -587,21 +983,28 @@ uint16_t MSTP_Get_Reply(
     bool matched = false;
     uint8_t frame_type = 0;
     struct mstp_pdu_packet *pkt;
+    int lane;
     SHARED_MSTP_DATA *poSharedData = (SHARED_MSTP_DATA *) mstp_port->UserData;
 
     if (!poSharedData) {
         return 0;
     }
 
-    if (Ringbuf_Empty(&poSharedData->PDU_Queue)) {
-        return 0;
+    /* is the next PDU of one of the lanes the reply to the DER? */
+    for (lane = 0; lane < MSTP_PDU_LANES; lane++) {
+        pkt = (struct mstp_pdu_packet *)
+            Ringbuf_Peek(&poSharedData->PDU_Queue[lane]);
+        if (!pkt) {
+            continue;
+        }
+        matched =
+            dlmstp_compare_data_expecting_reply(&mstp_port->InputBuffer[0],
+            mstp_port->DataLength, mstp_port->SourceAddress,
+            (uint8_t *) & pkt->buffer[0], pkt->length, pkt->destination_mac);
+        if (matched) {
+            break;
+        }
     }
-    pkt = (struct mstp_pdu_packet *) Ringbuf_Peek(&poSharedData->PDU_Queue);
-    /* is this the reply to the DER? */
-    matched =
-        dlmstp_compare_data_expecting_reply(&mstp_port->InputBuffer[0],
-        mstp_port->DataLength, mstp_port->SourceAddress,
-        (uint8_t *) & pkt->buffer[0], pkt->length, pkt->destination_mac);
     if (!matched) {
         return 0;
     }
@@ -614,7 +1017,7 @@ uint16_t MSTP_Get_Reply(
     pdu_len = MSTP_Create_Frame(&mstp_port->OutputBuffer[0],    /* <-- loading this */
         mstp_port->OutputBufferSize, frame_type, pkt->destination_mac,
         mstp_port->This_Station, (uint8_t *) & pkt->buffer[0], pkt->length);
-    (void) Ringbuf_Pop(&poSharedData->PDU_Queue, NULL);
+    dlmstp_pdu_queue_pop(poSharedData, lane);
 
     return pdu_len;
 }
@@ -896,6 +1299,8 @@ bool dlmstp_init(
 {
     pthread_t hThread;
     int rv = 0;
+    unsigned depth;
+    unsigned lane;
     SHARED_MSTP_DATA *poSharedData;
     struct mstp_port_struct_t *mstp_port =
         (struct mstp_port_struct_t *) poPort;
@@ -911,10 +1316,51 @@ bool dlmstp_init(
     }
 
     poSharedData->RS485_Port_Name = ifname;
-    /* initialize PDU queue */
-    Ringbuf_Init(&poSharedData->PDU_Queue,
-        (uint8_t *) & poSharedData->PDU_Buffer, sizeof(struct mstp_pdu_packet),
-        MSTP_PDU_PACKET_COUNT);
+    /* initialize PDU queue, the depth is rounded up to a power of 2 */
+    depth = 1;
+    while (depth < poSharedData->PDU_Queue_Depth &&
+        depth < MSTP_PDU_PACKET_MAX) {
+        depth <<= 1;
+    }
+    if (poSharedData->PDU_Queue_Depth == 0) {
+        depth = MSTP_PDU_PACKET_COUNT;
+    }
+    poSharedData->PDU_Queue_Depth = depth;
+    poSharedData->PDU_Queue_High_Water = 0;
+    poSharedData->PDU_Queue_Full = 0;
+    /* each lane can take the whole depth, as long as the others are empty */
+    for (lane = 0; lane < MSTP_PDU_LANES; lane++) {
+        poSharedData->PDU_Lane_Sent[lane] = 0;
+        Ringbuf_Init(&poSharedData->PDU_Queue[lane],
+            (uint8_t *) & poSharedData->PDU_Buffer[lane],
+            sizeof(struct mstp_pdu_packet), depth);
+    }
+    memset(&poSharedData->Token_Rotation, 0, sizeof(MSTP_HISTOGRAM));
+    memset(&poSharedData->Token_Hold, 0, sizeof(MSTP_HISTOGRAM));
+    memset(poSharedData->Reply_Latency, 0,
+        sizeof(poSharedData->Reply_Latency));
+    poSharedData->Token_Received_Time = 0;
+    poSharedData->Token_Held = false;
+    poSharedData->Reply_Wait_Time = 0;
+    poSharedData->Capture_Frame = NULL;
+    poSharedData->Capture_Context = NULL;
+    /* the state machines sleep on this as well as the serial port */
+    if (pipe(poSharedData->Wakeup_Pipe) != 0) {
+        fprintf(stderr, "MS/TP Interface: %s\n cannot create a pipe.\n",
+            ifname);
+        exit(1);
+    }
+    fcntl(poSharedData->Wakeup_Pipe[0], F_SETFL, O_NONBLOCK);
+    fcntl(poSharedData->Wakeup_Pipe[1], F_SETFL, O_NONBLOCK);
+    /* a sender waiting for room in the queue sleeps on this one */
+    poSharedData->Room_Wanted = false;
+    if (pipe(poSharedData->Room_Pipe) != 0) {
+        fprintf(stderr, "MS/TP Interface: %s\n cannot create a pipe.\n",
+            ifname);
+        exit(1);
+    }
+    fcntl(poSharedData->Room_Pipe[0], F_SETFL, O_NONBLOCK);
+    fcntl(poSharedData->Room_Pipe[1], F_SETFL, O_NONBLOCK);
     /* initialize packet queue */
     poSharedData->Receive_Packet.ready = false;
     poSharedData->Receive_Packet.pdu_len = 0;
@@ -1004,9 +1450,6 @@ bool dlmstp_init(
 
 #endif
 
-    /* flush any data waiting */
-    usleep(200000);
-    tcflush(poSharedData->RS485_Handle, TCIOFLUSH);
     /* ringbuffer */
     FIFO_Init(&poSharedData->Rx_FIFO, poSharedData->Rx_Buffer,
         sizeof(poSharedData->Rx_Buffer));
@@ -1029,6 +1472,7 @@ bool dlmstp_init(
     rv = pthread_create(&hThread, NULL, dlmstp_master_fsm_task, mstp_port);
     if (rv != 0) {
         fprintf(stderr, "Failed to start Master Node FSM task\n");
+        return false;
     }
 
     return true;
@@ -51,6 +51,29 @@
 #ifndef MSTP_PDU_PACKET_COUNT
 #define MSTP_PDU_PACKET_COUNT 8
 #endif
+/* the depth of the queue can be raised up to this at runtime */
+#ifndef MSTP_PDU_PACKET_MAX
+#define MSTP_PDU_PACKET_MAX 64
+#endif
+/* priority lanes of the queue, lane 0 is sent first */
+#ifndef MSTP_PDU_LANES
+#define MSTP_PDU_LANES 4
+#endif
+/* lane of the PDUs that are queued without one */
+#define MSTP_PDU_LANE_DEFAULT 1
+
+/* log-linear histograms of times in microseconds, a bucket for each of the
+   first values then 1 << MSTP_HISTOGRAM_SUB_BITS buckets for each power of
+   two, the last bucket goes up to about 67 seconds and takes the rest */
+#define MSTP_HISTOGRAM_SUB_BITS 2
+#define MSTP_HISTOGRAM_BUCKETS 100
+
+typedef struct mstp_histogram {
+    uint32_t count;
+    uint32_t max;       /* microseconds */
+    uint64_t sum;       /* microseconds */
+    uint32_t buckets[MSTP_HISTOGRAM_BUCKETS];
+} MSTP_HISTOGRAM;
 
 typedef struct dlmstp_packet {
     bool ready; /* true if ready to be sent or received */
@@ -127,9 +150,44 @@ typedef struct shared_mstp_data {
     uint8_t Rx_Buffer[4096];
     struct timeval start;
 
-    RING_BUFFER PDU_Queue;
+    /* one queue for each lane, together they hold PDU_Queue_Depth */
+    RING_BUFFER PDU_Queue[MSTP_PDU_LANES];
+
+    struct mstp_pdu_packet PDU_Buffer[MSTP_PDU_LANES][MSTP_PDU_PACKET_MAX];
+    /* slots of the queue in use, 0 for MSTP_PDU_PACKET_COUNT */
+    unsigned PDU_Queue_Depth;
+    /* PDUs sent from each lane */
+    unsigned PDU_Lane_Sent[MSTP_PDU_LANES];
+    /* most PDUs that were waiting at once */
+    unsigned PDU_Queue_High_Water;
+    /* PDUs that found the queue full */
+    unsigned PDU_Queue_Full;
+
+    /* written when a PDU is queued, wakes up the sleeping state machines */
+    int Wakeup_Pipe[2];
+    /* written when a PDU leaves the queue while Room_Wanted is set, wakes
+       up a sender waiting for room in a lane */
+    int Room_Pipe[2];
+    volatile bool Room_Wanted;
 
-    struct mstp_pdu_packet PDU_Buffer[MSTP_PDU_PACKET_COUNT];
+    /* time from a token to the next one, from a token to passing it on,
+       and from a data expecting reply frame to the answer of each station */
+    MSTP_HISTOGRAM Token_Rotation;
+    MSTP_HISTOGRAM Token_Hold;
+    MSTP_HISTOGRAM Reply_Latency[MSTP_BROADCAST_ADDRESS];
+    /* microseconds of the last token, 0 after the token was lost */
+    uint64_t Token_Received_Time;
+    bool Token_Held;
+    /* microseconds the request to Reply_Station went out, 0 when none */
+    uint64_t Reply_Wait_Time;
+    uint8_t Reply_Station;
+
+    /* called with every frame received or sent once set, from the state
+       machine threads so it must not block, the original length is the
+       length on the wire when only part of the frame was kept */
+    void (*Capture_Frame) (void *context, uint8_t * frame, unsigned length,
+        unsigned original_length);
+    void *Capture_Context;
 
 } SHARED_MSTP_DATA;
 
@@ -151,6 +209,31 @@ extern "C" {
         BACNET_ADDRESS * dest,  /* destination address */
         uint8_t * pdu,  /* any data to be sent - may be null */
         unsigned pdu_len);      /* number of bytes of data */
+    /* same as dlmstp_send_pdu, into one of the priority lanes */
+    int dlmstp_send_pdu_lane(
+        void *poShared,
+        BACNET_ADDRESS * dest,  /* destination address */
+        uint8_t * pdu,  /* any data to be sent - may be null */
+        unsigned pdu_len,       /* number of bytes of data */
+        unsigned lane); /* 0 to MSTP_PDU_LANES - 1, 0 goes first */
+    /* PDUs waiting in all the lanes, and true when there is no room */
+    unsigned dlmstp_pdu_queue_count(
+        SHARED_MSTP_DATA * poSharedData);
+    bool dlmstp_pdu_queue_full(
+        SHARED_MSTP_DATA * poSharedData);
+    /* true when there is no room for a PDU in the lane */
+    bool dlmstp_pdu_lane_full(
+        SHARED_MSTP_DATA * poSharedData,
+        unsigned lane);
+
+    /* add a time to a histogram, and the upper bound in microseconds of
+       the bucket that has the given percent of the times */
+    void dlmstp_histogram_record(
+        MSTP_HISTOGRAM * histogram,
+        uint64_t usec);
+    uint32_t dlmstp_histogram_percentile(
+        MSTP_HISTOGRAM * histogram,
+        unsigned percent);
 
     /* returns the number of octets in the PDU, or zero on failure */
     uint16_t dlmstp_receive(
@@ -71,6 +71,7 @@
 
 #include <sys/select.h>
 #include <sys/time.h>
+#include <poll.h>
 
 #include "dlmstp_linux.h"
 
@@ -466,6 +467,14 @@ void RS485_Send_Frame(
                 printf("Came out of Lock in tcdrain\n");
             }
             mstp_port->bytes_xmit += written;
+            /* the frame type follows the preamble */
+            if (nbytes > 2) {
+                mstp_port->rt_frames_sent[MSTP_STAT_FRAME_INDEX(buffer[2])]++;
+            }
+            if (poSharedData->Capture_Frame) {
+                poSharedData->Capture_Frame(poSharedData->Capture_Context,
+                    buffer, written, nbytes);
+            }
         }
         /*  tcdrain(RS485_Handle); */
         /* per MSTP spec, sort of */
@@ -560,6 +569,69 @@ void RS485_Check_UART_Data(
     }
 }
 
+/****************************************************************************
+* DESCRIPTION: Get a byte of receive data, sleeping until there is one
+* RETURN:      none
+* ALGORITHM:   The serial port is only polled when the FIFO is empty, then
+*              the thread sleeps until a byte arrives, the wakeup fd is
+*              readable or timeout milliseconds pass (-1 waits forever).
+* NOTES:       none
+*****************************************************************************/
+void RS485_Wait_UART_Data(
+    volatile struct mstp_port_struct_t *mstp_port,
+    int timeout,
+    int wakeup_fd)
+{
+    struct pollfd fds[2];
+    nfds_t nfds = 1;
+    uint8_t buf[2048];
+    int n;
+
+    SHARED_MSTP_DATA *poSharedData = (SHARED_MSTP_DATA *) mstp_port->UserData;
+    if (!poSharedData) {
+        RS485_Check_UART_Data(mstp_port);
+        return;
+    }
+
+    if ((mstp_port->ReceiveError == false) &&
+        (mstp_port->DataAvailable == false) &&
+        (FIFO_Count(&poSharedData->Rx_FIFO) == 0)) {
+        fds[0].fd = poSharedData->RS485_Handle;
+        fds[0].events = POLLIN;
+        fds[0].revents = 0;
+        if (wakeup_fd >= 0) {
+            fds[1].fd = wakeup_fd;
+            fds[1].events = POLLIN;
+            fds[1].revents = 0;
+            nfds = 2;
+        }
+        n = poll(fds, nfds, timeout);
+        if (n > 0) {
+            if (fds[0].revents & POLLIN) {
+                n = read(poSharedData->RS485_Handle, buf, sizeof(buf));
+                if (n > 0) {
+                    FIFO_Add(&poSharedData->Rx_FIFO, &buf[0], n);
+                }
+            } else if (fds[0].revents & (POLLERR | POLLHUP | POLLNVAL)) {
+                /* nothing on the other end, don't spin on it */
+                usleep(5000);
+            }
+            if ((nfds == 2) && (fds[1].revents & POLLIN)) {
+                while (read(wakeup_fd, buf, sizeof(buf)) > 0) {
+                    /* drain the wakeups */
+                }
+            }
+        }
+    }
+
+    if ((mstp_port->ReceiveError == false) &&
+        (mstp_port->DataAvailable == false) &&
+        (FIFO_Count(&poSharedData->Rx_FIFO) > 0)) {
+        mstp_port->DataRegister = FIFO_Get(&poSharedData->Rx_FIFO);
+        mstp_port->DataAvailable = true;
+    }
+}
+
 void RS485_Cleanup(
     void)
 {
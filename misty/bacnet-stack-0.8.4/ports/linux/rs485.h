@@ -58,6 +58,10 @@ extern "C" {
 
     void RS485_Check_UART_Data(
         volatile struct mstp_port_struct_t *mstp_port); /* port specific data */
+    void RS485_Wait_UART_Data(
+        volatile struct mstp_port_struct_t *mstp_port,  /* port specific data */
+        int timeout,    /* milliseconds to sleep with no data, -1 forever */
+        int wakeup_fd); /* also wake up when this is readable, or -1 */
     uint32_t RS485_Get_Port_Baud_Rate(
         volatile struct mstp_port_struct_t *mstp_port);
     uint32_t RS485_Get_Baud_Rate(
@@ -36,33 +36,447 @@
 #include <stdbool.h>    /* for the standard bool type. */
 #include <stdio.h>      /* Standard I/O */
 #include <stdlib.h>     /* Standard Library */
+#include <stddef.h>
 #include <stdarg.h>
 #include <string.h>
+#include <time.h>
+#include <pthread.h>
 #include "debug.h"
 
-/** @file debug.c  Debug print function */
+/** @file debug.c  Debug print function
+
+ The callers, the MS/TP state machines among them, only put a record in a
+ ring: the time, the format and the arguments.  Nothing is formatted and no
+ system call is made in the caller, a writer thread formats the records and
+ writes them to the file.  The ring has many producers and one consumer,
+ a producer claims a slot by moving the head with a compare and swap and
+ publishes it by setting its sequence, a full ring drops the record and
+ counts it.
+ */
+
+typedef union debug_arg {
+    long long i;
+    unsigned long long u;
+    double d;
+    const void *p;
+} debug_arg_t;
+
+typedef struct debug_record {
+    uint32_t sequence;
+    uint8_t nargs;
+    uint8_t truncated;          /* ran out of args or text */
+    uint64_t nsec;              /* CLOCK_REALTIME */
+    const char *format;
+    debug_arg_t args[DEBUG_TRACE_ARGS];
+    char text[DEBUG_TRACE_TEXT];        /* the %s strings, one after the other */
+} debug_record_t;
+
+/* a conversion in the format */
+typedef struct debug_spec {
+    const char *start;          /* the '%' */
+    const char *end;            /* after the conversion character */
+    char conversion;
+    char length;                /* 'H' hh, 'h', 'l', 'L' ll, 'z', 'j', 't' or 0 */
+    uint8_t stars;              /* '*' width and precision */
+} debug_spec_t;
+
+static debug_record_t *Debug_Records = NULL;
+static uint32_t Debug_Head = 0;
+static uint32_t Debug_Tail = 0;
+static uint32_t Debug_Dropped = 0;
+static uint32_t Debug_Written = 0;
+static unsigned Debug_Level = DEBUG_LEVEL_DEBUG;
+static unsigned Debug_Categories = DEBUG_CATEGORY_ALL;
+static int Debug_Active = 0;
+static int Debug_Stopping = 0;
+static pthread_t Debug_Writer;
+static pthread_mutex_t Debug_Lock = PTHREAD_MUTEX_INITIALIZER;
 
 static FILE *debug_fp=NULL;
 static char log_filename[1024];
 
+/* find the next conversion, false at the end of the format */
+static bool debug_next_spec(
+    const char *format,
+    debug_spec_t * spec)
+{
+    const char *p = format;
+
+    for (;;) {
+        p = strchr(p, '%');
+        if (p == NULL) {
+            return false;
+        }
+        if (p[1] != '%') {
+            break;
+        }
+        p += 2;
+    }
+    spec->start = p++;
+    spec->stars = 0;
+    spec->length = 0;
+
+    while (*p && strchr("-+ #0", *p)) {
+        p++;
+    }
+    if (*p == '*') {
+        spec->stars++;
+        p++;
+    }
+    while (*p >= '0' && *p <= '9') {
+        p++;
+    }
+    if (*p == '.') {
+        p++;
+        if (*p == '*') {
+            spec->stars++;
+            p++;
+        }
+        while (*p >= '0' && *p <= '9') {
+            p++;
+        }
+    }
+    if (*p == 'h' || *p == 'l') {
+        spec->length = *p++;
+        if (*p == spec->length) {
+            spec->length = (spec->length == 'h') ? 'H' : 'L';
+            p++;
+        }
+    } else if (*p == 'z' || *p == 'j' || *p == 't') {
+        spec->length = *p++;
+    }
+    spec->conversion = *p;
+    spec->end = *p ? p + 1 : p;
+
+    return true;
+}
+
+static bool debug_integer(
+    char conversion)
+{
+    return strchr("diouxXc", conversion) != NULL;
+}
+
+static bool debug_signed(
+    char conversion)
+{
+    return conversion == 'd' || conversion == 'i' || conversion == 'c';
+}
+
+/* take the arguments off the list the way printf() would */
+static void debug_capture(
+    debug_record_t * record,
+    const char *format,
+    va_list ap)
+{
+    debug_spec_t spec;
+    size_t used = 0;
+    size_t size;
+    const char *string;
+    unsigned i;
+
+    record->nargs = 0;
+    record->truncated = 0;
+    while (debug_next_spec(format, &spec)) {
+        format = spec.end;
+        if (record->nargs + spec.stars + 1 > DEBUG_TRACE_ARGS) {
+            record->truncated = 1;
+            return;
+        }
+        for (i = 0; i < spec.stars; i++) {
+            record->args[record->nargs++].i = va_arg(ap, int);
+        }
+        if (debug_integer(spec.conversion)) {
+            bool is_signed = debug_signed(spec.conversion);
+            debug_arg_t *arg = &record->args[record->nargs++];
+
+            switch (spec.length) {
+                case 'l':
+                    if (is_signed)
+                        arg->i = va_arg(ap, long);
+                    else
+                        arg->u = va_arg(ap, unsigned long);
+                    break;
+                case 'L':
+                    if (is_signed)
+                        arg->i = va_arg(ap, long long);
+                    else
+                        arg->u = va_arg(ap, unsigned long long);
+                    break;
+                case 'z':
+                    arg->u = va_arg(ap, size_t);
+                    break;
+                case 'j':
+                    arg->u = va_arg(ap, uintmax_t);
+                    break;
+                case 't':
+                    arg->i = va_arg(ap, ptrdiff_t);
+                    break;
+                case 'H':
+                    if (is_signed)
+                        arg->i = (signed char) va_arg(ap, int);
+                    else
+                        arg->u = (unsigned char) va_arg(ap, unsigned);
+                    break;
+                case 'h':
+                    if (is_signed)
+                        arg->i = (short) va_arg(ap, int);
+                    else
+                        arg->u = (unsigned short) va_arg(ap, unsigned);
+                    break;
+                default:
+                    if (is_signed)
+                        arg->i = va_arg(ap, int);
+                    else
+                        arg->u = va_arg(ap, unsigned);
+                    break;
+            }
+        } else if (strchr("eEfFgGaA", spec.conversion)) {
+            record->args[record->nargs++].d = va_arg(ap, double);
+        } else if (spec.conversion == 'p') {
+            record->args[record->nargs++].p = va_arg(ap, void *);
+        } else if (spec.conversion == 's') {
+            /* the string may not outlive the call, keep a copy */
+            string = va_arg(ap, const char *);
+            if (string == NULL) {
+                string = "(null)";
+            }
+            if (used >= DEBUG_TRACE_TEXT) {
+                record->truncated = 1;
+                return;
+            }
+            size = strlen(string);
+            if (used + size + 1 > DEBUG_TRACE_TEXT) {
+                size = DEBUG_TRACE_TEXT - used - 1;
+                record->truncated = 1;
+            }
+            memcpy(&record->text[used], string, size);
+            record->text[used + size] = 0;
+            record->args[record->nargs++].u = used;
+            used += size + 1;
+            if (record->truncated) {
+                return;
+            }
+        } else {
+            /* %n and anything unknown end the record here */
+            record->truncated = 1;
+            return;
+        }
+    }
+}
+
+/* format a record the way printf() would have */
+static bool debug_write_record(
+    FILE * fp,
+    debug_record_t * record,
+    bool line_start)
+{
+    const char *format = record->format;
+    debug_spec_t spec;
+    char conversion[32];
+    size_t length;
+    unsigned arg = 0;
+    int star[2] = { 0, 0 };
+    unsigned i;
+    char last = line_start ? '\n' : 0;
+
+    if (line_start) {
+        fprintf(fp, "%lu.%06lu ",
+            (unsigned long) (record->nsec / 1000000000),
+            (unsigned long) ((record->nsec % 1000000000) / 1000));
+    }
+    while (debug_next_spec(format, &spec)) {
+        if (arg + spec.stars + 1 > record->nargs) {
+            break;
+        }
+        /* the text up to the conversion, %% included */
+        for (; format < spec.start; format++) {
+            if (format[0] == '%' && format[1] == '%') {
+                format++;
+            }
+            fputc(*format, fp);
+            last = *format;
+        }
+        format = spec.end;
+
+        /* the conversion with ll in place of its length modifier */
+        length = 0;
+        for (i = 0; i < spec.stars; i++) {
+            star[i] = (int) record->args[arg++].i;
+        }
+        for (; spec.start < spec.end - 1 && length < sizeof(conversion) - 4;
+            spec.start++) {
+            if (!strchr("hlzjt", *spec.start)) {
+                conversion[length++] = *spec.start;
+            }
+        }
+        if (debug_integer(spec.conversion) && spec.conversion != 'c') {
+            conversion[length++] = 'l';
+            conversion[length++] = 'l';
+        }
+        conversion[length++] = spec.conversion;
+        conversion[length] = 0;
+
+#define DEBUG_PRINT(value) \
+        (spec.stars == 2 ? fprintf(fp, conversion, star[0], star[1], value) : \
+         spec.stars == 1 ? fprintf(fp, conversion, star[0], value) : \
+         fprintf(fp, conversion, value))
+        if (spec.conversion == 'c') {
+            DEBUG_PRINT((int) record->args[arg].i);
+        } else if (spec.conversion == 's') {
+            DEBUG_PRINT(&record->text[record->args[arg].u]);
+        } else if (spec.conversion == 'p') {
+            DEBUG_PRINT(record->args[arg].p);
+        } else if (debug_signed(spec.conversion)) {
+            DEBUG_PRINT(record->args[arg].i);
+        } else if (debug_integer(spec.conversion)) {
+            DEBUG_PRINT(record->args[arg].u);
+        } else {
+            DEBUG_PRINT(record->args[arg].d);
+        }
+#undef DEBUG_PRINT
+        arg++;
+        last = 0;
+    }
+    if (record->truncated) {
+        fputs("...\n", fp);
+        return true;
+    }
+    for (; *format; format++) {
+        if (format[0] == '%' && format[1] == '%') {
+            format++;
+        }
+        fputc(*format, fp);
+        last = *format;
+    }
+
+    return last == '\n';
+}
+
+static void *debug_writer_thread(
+    void *arg)
+{
+    FILE *fp = (FILE *) arg;
+    debug_record_t *record;
+    struct timespec interval;
+    uint32_t dropped = __atomic_load_n(&Debug_Dropped, __ATOMIC_RELAXED);
+    uint32_t now_dropped;
+    bool line_start = true;
+    int stopping;
+
+    interval.tv_sec = 0;
+    interval.tv_nsec = DEBUG_TRACE_FLUSH_MS * 1000000L;
+
+    for (;;) {
+        /* once stopping is seen nothing new is put, empty the ring */
+        stopping = __atomic_load_n(&Debug_Stopping, __ATOMIC_ACQUIRE);
+
+        for (;;) {
+            record = &Debug_Records[Debug_Tail & (DEBUG_TRACE_SLOTS - 1)];
+            if (__atomic_load_n(&record->sequence,
+                    __ATOMIC_ACQUIRE) != Debug_Tail + 1) {
+                break;
+            }
+            line_start = debug_write_record(fp, record, line_start);
+            __atomic_store_n(&record->sequence,
+                Debug_Tail + DEBUG_TRACE_SLOTS, __ATOMIC_RELEASE);
+            Debug_Tail++;
+            __atomic_fetch_add(&Debug_Written, 1, __ATOMIC_RELAXED);
+        }
+        now_dropped = __atomic_load_n(&Debug_Dropped, __ATOMIC_RELAXED);
+        if (now_dropped != dropped) {
+            fprintf(fp, "%sdebug: %u records dropped\n",
+                line_start ? "" : "\n", now_dropped - dropped);
+            dropped = now_dropped;
+            line_start = true;
+        }
+        fflush(fp);
+
+        if (stopping) {
+            break;
+        }
+        nanosleep(&interval, NULL);
+    }
+
+    return NULL;
+}
+
 #if DEBUG_ENABLED
-void debug_printf(
+static void debug_vtrace(
+    unsigned category,
+    unsigned level,
     const char *format,
-    ...)
+    va_list ap)
 {
-    va_list ap;
+    debug_record_t *record;
+    struct timespec now;
+    uint32_t head;
+    int32_t diff;
 
-    if(debug_fp == NULL){
+    if (!__atomic_load_n(&Debug_Active, __ATOMIC_ACQUIRE) ||
+        !(__atomic_load_n(&Debug_Categories, __ATOMIC_RELAXED) & category) ||
+        level > __atomic_load_n(&Debug_Level, __ATOMIC_RELAXED)) {
         return;
     }
+    clock_gettime(CLOCK_REALTIME, &now);
+
+    head = __atomic_load_n(&Debug_Head, __ATOMIC_RELAXED);
+    for (;;) {
+        record = &Debug_Records[head & (DEBUG_TRACE_SLOTS - 1)];
+        diff = (int32_t) (__atomic_load_n(&record->sequence,
+                __ATOMIC_ACQUIRE) - head);
+        if (diff == 0) {
+            if (__atomic_compare_exchange_n(&Debug_Head, &head, head + 1,
+                    true, __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+                break;
+            }
+        } else if (diff < 0) {
+            __atomic_fetch_add(&Debug_Dropped, 1, __ATOMIC_RELAXED);
+            return;
+        } else {
+            head = __atomic_load_n(&Debug_Head, __ATOMIC_RELAXED);
+        }
+    }
+
+    record->nsec = ((uint64_t) now.tv_sec * 1000000000) + now.tv_nsec;
+    record->format = format;
+    debug_capture(record, format, ap);
+    __atomic_store_n(&record->sequence, head + 1, __ATOMIC_RELEASE);
+}
+
+void debug_trace(
+    unsigned category,
+    unsigned level,
+    const char *format,
+    ...)
+{
+    va_list ap;
+
     va_start(ap, format);
-    vfprintf(debug_fp, format, ap);
+    debug_vtrace(category, level, format, ap);
     va_end(ap);
-    fflush(debug_fp);
+}
+
+void debug_printf(
+    const char *format,
+    ...)
+{
+    va_list ap;
 
-    return;
+    va_start(ap, format);
+    debug_vtrace(DEBUG_CATEGORY_GENERAL, DEBUG_LEVEL_INFO, format, ap);
+    va_end(ap);
 }
 #else
+void debug_trace(
+    unsigned category,
+    unsigned level,
+    const char *format,
+    ...)
+{
+    format = format;
+}
+
 void debug_printf(
     const char *format,
     ...)
@@ -71,29 +485,113 @@ void debug_printf(
 }
 #endif
 
+/* stop the writer, the caller holds Debug_Lock */
+static void debug_stop(
+    void)
+{
+    if (debug_fp == NULL) {
+        return;
+    }
+    __atomic_store_n(&Debug_Active, 0, __ATOMIC_RELEASE);
+    __atomic_store_n(&Debug_Stopping, 1, __ATOMIC_RELEASE);
+    pthread_join(Debug_Writer, NULL);
+    fclose(debug_fp);
+    debug_fp = NULL;
+}
+
 void enable_debug_flag(char *fname)
 {
-    debug_fp = fopen(fname, "w");
-    if (debug_fp == NULL){
+    uint32_t i;
+    FILE *fp;
+
+    pthread_mutex_lock(&Debug_Lock);
+    debug_stop();
+
+    /* the ring is allocated the first time and kept */
+    if (Debug_Records == NULL) {
+        Debug_Records = calloc(DEBUG_TRACE_SLOTS, sizeof(debug_record_t));
+        if (Debug_Records == NULL) {
+            printf("Unable to allocate the debug trace\n");
+            pthread_mutex_unlock(&Debug_Lock);
+            return;
+        }
+        for (i = 0; i < DEBUG_TRACE_SLOTS; i++) {
+            Debug_Records[i].sequence = i;
+        }
+    }
+
+    fp = fopen(fname, "w");
+    if (fp == NULL){
         printf("Unable to open the file %s in write mode\n", fname);
+        pthread_mutex_unlock(&Debug_Lock);
+        return;
+    }
+    Debug_Stopping = 0;
+    if (pthread_create(&Debug_Writer, NULL, debug_writer_thread, fp) != 0) {
+        printf("Unable to start the debug writer\n");
+        fclose(fp);
+        pthread_mutex_unlock(&Debug_Lock);
         return;
-    }else{
-        printf("Logging debug messages in '%s' \n", fname);
     }
-    strcpy(log_filename, fname);
+    debug_fp = fp;
+    snprintf(log_filename, sizeof(log_filename), "%s", fname);
+    __atomic_store_n(&Debug_Active, 1, __ATOMIC_RELEASE);
+    pthread_mutex_unlock(&Debug_Lock);
+
+    printf("Logging debug messages in '%s' \n", fname);
 }
 
 void status_debug_flag()
 {
+    static const char *levels[] = { "none", "error", "info", "debug" };
+    static const char *categories[] = { "general", "receive", "data", "master" };
+    unsigned level = get_debug_level();
+    unsigned mask = get_debug_categories();
+    unsigned i;
+
+    pthread_mutex_lock(&Debug_Lock);
     if(debug_fp == NULL){
         printf("Debugging disabled\n");
     }else{
         printf("Debug logging enabled into %s \n",log_filename);
     }
+    pthread_mutex_unlock(&Debug_Lock);
+
+    printf("level: %s categories:", level < 4 ? levels[level] : "debug");
+    for (i = 0; i < 4; i++) {
+        if (mask & (1 << i)) {
+            printf(" %s", categories[i]);
+        }
+    }
+    printf("\nwritten: %u dropped: %u\n",
+        __atomic_load_n(&Debug_Written, __ATOMIC_RELAXED),
+        __atomic_load_n(&Debug_Dropped, __ATOMIC_RELAXED));
 }
 
 void disable_debug_flag()
 {
-    debug_fp = NULL;
+    pthread_mutex_lock(&Debug_Lock);
+    debug_stop();
+    pthread_mutex_unlock(&Debug_Lock);
     printf("Stopped logging of debug messages\n");
 }
+
+void set_debug_level(unsigned level)
+{
+    __atomic_store_n(&Debug_Level, level, __ATOMIC_RELAXED);
+}
+
+void set_debug_categories(unsigned mask)
+{
+    __atomic_store_n(&Debug_Categories, mask, __ATOMIC_RELAXED);
+}
+
+unsigned get_debug_level(void)
+{
+    return __atomic_load_n(&Debug_Level, __ATOMIC_RELAXED);
+}
+
+unsigned get_debug_categories(void)
+{
+    return __atomic_load_n(&Debug_Categories, __ATOMIC_RELAXED);
+}
@@ -68,7 +68,8 @@
 #endif
 
 #if defined(PRINT_ENABLED_RECEIVE)
-#define printf_receive debug_printf
+#define printf_receive(...) \
+    debug_trace(DEBUG_CATEGORY_RECEIVE, DEBUG_LEVEL_DEBUG, __VA_ARGS__)
 #else
 static inline void printf_receive(
     const char *format,
@@ -79,7 +80,8 @@ static inline void printf_receive(
 #endif
 
 #if defined(PRINT_ENABLED_RECEIVE_DATA)
-#define printf_receive_data debug_printf
+#define printf_receive_data(...) \
+    debug_trace(DEBUG_CATEGORY_RECEIVE_DATA, DEBUG_LEVEL_DEBUG, __VA_ARGS__)
 #else
 static inline void printf_receive_data(
     const char *format,
@@ -90,7 +92,8 @@ static inline void printf_receive_data(
 #endif
 
 #if defined(PRINT_ENABLED_RECEIVE_ERRORS)
-#define printf_receive_error debug_printf
+#define printf_receive_error(...) \
+    debug_trace(DEBUG_CATEGORY_RECEIVE, DEBUG_LEVEL_ERROR, __VA_ARGS__)
 #else
 static inline void printf_receive_error(
     const char *format,
@@ -101,7 +104,8 @@ static inline void printf_receive_error(
 #endif
 
 #if defined(PRINT_ENABLED_MASTER)
-#define printf_master debug_printf
+#define printf_master(...) \
+    debug_trace(DEBUG_CATEGORY_MASTER, DEBUG_LEVEL_INFO, __VA_ARGS__)
 #else
 static inline void printf_master(
     const char *format,
@@ -443,6 +447,8 @@ void MSTP_Receive_Frame_FSM(
                                 /* ForUs */
                                 /* indicate that a frame with no data has been received */
                                 mstp_port->ReceivedValidFrame = true;
+                                mstp_port->rt_frames_rcvd[MSTP_STAT_FRAME_INDEX
+                                    (mstp_port->FrameType)]++;
                             } else {
                                 /* NotForUs */
                                 mstp_port->ReceivedValidFrameNotForUs = true;
@@ -553,6 +559,8 @@ void MSTP_Receive_Frame_FSM(
                             MSTP_RECEIVE_STATE_DATA) {
                             /* ForUs */
                             mstp_port->ReceivedValidFrame = true;
+                            mstp_port->rt_frames_rcvd[MSTP_STAT_FRAME_INDEX
+                                (mstp_port->FrameType)]++;
                         } else {
                             /* NotForUs */
                             mstp_port->ReceivedValidFrameNotForUs = true;
@@ -635,6 +643,7 @@ bool MSTP_Master_Node_FSM(
             if (mstp_port->SilenceTimer((void *) mstp_port) >= Tno_token) {
                 /* assume that the token has been lost */
                 mstp_port->EventCount = 0;      /* Addendum 135-2004d-8 */
+                mstp_port->rt_lost_tokens++;
                 mstp_port->master_state = MSTP_MASTER_STATE_NO_TOKEN;
                 /* set the receive frame flags to false in case we received
                    some bytes and had a timeout for some reason */
@@ -767,6 +776,7 @@ bool MSTP_Master_Node_FSM(
             if (mstp_port->SilenceTimer((void *) mstp_port) >= Treply_timeout) {
                 /* ReplyTimeout */
                 /* assume that the request has failed */
+                mstp_port->rt_reply_timeouts++;
                 mstp_port->FrameCount = mstp_port->Nmax_info_frames;
                 mstp_port->master_state = MSTP_MASTER_STATE_DONE_WITH_TOKEN;
                 /* Any retry of the data frame shall await the next entry */
@@ -923,6 +933,7 @@ bool MSTP_Master_Node_FSM(
                 if (mstp_port->RetryCount < Nretry_token) {
                     /* RetrySendToken */
                     mstp_port->RetryCount++;
+                    mstp_port->rt_token_retries++;
                     /* Transmit a Token frame to NS */
                     MSTP_Create_And_Send_Frame(mstp_port, FRAME_TYPE_TOKEN,
                         mstp_port->Next_Station, mstp_port->This_Station, NULL,
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the frames per second that go through the MSTP agent, from the
+IPC of one port through its transmit thread and state machines, over a wire
+and up through the receiver thread of another port to its IPC.  A worker
+process starts the agent on two pseudo terminals and floods the first port
+while it counts what comes out of the second, and this process plays the
+wire between them without any delay, so the baud rate does not set the
+pace and the cost of the agent and its IPC does.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import errno
+import select
+import shutil
+import socket
+import struct
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import tty
+
+from ctypes import c_ushort, cdll, create_string_buffer
+
+
+SENDER = 1
+RECEIVER = 2
+
+# frames the flood offers to the sender port at a time, and the most frames
+# copied out of or into a ring with each call into the agent
+BATCH = 64
+
+# octets for each frame copied out of a ring
+SLAB = 512
+
+
+def agent_library():
+    dirname = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mstplib')
+    libname = "libmstp_agent_{}.so".format(platform.system().lower())
+    return cdll.LoadLibrary(os.path.join(dirname, libname))
+
+
+class SocketPort(object):
+
+    """A port of the agent with the datagram sockets between it and python."""
+
+    def __init__(self, mstp_lib, mac, devname, params, mstp_dir):
+        self.mstp_dir = tempfile.mkdtemp(dir=mstp_dir)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        self.sock.bind('{}/mstp{}'.format(self.mstp_dir, os.path.basename(devname)))
+        if mstp_lib.init(params, devname.encode(), self.mstp_dir.encode()) < 0:
+            raise RuntimeError("agent init failed on {}".format(devname))
+        self.server = '{}/mstp_server'.format(self.mstp_dir)
+
+    def send_many(self, frames):
+        for frame in frames:
+            self.sock.sendto(frame, self.server)
+
+    def recv(self, timeout):
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return None
+        return self.sock.recv(1024)
+
+
+class RingPort(object):
+
+    """A port of the agent with the shared memory rings between it and
+    python."""
+
+    def __init__(self, mstp_lib, mac, devname, params, mstp_dir):
+        self.mstp_lib = mstp_lib
+        self.port = mstp_lib.init_ring(params, devname.encode(), 0)
+        if self.port < 0:
+            raise RuntimeError("agent init failed on {}".format(devname))
+        self.efd = mstp_lib.ring_rx_fd(self.port)
+        self.roomfd = mstp_lib.ring_tx_room_fd(self.port)
+
+        # a batch of frames is copied out of the ring at a time, like the
+        # ring director does
+        self.buffer = create_string_buffer(SLAB * BATCH)
+        self.view = memoryview(self.buffer).cast('B')
+        self.lengths = (c_ushort * BATCH)()
+        self.received = []
+        self.sendLengths = (c_ushort * BATCH)()
+
+    def send_many(self, frames):
+        # the transmit thread empties the ring, wait for room when it is full
+        frames = frames[:BATCH]
+        while frames:
+            for i, frame in enumerate(frames):
+                self.sendLengths[i] = len(frame)
+            sent = self.mstp_lib.ring_send_many(self.port, b''.join(frames), self.sendLengths, len(frames))
+            frames = frames[sent:]
+            if frames:
+                select.select([self.roomfd], [], [], 1.0)
+                try:
+                    os.read(self.roomfd, 8)
+                except OSError as err:
+                    if err.errno != errno.EAGAIN:
+                        raise
+
+    def recv(self, timeout):
+        if not self.received:
+            count = self.mstp_lib.ring_recv_many(self.port, self.buffer, SLAB, self.lengths, BATCH)
+            if count <= 0:
+                if not select.select([self.efd], [], [], timeout)[0]:
+                    return None
+                try:
+                    os.read(self.efd, 8)
+                except OSError as err:
+                    if err.errno != errno.EAGAIN:
+                        raise
+                count = self.mstp_lib.ring_recv_many(self.port, self.buffer, SLAB, self.lengths, BATCH)
+                if count <= 0:
+                    return b''
+            view = self.view
+            self.received = [view[i * SLAB:i * SLAB + self.lengths[i]].tobytes() for i in range(count)]
+            self.received.reverse()
+        return self.received.pop()
+
+
+def worker(config):
+    """Flood the sender port and count the frames out of the receiver."""
+    mstp_lib = agent_library()
+    port_class = RingPort if config['ipc'] == 'ring' else SocketPort
+
+    ports = {}
+    for mac, devname in config['agents']:
+        params = struct.pack('iiiii', mac, config['max_master'], config['baudrate'], config['max_info_frames'], 0)
+        ports[mac] = port_class(mstp_lib, mac, devname, params, config['mstp_dir'])
+    sender, receiver = ports[SENDER], ports[RECEIVER]
+
+    # destination, lane and an NPDU that does not expect a reply
+    frame = bytes(bytearray([RECEIVER, 0, 0x01, 0x00] + [i & 0xFF for i in range(config['size'] - 2)]))
+
+    def flood():
+        frames = [frame] * BATCH
+        while True:
+            sender.send_many(frames)
+
+    thread = threading.Thread(target=flood)
+    thread.daemon = True
+    thread.start()
+
+    def count(seconds):
+        frames = octets = 0
+        end = time.time() + seconds
+        while True:
+            left = end - time.time()
+            if left <= 0:
+                break
+            received = receiver.recv(left)
+            if received:
+                frames += 1
+                octets += len(received) - 1
+        return frames, octets
+
+    count(config['warmup'])
+    start_cpu = time.process_time()
+    start = time.time()
+    frames, octets = count(config['seconds'])
+    elapsed = time.time() - start
+    used = time.process_time() - start_cpu
+
+    print(json.dumps({
+        'frames': frames,
+        'seconds': elapsed,
+        'frames_per_second': frames / elapsed,
+        'octets_per_second': octets / elapsed,
+        'cpu_usec_per_frame': 1e6 * used / frames if frames else None,
+        }))
+    sys.stdout.flush()
+
+    # leave the agent threads be
+    os._exit(0)
+
+
+def run(ipc, seconds, size, baudrate=115200, max_info_frames=16, warmup=2.0):
+    """Return the throughput of the agent with an IPC backend."""
+    wires = []
+    agents = []
+    for mac in (SENDER, RECEIVER):
+        master, slave = os.openpty()
+        tty.setraw(master)
+        wires.append((master, slave))
+        agents.append((mac, os.ttyname(slave)))
+
+    mstp_dir = tempfile.mkdtemp(prefix="agent_ipc_")
+    config = json.dumps({
+        'agents': agents, 'ipc': ipc, 'mstp_dir': mstp_dir, 'size': size, 'baudrate': baudrate,
+        'max_master': RECEIVER, 'max_info_frames': max_info_frames,
+        'seconds': seconds, 'warmup': warmup,
+        })
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--worker', config],
+        stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'),
+        )
+
+    # the wire, whatever one agent writes the other one reads
+    peers = {wires[0][0]: wires[1][0], wires[1][0]: wires[0][0]}
+    try:
+        while proc.poll() is None:
+            readable, _, _ = select.select(list(peers), [], [], 0.1)
+            for fd in readable:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    continue
+                os.write(peers[fd], data)
+        output = proc.stdout.read()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        for master, slave in wires:
+            os.close(master)
+            os.close(slave)
+        shutil.rmtree(mstp_dir, ignore_errors=True)
+
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result.update({
+        'ipc': ipc,
+        'size': size,
+        'max_info_frames': max_info_frames,
+        })
+    return result
+
+
+def main():
+    if sys.argv[1:2] == ['--worker']:
+        worker(json.loads(sys.argv[2]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ipc", choices=['socket', 'ring'], nargs='+', default=['socket', 'ring'], help="IPC backends")
+    parser.add_argument("--seconds", type=float, default=5.0, help="length of each measurement")
+    parser.add_argument("--size", type=int, default=50, help="NPDU octets per frame")
+    parser.add_argument("--max-info-frames", type=int, default=16, help="frames the sender sends with each token")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = {}
+    for ipc in args.ipc:
+        results[ipc] = run(ipc, args.seconds, args.size, max_info_frames=args.max_info_frames)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{:<8} {:>12} {:>14} {:>16}".format("ipc", "frames/s", "octets/s", "cpu usec/frame"))
+    for ipc in args.ipc:
+        result = results[ipc]
+        print("{:<8} {:>12.1f} {:>14.1f} {:>16}".format(
+            ipc, result['frames_per_second'], result['octets_per_second'],
+            "{:.1f}".format(result['cpu_usec_per_frame']) if result['cpu_usec_per_frame'] else "-"))
+
+
+if __name__ == "__main__":
+    main()
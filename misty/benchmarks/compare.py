@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+Compare two result files of run_suite.py and print how each metric changed.
+Frames and octets per second are better when they go up, times, CPU,
+wakeups and allocations are better when they go down, and the rest (counts,
+settings) is left out.  The exit status is 1 when a metric got worse by more
+than the threshold.
+"""
+
+from __future__ import print_function
+import sys
+import json
+import argparse
+
+
+# fields of a list item that name it, like the module of import_time
+LABEL_KEYS = ('module', 'ipc', 'trunks', 'mode')
+
+# metrics that say how much work was done rather than how fast
+IGNORED = ('seconds', 'frames', 'count', 'agents', 'trunks', 'baudrate', 'size',
+    'max_info_frames', 'max_master', 'errors', 'per_trunk')
+
+LOWER_NAMES = ('usec', 'blocks', 'bytes', 'peak_bytes', 'total', 'wall', 'misty', 'bacpypes',
+    'other', 'process', 'max_per_trunk', 'cpu_seconds')
+
+
+def flatten(value, path=()):
+    """Yield the path and value of each number in the results."""
+    if isinstance(value, dict):
+        for key in sorted(value):
+            for item in flatten(value[key], path + (str(key),)):
+                yield item
+    elif isinstance(value, list):
+        for index, element in enumerate(value):
+            label = str(index)
+            if isinstance(element, dict):
+                label = ",".join("{}={}".format(key, element[key]) for key in LABEL_KEYS if key in element) or label
+            for item in flatten(element, path + (label,)):
+                yield item
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield path, value
+
+
+def direction(path):
+    """Return 1 when a bigger value is better, -1 when a smaller one is,
+    None when the metric is not compared."""
+    name = path[-1]
+    if name in IGNORED or any(part in IGNORED for part in path[:-1]):
+        return None
+    if name.startswith('wakeups') or name.startswith('cpu_'):
+        return -1
+    if 'per_second' in name:
+        return 1
+    if name in LOWER_NAMES or name.endswith('_ms') or name.endswith('_usec'):
+        return -1
+    return None
+
+
+def compare(old, new, threshold):
+    """Return the rows of the comparison and whether something regressed."""
+    old_metrics = dict(flatten(old['benchmarks']))
+    rows = []
+    regressed = False
+    for path, value in flatten(new['benchmarks']):
+        better = direction(path)
+        if better is None or path not in old_metrics:
+            continue
+        before = old_metrics[path]
+        if not before:
+            continue
+
+        change = 100.0 * (value - before) / before
+        worse = -change * better > threshold
+        regressed = regressed or worse
+        rows.append(("/".join(path), before, value, change, worse))
+
+    return rows, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("old", help="results of the baseline")
+    parser.add_argument("new", help="results to compare with the baseline")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent a metric may get worse")
+    parser.add_argument("--all", action="store_true", help="list the metrics that did not get worse too")
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print("old: {} {}".format(old.get('commit'), "(dirty)" if old.get('dirty') else ""))
+    print("new: {} {}".format(new.get('commit'), "(dirty)" if new.get('dirty') else ""))
+    if old.get('quick') != new.get('quick'):
+        print("warning: only one of the runs is quick")
+
+    rows, regressed = compare(old, new, args.threshold)
+    width = max([len(row[0]) for row in rows] + [6])
+    print("{:<{}} {:>14} {:>14} {:>9}".format("metric", width, "old", "new", "change"))
+    for name, before, value, change, worse in rows:
+        if not (worse or args.all):
+            continue
+        print("{:<{}} {:>14.4g} {:>14.4g} {:>+8.1f}%{}".format(
+            name, width, before, value, change, "  worse" if worse else ""))
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of the MSTPDirector frame path.  Frames go through a local
+datagram socket pair in both directions, once with the original code (recvfrom,
+PDU copy and pdu.get() on receive, pduData.insert() on transmit) and once with
+the slab receive and header send of MSTPDirector.  For each direction it
+reports the time per frame and, from tracemalloc, the peak bytes allocated
+while handling a frame and the blocks and bytes still allocated per frame
+while the PDUs wait in the deferred function list for the stack.
+"""
+
+from __future__ import print_function
+import sys
+import json
+import time
+import socket
+import argparse
+import tracemalloc
+
+from bacpypes import core
+from bacpypes.pdu import Address
+from bacpypes.comm import PDU
+
+from misty.mstplib import MSTPDirector
+from misty.mstplib.mmsg import SlabPool, BatchCounter
+from misty.mstplib.priority import MSTPLaneQueue
+from misty.mstplib.bandwidth import MSTPBandwidth
+
+
+MAC = 25
+PEER = 30
+
+
+def legacy_handle_read(director):
+    """The receive path before the slabs."""
+    msg, addr = director.socket.recvfrom(512)
+    pdu = PDU(msg,destination=int(str(director.address)))
+    mstp_src = pdu.get()
+    pdu.pduSource = Address(mstp_src)
+    core.deferred(director._response, pdu)
+
+
+def legacy_handle_write(sock, request, address):
+    """The transmit path before the header send."""
+    pdu = request.get()
+    pdu.pduSource=address
+    pdu.pduData.insert(0, int(str(pdu.pduDestination)))
+    sock.send(pdu.pduData)
+
+
+def make_director(sock):
+    """Return a director on sock without starting an agent."""
+    director = MSTPDirector.__new__(MSTPDirector)
+    director.socket = sock
+    director.address = Address(MAC)
+    director.request = MSTPLaneQueue()
+    director.unsent = []
+    director.peers = {}
+    director.batcher = None
+    director.slabs = SlabPool(1, 512)
+    director.readBatches = BatchCounter(1)
+    director.writeBatches = BatchCounter(1)
+    director.bandwidth = MSTPBandwidth(38400)
+    return director
+
+
+def measure(fn, frames, prepare):
+    """Run fn once per frame after prepare, return the results per frame."""
+    # timing without tracing
+    prepare(frames)
+    start = time.perf_counter()
+    for i in range(frames):
+        fn()
+    elapsed = time.perf_counter() - start
+    core.deferredFns = []
+
+    # peak allocated while handling each frame
+    prepare(frames)
+    tracemalloc.start()
+    peak = 0
+    for i in range(frames):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        peak += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    core.deferredFns = []
+
+    # allocations left behind by each frame
+    prepare(frames)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(frames):
+        fn()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    core.deferredFns = []
+
+    return {
+        'usec': elapsed * 1e6 / frames,
+        'peak_bytes': float(peak) / frames,
+        'blocks': float(blocks) / frames,
+        'bytes': float(size) / frames,
+        }
+
+
+def run(frames, size):
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    ours.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    theirs.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    director = make_director(ours)
+    payload = bytes(bytearray([PEER] + [i & 0xFF for i in range(size)]))
+    batch = 8
+
+    # receive a batch from the peer at a time, the socket buffer is limited
+    def receive_prepare(frames):
+        receive_prepare.left = 0
+
+    def receive_with(fn):
+        def receive():
+            if not receive_prepare.left:
+                for i in range(batch):
+                    theirs.send(payload)
+                receive_prepare.left = batch
+            receive_prepare.left -= 1
+            fn()
+        return receive
+
+    def send_prepare(frames):
+        for i in range(frames):
+            director.request.put(PDU(bytearray(payload[1:]), destination=Address(PEER)))
+
+    def drain():
+        try:
+            while True:
+                theirs.recv(1024, socket.MSG_DONTWAIT)
+        except socket.error:
+            pass
+
+    def send_with(fn):
+        def send():
+            fn()
+            send.count += 1
+            if send.count % batch == 0:
+                drain()
+        send.count = 0
+        return send
+
+    results = {
+        'receive': {
+            'before': measure(receive_with(lambda: legacy_handle_read(director)), frames, receive_prepare),
+            'after': measure(receive_with(director.handle_read), frames, receive_prepare),
+            },
+        'transmit': {
+            'before': measure(send_with(lambda: legacy_handle_write(ours, director.request, director.address)), frames, send_prepare),
+            'after': measure(send_with(director.handle_write), frames, send_prepare),
+            },
+        }
+
+    ours.close()
+    theirs.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=20000, help="frames per measurement")
+    parser.add_argument("--size", type=int, default=200, help="payload octets per frame")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = run(args.frames, args.size)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{:<10} {:<8} {:>10} {:>12} {:>10} {:>12}".format(
+        "path", "code", "usec", "peak bytes", "blocks", "bytes"))
+    for path in ('receive', 'transmit'):
+        for code in ('before', 'after'):
+            result = results[path][code]
+            print("{:<10} {:<8} {:>10.2f} {:>12.1f} {:>10.2f} {:>12.1f}".format(
+                path, code, result['usec'], result['peak_bytes'],
+                result['blocks'], result['bytes']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the time it takes to import misty and the command line tools.
+Each module is imported in a new interpreter with 'python -X importtime', the
+cumulative time of the module is split into the part spent in the modules of
+misty, in bacpypes and in everything else, and the wall time of the whole
+interpreter is measured as well.  The median of a number of runs is reported.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+# the modules behind bc and bs
+MODULES = [
+    'misty.mstplib',
+    'misty.mstplib.router',
+    'misty.samples.bac_client',
+    'misty.samples.CommandableMixin',
+    ]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def importtime(module):
+    """Import the module in a new interpreter and return the wall time in
+    seconds and the import times in microseconds."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')]
+        + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else [])
+        )
+
+    # installed packages have their byte code
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+        )
+    _, stderr = proc.communicate()
+    wall = time.time() - start
+    if proc.returncode:
+        raise RuntimeError("import of {} failed:\n{}".format(module, stderr.decode()))
+
+    # lines are 'import time: self [us] | cumulative | imported package'
+    result = {'total': 0, 'misty': 0, 'bacpypes': 0, 'other': 0}
+    for line in stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if name.startswith('misty'):
+            result['misty'] += int(self_us)
+        elif name.startswith('bacpypes'):
+            result['bacpypes'] += int(self_us)
+        else:
+            result['other'] += int(self_us)
+        if name == module:
+            result['total'] = int(cumulative_us)
+
+    return wall, result
+
+
+def run(module, runs):
+    # the first import may have to write the byte code
+    importtime(module)
+
+    walls = []
+    results = []
+    for i in range(runs):
+        wall, result = importtime(module)
+        walls.append(wall)
+        results.append(result)
+
+    summary = dict(
+        (key, median([result[key] for result in results]) / 1000.0)
+        for key in results[0]
+        )
+    summary['module'] = module
+    summary['wall'] = median(walls) * 1000.0
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("modules", nargs='*', default=MODULES, help="modules to import")
+    parser.add_argument("--runs", type=int, default=9, help="runs of each module")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = [run(module, args.runs) for module in args.modules]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    for result in results:
+        print("{:<32} {:6.1f}ms import ({:5.1f} misty, {:6.1f} bacpypes, {:5.1f} other), "
+            "{:6.1f}ms wall".format(
+            result['module'], result['total'], result['misty'], result['bacpypes'],
+            result['other'], result['wall']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the time a confirmed request takes from the application of a
+client to the application of a server and back, at several baud rates.  For
+each baud rate the virtual bus of misty.mstplib.vbus is started with a pseudo
+terminal for each side, the ReadPropertyMultipleServer sample is the server,
+and a worker process with an MSTPSimpleApplication, like the one of bc, sends
+ReadProperty, ReadPropertyMultiple and WriteProperty requests one after the
+other and times each of them.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+CLIENT = 1
+SERVER = 2
+
+# both masters are found after polling one address
+MAX_MASTER = 3
+
+# seconds to wait for the token ring to form and the server to answer
+READY_TIMEOUT = 60.0
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples')
+
+SERVER_INI = """[BACpypes]
+objectName: Benchmark Server
+address: {address}
+interface: {interface}
+max_masters: {max_master}
+baudrate: {baudrate}
+maxinfo: 1
+objectIdentifier: 699
+maxApduLengthAccepted: 1024
+segmentationSupported: segmentedBoth
+vendorIdentifier: 15
+"""
+
+
+def percentiles(latencies):
+    """Return the summary of a list of latencies in seconds, in ms."""
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'mean_ms': 1000.0 * sum(ordered) / len(ordered),
+        'p50_ms': 1000.0 * ordered[len(ordered) // 2],
+        'p95_ms': 1000.0 * ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+        'max_ms': 1000.0 * ordered[-1],
+        }
+
+
+def worker(config):
+    """Send the requests one at a time and print the latencies."""
+    from bacpypes.core import run, stop, deferred
+    from bacpypes.iocb import IOCB
+    from bacpypes.pdu import Address
+    from bacpypes.apdu import ReadPropertyRequest, ReadPropertyMultipleRequest, \
+        ReadAccessSpecification, PropertyReference, WritePropertyRequest
+    from bacpypes.primitivedata import CharacterString
+    from bacpypes.constructeddata import Any
+    from bacpypes.local.device import LocalDeviceObject
+    from misty.mstplib import MSTPSimpleApplication
+
+    device = LocalDeviceObject(
+        objectName='Benchmark Client',
+        objectIdentifier=('device', 599),
+        maxApduLengthAccepted=1024,
+        segmentationSupported='segmentedBoth',
+        vendorIdentifier=15,
+        _address=CLIENT,
+        _interface=config['interface'],
+        _max_masters=MAX_MASTER,
+        _baudrate=config['baudrate'],
+        _maxinfo=1,
+        _mstp_dir=config['mstp_dir'],
+        )
+    application = MSTPSimpleApplication(device, CLIENT)
+    server = Address(SERVER)
+
+    def read_property():
+        return ReadPropertyRequest(
+            objectIdentifier=('analogValue', 1),
+            propertyIdentifier='presentValue',
+            )
+
+    def read_property_multiple():
+        return ReadPropertyMultipleRequest(listOfReadAccessSpecs=[
+            ReadAccessSpecification(
+                objectIdentifier=('analogValue', instance),
+                listOfPropertyReferences=[
+                    PropertyReference(propertyIdentifier='presentValue'),
+                    PropertyReference(propertyIdentifier='objectName'),
+                    PropertyReference(propertyIdentifier='statusFlags'),
+                    ],
+                )
+            for instance in (1, 2)
+            ])
+
+    def write_property():
+        request = WritePropertyRequest(
+            objectIdentifier=('analogValue', 1),
+            propertyIdentifier='eventMessageTexts',
+            propertyArrayIndex=1,
+            )
+        request.propertyValue = Any()
+        request.propertyValue.cast_in(CharacterString('benchmark'))
+        return request
+
+    services = [
+        ('read_property', read_property),
+        ('read_property_multiple', read_property_multiple),
+        ('write_property', write_property),
+        ]
+    results = {}
+    state = {'ready_until': time.time() + READY_TIMEOUT, 'service': 0, 'count': 0,
+        'latencies': [], 'errors': 0}
+
+    def send(make):
+        request = make()
+        request.pduDestination = server
+        iocb = IOCB(request)
+        iocb.add_callback(complete, time.time())
+        application.request_io(iocb)
+
+    def complete(iocb, start):
+        elapsed = time.time() - start
+
+        # the first read that is answered says the ring is up
+        if state['ready_until'] is not None:
+            if iocb.ioResponse:
+                state['ready_until'] = None
+            elif time.time() > state['ready_until']:
+                results['error'] = 'the server did not answer'
+                stop()
+                return
+            deferred(next_request)
+            return
+
+        if iocb.ioResponse:
+            state['latencies'].append(elapsed)
+        else:
+            state['errors'] += 1
+        state['count'] += 1
+
+        if state['count'] >= config['requests']:
+            name = services[state['service']][0]
+            results[name] = percentiles(state['latencies'])
+            results[name]['errors'] = state['errors']
+            state.update({'service': state['service'] + 1, 'count': 0, 'latencies': [], 'errors': 0})
+            if state['service'] >= len(services):
+                stop()
+                return
+        deferred(next_request)
+
+    def next_request():
+        if state['ready_until'] is not None:
+            send(read_property)
+        else:
+            send(services[state['service']][1])
+
+    deferred(next_request)
+    run()
+
+    print(json.dumps(results))
+    sys.stdout.flush()
+
+    # leave the agent threads be
+    os._exit(0)
+
+
+def run(baudrate, requests):
+    """Return the latencies of the requests at the baud rate."""
+    workdir = tempfile.mkdtemp(prefix="round_trip_")
+    client_pty = os.path.join(workdir, 'client')
+    server_pty = os.path.join(workdir, 'server')
+    devnull = open(os.devnull, 'w')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.join(SAMPLES, '..', '..')] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    processes = []
+    try:
+        bus = subprocess.Popen(
+            [sys.executable, '-m', 'misty.mstplib.vbus', '--pty', client_pty, '--pty', server_pty,
+             '--baudrate', str(baudrate), '--interval', '0'],
+            stdout=devnull, stderr=devnull, env=env,
+            )
+        processes.append(bus)
+        while not (os.path.islink(client_pty) and os.path.islink(server_pty)):
+            if bus.poll() is not None:
+                raise RuntimeError("the virtual bus did not start")
+            time.sleep(0.05)
+
+        server_ini = os.path.join(workdir, 'server.ini')
+        with open(server_ini, 'w') as f:
+            f.write(SERVER_INI.format(address=SERVER, interface=server_pty,
+                max_master=MAX_MASTER, baudrate=baudrate))
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(SAMPLES, 'ReadPropertyMultipleServer.py'), '--ini', server_ini],
+            stdout=devnull, stderr=devnull, cwd=workdir, env=env,
+            ))
+
+        config = json.dumps({
+            'interface': client_pty, 'baudrate': baudrate, 'mstp_dir': workdir, 'requests': requests,
+            })
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--worker', config],
+            stderr=devnull, cwd=workdir, env=env,
+            )
+    finally:
+        for proc in reversed(processes):
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result['baudrate'] = baudrate
+    return result
+
+
+def main():
+    if sys.argv[1:2] == ['--worker']:
+        worker(json.loads(sys.argv[2]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--baudrates", type=int, nargs='+', default=[9600, 38400, 76800, 115200], help="baud rates of the bus")
+    parser.add_argument("--requests", type=int, default=50, help="requests of each service")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = {}
+    for baudrate in args.baudrates:
+        results[str(baudrate)] = run(baudrate, args.requests)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{:>8} {:<24} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+        "baud", "service", "errors", "mean ms", "p50 ms", "p95 ms", "max ms"))
+    for baudrate in args.baudrates:
+        result = results[str(baudrate)]
+        if 'error' in result:
+            print("{:>8} {}".format(baudrate, result['error']))
+            continue
+        for service in ('read_property', 'read_property_multiple', 'write_property'):
+            latency = result[service]
+            if not latency['count']:
+                print("{:>8} {:<24} {:>6} {:>10}".format(baudrate, service, latency['errors'], "-"))
+                continue
+            print("{:>8} {:<24} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                baudrate, service, latency['errors'], latency['mean_ms'],
+                latency['p50_ms'], latency['p95_ms'], latency['max_ms']))
+
+
+if __name__ == "__main__":
+    main()
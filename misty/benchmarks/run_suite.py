@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Run the benchmarks in this directory and write their results to one JSON
+document along with the commit they were run on, so the results of two
+commits can be put side by side with compare.py:
+
+    $ python misty/benchmarks/run_suite.py --output before.json
+    $ git checkout other-branch
+    $ python misty/benchmarks/run_suite.py --output after.json
+    $ python misty/benchmarks/compare.py before.json after.json
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.abspath(os.path.join(HERE, '..', '..'))
+
+# the arguments of each benchmark, the full run and the quick one
+BENCHMARKS = [
+    ('agent_ipc', [], ['--seconds', '2']),
+    ('frame_alloc', [], ['--frames', '5000']),
+    ('round_trip', [], ['--baudrates', '38400', '115200', '--requests', '20']),
+    ('trunk_cpu', [], ['--seconds', '3']),
+    ('startup_time', [], []),
+    ('import_time', [], ['--runs', '3']),
+    ]
+
+
+def git(*args):
+    try:
+        return subprocess.check_output(('git',) + args, cwd=TOP, stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(name, args):
+    """Return the results of a benchmark, or the error it failed with."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([TOP] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, name + '.py'), '--json'] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=TOP, env=env,
+        )
+    output, error = proc.communicate()
+    if proc.returncode:
+        lines = error.decode(errors='replace').strip().splitlines()
+        return {'error': lines[-1] if lines else 'exit status {}'.format(proc.returncode)}
+    return json.loads(output.decode())
+
+
+def main():
+    names = [name for name, _, _ in BENCHMARKS]
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs='*', default=names, help="benchmarks to run, all of them by default")
+    parser.add_argument("--quick", action="store_true", help="shorter measurements")
+    parser.add_argument("--output", help="file for the results, standard output by default")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error("unknown benchmark {!r}, one of {}".format(name, ", ".join(names)))
+
+    status = git('status', '--porcelain', '--untracked-files=no')
+    document = {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'quick': args.quick,
+        'benchmarks': {},
+        }
+
+    for name, full, quick in BENCHMARKS:
+        if name not in args.benchmarks:
+            continue
+        print("running {}".format(name), file=sys.stderr)
+        start = time.time()
+        document['benchmarks'][name] = run(name, quick if args.quick else full)
+        print("    {:.1f}s".format(time.time() - start), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the startup of the MSTP directors.  A worker process creates one
+director for each of a number of pseudo terminals, the way the applications
+do, and reports how long each one took to be ready to send.  Every run is a
+new process because an agent has a limited number of ports.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+import tty
+
+
+class Settings(object):
+
+    """Stand in for the local device, the director only reads the MSTP
+    agent settings from it."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def worker(config):
+    """Create the directors on the ttys and print the times."""
+    from misty.mstplib import mstp_director_class
+
+    times = []
+    directors = []
+    start = time.time()
+    for mac, devname in config['agents']:
+        settings = Settings(
+            _interface=devname, _max_masters=127, _baudrate=38400, _maxinfo=1,
+            _mstp_dir=config['mstp_dir'], _mstp_ipc=config['ipc'],
+            )
+        director_start = time.time()
+        directors.append(mstp_director_class(settings)(settings, mac))
+        times.append(time.time() - director_start)
+    total = time.time() - start
+
+    print(json.dumps({'total': total, 'per_trunk': times}))
+    sys.stdout.flush()
+
+    # let the agent threads be
+    os._exit(0)
+
+
+def run(trunks, ipc):
+    """Return the startup times of the directors for a number of trunks."""
+    wires = []
+    agents = []
+    for trunk in range(trunks):
+        master, slave = os.openpty()
+        tty.setraw(master)
+        wires.append((master, slave))
+        agents.append((trunk + 1, os.ttyname(slave)))
+
+    mstp_dir = tempfile.mkdtemp(prefix="startup_")
+    config = json.dumps({'agents': agents, 'ipc': ipc, 'mstp_dir': mstp_dir})
+    try:
+        start = time.time()
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--worker', config],
+            stderr=open(os.devnull, 'w'),
+            )
+        elapsed = time.time() - start
+    finally:
+        for master, slave in wires:
+            os.close(master)
+            os.close(slave)
+        for dirpath, dirnames, filenames in os.walk(mstp_dir, topdown=False):
+            for name in filenames:
+                os.remove(os.path.join(dirpath, name))
+            os.rmdir(dirpath)
+
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result.update({
+        'trunks': trunks,
+        'ipc': ipc,
+        'process': elapsed,
+        'max_per_trunk': max(result['per_trunk']),
+        })
+    return result
+
+
+def main():
+    if sys.argv[1:2] == ['--worker']:
+        worker(json.loads(sys.argv[2]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trunks", type=int, nargs='+', default=[1, 10], help="numbers of trunks")
+    parser.add_argument("--ipc", choices=['socket', 'ring'], nargs='+', default=['socket'], help="IPC backends")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = [run(trunks, ipc) for ipc in args.ipc for trunks in args.trunks]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    for result in results:
+        print("{:>2} trunks, {:<6}: {:.3f}s for the directors, {:.3f}s at most per trunk, "
+            "{:.3f}s for the process".format(
+            result['trunks'], result['ipc'], result['total'], result['max_per_trunk'],
+            result['process']))
+
+
+if __name__ == "__main__":
+    main()
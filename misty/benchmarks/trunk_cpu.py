@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the CPU that the MSTP agent uses per trunk.  A worker process
+starts the agent on a number of pseudo terminals, one port per trunk, and
+this process plays the other end of the wires.  With --idle nothing answers
+the agents so each one polls for a master now and then, otherwise the
+trunks are pairs of agents that pass the token back and forth.  The CPU time
+and the context switches of the worker threads are read from /proc before and
+after the measurement.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import select
+import struct
+import argparse
+import platform
+import subprocess
+import tty
+
+from ctypes import cdll
+
+
+def worker(config):
+    """Start the agent on each of the ttys and wait to be killed."""
+    dirname = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mstplib')
+    libname = "libmstp_agent_{}.so".format(platform.system().lower())
+    mstp_lib = cdll.LoadLibrary(os.path.join(dirname, libname))
+
+    for mac, devname in config['agents']:
+        buf = struct.pack('iiiii', mac, config['max_master'], config['baudrate'], 1, 0)
+        mstp_lib.init_ring(buf, devname.encode(), 0)
+
+    while True:
+        time.sleep(60)
+
+
+def cpu_seconds(pid):
+    """Return the user and system time of the process in seconds."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def wakeups(pid):
+    """Return the number of context switches of all the threads."""
+    count = 0
+    for task in os.listdir('/proc/{}/task'.format(pid)):
+        with open('/proc/{}/task/{}/status'.format(pid, task)) as f:
+            for line in f:
+                if line.endswith('ctxt_switches:\t', 0, line.index('\t') + 1):
+                    count += int(line.split()[1])
+    return count
+
+
+def run(trunks, seconds, baudrate, idle, max_master=127, warmup=2.0):
+    # each wire is a pty, the agent opens the slave side
+    wires = []
+    agents = []
+    for trunk in range(trunks):
+        for mac in ((1,) if idle else (1, 2)):
+            master, slave = os.openpty()
+            tty.setraw(master)
+            wires.append((trunk, master, slave))
+            agents.append((mac, os.ttyname(slave)))
+
+    if len(agents) > 10:
+        raise ValueError("the agent supports at most 10 ports")
+
+    config = json.dumps({'agents': agents, 'baudrate': baudrate, 'max_master': max_master})
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--worker', config],
+        stdout=devnull, stderr=devnull,
+        )
+
+    # the other end of each wire on the same trunk
+    peers = {}
+    for trunk, master, slave in wires:
+        peers[master] = [m for t, m, s in wires if t == trunk and m != master]
+
+    octets = [0]
+
+    def pump(until):
+        while True:
+            left = until - time.time()
+            if left <= 0:
+                break
+            readable, _, _ = select.select(list(peers), [], [], left)
+            for fd in readable:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    continue
+                octets[0] += len(data)
+                for peer in peers[fd]:
+                    os.write(peer, data)
+
+    try:
+        pump(time.time() + warmup)
+
+        octets[0] = 0
+        start_cpu = cpu_seconds(proc.pid)
+        start_wakeups = wakeups(proc.pid)
+        start = time.time()
+        pump(start + seconds)
+        elapsed = time.time() - start
+        used = cpu_seconds(proc.pid) - start_cpu
+        switches = wakeups(proc.pid) - start_wakeups
+    finally:
+        proc.kill()
+        proc.wait()
+        for trunk, master, slave in wires:
+            os.close(master)
+            os.close(slave)
+
+    return {
+        'trunks': trunks,
+        'agents': len(agents),
+        'mode': 'idle' if idle else 'token',
+        'max_master': max_master,
+        'seconds': elapsed,
+        'cpu_seconds': used,
+        'cpu_percent_per_trunk': 100.0 * used / elapsed / trunks,
+        'wakeups_per_second_per_trunk': switches / elapsed / trunks,
+        'octets_per_second': octets[0] / elapsed,
+        }
+
+
+def main():
+    if sys.argv[1:2] == ['--worker']:
+        worker(json.loads(sys.argv[2]))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trunks", type=int, default=4, help="number of trunks")
+    parser.add_argument("--seconds", type=float, default=10.0, help="length of the measurement")
+    parser.add_argument("--baudrate", type=int, default=38400, help="baud rate of the agents")
+    parser.add_argument("--max-master", type=int, default=127, help="max master of the agents")
+    parser.add_argument("--idle", action="store_true", help="one agent per trunk and no traffic")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    result = run(args.trunks, args.seconds, args.baudrate, args.idle, args.max_master)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{} trunks, {} agents, {} max master {}: {:.2f} cpu seconds in {:.1f}s, "
+        "{:.1f}% cpu and {:.0f} wakeups/s per trunk, {:.0f} octets/s on the wires".format(
+        result['trunks'], result['agents'], result['mode'], result['max_master'],
+        result['cpu_seconds'], result['seconds'],
+        result['cpu_percent_per_trunk'], result['wakeups_per_second_per_trunk'],
+        result['octets_per_second']))
+
+
+if __name__ == "__main__":
+    main()
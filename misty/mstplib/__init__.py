@@ -8,66 +8,89 @@ from __future__ import print_function
 import asyncore
 import socket
 import six.moves.queue as queue
-import warnings
-import binascii
 import os
-import time
 import struct
 import atexit
-import glob
-import tempfile
+import ctypes
 import six
-import platform
-from ctypes import cdll
 
-
-from bacpypes.pdu import Address, PCI, PDUData
-from bacpypes.debugging import bacpypes_debugging, DebugContents, ModuleLogger
-from bacpypes.comm import ApplicationServiceElement, bind, PDU
-from bacpypes.iocb import IOController, SieveQueue
+from bacpypes.pdu import Address, LocalBroadcast
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.comm import PDU, Client, Server, ServiceAccessPoint, bind
 from bacpypes.app import ApplicationIOController
 from bacpypes.core import deferred
-
-from bacpypes.pdu import Address
 from bacpypes.udp import UDPActor
 
-
-from bacpypes.primitivedata import ObjectIdentifier
-
-from bacpypes.capability import Collector
 from bacpypes.appservice import StateMachineAccessPoint, ApplicationServiceAccessPoint
 from bacpypes.netservice import NetworkServiceAccessPoint, NetworkServiceElement
-from bacpypes.bvllservice import BIPSimple, BIPForeign, AnnexJCodec, UDPMultiplexer, _MultiplexServer, _MultiplexClient, OriginalUnicastNPDU, OriginalBroadcastNPDU
-
-from bacpypes.bvll import BVLPDU, DeleteForeignDeviceTableEntry, \
-    DistributeBroadcastToNetwork, FDTEntry, ForwardedNPDU, \
-    OriginalBroadcastNPDU, OriginalUnicastNPDU, \
-    ReadBroadcastDistributionTable, ReadBroadcastDistributionTableAck, \
-    ReadForeignDeviceTable, ReadForeignDeviceTableAck, RegisterForeignDevice, \
-    Result, WriteBroadcastDistributionTable, bvl_pdu_types
-
-
-from bacpypes.apdu import UnconfirmedRequestPDU, ConfirmedRequestPDU, \
-    SimpleAckPDU, ComplexAckPDU, ErrorPDU, RejectPDU, AbortPDU, Error
-
-from bacpypes.errors import ExecutionError, UnrecognizedService, AbortException, RejectException
-
-# for computing protocol services supported
-from bacpypes.apdu import confirmed_request_types, unconfirmed_request_types, \
-    ConfirmedServiceChoice, UnconfirmedServiceChoice
-from bacpypes.basetypes import ServicesSupported
 
 # basic services
 from bacpypes.service.device import WhoIsIAmServices
 from bacpypes.service.object import ReadWritePropertyServices
-from bacpypes.comm import Client, Server, bind, \
-    ServiceAccessPoint, ApplicationServiceElement
 
+from .mmsg import BatchCounter, DatagramBatcher, SlabPool, send_frame, _WOULD_BLOCK
+from .priority import MSTPLaneQueue, MSTPPriorityMixin, pdu_lane
+from .coalesce import MSTPCoalesceMixin
+from .bandwidth import MSTPAdmissionMixin, MSTPBandwidth, BANDWIDTH_BUDGET
+from .cov import MSTPCOVClientMixin
+from .window import MSTPWindowMixin, MSTP_WINDOW
+from .cache import MSTPResponseCacheMixin
+from .stats import MSTPStatsServer, agent_stats, agent_tokens
+from .devices import MSTPDeviceInfoCache
 
 # some debugging
 _debug = 0
 _log = ModuleLogger(globals())
 
+# PDUs waiting for the agent unless the local device says otherwise
+MSTP_QUEUE_DEPTH = 64
+
+# octets of an MS/TP frame around the NPDU, preamble, header and CRC
+MSTP_FRAME_OVERHEAD = 10
+
+# least time a refused request is told to wait before trying again
+MSTP_RETRY_AFTER = 0.05
+
+# levels and categories of the debug trace of the agent, see debug.h
+MSTP_DEBUG_LEVELS = {'error': 1, 'info': 2, 'debug': 3}
+MSTP_DEBUG_CATEGORIES = {'general': 0x01, 'receive': 0x02, 'data': 0x04, 'master': 0x08}
+
+#
+#   MSTPQueueFull
+#
+
+class MSTPQueueFull(RuntimeError):
+
+    """The queue of PDUs for the trunk is full, the request was not sent.
+    The retry_after attribute is an estimate of the seconds it takes the
+    trunk to make room."""
+
+    def __init__(self, retry_after):
+        RuntimeError.__init__(self, "MSTP queue full, retry after {:.3f}s".format(retry_after))
+        self.retry_after = retry_after
+
+#
+#   _Multiplex Client and Server
+#
+
+class _MultiplexClient(Client):
+
+    def __init__(self, mux):
+        Client.__init__(self)
+        self.multiplexer = mux
+
+    def confirmation(self, pdu):
+        self.multiplexer.confirmation(self, pdu)
+
+class _MultiplexServer(Server):
+
+    def __init__(self, mux):
+        Server.__init__(self)
+        self.multiplexer = mux
+
+    def indication(self, pdu):
+        self.multiplexer.indication(self, pdu)
+
 #
 #   MSTPSAP
 #
@@ -111,8 +134,8 @@ class MSTPSimple(MSTPSAP, Client, Server):
 
         # check for local stations
         if pdu.pduDestination.addrType == Address.localStationAddr:
-            # make an original unicast PDU
-            xpdu = OriginalUnicastNPDU(pdu, destination=pdu.pduDestination, user_data=pdu.pduUserData)
+            # the MAC address is the only header
+            xpdu = PDU(pdu, destination=pdu.pduDestination, user_data=pdu.pduUserData)
             if _debug: MSTPSimple._debug("    - xpdu: %r", xpdu)
 
             # send it downstream
@@ -120,8 +143,8 @@ class MSTPSimple(MSTPSAP, Client, Server):
 
         # check for broadcasts
         elif pdu.pduDestination.addrType == Address.localBroadcastAddr:
-            # make an original broadcast PDU
-            xpdu = OriginalBroadcastNPDU(pdu, destination=pdu.pduDestination, user_data=pdu.pduUserData)
+            # the MAC address is the only header
+            xpdu = PDU(pdu, destination=pdu.pduDestination, user_data=pdu.pduUserData)
             if _debug: MSTPSimple._debug("    - xpdu: %r", xpdu)
 
             # send it downstream
@@ -136,6 +159,170 @@ class MSTPSimple(MSTPSAP, Client, Server):
         # send it upstream
         self.response(pdu)
 
+#
+#   mstp_agent_init
+#
+
+def mstp_agent_library():
+    """Load the MSTP agent library for this platform, once."""
+    if MSTPDirector.mstp_lib is not None:
+        return MSTPDirector.mstp_lib
+    if _debug: _log.debug("mstp_agent_library")
+
+    import platform
+
+    dirname=os.path.dirname(__file__)
+    libname = "libmstp_agent_{}.so".format(platform.system().lower())
+    libmstp_path=os.path.join(dirname, libname)
+    mstp_lib = ctypes.cdll.LoadLibrary(libmstp_path)
+    MSTPDirector.mstp_lib = mstp_lib
+
+    return mstp_lib
+
+def mstp_agent_params(localDevice, address, mstp_lib):
+    """Return the packed interface parameters for the agent, turning on the
+    debug log of the agent when the local device has a file for it."""
+    if _debug: _log.debug("mstp_agent_params %r %r", localDevice, address)
+
+    #send control stuff
+    # 0x5 - Mac Address
+    # 127 - Max Masters
+    # 38400 - Baud rate
+    # 0x1 - Max info Frames
+    # depth of the PDU queue of the agent, 0 for the default
+    mac = str(address)
+    mac = int(mac)
+    max_masters = localDevice._max_masters
+    baud_rate = localDevice._baudrate
+    maxinfo = localDevice._maxinfo
+    pdu_queue = int(getattr(localDevice, '_mstp_pdu_queue', 0) or 0)
+    buf = struct.pack('iiiii', mac, max_masters, baud_rate, maxinfo, pdu_queue);
+
+    if hasattr(localDevice, '_mstpdbglevel') or hasattr(localDevice, '_mstpdbgcategories'):
+        mstp_debug(mstp_lib,
+            level=getattr(localDevice, '_mstpdbglevel', None),
+            categories=getattr(localDevice, '_mstpdbgcategories', None),
+            )
+    if hasattr(localDevice, '_mstpdbgfile'):
+        fname = localDevice._mstpdbgfile
+        if six.PY3:
+            mstp_lib.enable_debug_flag(six.ensure_binary(fname))
+        else:
+            mstp_lib.enable_debug_flag(fname)
+
+    return buf
+
+def mstp_agent_init(localDevice, address, sock):
+    """Bind the datagram socket to the client path for the interface of the
+    local device, start the MSTP agent on that interface and return the
+    path of the agent server socket and the port of the agent."""
+    if _debug: _log.debug("mstp_agent_init %r %r", localDevice, address)
+
+    interface_filename = os.path.basename(localDevice._interface)
+    interface_devname = localDevice._interface
+
+    # proceed with the bind
+    if hasattr(localDevice, '_mstp_dir'):
+        mstp_dir = localDevice._mstp_dir
+    else:
+        mstp_dir = '/var/tmp'
+
+    import tempfile
+    mstp_dir = tempfile.mkdtemp(prefix="ma_",dir=mstp_dir)
+    MSTPDirector.mstp_dir = mstp_dir
+    MSTPDirector.mstp_dirs.append(mstp_dir)
+
+    my_addr = '{}/mstp{}'.format(mstp_dir, interface_filename)
+    try:
+        os.remove(my_addr)
+    except:
+        pass
+
+    # Call the library to init the mstp_agent
+    mstp_lib = mstp_agent_library()
+
+    sock.bind(my_addr)
+
+    buf = mstp_agent_params(localDevice, address, mstp_lib)
+
+    # returns once the server socket is bound and the threads of the
+    # port are running
+    if six.PY3:
+        interface_devname_b = six.ensure_binary(interface_devname)
+        mstp_dir_b=six.ensure_binary(mstp_dir)
+        port = mstp_lib.init(buf, interface_devname_b, mstp_dir_b)
+    else:
+        port = mstp_lib.init(buf, interface_devname, mstp_dir)
+    if port < 0:
+        raise RuntimeError("MSTP agent init failed on {}".format(interface_devname))
+    if _debug: _log.debug("    - port: %r", port)
+
+    # capture from the start when the local device asks for it
+    if getattr(localDevice, '_mstp_capture', None):
+        mstp_capture(
+            mstp_lib, port, localDevice._mstp_capture,
+            getattr(localDevice, '_mstp_capture_size', 0) or 0,
+            getattr(localDevice, '_mstp_capture_files', 0) or 0,
+            )
+
+    return '{}/mstp_server'.format(mstp_dir), port
+
+def mstp_capture(mstp_lib, port, path=None, max_bytes=0, max_files=0):
+    """Start writing the frames of the port to a pcap file, or stop when
+    there is no path.  The file is rotated when it gets to max_bytes and
+    max_files are kept, path.1 being the newest of the older ones, 0 for
+    the defaults of the agent."""
+    if _debug: _log.debug("mstp_capture %r %r max_bytes=%r max_files=%r", port, path, max_bytes, max_files)
+
+    if not path:
+        mstp_lib.port_capture_stop(port)
+        return
+
+    if mstp_lib.port_capture_start(port, six.ensure_binary(path), int(max_bytes), int(max_files)) < 0:
+        raise RuntimeError("MSTP capture to {} failed".format(path))
+
+def mstp_debug(mstp_lib, level=None, categories=None):
+    """Change what goes into the debug trace of the agent, which can be
+    done while it is being written.  The level is a name or a number, the
+    categories a comma separated list of names, 'all', or a mask."""
+    if _debug: _log.debug("mstp_debug %r categories=%r", level, categories)
+
+    if level is not None:
+        if not isinstance(level, int):
+            level = str(level).strip().lower()
+            level = MSTP_DEBUG_LEVELS[level] if level in MSTP_DEBUG_LEVELS else int(level)
+        mstp_lib.set_debug_level(level)
+
+    if categories is not None:
+        if not isinstance(categories, int):
+            names = [name.strip().lower() for name in str(categories).split(',') if name.strip()]
+            if names == ['all']:
+                categories = sum(MSTP_DEBUG_CATEGORIES.values())
+            else:
+                for name in names:
+                    if name not in MSTP_DEBUG_CATEGORIES:
+                        raise ValueError("unknown debug category: {}".format(name))
+                categories = sum(MSTP_DEBUG_CATEGORIES[name] for name in set(names))
+        mstp_lib.set_debug_categories(categories)
+
+def mstp_queue_depth(localDevice):
+    """Return the number of PDUs that can wait for the agent."""
+    return int(getattr(localDevice, '_mstp_queue_depth', 0) or MSTP_QUEUE_DEPTH)
+
+def mstp_director_class(localDevice):
+    """Return the director class for the IPC backend the local device asks
+    for, 'socket' (the default) or 'ring'."""
+    ipc = getattr(localDevice, '_mstp_ipc', None) or 'socket'
+    if _debug: _log.debug("mstp_director_class %r", ipc)
+
+    if ipc == 'socket':
+        return MSTPDirector
+    elif ipc == 'ring':
+        from .ring import MSTPRingDirector
+        return MSTPRingDirector
+    else:
+        raise ValueError("unknown MSTP IPC backend: {}".format(ipc))
+
 #
 #   MSTPDirector
 #
@@ -143,6 +330,7 @@ class MSTPSimple(MSTPSAP, Client, Server):
 @bacpypes_debugging
 class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
     mstp_dir = None
+    mstp_dirs = []
     mstp_lib = None
 
     def __init__(
@@ -171,9 +359,6 @@ class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
         # save the address
         self.address = address
 
-        interface_filename = os.path.basename(self.localDevice._interface)
-        interface_devname = self.localDevice._interface
-
         asyncore.dispatcher.__init__(self)
 
         # ask the dispatcher for a socket
@@ -183,86 +368,62 @@ class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
         if reuse:
             self.set_reuse_addr()
 
-        # proceed with the bind
-        if hasattr(self.localDevice, '_mstp_dir'):
-            mstp_dir = self.localDevice._mstp_dir
-        else:
-            mstp_dir = '/var/tmp'
-
-        mstp_dir = tempfile.mkdtemp(prefix="ma_",dir=mstp_dir)
-        MSTPDirector.mstp_dir = mstp_dir
+        # create the request queue, bounded so a flood of requests backs up
+        # to the application instead of growing without limit, with a lane
+        # for each priority class
+        self.request = MSTPLaneQueue(mstp_queue_depth(self.localDevice))
+        self.requestHighWater = 0
+        self.requestDropped = 0
+        self.requestRefused = 0
 
-        my_addr = '{}/mstp{}'.format(mstp_dir, interface_filename)
-        try:
-            os.remove(my_addr)
-        except:
-            pass
-
-        # Call the library to init the mstp_agent
-        dirname=os.path.dirname(__file__)
-        libname = "libmstp_agent_{}.so".format(platform.system().lower())
-        libmstp_path=os.path.join(dirname, libname)
-        mstp_lib = cdll.LoadLibrary(libmstp_path)
-        MSTPDirector.mstp_lib = mstp_lib
+        # start with an empty peer pool
+        self.peers = {}
 
+        # frames taken from the queue that the socket would not take yet
+        self.unsent = []
 
-        self.bind(my_addr)
+        # bind the socket and start the mstp agent on the interface
+        self.server_address, self.port = mstp_agent_init(self.localDevice, self.address, self.socket)
         if _debug: MSTPDirector._debug("    - getsockname: %r", self.socket.getsockname())
 
         # allow it to send broadcasts
         self.socket.setsockopt( socket.SOL_SOCKET, socket.SO_BROADCAST, 1 )
 
-        # create the request queue
-        self.request = queue.Queue()
-
-        # start with an empty peer pool
-        self.peers = {}
+        # server to send the MSTP PDU's
+        self.socket.connect(self.server_address)
 
+        # in batched mode every wakeup drains the socket and the queue
+        batch = int(getattr(self.localDevice, '_mstp_batch', 0) or 0)
 
-        #send control stuff
-        # 0x5 - Mac Address
-        # 127 - Max Masters
-        # 38400 - Baud rate
-        # 0x1 - Max info Frames
-        mac = str(self.address)
-        mac = int(mac)
-        max_masters = self.localDevice._max_masters
-        baud_rate = self.localDevice._baudrate
-        maxinfo = self.localDevice._maxinfo
-        buf = struct.pack('iiii', mac, max_masters, baud_rate, maxinfo);
-
-        if hasattr(self.localDevice, '_mstpdbgfile'):
-            fname = self.localDevice._mstpdbgfile
-            if six.PY3:
-                mstp_lib.enable_debug_flag(six.ensure_binary(fname))
-            else:
-                mstp_lib.enable_debug_flag(fname)
+        # frames are received into slabs, one for each frame of a batch
+        self.slabs = SlabPool(max(batch, 1), 512)
 
-        if six.PY3:
-            interface_devname_b = six.ensure_binary(interface_devname)
-            mstp_dir_b=six.ensure_binary(mstp_dir)
-            mstp_lib.init(buf, interface_devname_b, mstp_dir_b)
+        if batch > 1:
+            self.batcher = DatagramBatcher(self.socket, batch, self.slabs)
         else:
-            mstp_lib.init(buf, interface_devname, mstp_dir)
+            self.batcher = None
 
+        # datagrams handled per wakeup
+        self.readBatches = BatchCounter(max(batch, 1))
+        self.writeBatches = BatchCounter(max(batch, 1))
 
-        # to ensure that the server is ready
-        time.sleep(0.5)
-
-        # server to send the MSTP PDU's
-        self.server_address = '{}/mstp_server'.format(mstp_dir)
-        self.socket.connect(self.server_address)
+        # the use of the wire, from the frames and the counters of the agent
+        self.bandwidth = MSTPBandwidth(self.localDevice._baudrate, self.tokens)
 
     @staticmethod
     @atexit.register
     def atexit_handler():
-        if MSTPDirector.mstp_dir is None:
+        if not MSTPDirector.mstp_dirs:
             return
 
-        files = glob.glob("{}/mstp*".format(MSTPDirector.mstp_dir))
-        for f in files:
-            os.remove(f)
-        os.rmdir(MSTPDirector.mstp_dir)
+        import glob
+
+        # one directory for each port of the agent
+        for mstp_dir in MSTPDirector.mstp_dirs:
+            files = glob.glob("{}/mstp*".format(mstp_dir))
+            for f in files:
+                os.remove(f)
+            os.rmdir(mstp_dir)
         print("Cleaned up MSTP temp directory")
 
     def add_actor(self, actor):
@@ -305,16 +466,15 @@ class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
         if _debug: MSTPDirector._debug("handle_read")
 
         try:
-            msg, addr = self.socket.recvfrom(512)
-            if _debug: MSTPDirector._debug("    - received %d octets ", len(msg))
-            pdu = PDU(msg,destination=int(str(self.address)))
-            mstp_src = pdu.get()
-            pdu.pduSource = Address(mstp_src)
-
-            if _debug: MSTPDirector._debug("Received MSTP PDU={}".format(str(pdu)))
+            if self.batcher:
+                lengths = self.batcher.recv()
+            else:
+                lengths = [self.socket.recv_into(self.slabs[0])]
+            self.readBatches.record(len(lengths))
 
-            # send the PDU up to the client
-            deferred(self._response, pdu)
+            # frame i of the batch is in slab i
+            for i, nbytes in enumerate(lengths):
+                self.receive_frame(*self.slabs.split(i, nbytes))
 
         except socket.timeout as err:
             if _debug: MSTPDirector._debug("    - socket timeout: %s", err)
@@ -331,36 +491,68 @@ class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
         except Exception as e:
             MSTPDirector._error('Exception in handle_read: {}'.format(e))
 
+    def receive_frame(self, mstp_src, data):
+        """Turn a frame from the agent into a PDU and send it up, the data
+        is the payload copied out of the slab it was received into."""
+        if _debug: MSTPDirector._debug("    - received %d octets from %d", len(data), mstp_src)
+
+        # format is src_mac, payload
+        pdu = PDU(source=Address(mstp_src), destination=int(str(self.address)))
+        pdu.pduData = data
+
+        if _debug: MSTPDirector._debug("Received MSTP PDU={}".format(str(pdu)))
+
+        self.bandwidth.frame(len(data), True)
+
+        # send the PDU up to the client
+        deferred(self._response, pdu)
+
     def writable(self):
         """Return true iff there is a request pending."""
-        return (not self.request.empty())
+        return bool(self.unsent) or (not self.request.empty())
+
+    def encode_frame(self, pdu):
+        """Return the destination MAC, the priority lane and the payload of
+        the PDU, they are gathered into one datagram for the agent when it
+        is sent."""
+        pdu.pduSource=self.address
+
+        if _debug: MSTPDirector._debug("Sending MSTP PDU={}".format(str(pdu)))
+
+        self.bandwidth.frame(len(pdu.pduData))
+
+        # format is dest_mac, lane, payload
+        return int(str(pdu.pduDestination)), pdu_lane(pdu), pdu.pduData
 
     def handle_write(self):
         """get a PDU from the queue and send it."""
         if _debug: MSTPDirector._debug("handle_write")
 
-        try:
-            pdu = self.request.get()
-            pdu.pduSource=self.address
-
-            if _debug: MSTPDirector._debug("Sending MSTP PDU={}".format(str(pdu)))
-
-            # format is 0 for data, src_mac, payload
-            if six.PY3:
-                pdu.pduData.insert(0, int(str(pdu.pduDestination)))
-            else:
-                mstpData = chr(int(str(pdu.pduDestination))) + pdu.pduData
-                pdu.pduData = mstpData
+        if self.batcher:
+            self.handle_write_batch()
+            return
 
+        # a frame the agent had no room for goes first
+        if self.unsent:
+            dest, lane, data = self.unsent.pop(0)
+        else:
+            dest, lane, data = self.encode_frame(self.request.get())
 
-            sent = self.socket.send(pdu.pduData) # , pdu.pduDestination)
-            if _debug: MSTPDirector._debug("    - sent %d octets to %s", sent, pdu.pduDestination)
+        try:
+            sent = send_frame(self.socket, dest, lane, data)
+            if _debug: MSTPDirector._debug("    - sent %d octets to %s", sent, dest)
+            self.writeBatches.record(1)
 
         except socket.error as err:
             if _debug: MSTPDirector._debug("    - socket error: %s", err)
 
+            # the agent is backed up, try again when the socket is writable
+            if err.args[0] in _WOULD_BLOCK:
+                self.unsent.insert(0, (dest, lane, data))
+                return
+
             # get the peer
-            peer = self.peers.get(pdu.pduDestination, None)
+            peer = self.peers.get(Address(dest), None)
             if peer:
                 # let the actor handle the error
                 peer.handle_error(err)
@@ -368,6 +560,114 @@ class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
                 # let the director handle the error
                 self.handle_error(err)
 
+    def handle_write_batch(self):
+        """Send everything that is queued, as far as the socket takes it."""
+        if _debug: MSTPDirector._debug("handle_write_batch")
+
+        # frames left over from the last pass go first
+        frames, self.unsent = self.unsent, []
+        try:
+            while len(frames) < self.batcher.size:
+                frames.append(self.encode_frame(self.request.get_nowait()))
+        except queue.Empty:
+            pass
+
+        try:
+            sent = self.batcher.send(frames)
+            if _debug: MSTPDirector._debug("    - sent %d of %d frames", sent, len(frames))
+            self.writeBatches.record(sent)
+
+        except socket.error as err:
+            if _debug: MSTPDirector._debug("    - socket error: %s", err)
+
+            # the first frame was refused, drop it and keep the rest
+            sent = 1
+            self.handle_error(err)
+
+        self.unsent = frames[sent:]
+
+    def batch_counters(self):
+        """Return the datagrams per wakeup counters for each direction."""
+        return {
+            'batched': self.batcher is not None,
+            'mmsg': bool(self.batcher and self.batcher.use_mmsg),
+            'read': self.readBatches.dict_contents(),
+            'write': self.writeBatches.dict_contents(),
+            }
+
+    def queue_full(self):
+        """Return true when there is no room for another PDU."""
+        return self.request.full()
+
+    def retry_after(self):
+        """Return an estimate of the seconds it takes the trunk to send the
+        PDUs that are waiting, from their length and the baud rate."""
+        octets = sum(len(data) + MSTP_FRAME_OVERHEAD for dest, lane, data in self.unsent)
+        octets += sum(len(pdu.pduData) + MSTP_FRAME_OVERHEAD for pdu in self.request.pdus())
+        return max(octets * 10.0 / self.localDevice._baudrate, MSTP_RETRY_AFTER)
+
+    def tokens(self):
+        """Return the tokens the agent was passed."""
+        return agent_tokens(self.mstp_lib, self.port)
+
+    def queue_counters(self, agent=None):
+        """Return the counters of the queue of PDUs for the agent and of the
+        PDU queue of the agent itself, from the agent counters when they are
+        given."""
+        counters = {
+            'depth': self.request.maxsize,
+            'length': self.request.qsize() + len(self.unsent),
+            'high_water': self.requestHighWater,
+            'refused': self.requestRefused,
+            'dropped': self.requestDropped,
+            }
+
+        if agent is None:
+            agent = agent_stats(self.mstp_lib, self.port, reply_latency=False)
+        if agent:
+            counters['agent'] = {
+                'depth': agent['pdu_queue_depth'],
+                'length': agent['pdu_queue_length'],
+                'high_water': agent['pdu_queue_high_water'],
+                'full': agent['pdu_queue_full'],
+                }
+
+        return counters
+
+    def lane_counters(self, agent=None):
+        """Return the PDUs waiting in each lane, how long they waited for the
+        agent and how many the agent sent from each lane, from the agent
+        counters when they are given."""
+        counters = self.request.lane_counters()
+
+        if agent is None:
+            agent = agent_stats(self.mstp_lib, self.port, reply_latency=False)
+        if agent:
+            for priority_class, count in agent['lane_sent'].items():
+                counters[priority_class]['sent'] = count
+
+        return counters
+
+    def capture(self, path=None, max_bytes=0, max_files=0):
+        """Write the frames of the trunk to a pcap file, or stop without a
+        path, see mstp_capture."""
+        if _debug: MSTPDirector._debug("capture %r", path)
+
+        mstp_capture(self.mstp_lib, self.port, path, max_bytes, max_files)
+
+    def stats(self):
+        """Return the counters of the agent port, frames by type, retries and
+        drops included, with the counters of the queues and the batches."""
+        # one copy of the counters of the agent for all of them
+        agent = agent_stats(self.mstp_lib, self.port)
+        return {
+            'labels': {'interface': self.localDevice._interface, 'mac': str(self.address)},
+            'agent': agent,
+            'queue': self.queue_counters(agent),
+            'lanes': self.lane_counters(agent),
+            'batches': self.batch_counters(),
+            }
+
     def close_socket(self):
         """Close the socket."""
         if _debug: MSTPDirector._debug("close_socket")
@@ -387,9 +687,16 @@ class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
         if _debug: MSTPDirector._debug("handle_error %r", error)
 
     def indication(self, pdu):
-        """Client requests are queued for delivery."""
+        """Client requests are queued for delivery, when the queue is full
+        the PDU is dropped, requests from the application are refused before
+        they get this far."""
         if _debug: MSTPDirector._debug("indication %r", pdu)
 
+        if self.request.full():
+            if _debug: MSTPDirector._debug("    - queue full, dropped")
+            self.requestDropped += 1
+            return
+
         # get the destination
         addr = pdu.pduDestination
 
@@ -401,6 +708,8 @@ class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
         # send the message
         peer.indication(pdu)
 
+        self.requestHighWater = max(self.requestHighWater, self.request.qsize())
+
     def _response(self, pdu):
         """Incoming datagrams are routed through an actor."""
         if _debug: MSTPDirector._debug("_response %r", pdu)
@@ -422,15 +731,19 @@ class MSTPDirector(asyncore.dispatcher, Server, ServiceAccessPoint):
 @bacpypes_debugging
 class MSTPMultiplexer:
 
-    def __init__(self, localDevice, addr=None, noBroadcast=False):
-        if _debug: MSTPMultiplexer._debug("__init__ %r noBroadcast=%r", addr, noBroadcast)
+    def __init__(self, localDevice, addr=None, noBroadcast=False, directorClass=None):
+        if _debug: MSTPMultiplexer._debug("__init__ %r noBroadcast=%r directorClass=%r", addr, noBroadcast, directorClass)
 
         self.address = addr
         self.localDevice = localDevice
 
+        # the director talks to the mstp agent
+        if directorClass is None:
+            directorClass = mstp_director_class(localDevice)
+
         # create and bind the direct address
         self.direct = _MultiplexClient(self)
-        self.directPort = MSTPDirector(self.localDevice, self.address)
+        self.directPort = directorClass(self.localDevice, self.address)
         bind(self.direct, self.directPort)
 
         # create and bind the Annex H and J servers
@@ -494,18 +807,42 @@ class MSTPMultiplexer:
         except Exception as e:
             MSTPMultiplexer._error('Exception in confirmation {}'.format(e))
 
+#
+#   MSTPApplicationBase
+#
+
 @bacpypes_debugging
-class MSTPSimpleApplication(ApplicationIOController, WhoIsIAmServices, ReadWritePropertyServices):
+class MSTPApplicationBase(MSTPWindowMixin, MSTPCoalesceMixin, MSTPAdmissionMixin, MSTPPriorityMixin, MSTPCOVClientMixin, MSTPResponseCacheMixin, ApplicationIOController, WhoIsIAmServices, ReadWritePropertyServices):
 
-    def __init__(self, localDevice, localAddress, deviceInfoCache=None, aseID=None):
-        if _debug: MSTPSimpleApplication._debug("__init__ %r %r deviceInfoCache=%r aseID=%r", localDevice, localAddress, deviceInfoCache, aseID)
-        ApplicationIOController.__init__(self, localDevice, deviceInfoCache, aseID=aseID)
+    """The services and the mixins of the MSTP applications and the top of
+    their stack.  A subclass binds the network layer to its trunks after
+    calling this and says which trunks a PDU goes out."""
 
-        # local address might be useful for subclasses
-        if isinstance(localAddress, Address):
-            self.localAddress = localAddress
-        else:
-            self.localAddress = Address(localAddress)
+    def __init__(self, localDevice, deviceInfoCache=None, aseID=None):
+        if _debug: MSTPApplicationBase._debug("__init__ %r deviceInfoCache=%r aseID=%r", localDevice, deviceInfoCache, aseID)
+        # the devices of the last run when the local device has a file for them
+        if deviceInfoCache is None:
+            deviceInfoCache = MSTPDeviceInfoCache(getattr(localDevice, '_mstp_device_cache', None))
+
+        ApplicationIOController.__init__(self, localDevice, deviceInfoCache=deviceInfoCache, aseID=aseID)
+        MSTPPriorityMixin.__init__(self)
+
+        # reads waiting for the same device go out together unless the
+        # local device says otherwise
+        MSTPCoalesceMixin.__init__(self, bool(getattr(localDevice, '_mstp_coalesce', True)))
+
+        # background requests wait while a trunk is over the budget
+        MSTPAdmissionMixin.__init__(self, float(getattr(localDevice, '_mstp_bandwidth_budget', BANDWIDTH_BUDGET)))
+
+        # notifications go to the subscription manager when there is one
+        MSTPCOVClientMixin.__init__(self)
+
+        # requests each device has out at a time unless it is given more
+        MSTPWindowMixin.__init__(self, int(getattr(localDevice, '_mstp_window', MSTP_WINDOW)))
+
+        # reads of the properties that rarely change are answered from the
+        # encoded responses unless the local device says otherwise
+        MSTPResponseCacheMixin.__init__(self, bool(getattr(localDevice, '_mstp_response_cache', True)))
 
         self.localDevice = localDevice
 
@@ -520,6 +857,76 @@ class MSTPSimpleApplication(ApplicationIOController, WhoIsIAmServices, ReadWrite
         # information cache as the application
         self.smap.deviceInfoCache = self.deviceInfoCache
 
+        # serve the counters of the trunks when the local device asks for it,
+        # the server asks for the directors when it is asked
+        self.statsServer = None
+        if getattr(localDevice, '_mstp_stats', None):
+            self.statsServer = self.stats_server(localDevice._mstp_stats)
+
+    def mstp_directors(self):
+        """Return the directors of the trunks of the application."""
+        raise NotImplementedError("mstp_directors must be overridden")
+
+    def trunk_directors(self, address):
+        """Return the directors of the trunks a PDU to the address goes out."""
+        raise NotImplementedError("trunk_directors must be overridden")
+
+    def stats_server(self, address):
+        """Return a server of the counters of the trunks on a UNIX socket
+        path or a loopback port."""
+        if _debug: MSTPApplicationBase._debug("stats_server %r", address)
+
+        return MSTPStatsServer(self.mstp_directors, address)
+
+    def process_io(self, iocb):
+        """Refuse the request when the queue of a trunk it goes out is full,
+        the IOCB gets an MSTPQueueFull error that says when to try again."""
+        if _debug: MSTPApplicationBase._debug("process_io %r", iocb)
+
+        for directPort in self.trunk_directors(iocb.args[0].pduDestination):
+            if directPort.queue_full():
+                directPort.requestRefused += 1
+                raise MSTPQueueFull(directPort.retry_after())
+
+        MSTPWindowMixin.process_io(self, iocb)
+
+    def do_IAmRequest(self, apdu):
+        """Keep the maximum APDU, segmentation and vendor of the device."""
+        if _debug: MSTPApplicationBase._debug("do_IAmRequest %r", apdu)
+
+        WhoIsIAmServices.do_IAmRequest(self, apdu)
+        self.deviceInfoCache.iam_device_info(apdu)
+
+    def close_socket(self):
+        if _debug: MSTPApplicationBase._debug("close_socket")
+
+        if self.statsServer:
+            self.statsServer.close_socket()
+
+        if getattr(self.deviceInfoCache, 'path', None):
+            self.deviceInfoCache.save()
+
+        # pass down to the sockets of the trunks
+        for director in self.mstp_directors():
+            director.close_socket()
+
+#
+#   MSTPSimpleApplication
+#
+
+@bacpypes_debugging
+class MSTPSimpleApplication(MSTPApplicationBase):
+
+    def __init__(self, localDevice, localAddress, deviceInfoCache=None, aseID=None, directorClass=None):
+        if _debug: MSTPSimpleApplication._debug("__init__ %r %r deviceInfoCache=%r aseID=%r directorClass=%r", localDevice, localAddress, deviceInfoCache, aseID, directorClass)
+        MSTPApplicationBase.__init__(self, localDevice, deviceInfoCache, aseID)
+
+        # local address might be useful for subclasses
+        if isinstance(localAddress, Address):
+            self.localAddress = localAddress
+        else:
+            self.localAddress = Address(localAddress)
+
         # a network service access point will be needed
         self.nsap = NetworkServiceAccessPoint()
 
@@ -533,7 +940,7 @@ class MSTPSimpleApplication(ApplicationIOController, WhoIsIAmServices, ReadWrite
         # create a generic MSTP stack, bound to the Annex J server
         # on the MSTP multiplexer
         self.mstp = MSTPSimple()
-        self.mux = MSTPMultiplexer(self.localDevice, self.localAddress)
+        self.mux = MSTPMultiplexer(self.localDevice, self.localAddress, directorClass=directorClass)
 
         # bind the bottom layers
         bind(self.mstp, self.mux.annexH)
@@ -541,9 +948,11 @@ class MSTPSimpleApplication(ApplicationIOController, WhoIsIAmServices, ReadWrite
         # bind the MSTP stack to the network, no network number
         self.nsap.bind(self.mstp)
 
-    def close_socket(self):
-        if _debug: MSTPSimpleApplication._debug("close_socket")
-
-        # pass to the multiplexer, then down to the sockets
-        self.mux.close_socket()
+    def mstp_directors(self):
+        """Return the directors of the trunks of the application."""
+        return [self.mux.directPort]
 
+    def trunk_directors(self, address):
+        """Return the directors of the trunks a PDU to the address goes out,
+        there is only the one."""
+        return [self.mux.directPort]
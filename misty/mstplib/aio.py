@@ -0,0 +1,430 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+asyncio transport for the MSTP agent.  The director is a datagram protocol
+on the AF_UNIX link to the mstp_server of the agent, and the bacpypes task
+manager and deferred functions are driven from the same asyncio event loop,
+so an MSTP application runs without the bacpypes core.run() loop.
+"""
+
+import asyncio
+import functools
+import socket
+
+from bacpypes import core
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.comm import Server, ServiceAccessPoint, PDU
+from bacpypes.pdu import Address
+from bacpypes.task import TaskManager
+
+from . import MSTPDirector, MSTPSimpleApplication, mstp_agent_init, mstp_capture, \
+    mstp_queue_depth, MSTP_FRAME_OVERHEAD, MSTP_RETRY_AFTER
+from .mmsg import frame_header
+from .bandwidth import MSTPBandwidth
+from .priority import MSTP_PRIORITY_CLASSES, pdu_lane
+from .stats import agent_stats, agent_tokens, stats_address, stats_response
+
+# octets of the largest frame to the agent, the MAC and the NPDU
+MSTP_FRAME_SIZE = 512
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# there is only one task manager, so there is only one driver
+_task_driver = None
+
+
+def _get_loop(loop=None):
+    """Return the given loop, the running loop or the current loop."""
+    if loop is not None:
+        return loop
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.get_event_loop()
+
+#
+#   MSTPTaskDriver
+#
+
+@bacpypes_debugging
+class MSTPTaskDriver:
+
+    def __init__(self, loop=None):
+        """Process the bacpypes tasks and deferred functions on an asyncio
+        event loop, this takes the place of bacpypes.core.run()."""
+        if _debug: MSTPTaskDriver._debug("__init__ loop=%r", loop)
+
+        self.loop = _get_loop(loop)
+        self._handle = None
+
+        # reference the task manager (a singleton), the deferred function
+        # looks for it in the core module to trigger the event
+        self.taskManager = TaskManager()
+        core.taskManager = self.taskManager
+        core.running = True
+
+        # the trigger is set when a task is installed or a function deferred
+        trigger = self.taskManager.trigger
+        if trigger:
+            self.loop.add_reader(trigger._read_fd, self._trigger)
+
+        self.schedule(0.0)
+
+    def _trigger(self):
+        if _debug: MSTPTaskDriver._debug("_trigger")
+
+        self.taskManager.trigger.clear()
+        self.schedule(0.0)
+
+    def schedule(self, delta):
+        """Process the tasks after delta seconds."""
+        if self._handle:
+            self._handle.cancel()
+        if delta:
+            self._handle = self.loop.call_later(delta, self.process)
+        else:
+            self._handle = self.loop.call_soon(self.process)
+
+    def process(self):
+        """Process the tasks that are due and the deferred functions."""
+        self._handle = None
+        taskManager = self.taskManager
+
+        while True:
+            # get the next task
+            task, delta = taskManager.get_next_task()
+
+            try:
+                # if there is a task to process, do it
+                if task:
+                    taskManager.process_task(task)
+
+                # check for deferred functions
+                while core.deferredFns:
+                    # get a reference to the list
+                    fnlist = core.deferredFns
+                    core.deferredFns = []
+
+                    # call the functions
+                    for fn, args, kwargs in fnlist:
+                        fn(*args, **kwargs)
+
+            except Exception as err:
+                MSTPTaskDriver._exception("an error has occurred: %s", err)
+
+            # keep going while tasks are due
+            if not task:
+                break
+
+        # without a trigger nothing will wake the driver up, keep spinning
+        if (delta is None) and (not taskManager.trigger):
+            delta = core.SPIN
+        if delta is not None:
+            self.schedule(delta)
+
+
+def get_task_driver(loop=None):
+    """Return the task driver, starting it on the loop if necessary."""
+    global _task_driver
+
+    if _task_driver is None:
+        _task_driver = MSTPTaskDriver(loop)
+    elif (loop is not None) and (loop is not _task_driver.loop):
+        raise RuntimeError("the task driver is running on another loop")
+
+    return _task_driver
+
+#
+#   MSTPAsyncDirector
+#
+
+@bacpypes_debugging
+class MSTPAsyncDirector(asyncio.DatagramProtocol, Server, ServiceAccessPoint):
+
+    def __init__(self, localDevice, address, loop=None, sid=None, sapID=None):
+        if _debug: MSTPAsyncDirector._debug("__init__ %r loop=%r sid=%r sapID=%r", address, loop, sid, sapID)
+        Server.__init__(self, sid)
+        ServiceAccessPoint.__init__(self, sapID)
+
+        # save the localDevice and the address
+        self.localDevice = localDevice
+        self.address = address
+        self.mac = int(str(address))
+
+        self.loop = _get_loop(loop)
+
+        # frames requested before the transport is up
+        self.transport = None
+        self.pending = []
+
+        # the transport buffers up to depth frames when the agent is backed
+        # up, then it pauses the protocol and requests are refused
+        self.depth = mstp_queue_depth(self.localDevice)
+        self.paused = False
+        self.requestHighWater = 0
+        self.requestDropped = 0
+        self.requestRefused = 0
+
+        # bind the socket and start the mstp agent on the interface
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.server_address, self.port = mstp_agent_init(self.localDevice, self.address, self.socket)
+        if _debug: MSTPAsyncDirector._debug("    - getsockname: %r", self.socket.getsockname())
+
+        # server to send the MSTP PDU's
+        self.socket.connect(self.server_address)
+        self.socket.setblocking(False)
+
+        # the use of the wire, from the frames and the counters of the agent
+        self.bandwidth = MSTPBandwidth(self.localDevice._baudrate, self.tokens)
+
+        # the director is the protocol of the datagram transport
+        self.ready = self.loop.create_task(
+            self.loop.create_datagram_endpoint(lambda: self, sock=self.socket)
+            )
+
+    @property
+    def mstp_lib(self):
+        return MSTPDirector.mstp_lib
+
+    def connection_made(self, transport):
+        if _debug: MSTPAsyncDirector._debug("connection_made %r", transport)
+
+        self.transport = transport
+        self.transport.set_write_buffer_limits(high=self.depth * MSTP_FRAME_SIZE)
+
+        # send what has been waiting
+        pending, self.pending = self.pending, []
+        for data in pending:
+            self.transport.sendto(data)
+
+    def connection_lost(self, exc):
+        if _debug: MSTPAsyncDirector._debug("connection_lost %r", exc)
+
+        self.transport = None
+
+    def pause_writing(self):
+        if _debug: MSTPAsyncDirector._debug("pause_writing")
+
+        self.paused = True
+
+    def resume_writing(self):
+        if _debug: MSTPAsyncDirector._debug("resume_writing")
+
+        self.paused = False
+
+    def error_received(self, exc):
+        if _debug: MSTPAsyncDirector._debug("error_received %r", exc)
+
+    def datagram_received(self, data, addr):
+        if _debug: MSTPAsyncDirector._debug("datagram_received %d octets", len(data))
+
+        try:
+            # format is src_mac, payload, the payload is the only copy
+            pdu = PDU(source=Address(data[0]), destination=self.mac)
+            pdu.pduData = bytearray(memoryview(data)[1:])
+            self.bandwidth.frame(len(pdu.pduData), True)
+            if _debug: MSTPAsyncDirector._debug("Received MSTP PDU={}".format(str(pdu)))
+
+            # send the PDU up to the client
+            self.response(pdu)
+
+        except Exception as e:
+            MSTPAsyncDirector._error('Exception in datagram_received: {}'.format(e))
+
+    def indication(self, pdu):
+        """Client requests are sent to the agent, or held until the
+        transport is up."""
+        if _debug: MSTPAsyncDirector._debug("indication %r", pdu)
+
+        if self.queue_full():
+            if _debug: MSTPAsyncDirector._debug("    - queue full, dropped")
+            self.requestDropped += 1
+            return
+
+        # format is dest_mac, lane, payload, the transport keeps the order
+        # and the agent sends the lanes in priority order
+        data = frame_header(int(str(pdu.pduDestination)), pdu_lane(pdu)) + pdu.pduData
+        self.bandwidth.frame(len(pdu.pduData))
+
+        if self.transport:
+            self.transport.sendto(data)
+            buffered = self.transport.get_write_buffer_size() // MSTP_FRAME_SIZE
+        else:
+            self.pending.append(data)
+            buffered = len(self.pending)
+        self.requestHighWater = max(self.requestHighWater, buffered)
+
+    def queue_full(self):
+        """Return true when there is no room for another PDU."""
+        return self.paused or (len(self.pending) >= self.depth)
+
+    def retry_after(self):
+        """Return an estimate of the seconds it takes the trunk to send the
+        PDUs that are waiting, from their length and the baud rate."""
+        octets = sum(len(data) + MSTP_FRAME_OVERHEAD for data in self.pending)
+        if self.transport:
+            octets += self.transport.get_write_buffer_size()
+        return max(octets * 10.0 / self.localDevice._baudrate, MSTP_RETRY_AFTER)
+
+    def tokens(self):
+        """Return the tokens the agent was passed."""
+        return agent_tokens(self.mstp_lib, self.port)
+
+    def queue_counters(self, agent=None):
+        """Return the counters of the frames waiting for the agent, the
+        transport buffer is counted in frames of the largest size, from the
+        agent counters when they are given."""
+        counters = {
+            'depth': self.depth,
+            'length': len(self.pending),
+            'high_water': self.requestHighWater,
+            'refused': self.requestRefused,
+            'dropped': self.requestDropped,
+            }
+        if self.transport:
+            counters['length'] += self.transport.get_write_buffer_size() // MSTP_FRAME_SIZE
+
+        if agent is None:
+            agent = agent_stats(self.mstp_lib, self.port, reply_latency=False)
+        if agent:
+            counters['agent'] = {
+                'depth': agent['pdu_queue_depth'],
+                'length': agent['pdu_queue_length'],
+                'high_water': agent['pdu_queue_high_water'],
+                'full': agent['pdu_queue_full'],
+                }
+
+        return counters
+
+    def lane_counters(self, agent=None):
+        """Return how many PDUs the agent sent from each lane, from the agent
+        counters when they are given, the transport has no lanes of its own."""
+        counters = dict((priority_class, {}) for priority_class in MSTP_PRIORITY_CLASSES)
+
+        if agent is None:
+            agent = agent_stats(self.mstp_lib, self.port, reply_latency=False)
+        if agent:
+            for priority_class, count in agent['lane_sent'].items():
+                counters[priority_class]['sent'] = count
+
+        return counters
+
+    def capture(self, path=None, max_bytes=0, max_files=0):
+        """Write the frames of the trunk to a pcap file, or stop without a
+        path, see mstp_capture."""
+        if _debug: MSTPAsyncDirector._debug("capture %r", path)
+
+        mstp_capture(self.mstp_lib, self.port, path, max_bytes, max_files)
+
+    def stats(self):
+        """Return the counters of the agent port with the counters of the
+        frames waiting for it."""
+        # one copy of the counters of the agent for all of them
+        agent = agent_stats(self.mstp_lib, self.port)
+        return {
+            'labels': {'interface': self.localDevice._interface, 'mac': str(self.address)},
+            'agent': agent,
+            'queue': self.queue_counters(agent),
+            'lanes': self.lane_counters(agent),
+            }
+
+    def close_socket(self):
+        """Close the socket."""
+        if _debug: MSTPAsyncDirector._debug("close_socket")
+
+        if self.transport:
+            self.transport.close()
+        else:
+            self.ready.cancel()
+            self.socket.close()
+
+#
+#   MSTPAsyncStatsServer
+#
+
+@bacpypes_debugging
+class MSTPAsyncStatsServer:
+
+    def __init__(self, directors, address, loop=None):
+        """Serve the counters of the directors on the event loop, the same
+        way MSTPStatsServer does with asyncore."""
+        if _debug: MSTPAsyncStatsServer._debug("__init__ %r %r loop=%r", directors, address, loop)
+
+        self.directors = directors
+        self.loop = _get_loop(loop)
+
+        family, self.address = stats_address(address)
+        if family == socket.AF_UNIX:
+            start = asyncio.start_unix_server(self.handle, path=self.address)
+        else:
+            start = asyncio.start_server(self.handle, host=self.address[0], port=self.address[1])
+        self.server = self.loop.create_task(start)
+
+    async def handle(self, reader, writer):
+        if _debug: MSTPAsyncStatsServer._debug("handle")
+
+        # the request itself does not matter, read up to the blank line
+        try:
+            while (await reader.readline()).strip():
+                pass
+            writer.write(stats_response(self.directors()))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def close_socket(self):
+        if _debug: MSTPAsyncStatsServer._debug("close_socket")
+
+        if self.server.done() and not self.server.exception():
+            self.server.result().close()
+        else:
+            self.server.cancel()
+
+#
+#   MSTPAsyncApplication
+#
+
+@bacpypes_debugging
+class MSTPAsyncApplication(MSTPSimpleApplication):
+
+    def __init__(self, localDevice, localAddress, deviceInfoCache=None, aseID=None, loop=None):
+        if _debug: MSTPAsyncApplication._debug("__init__ %r %r deviceInfoCache=%r aseID=%r loop=%r", localDevice, localAddress, deviceInfoCache, aseID, loop)
+
+        # the bacpypes tasks run on the same loop as the transport
+        self.loop = _get_loop(loop)
+        self.taskDriver = get_task_driver(self.loop)
+
+        MSTPSimpleApplication.__init__(
+            self, localDevice, localAddress, deviceInfoCache, aseID,
+            directorClass=functools.partial(MSTPAsyncDirector, loop=self.loop),
+            )
+
+    def stats_server(self, address):
+        """Return a server of the counters of the trunk on the event loop."""
+        if _debug: MSTPAsyncApplication._debug("stats_server %r", address)
+
+        return MSTPAsyncStatsServer(self.mstp_directors, address, loop=self.loop)
+
+    async def wait_ready(self):
+        """Wait for the transport to the agent to be up."""
+        await asyncio.shield(self.mux.directPort.ready)
+
+    async def request_io_async(self, iocb, priority_class=None):
+        """Pass the IOCB to the application and wait for it to complete."""
+        if _debug: MSTPAsyncApplication._debug("request_io_async %r priority_class=%r", iocb, priority_class)
+
+        future = self.loop.create_future()
+
+        def iocb_done(iocb):
+            if not future.done():
+                future.set_result(iocb)
+
+        iocb.add_callback(iocb_done)
+        self.request_io(iocb, priority_class=priority_class)
+
+        return await future
@@ -0,0 +1,363 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Bandwidth of a trunk and admission of the background requests.  The share of
+the wire the data frames take is estimated over a sliding window.  The frames
+the director sends and receives count at their length at the baud rate, and
+the requests that are out count at an estimate of their request and reply
+frames until they are answered.  The frames of the other stations come from
+the token: the agent is passed the token once for each rotation of the ring,
+and a rotation takes as long as the token passes, the fastest rotation seen
+lately, plus the data frames of all the stations.
+
+The token fills the wire when there is nothing else to send, so the share of
+the rotations that is not token passes is the utilization.  When it is over
+the budget the requests in the poll and bulk classes wait until it is not,
+the interactive and command classes always go, and a request that waits too
+long, or finds too many waiting, is refused with MSTPBandwidthExceeded.
+"""
+
+from __future__ import absolute_import
+import time
+import collections
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.task import FunctionTask
+from bacpypes.iocb import PENDING, COMPLETED, ABORTED
+from bacpypes.apdu import ReadPropertyMultipleRequest
+
+from .coalesce import BITS_PER_OCTET, COALESCE_ACK_OVERHEAD, COALESCE_ACK_READ, \
+    COALESCE_REQUEST_OVERHEAD, COALESCE_REQUEST_READ
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# octets of a frame without data, preamble and header, the octets of the
+# data CRC and the bit times a station waits before it answers, Tturnaround
+MSTP_HEADER_OCTETS = 8
+MSTP_DATA_CRC_OCTETS = 2
+MSTP_TURNAROUND_BITS = 40
+
+# share of the wire the data frames may take before the background requests
+# wait, and the priority classes that wait
+BANDWIDTH_BUDGET = 0.5
+BANDWIDTH_CLASSES = ('poll', 'bulk')
+
+# seconds of traffic the utilization is taken over, and between the samples
+# of the counters of the agent
+BANDWIDTH_WINDOW = 5.0
+BANDWIDTH_SAMPLE = 0.5
+
+# seconds of the frames of the director that are counted together
+BANDWIDTH_BUCKET = 0.1
+
+# samples of the rotation time the fastest one is taken from, the time of
+# the token passes, five minutes of them
+BANDWIDTH_ROTATIONS = 600
+
+# octets of the data of a frame when there is nothing to go by, an NPDU with
+# a short request or a present value
+BANDWIDTH_FRAME_OCTETS = 24
+
+# seconds between the checks of the waiting requests, the most a request
+# waits and the most requests that wait for a trunk
+BANDWIDTH_CHECK = 0.1
+BANDWIDTH_MAX_WAIT = 30.0
+BANDWIDTH_MAX_WAITING = 256
+
+#
+#   MSTPBandwidthExceeded
+#
+
+class MSTPBandwidthExceeded(RuntimeError):
+
+    """The trunk has been over the bandwidth budget for too long, the
+    background request was not sent.  The retry_after attribute is an
+    estimate of the seconds it takes the utilization to come down."""
+
+    def __init__(self, retry_after):
+        RuntimeError.__init__(self, "MSTP bandwidth exceeded, retry after {:.3f}s".format(retry_after))
+        self.retry_after = retry_after
+
+#
+#   MSTPBandwidth
+#
+
+@bacpypes_debugging
+class MSTPBandwidth(object):
+
+    """The use of the wire of a trunk at a baud rate.  The tokens function
+    returns the tokens the agent was passed, see agent_tokens, or None when
+    they are not known."""
+
+    def __init__(self, baudrate, tokens=None, window=BANDWIDTH_WINDOW):
+        if _debug: MSTPBandwidth._debug("__init__ %r window=%r", baudrate, window)
+
+        self.baudrate = baudrate
+        self.tokens = tokens
+        self.window = window
+        self.started = time.time()
+
+        # frames of the director counted in buckets of BANDWIDTH_BUCKET
+        # seconds, [bucket, frames, octets, received frames, received
+        # octets], the samples of the tokens, (when, tokens), and the
+        # rotation times between them
+        self.buckets = collections.deque()
+        self.samples = collections.deque()
+        self.rotations = collections.deque(maxlen=BANDWIDTH_ROTATIONS)
+
+        # seconds of the requests that are out
+        self.outstanding = 0.0
+
+    def frame_time(self, octets):
+        """Return the seconds a frame with the data takes, with the turnaround
+        before the next one."""
+        octets += MSTP_HEADER_OCTETS + MSTP_DATA_CRC_OCTETS
+        return (octets * BITS_PER_OCTET + MSTP_TURNAROUND_BITS) / float(self.baudrate)
+
+    def frames_time(self, frames, octets):
+        """Return the seconds of a number of frames with octets of data in
+        all, see frame_time."""
+        octets += frames * (MSTP_HEADER_OCTETS + MSTP_DATA_CRC_OCTETS)
+        return (octets * BITS_PER_OCTET + frames * MSTP_TURNAROUND_BITS) / float(self.baudrate)
+
+    def frame(self, octets, received=False):
+        """Count a data frame the director sent or received."""
+        index = int(time.time() / BANDWIDTH_BUCKET)
+
+        buckets = self.buckets
+        if buckets and (buckets[-1][0] == index):
+            bucket = buckets[-1]
+        else:
+            bucket = [index, 0, 0, 0, 0]
+            buckets.append(bucket)
+
+            # the buckets that went out of the window
+            first = index - int(self.window / BANDWIDTH_BUCKET)
+            while buckets[0][0] < first:
+                buckets.popleft()
+
+        bucket[1] += 1
+        bucket[2] += octets
+        if received:
+            bucket[3] += 1
+            bucket[4] += octets
+
+    def request(self, octets, reply_octets):
+        """Count a request that is out and return its seconds, they are
+        given back to release when it is answered."""
+        seconds = self.frame_time(octets) + self.frame_time(reply_octets)
+        self.outstanding += seconds
+        return seconds
+
+    def release(self, seconds):
+        self.outstanding = max(0.0, self.outstanding - seconds)
+
+    def reply_octets(self):
+        """Return the average octets of the frames received in the window."""
+        frames = sum(bucket[3] for bucket in self.buckets)
+        if not frames:
+            return BANDWIDTH_FRAME_OCTETS
+        return sum(bucket[4] for bucket in self.buckets) // frames
+
+    def sample(self, now):
+        """Take the tokens when the last sample is old enough, and the time
+        of the rotations since."""
+        if (not self.tokens) or (self.samples and (now - self.samples[-1][0] < BANDWIDTH_SAMPLE)):
+            return
+
+        tokens = self.tokens()
+        if tokens is None:
+            return
+
+        if self.samples:
+            when, last_tokens = self.samples[-1]
+            rotations = (tokens - last_tokens) & 0xFFFFFFFF
+            if rotations:
+                self.rotations.append((now - when) / rotations)
+
+        self.samples.append((now, tokens))
+
+    def trim(self, now):
+        """Let go of the frames and the samples that are out of the window,
+        the oldest sample in it is kept as the base."""
+        start = now - self.window
+        first = int(start / BANDWIDTH_BUCKET)
+        while self.buckets and (self.buckets[0][0] < first):
+            self.buckets.popleft()
+        while (len(self.samples) > 1) and (self.samples[1][0] <= start):
+            self.samples.popleft()
+
+    def counters(self):
+        """Return the share of the wire the data frames of this station, of
+        the other stations, of the requests out and the token passes took in
+        the window, the utilization and the time of a rotation of the ring,
+        the last one and the fastest one."""
+        now = time.time()
+        self.sample(now)
+        self.trim(now)
+
+        span = min(self.window, max(now - self.started, BANDWIDTH_SAMPLE))
+        own = sum(self.frames_time(bucket[1], bucket[2]) for bucket in self.buckets) / span
+
+        # the rotations that took longer than the token passes carried data
+        rotation = idle = 0.0
+        data = own
+        tokens = 0.0
+        if (len(self.samples) > 1) and self.rotations:
+            (first, first_tokens), (last, last_tokens) = self.samples[0], self.samples[-1]
+            rotations = (last_tokens - first_tokens) & 0xFFFFFFFF
+            if rotations:
+                rotation = (last - first) / rotations
+                idle = min(self.rotations)
+                tokens = idle / rotation
+                data = max(data, 1.0 - tokens)
+
+        requests = self.outstanding / self.window
+        return {
+            'baudrate': self.baudrate,
+            'own': own,
+            'others': data - own,
+            'requests': requests,
+            'tokens': tokens,
+            'rotation': rotation,
+            'idle_rotation': idle,
+            'utilization': min(data + requests, 1.0),
+            }
+
+    def utilization(self):
+        """Return the share of the wire the data frames take."""
+        return self.counters()['utilization']
+
+#
+#   request_octets
+#
+
+def request_octets(apdu):
+    """Return an estimate of the octets of the request and of its reply,
+    None for the reply when it is not known."""
+    if isinstance(apdu, ReadPropertyMultipleRequest):
+        reads = sum(len(spec.listOfPropertyReferences) for spec in apdu.listOfReadAccessSpecs)
+        return (COALESCE_REQUEST_OVERHEAD + reads * COALESCE_REQUEST_READ,
+            COALESCE_ACK_OVERHEAD + reads * COALESCE_ACK_READ)
+
+    return BANDWIDTH_FRAME_OCTETS, None
+
+#
+#   MSTPAdmissionMixin
+#
+
+@bacpypes_debugging
+class MSTPAdmissionMixin(object):
+
+    """Application mixin that holds the requests of the background classes
+    while a trunk they go out is over the budget.  It goes after
+    MSTPCoalesceMixin, a merged read is admitted as one request, and the
+    application has the trunk_directors of the address, each with the
+    bandwidth of its trunk.  A budget of zero admits everything."""
+
+    def __init__(self, budget=BANDWIDTH_BUDGET):
+        if _debug: MSTPAdmissionMixin._debug("__init__ budget=%r", budget)
+
+        self.bandwidthBudget = budget
+
+        # requests waiting for the first trunk they go out, a FIFO for each
+        # background class
+        self.admissionWaiting = {}
+        self.admissionTask = FunctionTask(self._admission_check)
+
+        # requests that went right away, that waited and that were refused
+        self.admissionCounters = {'admitted': 0, 'deferred': 0, 'shed': 0}
+
+    def request_io(self, iocb, priority_class=None):
+        """Pass the request along unless it is in a background class and the
+        trunk is over the budget, or other requests are waiting for it."""
+        if _debug: MSTPAdmissionMixin._debug("request_io %r priority_class=%r", iocb, priority_class)
+
+        if (not self.bandwidthBudget) or (priority_class not in BANDWIDTH_CLASSES):
+            super(MSTPAdmissionMixin, self).request_io(iocb, priority_class=priority_class)
+            return
+
+        directors = self.trunk_directors(iocb.args[0].pduDestination)
+        waiting = self.admissionWaiting.get(directors[0])
+        if (not waiting or not any(waiting)) and not self._admission_over(directors):
+            self.admissionCounters['admitted'] += 1
+            self._admission_send(iocb, priority_class, directors)
+            return
+
+        if waiting is None:
+            waiting = self.admissionWaiting[directors[0]] = [collections.deque() for c in BANDWIDTH_CLASSES]
+        if sum(len(fifo) for fifo in waiting) >= BANDWIDTH_MAX_WAITING:
+            if _debug: MSTPAdmissionMixin._debug("    - too many waiting")
+            self._admission_shed(iocb, directors)
+            return
+
+        if _debug: MSTPAdmissionMixin._debug("    - over budget, wait")
+        self.admissionCounters['deferred'] += 1
+        iocb.ioState = PENDING
+        waiting[BANDWIDTH_CLASSES.index(priority_class)].append((iocb, priority_class, directors, time.time()))
+
+        if not self.admissionTask.isScheduled:
+            self.admissionTask.install_task(delta=BANDWIDTH_CHECK)
+
+    def _admission_over(self, directors):
+        return any(director.bandwidth.utilization() > self.bandwidthBudget for director in directors)
+
+    def _admission_send(self, iocb, priority_class, directors):
+        """Count the request on its trunks until it is answered and pass it
+        along."""
+        octets, reply_octets = request_octets(iocb.args[0])
+        costs = [(director.bandwidth, director.bandwidth.request(octets, reply_octets or director.bandwidth.reply_octets()))
+            for director in directors]
+        iocb.add_callback(self._admission_done, costs)
+
+        super(MSTPAdmissionMixin, self).request_io(iocb, priority_class=priority_class)
+
+    def _admission_done(self, iocb, costs):
+        for bandwidth, seconds in costs:
+            bandwidth.release(seconds)
+
+    def _admission_shed(self, iocb, directors):
+        """Refuse the request, it is tried again when the share of the wire
+        over the budget has gone out of the window."""
+        over = max(director.bandwidth.utilization() for director in directors) - self.bandwidthBudget
+        self.admissionCounters['shed'] += 1
+        iocb.abort(MSTPBandwidthExceeded(max(over * BANDWIDTH_WINDOW, BANDWIDTH_CHECK)))
+
+    def _admission_check(self):
+        """Send the waiting requests while their trunks are under the budget,
+        poll before bulk, and refuse the ones that waited too long."""
+        if _debug: MSTPAdmissionMixin._debug("_admission_check")
+
+        now = time.time()
+        for waiting in self.admissionWaiting.values():
+            for fifo in waiting:
+                # requests that timed out while they waited are gone
+                for item in list(fifo):
+                    iocb, priority_class, directors, when = item
+                    if iocb.ioState in (COMPLETED, ABORTED):
+                        fifo.remove(item)
+                    elif now - when > BANDWIDTH_MAX_WAIT:
+                        fifo.remove(item)
+                        self._admission_shed(iocb, directors)
+
+            for fifo in waiting:
+                while fifo and not self._admission_over(fifo[0][2]):
+                    iocb, priority_class, directors, when = fifo.popleft()
+                    self._admission_send(iocb, priority_class, directors)
+
+        if any(fifo for waiting in self.admissionWaiting.values() for fifo in waiting):
+            self.admissionTask.install_task(delta=BANDWIDTH_CHECK)
+
+    def bandwidth_counters(self):
+        """Return the bandwidth of each trunk with the requests waiting for
+        it, and the requests admitted, deferred and shed."""
+        trunks = []
+        for director in self.mstp_directors():
+            counters = director.bandwidth.counters()
+            counters['waiting'] = sum(len(fifo) for fifo in self.admissionWaiting.get(director, ()))
+            trunks.append(counters)
+
+        return dict(self.admissionCounters, budget=self.bandwidthBudget, trunks=trunks)
@@ -0,0 +1,355 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Encoded responses of a server for the properties that rarely change.  The
+ReadProperty and ReadPropertyMultiple services of bacpypes encode every
+value on every request, the object list and the texts of an object over and
+over, and a server on MS/TP that does not answer within the reply delay has
+to postpone the reply and be polled for it on a later token.  The values of
+the properties in the cache are kept as the encoded tags, and the acks made
+only of them are kept as the octets that go on the wire.
+
+A property is kept when it is one of the cache properties and its value is
+the one stored in the object, not one computed when it is read.  A write to
+it, from the network or by setting the attribute, throws it away through the
+property monitors of bacpypes, and adding or deleting an object throws away
+what is kept for the object and the object list of the device.  A value that
+is changed in place, like an element of a list, is not seen.
+"""
+
+from __future__ import absolute_import
+import collections
+import six
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.errors import ExecutionError, UnrecognizedService
+from bacpypes.object import Property, PropertyError
+from bacpypes.apdu import ComplexAckPDU, ReadPropertyACK, ReadPropertyMultipleACK, \
+    ReadAccessResult, ReadAccessResultElement, ReadAccessResultElementChoice
+from bacpypes.service.object import read_property_to_any, read_property_to_result_element
+
+from .properties import STATIC_PROPERTIES
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# properties that are kept, the static ones of the metadata cache and the
+# ones of the device and the objects that are set up once
+CACHE_PROPERTIES = STATIC_PROPERTIES + (
+    'objectIdentifier', 'objectType', 'objectList', 'structuredObjectList',
+    'eventMessageTexts', 'eventMessageTextsConfig', 'location', 'profileName',
+    'vendorName', 'vendorIdentifier', 'modelName', 'firmwareRevision',
+    'applicationSoftwareVersion', 'protocolVersion', 'protocolRevision',
+    'protocolObjectTypesSupported', 'maxApduLengthAccepted', 'segmentationSupported',
+    'maxSegmentsAccepted', 'databaseRevision', 'minPresValue', 'maxPresValue',
+    'resolution',
+    )
+
+# acks and property values kept, the least recently used go first
+CACHE_ACKS = 1024
+CACHE_VALUES = 4096
+
+# the device instance that stands for the local device
+_WILDCARD_DEVICE = ('device', 4194303)
+
+_READ_PROPERTY = six.get_unbound_function(Property.ReadProperty)
+
+#
+#   ResponseCache
+#
+
+@bacpypes_debugging
+class ResponseCache(object):
+
+    """The encoded values of the properties by object and property, and the
+    octets of the acks by request with the properties they are made of."""
+
+    def __init__(self, properties=CACHE_PROPERTIES, acks=CACHE_ACKS, values=CACHE_VALUES):
+        if _debug: ResponseCache._debug("__init__ acks=%r values=%r", acks, values)
+
+        self.properties = frozenset(properties)
+        self.maxAcks = acks
+        self.maxValues = values
+
+        # the acks by request, the values by object and property with the
+        # values of the elements of arrays by index
+        self.acks = collections.OrderedDict()
+        self.values = collections.OrderedDict()
+
+        # the requests of the acks made of a property and the properties
+        # with a monitor
+        self.depends = {}
+        self.monitored = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def cacheable(self, obj, propId):
+        """Return true when the value of the property is kept."""
+        if propId not in self.properties:
+            return False
+
+        prop = obj._properties.get(propId)
+        return (prop is not None) and \
+            (six.get_unbound_function(type(prop).ReadProperty) is _READ_PROPERTY)
+
+    def value(self, obj, objId, propId, index=None):
+        """Return the value of a property that is kept as an Any, reading
+        and encoding it the first time."""
+        values = self.values.get((objId, propId))
+        if values is not None:
+            self.values[(objId, propId)] = self.values.pop((objId, propId))
+            if index in values:
+                return values[index]
+
+        value = read_property_to_any(obj, propId, index)
+        self.watch(obj, objId, propId)
+
+        if values is None:
+            values = self.values[(objId, propId)] = {}
+            while len(self.values) > self.maxValues:
+                self.values.popitem(last=False)
+        values[index] = value
+
+        return value
+
+    def watch(self, obj, objId, propId):
+        """Throw away what is kept for the property when it is written."""
+        if (objId, propId) in self.monitored:
+            return
+        if _debug: ResponseCache._debug("watch %r %r", objId, propId)
+
+        def changed(old_value, new_value):
+            self.invalidate(objId, propId)
+
+        obj._property_monitors[propId].append(changed)
+        self.monitored.add((objId, propId))
+
+    def get_ack(self, key):
+        """Return the octets of the ack of the request, None when they are
+        not kept."""
+        data = self.acks.pop(key, None)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.acks[key] = data
+        return data[0]
+
+    def put_ack(self, key, octets, depends):
+        """Keep the octets of the ack of the request, made of the properties
+        in depends."""
+        if _debug: ResponseCache._debug("put_ack %r %r", key, len(octets))
+
+        self.acks[key] = (octets, depends)
+        for item in depends:
+            self.depends.setdefault(item, set()).add(key)
+
+        while len(self.acks) > self.maxAcks:
+            self.forget(*self.acks.popitem(last=False))
+
+    def forget(self, key, data):
+        for item in data[1]:
+            keys = self.depends.get(item)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.depends[item]
+
+    def invalidate(self, objId, propId=None):
+        """Throw away what is kept for a property, or all the properties of
+        the object without one."""
+        if _debug: ResponseCache._debug("invalidate %r %r", objId, propId)
+
+        items = [item for item in set(self.values) | set(self.depends)
+            if (item[0] == objId) and (propId in (None, item[1]))]
+        for item in items:
+            self.values.pop(item, None)
+            for key in self.depends.pop(item, ()):
+                data = self.acks.pop(key, None)
+                if data is not None:
+                    self.forget(key, data)
+        if items:
+            self.invalidated += 1
+
+        # an object that is deleted takes its monitors with it
+        if propId is None:
+            self.monitored = set(item for item in self.monitored if item[0] != objId)
+
+    def counters(self):
+        return {
+            'acks': len(self.acks),
+            'values': sum(len(values) for values in self.values.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidated': self.invalidated,
+            }
+
+#
+#   encode_ack
+#
+
+def encode_ack(ack):
+    """Return the octets of the service part of an ack."""
+    xpdu = ComplexAckPDU()
+    ack.encode(xpdu)
+    return bytes(xpdu.pduData)
+
+#
+#   MSTPResponseCacheMixin
+#
+
+@bacpypes_debugging
+class MSTPResponseCacheMixin(object):
+
+    """Application mixin that goes before ApplicationIOController and answers
+    the reads of the properties that are kept from the cache.  A request with
+    a property that is not kept is read like bacpypes does, the values that
+    are kept still come from the cache, and only acks made of properties that
+    are kept are kept themselves."""
+
+    # objects are added before the mixin is initialized
+    responseCache = None
+
+    def __init__(self, cache=True, properties=CACHE_PROPERTIES):
+        if _debug: MSTPResponseCacheMixin._debug("__init__ cache=%r", cache)
+
+        self.responseCache = ResponseCache(properties) if cache else None
+
+    def add_object(self, obj):
+        super(MSTPResponseCacheMixin, self).add_object(obj)
+        self.object_changed(obj)
+
+    def delete_object(self, obj):
+        super(MSTPResponseCacheMixin, self).delete_object(obj)
+        self.object_changed(obj)
+
+    def object_changed(self, obj):
+        """Throw away what is kept for the object and the object list."""
+        if not self.responseCache:
+            return
+
+        self.responseCache.invalidate(obj.objectIdentifier)
+        if self.localDevice is not None:
+            self.responseCache.invalidate(self.localDevice.objectIdentifier, 'objectList')
+
+    def respond(self, apdu, octets):
+        """Send the octets of an ack as the response to the request."""
+        resp = ComplexAckPDU(context=apdu)
+        resp.put_data(octets)
+        self.response(resp)
+
+    def cache_object_id(self, objId):
+        if (objId == _WILDCARD_DEVICE) and (self.localDevice is not None):
+            return self.localDevice.objectIdentifier
+        return objId
+
+    def do_ReadPropertyRequest(self, apdu):
+        if _debug: MSTPResponseCacheMixin._debug("do_ReadPropertyRequest %r", apdu)
+
+        cache = self.responseCache
+        if not cache:
+            return super(MSTPResponseCacheMixin, self).do_ReadPropertyRequest(apdu)
+
+        objId = self.cache_object_id(apdu.objectIdentifier)
+        propId = apdu.propertyIdentifier
+        key = ('readProperty', objId, propId, apdu.propertyArrayIndex)
+
+        octets = cache.get_ack(key)
+        if octets is None:
+            obj = self.get_object_id(objId)
+            if (not obj) or (not cache.cacheable(obj, propId)):
+                return super(MSTPResponseCacheMixin, self).do_ReadPropertyRequest(apdu)
+
+            resp = ReadPropertyACK(context=apdu)
+            resp.objectIdentifier = objId
+            resp.propertyIdentifier = propId
+            resp.propertyArrayIndex = apdu.propertyArrayIndex
+            resp.propertyValue = cache.value(obj, objId, propId, apdu.propertyArrayIndex)
+
+            octets = encode_ack(resp)
+            cache.put_ack(key, octets, ((objId, propId),))
+
+        self.respond(apdu, octets)
+
+    def do_ReadPropertyMultipleRequest(self, apdu):
+        if _debug: MSTPResponseCacheMixin._debug("do_ReadPropertyMultipleRequest %r", apdu)
+
+        # only for the applications that have the service
+        parent = super(MSTPResponseCacheMixin, self)
+        if not hasattr(parent, 'do_ReadPropertyMultipleRequest'):
+            raise UnrecognizedService("no function do_ReadPropertyMultipleRequest")
+
+        cache = self.responseCache
+        if not cache:
+            return parent.do_ReadPropertyMultipleRequest(apdu)
+
+        specs = []
+        for read_access_spec in apdu.listOfReadAccessSpecs:
+            references = tuple((reference.propertyIdentifier, reference.propertyArrayIndex)
+                for reference in read_access_spec.listOfPropertyReferences)
+
+            # all, required and optional are left to bacpypes
+            if any(propId in ('all', 'required', 'optional') for propId, index in references):
+                return parent.do_ReadPropertyMultipleRequest(apdu)
+
+            specs.append((self.cache_object_id(read_access_spec.objectIdentifier), references))
+        key = ('readPropertyMultiple', tuple(specs))
+
+        octets = cache.get_ack(key)
+        if octets is None:
+            depends = set()
+            complete = True
+
+            read_access_result_list = []
+            for objId, references in specs:
+                obj = self.get_object_id(objId)
+
+                read_access_result_element_list = []
+                for propId, index in references:
+                    element = None
+                    if obj and cache.cacheable(obj, propId):
+                        try:
+                            element = ReadAccessResultElement(
+                                propertyIdentifier=propId,
+                                propertyArrayIndex=index,
+                                readResult=ReadAccessResultElementChoice(
+                                    propertyValue=cache.value(obj, objId, propId, index),
+                                    ),
+                                )
+                            depends.add((objId, propId))
+                        except (ExecutionError, PropertyError):
+                            pass
+
+                    # errors and the properties that are not kept are read
+                    # the way bacpypes does
+                    if element is None:
+                        element = read_property_to_result_element(obj, propId, index)
+                        complete = False
+
+                    read_access_result_element_list.append(element)
+
+                read_access_result_list.append(ReadAccessResult(
+                    objectIdentifier=objId,
+                    listOfResults=read_access_result_element_list,
+                    ))
+
+            resp = ReadPropertyMultipleACK(context=apdu)
+            resp.listOfReadAccessResults = read_access_result_list
+
+            octets = encode_ack(resp)
+            if complete:
+                cache.put_ack(key, octets, tuple(depends))
+
+        self.respond(apdu, octets)
+
+    def response_cache_counters(self):
+        """Return the acks and values kept, the requests answered from the
+        cache and not, and the times something kept was thrown away."""
+        if not self.responseCache:
+            return None
+        return self.responseCache.counters()
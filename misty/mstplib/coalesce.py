@@ -0,0 +1,280 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Coalescing of ReadProperty requests.  A device has no more than its window
+of confirmed requests outstanding, one unless it is given more (see
+misty.mstplib.window), so the reads that are made while the window is full
+wait anyway.  Instead of going one after the other they go out together as
+one ReadPropertyMultiple that fits in the APDU the device accepts, and the
+results are handed back to the IOCBs of the reads as if each one had been a
+ReadProperty.  A read to a device with room in its window is sent right
+away, reads made together in the same pass of the event loop go out
+together.
+
+The agent starts the reply timer when it has written a frame, not when the
+last octet is on the wire, so a merged request is also kept short enough to
+leave the reply time to start at the baud rate of the trunk.
+"""
+
+from __future__ import absolute_import
+import collections
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.core import deferred
+from bacpypes.iocb import IOCB, PENDING, COMPLETED, ABORTED
+from bacpypes.pdu import Address
+from bacpypes.apdu import ReadPropertyRequest, ReadPropertyACK, \
+    ReadPropertyMultipleRequest, ReadPropertyMultipleACK, \
+    ReadAccessSpecification, PropertyReference, \
+    AbortPDU, AbortReason, RejectPDU, RejectReason, ErrorPDU, Error
+
+from .priority import MSTP_PRIORITY_CLASSES, MSTP_DEFAULT_CLASS
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# largest APDU of a device that did not say, the largest one MS/TP carries
+COALESCE_MAX_APDU = 480
+
+# octets of a ReadPropertyMultiple ack around the results and the octets of
+# each result, a present value with its tags and a share of the object
+# identifier
+COALESCE_ACK_OVERHEAD = 10
+COALESCE_ACK_READ = 16
+
+# octets of a ReadPropertyMultiple request frame around the references and
+# the octets of each reference, the tagged object identifier, the property
+# and the opening and closing tags, and the seconds the frame may take on
+# the wire, half of Treply_timeout in mstp.c
+COALESCE_REQUEST_OVERHEAD = 12
+COALESCE_REQUEST_READ = 9
+COALESCE_REQUEST_TIME = 0.150
+
+# bits on the wire for each octet
+BITS_PER_OCTET = 10
+
+# addresses of a single device
+_UNICAST = (Address.localStationAddr, Address.remoteStationAddr)
+
+#
+#   coalesce_batch_size
+#
+
+def coalesce_batch_size(max_apdu, baudrate=None):
+    """Return the reads that fit in one unsegmented ReadPropertyMultiple ack
+    of the size, and in a request that is on the wire for no longer than
+    COALESCE_REQUEST_TIME at the baud rate when it is given."""
+    count = (max_apdu - COALESCE_ACK_OVERHEAD) // COALESCE_ACK_READ
+    if baudrate:
+        octets = int(baudrate * COALESCE_REQUEST_TIME / BITS_PER_OCTET)
+        count = min(count, (octets - COALESCE_REQUEST_OVERHEAD) // COALESCE_REQUEST_READ)
+    return max(1, count)
+
+#
+#   MSTPCoalesceMixin
+#
+
+@bacpypes_debugging
+class MSTPCoalesceMixin(object):
+
+    """Application mixin that merges the ReadProperty requests waiting for
+    the same device into ReadPropertyMultiple requests.  It goes before
+    MSTPPriorityMixin, the merged request goes in the most urgent class of
+    the reads in it.  A device that rejects ReadPropertyMultiple, or fails a
+    merged request as a whole with an error, a reject or an abort, is asked
+    for each read on its own.  A merged request that gets no response, or
+    that the stack refuses, fails all the reads in it."""
+
+    def __init__(self, coalesce=True):
+        if _debug: MSTPCoalesceMixin._debug("__init__ coalesce=%r", coalesce)
+
+        self.coalesceReads = coalesce
+
+        # reads waiting for each address, requests outstanding for each
+        # address and the addresses that do not take ReadPropertyMultiple
+        self.coalescePending = {}
+        self.coalesceBusy = collections.defaultdict(int)
+        self.coalesceRefused = set()
+
+        # reads that went out merged and the requests they went out in
+        self.coalesceCounters = {'reads': 0, 'requests': 0}
+
+    def request_io(self, iocb, priority_class=None):
+        """Hold a ReadProperty while the device has a request outstanding,
+        pass everything else along."""
+        if _debug: MSTPCoalesceMixin._debug("request_io %r priority_class=%r", iocb, priority_class)
+
+        if (priority_class is not None) and (priority_class not in MSTP_PRIORITY_CLASSES):
+            raise ValueError("unknown priority class: {}".format(priority_class))
+
+        apdu = iocb.args[0]
+        address = apdu.pduDestination
+        if (not self.coalesceReads) or (not isinstance(apdu, ReadPropertyRequest)) \
+                or (address.addrType not in _UNICAST) or (address in self.coalesceRefused):
+            self._coalesce_send(address, iocb, priority_class)
+            return
+
+        iocb.ioState = PENDING
+        pending = self.coalescePending.setdefault(address, [])
+        pending.append((iocb, priority_class))
+
+        # the first read waits for the rest of this pass of the event loop,
+        # the others go when the device has room in its window
+        if (len(pending) == 1) and (self.coalesceBusy.get(address, 0) < self.coalesce_window(address)):
+            deferred(self._coalesce_flush, address)
+
+    def coalesce_window(self, address):
+        """Return the requests the device may have outstanding, one unless
+        the application keeps windows."""
+        return 1
+
+    def coalesce_baudrate(self, address):
+        """Return the baud rate of the trunk of the address, None when it is
+        not known."""
+        return getattr(self.localDevice, '_baudrate', None)
+
+    def _coalesce_send(self, address, iocb, priority_class):
+        self.coalesceBusy[address] += 1
+        iocb.add_callback(self._coalesce_done, address)
+        super(MSTPCoalesceMixin, self).request_io(iocb, priority_class=priority_class)
+
+    def _coalesce_done(self, iocb, address):
+        self.coalesceBusy[address] -= 1
+        busy = self.coalesceBusy[address]
+        if not busy:
+            del self.coalesceBusy[address]
+        if self.coalescePending.get(address) and (busy < self.coalesce_window(address)):
+            deferred(self._coalesce_flush, address)
+
+    def _coalesce_flush(self, address):
+        """Send the reads waiting for the address while the device has room
+        in its window, as many as fit in one ack in each request."""
+        if _debug: MSTPCoalesceMixin._debug("_coalesce_flush %r", address)
+
+        while self.coalescePending.get(address) and \
+                (self.coalesceBusy.get(address, 0) < self.coalesce_window(address)):
+            self._coalesce_batch(address)
+
+    def _coalesce_batch(self, address):
+        """Send the next reads waiting for the address."""
+        # reads that timed out while they waited are gone
+        pending = [(iocb, priority_class) for iocb, priority_class in self.coalescePending.pop(address, [])
+            if iocb.ioState not in (COMPLETED, ABORTED)]
+        if not pending:
+            return
+
+        device_info = self.deviceInfoCache.get_device_info(address)
+        max_apdu = device_info.maxApduLengthAccepted if device_info else COALESCE_MAX_APDU
+        max_apdu = min(max_apdu, self.localDevice.maxApduLengthAccepted or COALESCE_MAX_APDU)
+        count = coalesce_batch_size(max_apdu, self.coalesce_baudrate(address))
+        if pending[count:]:
+            self.coalescePending[address] = pending[count:]
+        batch = pending[:count]
+
+        if (len(batch) == 1) or (address in self.coalesceRefused):
+            for iocb, priority_class in batch:
+                self._coalesce_send(address, iocb, priority_class)
+            return
+
+        # the properties of the same object go in one specification
+        specs = collections.OrderedDict()
+        for iocb, priority_class in batch:
+            read = iocb.args[0]
+            specs.setdefault(read.objectIdentifier, []).append((iocb, priority_class))
+        batch = [item for items in specs.values() for item in items]
+
+        request = ReadPropertyMultipleRequest(listOfReadAccessSpecs=[
+            ReadAccessSpecification(
+                objectIdentifier=obj_id,
+                listOfPropertyReferences=[
+                    PropertyReference(
+                        propertyIdentifier=iocb.args[0].propertyIdentifier,
+                        propertyArrayIndex=iocb.args[0].propertyArrayIndex,
+                        )
+                    for iocb, priority_class in items
+                    ],
+                )
+            for obj_id, items in specs.items()
+            ])
+        request.pduDestination = address
+
+        classes = [MSTP_PRIORITY_CLASSES.index(priority_class or MSTP_DEFAULT_CLASS)
+            for iocb, priority_class in batch]
+        self.coalesceCounters['reads'] += len(batch)
+        self.coalesceCounters['requests'] += 1
+
+        rpm_iocb = IOCB(request)
+        rpm_iocb.add_callback(self._coalesce_response, address, batch)
+        self._coalesce_send(address, rpm_iocb, MSTP_PRIORITY_CLASSES[min(classes)])
+
+    def _coalesce_response(self, rpm_iocb, address, batch):
+        """Hand the results of a merged request to the reads."""
+        if _debug: MSTPCoalesceMixin._debug("_coalesce_response %r %r", rpm_iocb, address)
+
+        err = rpm_iocb.ioError
+        if isinstance(err, RejectPDU) and (err.apduAbortRejectReason == RejectReason.unrecognizedService):
+            if _debug: MSTPCoalesceMixin._debug("    - no ReadPropertyMultiple")
+            self.coalesceRefused.add(address)
+            self._coalesce_alone(address, batch)
+            return
+        # the device did not take the merged request, a read on its own may
+        # still do, only a timeout or an error of the stack is for them all
+        if isinstance(err, (ErrorPDU, RejectPDU)) or \
+                (isinstance(err, AbortPDU) and (err.apduAbortRejectReason != AbortReason.noResponse)):
+            if _debug: MSTPCoalesceMixin._debug("    - merged request failed: %r", err)
+            self._coalesce_alone(address, batch)
+            return
+        if err:
+            for iocb, priority_class in batch:
+                iocb.abort(err)
+            return
+
+        ack = rpm_iocb.ioResponse
+        elements = []
+        if isinstance(ack, ReadPropertyMultipleACK):
+            elements = [(result.objectIdentifier, element)
+                for result in ack.listOfReadAccessResults for element in result.listOfResults]
+
+        # the results come back in the order they were asked for
+        matched = (len(elements) == len(batch)) and all(
+            (obj_id == iocb.args[0].objectIdentifier)
+            and (element.propertyIdentifier == iocb.args[0].propertyIdentifier)
+            and (element.propertyArrayIndex == iocb.args[0].propertyArrayIndex)
+            for (obj_id, element), (iocb, priority_class) in zip(elements, batch)
+            )
+        if not matched:
+            if _debug: MSTPCoalesceMixin._debug("    - results do not match")
+            self._coalesce_alone(address, batch)
+            return
+
+        for (obj_id, element), (iocb, priority_class) in zip(elements, batch):
+            if iocb.ioState in (COMPLETED, ABORTED):
+                continue
+
+            read = iocb.args[0]
+            access_error = element.readResult.propertyAccessError
+            if access_error:
+                error = Error(errorClass=access_error.errorClass, errorCode=access_error.errorCode)
+                error.apduService = ReadPropertyRequest.serviceChoice
+                error.pduSource = address
+                iocb.abort(error)
+                continue
+
+            response = ReadPropertyACK(
+                objectIdentifier=read.objectIdentifier,
+                propertyIdentifier=read.propertyIdentifier,
+                propertyArrayIndex=read.propertyArrayIndex,
+                )
+            response.propertyValue = element.readResult.propertyValue
+            response.pduSource = address
+            iocb.complete(response)
+
+    def _coalesce_alone(self, address, batch):
+        """Send the reads one at a time, ahead of the reads still waiting."""
+        if _debug: MSTPCoalesceMixin._debug("_coalesce_alone %r %r", address, len(batch))
+
+        for iocb, priority_class in batch:
+            if iocb.ioState not in (COMPLETED, ABORTED):
+                self._coalesce_send(address, iocb, priority_class)
@@ -0,0 +1,404 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Change of value subscriptions of a client.  Instead of reading a point over
+and over, the client subscribes to it with SubscribeCOV, or SubscribeCOVProperty
+for a property other than the present value, and the device sends a
+notification when the value changes.  Subscriptions last a lifetime and are
+renewed before it runs out, at a random point of the last part of it so the
+renewals of subscriptions made together spread out.  A lifetime of zero is
+indefinite and is never renewed.  A device that rejects
+the service, or an object the device will not notify about, is polled
+instead with a PointPoller.
+
+The frames the subscriptions took on the trunk, the subscribe requests and
+the notifications, are counted against the frames polling the same points at
+their poll interval would have taken.
+"""
+
+from __future__ import absolute_import
+import time
+import heapq
+import random
+import functools
+import itertools
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.iocb import IOCB
+from bacpypes.task import FunctionTask
+from bacpypes.pdu import Address
+from bacpypes.errors import ExecutionError, UnrecognizedService
+from bacpypes.apdu import SimpleAckPDU, SubscribeCOVRequest, SubscribeCOVPropertyRequest, \
+    PropertyReference, RejectPDU, RejectReason, ErrorPDU
+from bacpypes.primitivedata import Unsigned
+from bacpypes.constructeddata import Array
+from bacpypes.object import get_datatype
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# seconds a subscription lasts, the part of it after which it is renewed
+# and the part of it the renewal moves earlier at random
+COV_LIFETIME = 300
+COV_RENEW = 0.8
+COV_JITTER = 0.1
+
+# seconds before a subscription that was not answered is tried again
+COV_RETRY = 30.0
+
+# seconds between the reads of a point that is polled instead
+COV_POLL_INTERVAL = 30.0
+
+# frames of a confirmed request and its answer, and of an unconfirmed one
+FRAMES_CONFIRMED = 2
+FRAMES_UNCONFIRMED = 1
+
+#
+#   COVSubscription
+#
+
+class COVSubscription(object):
+
+    """A subscription to the change of value of an object, or of a property
+    of it.  The values are the last ones the device sent, or read when the
+    point is polled, by property, and value is the one of the property
+    subscribed to or the present value."""
+
+    __slots__ = ('address', 'objectIdentifier', 'propertyIdentifier', 'lifetime',
+        'confirmed', 'increment', 'pollInterval', 'callback', 'state', 'due',
+        'values', 'value', 'updated', 'notifications', 'point', 'covSince', 'covSeconds')
+
+    def __init__(self, address, obj_id, prop, lifetime, confirmed, increment, poll_interval, callback):
+        self.address = address
+        self.objectIdentifier = obj_id
+        self.propertyIdentifier = prop
+        self.lifetime = lifetime
+        self.confirmed = confirmed
+        self.increment = increment
+        self.pollInterval = poll_interval
+        self.callback = callback
+
+        # subscribing, active, retrying, polled or cancelled, and when the
+        # next renewal or retry is due
+        self.state = 'subscribing'
+        self.due = None
+
+        self.values = {}
+        self.value = None
+        self.updated = None
+        self.notifications = 0
+
+        # the point polled instead, and the seconds the subscription was
+        # active for the traffic that would have been polled
+        self.point = None
+        self.covSince = None
+        self.covSeconds = 0.0
+
+    def __repr__(self):
+        return "<COVSubscription {} {}:{} {} {}>".format(self.address,
+            self.objectIdentifier[0], self.objectIdentifier[1], self.propertyIdentifier or '', self.state)
+
+    def key(self):
+        return (self.address, self.objectIdentifier, self.propertyIdentifier)
+
+    def cov_seconds(self, now):
+        if self.covSince is None:
+            return self.covSeconds
+        return self.covSeconds + (now - self.covSince)
+
+#
+#   MSTPCOVClientMixin
+#
+
+@bacpypes_debugging
+class MSTPCOVClientMixin(object):
+
+    """Application mixin that passes the COV notifications it gets to the
+    subscription manager of the application.  A confirmed notification is
+    acked when it is for one of the subscriptions, answered with an unknown
+    subscription error when it is not, and rejected when the application has
+    no subscription manager."""
+
+    def __init__(self):
+        if _debug: MSTPCOVClientMixin._debug("__init__")
+
+        self.covManager = None
+
+    def do_ConfirmedCOVNotificationRequest(self, apdu):
+        if _debug: MSTPCOVClientMixin._debug("do_ConfirmedCOVNotificationRequest %r", apdu)
+
+        if not self.covManager:
+            raise UnrecognizedService("no subscription manager")
+        if not self.covManager.notification(apdu, True):
+            raise ExecutionError(errorClass='services', errorCode='unknownSubscription')
+
+        self.response(SimpleAckPDU(context=apdu))
+
+    def do_UnconfirmedCOVNotificationRequest(self, apdu):
+        if _debug: MSTPCOVClientMixin._debug("do_UnconfirmedCOVNotificationRequest %r", apdu)
+
+        if self.covManager:
+            self.covManager.notification(apdu, False)
+
+#
+#   COVSubscriptionManager
+#
+
+@bacpypes_debugging
+class COVSubscriptionManager(object):
+
+    """The subscriptions of an application, by address, object and property.
+    All of them use the same subscriber process identifier.  The poller is
+    the one points are polled with when the device will not notify, one of
+    its own in the poll class when it is not given."""
+
+    def __init__(self, application, process_id=1, poller=None, priority_class='poll', seed=None):
+        if _debug: COVSubscriptionManager._debug("__init__ %r process_id=%r", application, process_id)
+
+        self.application = application
+        self.processIdentifier = process_id
+        if poller is None:
+            from .poll import PointPoller
+            poller = PointPoller(application)
+        self.poller = poller
+        self.priority_class = priority_class
+        self.rng = random.Random(seed)
+
+        application.covManager = self
+
+        # the subscriptions, the addresses that reject the service, and the
+        # heap of the renewals and retries
+        self.subscriptions = {}
+        self.refused = set()
+        self.heap = []
+        self.counter = itertools.count()
+        self.task = FunctionTask(self.process)
+
+        # frames the subscriptions took, and the frames of polling that
+        # stopped when the subscriptions they were polled for went away
+        self.covFrames = 0
+        self.pollingFrames = 0.0
+
+    def subscribe(self, address, obj_id, prop=None, lifetime=COV_LIFETIME, confirmed=False,
+            increment=None, poll_interval=COV_POLL_INTERVAL, callback=None):
+        """Subscribe to the object, or the property of the object when one is
+        given, and return the subscription.  The callback is called with the
+        subscription when a value comes in."""
+        if _debug: COVSubscriptionManager._debug("subscribe %r %r %r lifetime=%r confirmed=%r", address, obj_id, prop, lifetime, confirmed)
+
+        if not isinstance(address, Address):
+            address = Address(address)
+
+        subscription = COVSubscription(address, obj_id, prop, lifetime, confirmed,
+            increment, poll_interval, callback)
+        old = self.subscriptions.get(subscription.key())
+        if old:
+            self.cancel(old)
+        self.subscriptions[subscription.key()] = subscription
+
+        if address in self.refused:
+            self.poll(subscription)
+        else:
+            self.send(subscription)
+
+        return subscription
+
+    def cancel(self, subscription):
+        """Stop the subscription, or the polling of its point."""
+        if _debug: COVSubscriptionManager._debug("cancel %r", subscription)
+
+        if self.subscriptions.get(subscription.key()) is subscription:
+            del self.subscriptions[subscription.key()]
+
+        now = time.time()
+        if subscription.point:
+            self.poller.remove(subscription.point)
+            subscription.point = None
+        elif subscription.state in ('subscribing', 'active'):
+            self.send(subscription, cancel=True)
+
+        # the polling it saved is kept in the counters
+        self.stop_cov(subscription, now)
+        self.pollingFrames += FRAMES_CONFIRMED * subscription.covSeconds / subscription.pollInterval
+        subscription.state = 'cancelled'
+
+    def request(self, subscription, cancel=False):
+        if subscription.propertyIdentifier is None:
+            request = SubscribeCOVRequest(
+                subscriberProcessIdentifier=self.processIdentifier,
+                monitoredObjectIdentifier=subscription.objectIdentifier,
+                )
+        else:
+            request = SubscribeCOVPropertyRequest(
+                subscriberProcessIdentifier=self.processIdentifier,
+                monitoredObjectIdentifier=subscription.objectIdentifier,
+                monitoredPropertyIdentifier=PropertyReference(propertyIdentifier=subscription.propertyIdentifier),
+                )
+            if (subscription.increment is not None) and not cancel:
+                request.covIncrement = subscription.increment
+
+        # a request without them cancels the subscription
+        if not cancel:
+            request.issueConfirmedNotifications = subscription.confirmed
+            request.lifetime = subscription.lifetime
+
+        request.pduDestination = subscription.address
+        return request
+
+    def send(self, subscription, cancel=False):
+        if _debug: COVSubscriptionManager._debug("send %r cancel=%r", subscription, cancel)
+
+        self.covFrames += FRAMES_CONFIRMED
+        iocb = IOCB(self.request(subscription, cancel))
+        if not cancel:
+            iocb.add_callback(self.subscribe_complete, subscription)
+        self.application.request_io(iocb, priority_class=self.priority_class)
+
+    def subscribe_complete(self, iocb, subscription):
+        if _debug: COVSubscriptionManager._debug("subscribe_complete %r %r", iocb, subscription)
+
+        if subscription.state == 'cancelled':
+            return
+
+        now = time.time()
+        err = iocb.ioError
+        if not err:
+            subscription.state = 'active'
+            if subscription.covSince is None:
+                subscription.covSince = now
+
+            # renew in the last part of the lifetime, unless it is indefinite
+            if subscription.lifetime:
+                renew = COV_RENEW - self.rng.uniform(0, COV_JITTER)
+                self.schedule(subscription, now + renew * subscription.lifetime)
+            return
+
+        self.stop_cov(subscription, now)
+        if isinstance(err, RejectPDU) and (err.apduAbortRejectReason == RejectReason.unrecognizedService):
+            if _debug: COVSubscriptionManager._debug("    - no COV: %r", subscription.address)
+            self.refused.add(subscription.address)
+            self.poll(subscription)
+        elif isinstance(err, ErrorPDU):
+            # the device will not notify about this one
+            if _debug: COVSubscriptionManager._debug("    - refused: %r", err)
+            self.poll(subscription)
+        else:
+            subscription.state = 'retrying'
+            self.schedule(subscription, now + COV_RETRY * (1.0 + self.rng.uniform(0, COV_JITTER)))
+
+    def stop_cov(self, subscription, now):
+        if subscription.covSince is not None:
+            subscription.covSeconds += now - subscription.covSince
+            subscription.covSince = None
+
+    def poll(self, subscription):
+        """Poll the point of the subscription instead."""
+        if _debug: COVSubscriptionManager._debug("poll %r", subscription)
+
+        subscription.state = 'polled'
+        subscription.point = self.poller.add(subscription.address, subscription.objectIdentifier,
+            subscription.propertyIdentifier or 'presentValue', subscription.pollInterval,
+            callback=functools.partial(self.polled, subscription))
+
+    def polled(self, subscription, point):
+        if point.error is None:
+            self.update(subscription, {point.propertyIdentifier: point.value})
+
+    def schedule(self, subscription, due):
+        subscription.due = due
+        heapq.heappush(self.heap, (due, next(self.counter), subscription))
+        if self.heap[0][2] is subscription:
+            self.task.install_task(when=due)
+
+    def process(self):
+        """Renew the subscriptions and retry the ones that are due."""
+        if _debug: COVSubscriptionManager._debug("process")
+
+        now = time.time()
+        while self.heap and (self.heap[0][0] <= now):
+            due, sequence, subscription = heapq.heappop(self.heap)
+            if (due != subscription.due) or (subscription.state not in ('active', 'retrying')):
+                continue
+            if self.subscriptions.get(subscription.key()) is not subscription:
+                continue
+
+            self.send(subscription)
+
+        if self.heap:
+            self.task.install_task(when=self.heap[0][0])
+
+    def notification(self, apdu, confirmed):
+        """Take the values of a notification for the subscriptions to the
+        object, return true when it was for one of them."""
+        if _debug: COVSubscriptionManager._debug("notification %r confirmed=%r", apdu, confirmed)
+
+        self.covFrames += FRAMES_CONFIRMED if confirmed else FRAMES_UNCONFIRMED
+        if apdu.subscriberProcessIdentifier != self.processIdentifier:
+            return False
+
+        obj_id = apdu.monitoredObjectIdentifier
+        values = {}
+        for element in apdu.listOfValues:
+            prop = element.propertyIdentifier
+            datatype = get_datatype(obj_id[0], prop)
+            if not datatype:
+                values[prop] = element.value
+            elif issubclass(datatype, Array) and (element.propertyArrayIndex is not None):
+                if element.propertyArrayIndex == 0:
+                    values[prop] = element.value.cast_out(Unsigned)
+                else:
+                    values[prop] = element.value.cast_out(datatype.subtype)
+            else:
+                values[prop] = element.value.cast_out(datatype)
+
+        # the subscription to the object, or to one of the properties
+        matched = False
+        for prop in [None] + list(values):
+            subscription = self.subscriptions.get((apdu.pduSource, obj_id, prop))
+            if not subscription or (subscription.state == 'polled'):
+                continue
+
+            matched = True
+            subscription.notifications += 1
+            self.update(subscription, values)
+
+            # the device has forgotten it, subscribe again, the time of an
+            # indefinite subscription is always zero
+            if (apdu.timeRemaining == 0) and subscription.lifetime and (subscription.state == 'active'):
+                self.schedule(subscription, time.time())
+
+        return matched
+
+    def update(self, subscription, values):
+        subscription.values.update(values)
+        subscription.value = subscription.values.get(subscription.propertyIdentifier or 'presentValue')
+        subscription.updated = time.time()
+
+        if subscription.callback:
+            try:
+                subscription.callback(subscription)
+            except Exception as err:
+                COVSubscriptionManager._exception("callback of %r: %r", subscription, err)
+
+    def counters(self):
+        """Return the subscriptions in each state, the frames they took and
+        the frames polling them instead would have taken."""
+        now = time.time()
+        counters = dict.fromkeys(('subscribing', 'active', 'retrying', 'polled'), 0)
+        polling_frames = self.pollingFrames
+        for subscription in self.subscriptions.values():
+            counters[subscription.state] += 1
+            polling_frames += FRAMES_CONFIRMED * subscription.cov_seconds(now) / subscription.pollInterval
+
+        saved = polling_frames - self.covFrames
+        counters.update({
+            'subscriptions': len(self.subscriptions),
+            'refused': len(self.refused),
+            'cov_frames': self.covFrames,
+            'polling_frames': int(polling_frames),
+            'saved_frames': int(saved),
+            'saved_percent': 100.0 * saved / polling_frames if polling_frames else 0.0,
+            })
+        return counters
@@ -0,0 +1,281 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Device information from I-Am, kept in a file between runs.  An application
+starts with the devices it knew the last time, so it can read and segment
+right away, and a scan sweeps the device instance space with ranged Who-Is
+requests to reconcile the cache with the trunk, reporting the devices that
+were added, moved, changed or went missing.
+"""
+
+from __future__ import absolute_import
+import os
+import time
+
+from bacpypes.debugging import bacpypes_debugging, DebugContents, ModuleLogger
+from bacpypes.app import DeviceInfo, DeviceInfoCache
+from bacpypes.iocb import IOCB
+from bacpypes.task import FunctionTask
+from bacpypes.pdu import Address, GlobalBroadcast
+from bacpypes.apdu import WhoIsRequest
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# largest device instance
+WHOIS_MAX_INSTANCE = 4194303
+
+# Who-Is requests of a scan, seconds between them and seconds to wait for
+# the I-Am replies after the last one
+SCAN_RANGES = 4
+SCAN_INTERVAL = 1.0
+SCAN_SETTLE = 5.0
+
+# version of the cache file
+DEVICE_CACHE_VERSION = 1
+
+# what is kept of each device, and what is compared between scans
+_FIELDS = ('maxApduLengthAccepted', 'segmentationSupported', 'vendorID', 'maxSegmentsAccepted')
+
+#
+#   MSTPDeviceInfo
+#
+
+class MSTPDeviceInfo(DeviceInfo):
+
+    """Device information with the time the device last said I-Am."""
+
+    _debug_contents = DeviceInfo._debug_contents + ('lastSeen',)
+
+    def __init__(self, device_identifier, address):
+        DeviceInfo.__init__(self, device_identifier, address)
+        self.lastSeen = None
+
+#
+#   MSTPDeviceInfoCache
+#
+
+@bacpypes_debugging
+class MSTPDeviceInfoCache(DeviceInfoCache):
+
+    """Cache of device information that keeps the records it is given, by
+    device instance and address, and loads them from and saves them to a
+    file when it has a path."""
+
+    def __init__(self, path=None):
+        if _debug: MSTPDeviceInfoCache._debug("__init__ %r", path)
+        DeviceInfoCache.__init__(self, MSTPDeviceInfo)
+
+        self.path = path
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def iam_device_info(self, apdu):
+        DeviceInfoCache.iam_device_info(self, apdu)
+
+        device_info = self.cache[apdu.iAmDeviceIdentifier[1]]
+        device_info.lastSeen = time.time()
+
+    def update_device_info(self, device_info):
+        DeviceInfoCache.update_device_info(self, device_info)
+
+        # the records of new devices go in too
+        self.cache[device_info.deviceIdentifier] = device_info
+        self.cache[device_info.address] = device_info
+
+    def acquire(self, key):
+        """Return the record and count one more segmentation state machine
+        using it, the state machines pass the record itself."""
+        if not isinstance(key, DeviceInfo):
+            return DeviceInfoCache.acquire(self, key)
+
+        key._ref_count = getattr(key, '_ref_count', 0) + 1
+        return key
+
+    def remove_device_info(self, device_info):
+        if _debug: MSTPDeviceInfoCache._debug("remove_device_info %r", device_info)
+
+        for key in (device_info.deviceIdentifier, device_info.address):
+            if self.cache.get(key) is device_info:
+                del self.cache[key]
+        device_info._cache_keys = (None, None)
+
+    def devices(self):
+        """Return the records in the order of the device instance."""
+        return sorted(
+            (device_info for key, device_info in self.cache.items() if isinstance(key, int)),
+            key=lambda device_info: device_info.deviceIdentifier,
+            )
+
+    def load(self, path=None):
+        """Add the records in the file to the cache."""
+        path = path or self.path
+        if _debug: MSTPDeviceInfoCache._debug("load %r", path)
+
+        import json
+        with open(path) as f:
+            content = json.load(f)
+        if content.get('version') != DEVICE_CACHE_VERSION:
+            raise ValueError("unknown device cache version: {!r}".format(content.get('version')))
+
+        for record in content['devices']:
+            device_info = self.device_info_class(record['deviceIdentifier'], Address(record['address']))
+            for attr in _FIELDS + ('lastSeen',):
+                setattr(device_info, attr, record.get(attr))
+            self.update_device_info(device_info)
+
+    def save(self, path=None):
+        """Write the records to the file, all at once so a crash leaves the
+        old file in place."""
+        path = path or self.path
+        if _debug: MSTPDeviceInfoCache._debug("save %r", path)
+
+        records = []
+        for device_info in self.devices():
+            record = {'deviceIdentifier': device_info.deviceIdentifier, 'address': str(device_info.address)}
+            for attr in _FIELDS + ('lastSeen',):
+                record[attr] = getattr(device_info, attr, None)
+            records.append(record)
+
+        import json
+        import tempfile
+        fd, temp_path = tempfile.mkstemp(prefix='.devices', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': DEVICE_CACHE_VERSION, 'devices': records}, f, indent=1, sort_keys=True)
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+#
+#   whois_ranges
+#
+
+def whois_ranges(low, high, count, known=()):
+    """Return up to count ranges of device instances that cover low to high,
+    with about the same number of the known instances in each one so the
+    I-Am replies are spread over the Who-Is requests, or of the same width
+    when too few are known."""
+    known = sorted(instance for instance in set(known) if low <= instance <= high)
+    count = max(1, min(count, high - low + 1))
+
+    if len(known) >= count:
+        starts = [low] + [known[(i * len(known)) // count] for i in range(1, count)]
+    else:
+        width = (high - low + 1) / float(count)
+        starts = [low + int(i * width) for i in range(count)]
+
+    # no empty ranges when instances repeat
+    starts = sorted(set(starts))
+    return [(start, end - 1) for start, end in zip(starts, starts[1:] + [high + 1])]
+
+#
+#   DeviceScan
+#
+
+@bacpypes_debugging
+class DeviceScan(DebugContents):
+
+    """A sweep of a range of device instances with ranged Who-Is requests,
+    sent one every interval without waiting for the replies of the ones
+    before.  The IOCB completes with the changes to the devices in the range
+    since the scan started, lists of device instances by kind of change.
+    The devices that did not answer are taken out of the cache when forget
+    is true, and the cache is saved when it has a file.  When none of the
+    devices the cache knows answered the IOCB aborts and the cache is left
+    alone, the trunk was more likely unreachable than empty."""
+
+    _debug_contents = ('low', 'high', 'ranges', 'interval', 'settle', 'forget')
+
+    def __init__(self, application, low=0, high=WHOIS_MAX_INSTANCE, ranges=SCAN_RANGES,
+            interval=SCAN_INTERVAL, settle=SCAN_SETTLE, forget=True, priority_class='bulk'):
+        if _debug: DeviceScan._debug("__init__ %r %r %r ranges=%r", application, low, high, ranges)
+
+        self.application = application
+        self.low = low
+        self.high = high
+        self.interval = interval
+        self.settle = settle
+        self.forget = forget
+        self.priority_class = priority_class
+        self.iocb = IOCB()
+
+        cache = application.deviceInfoCache
+        self.known = dict(
+            (device_info.deviceIdentifier, self.snapshot(device_info))
+            for device_info in cache.devices()
+            if low <= device_info.deviceIdentifier <= high
+            )
+        self.ranges = whois_ranges(low, high, ranges, self.known)
+        self.started = None
+
+    def snapshot(self, device_info):
+        return (device_info.address,) + tuple(getattr(device_info, attr, None) for attr in _FIELDS)
+
+    def start(self):
+        """Send the requests and return the IOCB."""
+        if _debug: DeviceScan._debug("start")
+
+        self.started = time.time()
+        for i, limits in enumerate(self.ranges):
+            FunctionTask(self.send, limits).install_task(delta=i * self.interval)
+        FunctionTask(self.finish).install_task(delta=(len(self.ranges) - 1) * self.interval + self.settle)
+
+        return self.iocb
+
+    def send(self, limits):
+        if _debug: DeviceScan._debug("send %r", limits)
+
+        request = WhoIsRequest()
+        request.pduDestination = GlobalBroadcast()
+        request.deviceInstanceRangeLowLimit, request.deviceInstanceRangeHighLimit = limits
+
+        self.application.request_io(IOCB(request), priority_class=self.priority_class)
+
+    def finish(self):
+        if _debug: DeviceScan._debug("finish")
+
+        cache = self.application.deviceInfoCache
+        changes = {'added': [], 'moved': [], 'changed': [], 'missing': [], 'seen': []}
+
+        devices = [device_info for device_info in cache.devices()
+            if self.low <= device_info.deviceIdentifier <= self.high]
+        answered = [device_info for device_info in devices
+            if device_info.lastSeen and (device_info.lastSeen >= self.started)]
+
+        # the requests may never have made it onto the trunk
+        if self.known and not answered:
+            self.iocb.abort(RuntimeError("no device answered, the device cache is unchanged"))
+            return
+
+        for device_info in devices:
+            instance = device_info.deviceIdentifier
+            if device_info not in answered:
+                if self.forget and (instance in self.known):
+                    cache.remove_device_info(device_info)
+                continue
+
+            changes['seen'].append(instance)
+            before = self.known.get(instance)
+            if before is None:
+                changes['added'].append(instance)
+            elif before[0] != device_info.address:
+                changes['moved'].append(instance)
+            elif before[1:] != self.snapshot(device_info)[1:]:
+                changes['changed'].append(instance)
+
+        # a device that answered with a new instance from the same address
+        # is missing under the old one too
+        changes['missing'] = sorted(set(self.known) - set(changes['seen']))
+        if _debug: DeviceScan._debug("    - changes: %r", changes)
+
+        if getattr(cache, 'path', None):
+            try:
+                cache.save()
+            except (IOError, OSError) as err:
+                DeviceScan._error("device cache not saved: %r", err)
+
+        self.iocb.complete(changes)
@@ -0,0 +1,486 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Discovery of the objects of devices.  The object list of a device is read in
+one segmented ReadProperty when both ends can segment, otherwise its length
+is read and then the entries are read in ReadPropertyMultiple batches that
+fit in the APDU the device accepts, with a few batches queued for the device
+so the next one goes as soon as the last one is answered.  Devices that do
+not know ReadPropertyMultiple are read one entry at a time.  The static
+properties asked for, like objectName and units, are read the same way a few
+objects at a time.
+
+With a metadata store the databaseRevision of the device is read first, and
+when it is the one in the store the object list and properties come from the
+store and only what is missing is read from the device.
+"""
+
+from __future__ import absolute_import
+import collections
+
+from bacpypes.debugging import bacpypes_debugging, DebugContents, ModuleLogger
+from bacpypes.iocb import IOCB, COMPLETED, ABORTED
+from bacpypes.task import FunctionTask
+from bacpypes.pdu import Address
+from bacpypes.apdu import ReadPropertyRequest, ReadPropertyACK, \
+    ReadPropertyMultipleRequest, ReadPropertyMultipleACK, \
+    ReadAccessSpecification, PropertyReference, \
+    AbortPDU, AbortReason, RejectPDU, RejectReason, ErrorPDU
+from bacpypes.primitivedata import Unsigned, ObjectIdentifier
+from bacpypes.object import get_datatype
+
+from . import MSTPQueueFull
+from .bandwidth import MSTPBandwidthExceeded
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# requests queued for each device and devices discovered at the same time
+DISCOVERY_WINDOW = 2
+DISCOVERY_DEVICES = 4
+
+# batches that may fail before the discovery of a device gives up
+DISCOVERY_RETRIES = 3
+
+# largest APDU of a device that did not say, the largest one MS/TP carries
+DISCOVERY_MAX_APDU = 480
+
+# octets of a ReadPropertyMultiple ack around the results, the header, the
+# object identifier and the tags of the list, and the octets of each result,
+# the property, an array index up to 65535 and the tagged object identifier
+RPM_ACK_OVERHEAD = 10
+RPM_ACK_ELEMENT = 12
+
+# octets of the result of a static property, a name of twenty or so
+# characters and the object identifier of its object
+RPM_ACK_PROPERTY = 32
+
+# the device says an ack would not fit
+_TOO_BIG = (AbortReason.bufferOverflow, AbortReason.segmentationNotSupported, AbortReason.apduTooLong)
+
+#
+#   rpm_batch_size
+#
+
+def rpm_batch_size(max_apdu, element=RPM_ACK_ELEMENT):
+    """Return the results of the size that fit in one unsegmented
+    ReadPropertyMultiple ack, entries of the object list by default."""
+    return max(1, (max_apdu - RPM_ACK_OVERHEAD) // element)
+
+#
+#   DeviceDiscovery
+#
+
+@bacpypes_debugging
+class DeviceDiscovery(DebugContents):
+
+    """The discovery of the objects of one device.  The IOCB completes with
+    a list of the object identifiers in the order of the object list, each
+    with a dict of the values of the properties asked for that the object
+    has, or aborts with the error of the request that could not be made.
+
+    What is read is a queue of (object identifier, property, array index)
+    items, first the entries of the object list and then the properties of
+    the objects, and the values that come back are kept by item."""
+
+    _debug_contents = ('address', 'deviceIdentifier', 'revision', 'phase',
+        'length', 'batchSize', 'useRPM', 'inflight', 'errors')
+
+    def __init__(self, engine, address, device_id):
+        if _debug: DeviceDiscovery._debug("__init__ %r %r %r", engine, address, device_id)
+
+        self.engine = engine
+        self.address = address if isinstance(address, Address) else Address(address)
+        self.deviceIdentifier = ('device', int(device_id))
+        self.iocb = IOCB()
+
+        # the database revision when the device has one and there is a store
+        self.revision = None
+
+        # items that are not asked for yet and the values that came back
+        self.phase = None
+        self.length = None
+        self.pending = collections.deque()
+        self.values = {}
+        self.objects = []
+        self.read = set()
+
+        self.inflight = 0
+        self.errors = 0
+        self.blocked = False
+        self.useRPM = True
+        self.batchSize = 1
+
+    def start(self):
+        if _debug: DeviceDiscovery._debug("start")
+
+        if self.engine.store is not None:
+            self.read_revision()
+        else:
+            self.start_list()
+
+    def read_property(self, item):
+        obj_id, prop, index = item
+        request = ReadPropertyRequest(
+            objectIdentifier=obj_id,
+            propertyIdentifier=prop,
+            )
+        if index is not None:
+            request.propertyArrayIndex = index
+        return request
+
+    def read_property_multiple(self, items):
+        # the properties of the same object go in one specification
+        specs = collections.OrderedDict()
+        for obj_id, prop, index in items:
+            specs.setdefault(obj_id, []).append(
+                PropertyReference(propertyIdentifier=prop, propertyArrayIndex=index))
+
+        return ReadPropertyMultipleRequest(listOfReadAccessSpecs=[
+            ReadAccessSpecification(objectIdentifier=obj_id, listOfPropertyReferences=references)
+            for obj_id, references in specs.items()
+            ])
+
+    def send(self, request, callback, *args):
+        if _debug: DeviceDiscovery._debug("send %r", request)
+
+        request.pduDestination = self.address
+        iocb = IOCB(request)
+        iocb.add_callback(callback, *args)
+        self.inflight += 1
+        self.engine.application.request_io(iocb, priority_class=self.engine.priority_class)
+
+    def read_revision(self):
+        if _debug: DeviceDiscovery._debug("read_revision")
+
+        self.send(self.read_property((self.deviceIdentifier, 'databaseRevision', None)), self.revision_response)
+
+    def revision_response(self, iocb):
+        if _debug: DeviceDiscovery._debug("revision_response %r", iocb)
+        self.inflight -= 1
+
+        err = iocb.ioError
+        if isinstance(err, ErrorPDU):
+            # nothing of a device without a revision can be kept
+            if _debug: DeviceDiscovery._debug("    - no revision: %r", err)
+            self.start_list()
+            return
+        elif err:
+            if self.retry(err):
+                self.later(self.read_revision, err)
+            else:
+                self.abort(err)
+            return
+
+        self.revision = iocb.ioResponse.propertyValue.cast_out(Unsigned)
+        if _debug: DeviceDiscovery._debug("    - revision: %r", self.revision)
+
+        store = self.engine.store
+        if store.check_revision(self.deviceIdentifier[1], self.revision):
+            objects = store.object_list(self.deviceIdentifier[1])
+            if objects is not None:
+                if _debug: DeviceDiscovery._debug("    - object list from the store")
+                self.start_properties(objects)
+                return
+
+        self.start_list()
+
+    def start_list(self):
+        if _debug: DeviceDiscovery._debug("start_list")
+
+        self.phase = 'list'
+        self.batchSize = rpm_batch_size(self.engine.max_apdu(self.address, self.deviceIdentifier[1]))
+
+        if self.engine.can_segment(self.address, self.deviceIdentifier[1]):
+            self.send(self.read_property((self.deviceIdentifier, 'objectList', None)), self.whole_response)
+        else:
+            self.read_length()
+
+    def whole_response(self, iocb):
+        if _debug: DeviceDiscovery._debug("whole_response %r", iocb)
+        self.inflight -= 1
+
+        if iocb.ioResponse and isinstance(iocb.ioResponse, ReadPropertyACK):
+            datatype = get_datatype('device', 'objectList')
+            self.list_done(list(iocb.ioResponse.propertyValue.cast_out(datatype)))
+            return
+
+        # the array did not come back in one piece, read it by index
+        if _debug: DeviceDiscovery._debug("    - whole read failed: %r", iocb.ioError)
+        self.read_length()
+
+    def read_length(self):
+        if _debug: DeviceDiscovery._debug("read_length")
+
+        self.send(self.read_property((self.deviceIdentifier, 'objectList', 0)), self.length_response)
+
+    def length_response(self, iocb):
+        if _debug: DeviceDiscovery._debug("length_response %r", iocb)
+        self.inflight -= 1
+
+        if iocb.ioError:
+            if self.retry(iocb.ioError):
+                self.later(self.read_length, iocb.ioError)
+            else:
+                self.abort(iocb.ioError)
+            return
+
+        self.length = iocb.ioResponse.propertyValue.cast_out(Unsigned)
+        if _debug: DeviceDiscovery._debug("    - length: %r", self.length)
+
+        self.pending.extend((self.deviceIdentifier, 'objectList', index) for index in range(1, self.length + 1))
+        self.fill()
+
+    def list_done(self, objects):
+        if _debug: DeviceDiscovery._debug("list_done %r", len(objects))
+
+        if self.revision is not None:
+            self.engine.store.set_object_list(self.deviceIdentifier[1], objects)
+        self.start_properties(objects)
+
+    def start_properties(self, objects):
+        """Queue the properties asked for that the objects have and are not
+        in the store."""
+        if _debug: DeviceDiscovery._debug("start_properties %r", len(objects))
+
+        self.phase = 'properties'
+        self.objects = objects
+        self.values = {}
+        self.batchSize = rpm_batch_size(self.engine.max_apdu(self.address, self.deviceIdentifier[1]), RPM_ACK_PROPERTY)
+
+        for obj_id in objects:
+            properties = self.engine.properties_of(obj_id[0])
+            if not properties:
+                continue
+
+            kept = {}
+            if self.revision is not None:
+                kept = self.engine.store.properties(self.deviceIdentifier[1], obj_id)
+            for prop in properties:
+                if prop in kept:
+                    self.values[(obj_id, prop, None)] = kept[prop]
+                else:
+                    self.pending.append((obj_id, prop, None))
+
+        self.read = set(self.pending)
+        self.fill()
+
+    def properties_done(self):
+        if _debug: DeviceDiscovery._debug("properties_done")
+
+        if (self.revision is not None) and self.read:
+            self.engine.store.set_properties(self.deviceIdentifier[1], dict(
+                ((obj_id, prop), self.values.get((obj_id, prop, index)))
+                for obj_id, prop, index in self.read
+                ))
+
+        objects = []
+        for obj_id in self.objects:
+            properties = {}
+            for prop in self.engine.properties_of(obj_id[0]):
+                value = self.values.get((obj_id, prop, None))
+                if value is not None:
+                    properties[prop] = value.cast_out(self.engine.datatype(obj_id[0], prop))
+            objects.append((obj_id, properties))
+
+        self.complete(objects)
+
+    def fill(self):
+        """Queue batches of the items that are left until the window of the
+        device is full."""
+        if _debug: DeviceDiscovery._debug("fill")
+
+        while self.pending and (self.inflight < self.engine.window) and not self.blocked:
+            count = self.batchSize if self.useRPM else 1
+            items = [self.pending.popleft() for i in range(min(count, len(self.pending)))]
+
+            if self.useRPM:
+                self.send(self.read_property_multiple(items), self.batch_response, items)
+            else:
+                self.send(self.read_property(items[0]), self.batch_response, items)
+
+        if self.pending or self.inflight or self.done():
+            return
+
+        if self.phase == 'list':
+            self.list_done([self.values[item].cast_out(ObjectIdentifier)
+                for item in sorted(self.values, key=lambda item: item[2])])
+        else:
+            self.properties_done()
+
+    def batch_response(self, iocb, items):
+        if _debug: DeviceDiscovery._debug("batch_response %r %r", iocb, items)
+        self.inflight -= 1
+
+        # the discovery has already failed
+        if self.done():
+            return
+
+        err = iocb.ioError
+        if isinstance(err, ErrorPDU) and (len(items) == 1) and (self.phase == 'properties'):
+            # one property of an object that does not have it
+            self.values[items[0]] = None
+
+        elif err:
+            # put the items back for the next batch
+            self.pending.extendleft(reversed(items))
+
+            if isinstance(err, RejectPDU) and (err.apduAbortRejectReason == RejectReason.unrecognizedService):
+                if _debug: DeviceDiscovery._debug("    - no ReadPropertyMultiple")
+                self.useRPM = False
+            elif isinstance(err, AbortPDU) and (err.apduAbortRejectReason in _TOO_BIG) and (len(items) > 1):
+                self.batchSize = max(1, len(items) // 2)
+                if _debug: DeviceDiscovery._debug("    - batch size: %r", self.batchSize)
+            elif self.retry(err):
+                # the next response fills the window when there is one
+                if not self.inflight or isinstance(err, (MSTPQueueFull, MSTPBandwidthExceeded)):
+                    self.later(self.fill, err)
+                return
+            else:
+                self.abort(err)
+                return
+
+        elif isinstance(iocb.ioResponse, ReadPropertyMultipleACK):
+            for result in iocb.ioResponse.listOfReadAccessResults:
+                for element in result.listOfResults:
+                    item = (result.objectIdentifier, element.propertyIdentifier, element.propertyArrayIndex)
+                    if element.readResult.propertyAccessError:
+                        if _debug: DeviceDiscovery._debug("    - error %r: %r", item, element.readResult.propertyAccessError)
+                        if self.phase == 'properties':
+                            self.values[item] = None
+                        continue
+                    self.values[item] = element.readResult.propertyValue
+
+        elif isinstance(iocb.ioResponse, ReadPropertyACK):
+            self.values[items[0]] = iocb.ioResponse.propertyValue
+
+        self.fill()
+
+    def retry(self, err):
+        """Return true when the request may be made again, not when the
+        stack has already given up on the device."""
+        if isinstance(err, (MSTPQueueFull, MSTPBandwidthExceeded)):
+            return True
+        if isinstance(err, AbortPDU) and (err.apduAbortRejectReason == AbortReason.noResponse):
+            return False
+
+        self.errors += 1
+        return self.errors <= DISCOVERY_RETRIES
+
+    def later(self, fn, err):
+        """Call the function again once the trunk has room, nothing more
+        is sent to the device until then."""
+        if self.blocked:
+            return
+        self.blocked = True
+        FunctionTask(self.unblock, fn).install_task(delta=getattr(err, 'retry_after', 0.0))
+
+    def unblock(self, fn):
+        self.blocked = False
+        if not self.done():
+            fn()
+
+    def done(self):
+        return self.iocb.ioState in (COMPLETED, ABORTED)
+
+    def complete(self, objects):
+        if _debug: DeviceDiscovery._debug("complete %r", len(objects))
+
+        self.iocb.complete(objects)
+        self.engine.device_done(self)
+
+    def abort(self, err):
+        if _debug: DeviceDiscovery._debug("abort %r", err)
+
+        self.iocb.abort(err)
+        self.engine.device_done(self)
+
+#
+#   ObjectDiscovery
+#
+
+@bacpypes_debugging
+class ObjectDiscovery:
+
+    """Discovers the objects of devices for an application, a few devices
+    at a time, and the properties of their objects that are asked for.  The
+    maximum APDU and the segmentation of a device come from the device
+    information cache of the application when it has a record of the device.
+    With a store the object lists and the properties are kept by the
+    database revision of each device."""
+
+    def __init__(self, application, window=DISCOVERY_WINDOW, devices=DISCOVERY_DEVICES, priority_class='bulk',
+            store=None, properties=()):
+        if _debug: ObjectDiscovery._debug("__init__ %r window=%r devices=%r priority_class=%r store=%r properties=%r",
+            application, window, devices, priority_class, store, properties)
+
+        self.application = application
+        self.window = window
+        self.devices = devices
+        self.priority_class = priority_class
+        self.store = store
+        self.properties = tuple(properties)
+
+        self.waiting = collections.deque()
+        self.active = []
+
+        # datatypes by object type and property, None for a property the
+        # object type does not have
+        self.datatypes = {}
+
+    def discover(self, address, device_id):
+        """Return an IOCB that completes with the object identifiers of the
+        device and the values of their properties."""
+        if _debug: ObjectDiscovery._debug("discover %r %r", address, device_id)
+
+        discovery = DeviceDiscovery(self, address, device_id)
+        self.waiting.append(discovery)
+        self.start_next()
+
+        return discovery.iocb
+
+    def start_next(self):
+        while self.waiting and (len(self.active) < self.devices):
+            discovery = self.waiting.popleft()
+            self.active.append(discovery)
+            discovery.start()
+
+    def device_done(self, discovery):
+        if _debug: ObjectDiscovery._debug("device_done %r", discovery)
+
+        if discovery in self.active:
+            self.active.remove(discovery)
+        self.start_next()
+
+    def datatype(self, object_type, prop):
+        key = (object_type, prop)
+        if key not in self.datatypes:
+            self.datatypes[key] = get_datatype(object_type, prop)
+        return self.datatypes[key]
+
+    def properties_of(self, object_type):
+        """Return the properties asked for that the object type has."""
+        return [prop for prop in self.properties if self.datatype(object_type, prop) is not None]
+
+    def device_info(self, address, device_id):
+        cache = self.application.deviceInfoCache
+        return cache.get_device_info(device_id) or cache.get_device_info(address)
+
+    def max_apdu(self, address, device_id):
+        """Return the largest APDU both ends take."""
+        device_info = self.device_info(address, device_id)
+        max_apdu = device_info.maxApduLengthAccepted if device_info else DISCOVERY_MAX_APDU
+        return min(max_apdu, self.application.localDevice.maxApduLengthAccepted or DISCOVERY_MAX_APDU)
+
+    def can_segment(self, address, device_id):
+        """Return true when the device can send a segmented ack and this
+        device can take one."""
+        device_info = self.device_info(address, device_id)
+        if not device_info:
+            return False
+
+        local = self.application.localDevice.segmentationSupported
+        return (device_info.segmentationSupported in ('segmentedBoth', 'segmentedTransmit')) \
+            and (local in ('segmentedBoth', 'segmentedReceive'))
@@ -0,0 +1,161 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Metadata of devices kept in an sqlite file between runs, the object list of
+each device and the values of static properties like objectName and units.
+Everything kept for a device is tied to its databaseRevision, when the
+revision the device reports is not the one in the file the metadata of the
+device is thrown away and read again.  Values are kept as the encoded tags
+of the property so any datatype can be stored.
+"""
+
+from __future__ import absolute_import
+import time
+import sqlite3
+import threading
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.pdu import PDU
+from bacpypes.primitivedata import TagList
+from bacpypes.constructeddata import Any
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    device INTEGER PRIMARY KEY,
+    revision INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    device INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    object_type TEXT NOT NULL,
+    object_instance INTEGER NOT NULL,
+    PRIMARY KEY (device, position)
+);
+CREATE TABLE IF NOT EXISTS properties (
+    device INTEGER NOT NULL,
+    object_type TEXT NOT NULL,
+    object_instance INTEGER NOT NULL,
+    property TEXT NOT NULL,
+    value BLOB,
+    PRIMARY KEY (device, object_type, object_instance, property)
+);
+"""
+
+#
+#   encode_value, decode_value
+#
+
+def encode_value(value):
+    """Return the octets of the tags of an Any."""
+    tag_list = TagList()
+    value.encode(tag_list)
+    pdu = PDU()
+    tag_list.encode(pdu)
+    return bytes(pdu.pduData)
+
+def decode_value(octets):
+    """Return the Any of the octets from encode_value."""
+    tag_list = TagList()
+    tag_list.decode(PDU(bytearray(octets)))
+    value = Any()
+    value.decode(tag_list)
+    return value
+
+#
+#   MSTPMetadataStore
+#
+
+@bacpypes_debugging
+class MSTPMetadataStore:
+
+    """The metadata of devices in an sqlite file, by device instance.  The
+    methods may be called from the console thread and the bacpypes thread
+    of an application."""
+
+    def __init__(self, path):
+        if _debug: MSTPMetadataStore._debug("__init__ %r", path)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(_SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def revision(self, device):
+        """Return the database revision the metadata of the device is from,
+        None when there is none."""
+        with self.lock:
+            row = self.db.execute("SELECT revision FROM devices WHERE device = ?", (device,)).fetchone()
+        return row[0] if row else None
+
+    def check_revision(self, device, revision):
+        """Return true when the metadata of the device is from the revision,
+        otherwise throw it away and start over at the revision."""
+        if _debug: MSTPMetadataStore._debug("check_revision %r %r", device, revision)
+
+        if self.revision(device) == revision:
+            return True
+
+        with self.lock, self.db:
+            for table in ('objects', 'properties'):
+                self.db.execute("DELETE FROM {} WHERE device = ?".format(table), (device,))
+            self.db.execute("INSERT OR REPLACE INTO devices (device, revision, updated) VALUES (?, ?, ?)",
+                (device, revision, time.time()))
+        return False
+
+    def forget(self, device):
+        """Throw away the metadata of the device."""
+        if _debug: MSTPMetadataStore._debug("forget %r", device)
+
+        with self.lock, self.db:
+            for table in ('devices', 'objects', 'properties'):
+                self.db.execute("DELETE FROM {} WHERE device = ?".format(table), (device,))
+
+    def object_list(self, device):
+        """Return the object identifiers of the device, None when the list
+        is not kept."""
+        with self.lock:
+            rows = self.db.execute("SELECT object_type, object_instance FROM objects "
+                "WHERE device = ? ORDER BY position", (device,)).fetchall()
+        if not rows:
+            return None
+        return [(str(object_type), object_instance) for object_type, object_instance in rows]
+
+    def set_object_list(self, device, objects):
+        if _debug: MSTPMetadataStore._debug("set_object_list %r %r", device, len(objects))
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE device = ?", (device,))
+            self.db.executemany("INSERT INTO objects (device, position, object_type, object_instance) "
+                "VALUES (?, ?, ?, ?)", [(device, position, obj_id[0], obj_id[1])
+                for position, obj_id in enumerate(objects)])
+
+    def properties(self, device, obj_id):
+        """Return the kept properties of the object, the Any of each value
+        or None for a property the object does not have."""
+        with self.lock:
+            rows = self.db.execute("SELECT property, value FROM properties "
+                "WHERE device = ? AND object_type = ? AND object_instance = ?",
+                (device, obj_id[0], obj_id[1])).fetchall()
+        return dict((str(prop), None if value is None else decode_value(value)) for prop, value in rows)
+
+    def set_properties(self, device, values):
+        """Keep the values, a dict of Any (or None) by object identifier and
+        property."""
+        if _debug: MSTPMetadataStore._debug("set_properties %r %r", device, len(values))
+
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO properties "
+                "(device, object_type, object_instance, property, value) VALUES (?, ?, ?, ?, ?)",
+                [(device, obj_id[0], obj_id[1], prop, None if value is None else sqlite3.Binary(encode_value(value)))
+                for (obj_id, prop), value in values.items()])
@@ -0,0 +1,267 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Datagram I/O for the MSTP agent socket.  Frames are received into a
+preallocated pool of slabs, so the source octet is not shifted off the
+front of the payload.  A batch is sent with the destination and lane octets
+gathered in front of each payload, a single frame is sent with them copied
+in front, which costs less than the gather for one datagram.  On Linux
+batches go through recvmmsg/sendmmsg, elsewhere they fall back to a loop of
+recv/send calls until the socket would block.
+"""
+
+from __future__ import absolute_import
+import ctypes
+import errno
+import socket
+
+from bacpypes.debugging import ModuleLogger
+
+from .priority import MSTP_LANES
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+
+# errors that mean the socket has nothing more to give or take
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+        ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+        ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _msghdr),
+        ('msg_len', ctypes.c_uint),
+        ]
+
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+    HAVE_MMSG = True
+except (OSError, AttributeError):
+    HAVE_MMSG = False
+
+# octets of the header of a frame to the agent, the MAC and the lane
+FRAME_HEADER = 2
+
+# header strings for each MAC address and lane, gathered in front of the
+# payload, the header of dest and lane is at FRAME_HEADER * (dest * MSTP_LANES + lane)
+_header_octets = bytes(bytearray(
+    octet for dest in range(256) for lane in range(MSTP_LANES) for octet in (dest, lane)
+    ))
+FRAME_HEADERS = [
+    _header_octets[i:i + FRAME_HEADER] for i in range(0, len(_header_octets), FRAME_HEADER)
+    ]
+_header_table = ctypes.create_string_buffer(_header_octets, len(_header_octets))
+
+
+def frame_header(dest, lane):
+    """Return the header of a frame to the agent."""
+    return FRAME_HEADERS[dest * MSTP_LANES + lane]
+
+
+def send_frame(sock, dest, lane, data):
+    """Send the data to the agent with the destination MAC and the lane in
+    front of it."""
+    return sock.send(frame_header(dest, lane) + data)
+
+
+def _buffer_address(data):
+    """Return a ctypes object that references the contents of data and the
+    address of the contents, the object must be kept until the call that
+    uses the address returns."""
+    if isinstance(data, bytearray):
+        ref = (ctypes.c_char * len(data)).from_buffer(data)
+        return ref, ctypes.addressof(ref)
+    else:
+        ref = ctypes.c_char_p(data)
+        return ref, ctypes.cast(ref, ctypes.c_void_p).value
+
+#
+#   SlabPool
+#
+
+class SlabPool:
+
+    def __init__(self, count, size):
+        """A preallocated buffer cut into count slabs of size octets."""
+        self.count = count
+        self.size = size
+        self.buffer = bytearray(count * size)
+
+        view = memoryview(self.buffer)
+        self.views = [view[i * size:(i + 1) * size] for i in range(count)]
+
+    def __getitem__(self, i):
+        return self.views[i]
+
+    def split(self, i, nbytes):
+        """Return the first octet of the nbytes in slab i and a bytearray
+        with the rest of them, the only allocation is the bytearray."""
+        start = i * self.size
+        return self.buffer[start], self.buffer[start + 1:start + nbytes]
+
+#
+#   BatchCounter
+#
+
+class BatchCounter:
+
+    def __init__(self, size):
+        """Count the number of datagrams handled per wakeup, the histogram
+        has a bucket for each batch size from 0 to size."""
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self.wakeups = 0
+        self.datagrams = 0
+        self.largest = 0
+        self.histogram = [0] * (self.size + 1)
+
+    def record(self, count):
+        self.wakeups += 1
+        self.datagrams += count
+        self.largest = max(self.largest, count)
+        self.histogram[min(count, self.size)] += 1
+
+    def dict_contents(self):
+        return {
+            'wakeups': self.wakeups,
+            'datagrams': self.datagrams,
+            'largest': self.largest,
+            'average': (float(self.datagrams) / self.wakeups) if self.wakeups else 0.0,
+            'histogram': list(self.histogram),
+            }
+
+#
+#   DatagramBatcher
+#
+
+class DatagramBatcher:
+
+    def __init__(self, sock, size, slabs=None):
+        """Receive and send up to size datagrams per call on sock, received
+        datagrams land in the slabs."""
+        self.sock = sock
+        self.size = size
+        self.slabs = slabs or SlabPool(size, 512)
+        if self.slabs.count < size:
+            raise ValueError("not enough slabs for the batch size")
+        self.use_mmsg = HAVE_MMSG
+
+        if self.use_mmsg:
+            # receive headers point into the slabs, built once and reused
+            self._rbufs = [
+                (ctypes.c_char * self.slabs.size).from_buffer(self.slabs.buffer, i * self.slabs.size)
+                for i in range(size)
+                ]
+            self._riov = (_iovec * size)()
+            self._rmsgs = (_mmsghdr * size)()
+            for i, buf in enumerate(self._rbufs):
+                self._riov[i].iov_base = ctypes.addressof(buf)
+                self._riov[i].iov_len = self.slabs.size
+                self._rmsgs[i].msg_hdr.msg_iov = ctypes.pointer(self._riov[i])
+                self._rmsgs[i].msg_hdr.msg_iovlen = 1
+
+            # send headers gather the frame header and the payload
+            self._siov = (_iovec * (2 * size))()
+            self._smsgs = (_mmsghdr * size)()
+            for i in range(size):
+                self._siov[2 * i].iov_len = FRAME_HEADER
+                self._smsgs[i].msg_hdr.msg_iov = ctypes.pointer(self._siov[2 * i])
+                self._smsgs[i].msg_hdr.msg_iovlen = 2
+
+    def recv(self):
+        """Receive the datagrams waiting on the socket, at most size of them,
+        without blocking.  Datagram i lands in slab i, the list of lengths is
+        returned and the slabs are only good until the next call."""
+        if not self.use_mmsg:
+            lengths = []
+            while len(lengths) < self.size:
+                slab = self.slabs[len(lengths)]
+                try:
+                    nbytes = self.sock.recv_into(slab, 0, MSG_DONTWAIT)
+                except socket.error as err:
+                    if err.args[0] in _WOULD_BLOCK:
+                        break
+                    if not lengths:
+                        raise
+                    break
+                lengths.append(nbytes)
+            return lengths
+
+        count = _recvmmsg(self.sock.fileno(), self._rmsgs, self.size, MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in _WOULD_BLOCK:
+                return []
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+
+        return [self._rmsgs[i].msg_len for i in range(count)]
+
+    def send(self, frames):
+        """Send as many of the (dest, lane, data) frames as the socket will
+        take without blocking, at most size of them, and return the number
+        sent."""
+        frames = frames[:self.size]
+        if not self.use_mmsg:
+            sent = 0
+            for dest, lane, data in frames:
+                try:
+                    send_frame(self.sock, dest, lane, data)
+                except socket.error as err:
+                    if (err.args[0] in _WOULD_BLOCK) or sent:
+                        break
+                    raise
+                sent += 1
+            return sent
+
+        # keep references to the payloads until the call returns
+        refs = []
+        table = ctypes.addressof(_header_table)
+        for i, (dest, lane, data) in enumerate(frames):
+            self._siov[2 * i].iov_base = table + FRAME_HEADER * (dest * MSTP_LANES + lane)
+            if len(data):
+                refs.append(_buffer_address(data))
+                self._siov[2 * i + 1].iov_base = refs[-1][1]
+            else:
+                self._siov[2 * i + 1].iov_base = None
+            self._siov[2 * i + 1].iov_len = len(data)
+
+        count = _sendmmsg(self.sock.fileno(), self._smsgs, len(frames), MSG_DONTWAIT)
+        del refs
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in _WOULD_BLOCK:
+                return 0
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+
+        return count
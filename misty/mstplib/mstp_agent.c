@@ -21,6 +21,7 @@ All rights reserved.
 #include <sys/socket.h>
 #include <ctype.h>
 #include <libgen.h>
+#include <sys/time.h>
 
 
 #include "mstp_agent.h"
@@ -67,6 +68,49 @@ int log_printf(const char *format, ...)
     return (ret);
 }
 
+/* called by each thread of a port once it is running */
+void port_thread_ready(port_info_t *port_info_ptr)
+{
+    pthread_mutex_lock(&port_info_ptr->ready_lock);
+    port_info_ptr->threads_ready++;
+    pthread_cond_broadcast(&port_info_ptr->ready_cond);
+    pthread_mutex_unlock(&port_info_ptr->ready_lock);
+}
+
+/* wait for the threads of a port to start, returns 0 when they are all
+   running or -1 when the timeout passes first */
+int port_wait_ready(port_info_t *port_info_ptr, int count, int timeout)
+{
+    struct timeval now;
+    struct timespec deadline;
+    int ret = 0;
+
+    gettimeofday(&now, NULL);
+    deadline.tv_sec = now.tv_sec + timeout / 1000;
+    deadline.tv_nsec = now.tv_usec * 1000 + (timeout % 1000) * 1000000;
+    if (deadline.tv_nsec >= 1000000000) {
+        deadline.tv_sec++;
+        deadline.tv_nsec -= 1000000000;
+    }
+
+    pthread_mutex_lock(&port_info_ptr->ready_lock);
+    while (port_info_ptr->threads_ready < count && ret == 0) {
+        ret = pthread_cond_timedwait(&port_info_ptr->ready_cond,
+            &port_info_ptr->ready_lock, &deadline);
+    }
+    ret = (port_info_ptr->threads_ready < count) ? -1 : 0;
+    pthread_mutex_unlock(&port_info_ptr->ready_lock);
+
+    return (ret);
+}
+
+void port_ready_init(port_info_t *port_info_ptr)
+{
+    pthread_mutex_init(&port_info_ptr->ready_lock, NULL);
+    pthread_cond_init(&port_info_ptr->ready_cond, NULL);
+    port_info_ptr->threads_ready = 0;
+}
+
 void *receiver_thread(void *arg)
 {
     uint16_t pdu_len = 0;
@@ -84,6 +128,7 @@ void *receiver_thread(void *arg)
     debug_printf("Receiver Thread started on %s port_index=%d \n",
             port_info_ptr->path,
             targ->port_index);
+    port_thread_ready(port_info_ptr);
 
     while (port_info_ptr->in_use) {
         m = (MSTP_DATA *) port_info_ptr->data_element;
@@ -98,18 +143,30 @@ void *receiver_thread(void *arg)
             m->pdu_len = pdu_len;
             m->src = src.mac[0];
 
-            buf[0] = m->src;
-            memcpy(&buf[1], m->pdu, m->pdu_len);
-
             debug_printf("received a mstp packet on %s\n",
                          port_info_ptr->path);
             debug_print_packet((unsigned char *) m->pdu, m->pdu_len);
 
+#ifdef MSTP_RING
+            if (port_info_ptr->ipc_mode == MSTP_IPC_RING) {
+                /* the frame is dropped when the ring is full */
+                if (mstp_ring_put(port_info_ptr->rx_ring, m->src,
+                                  (uint8_t *) m->pdu, m->pdu_len) < 0) {
+                    port_info_ptr->rx_dropped++;
+                }
+                continue;
+            }
+#endif
+
+            buf[0] = m->src;
+            memcpy(&buf[1], m->pdu, m->pdu_len);
+
             ret = sendto(port_info_ptr->server_info.fd, buf, (m->pdu_len + 1), 0,
                          (struct sockaddr *) &port_info_ptr->claddr,
                          sizeof(struct sockaddr_un)
                 );
             if (ret == -1) {
+                port_info_ptr->rx_dropped++;
                 perror("sendto failed");
             }
         }
@@ -151,25 +208,79 @@ void init_server_socket(char *server_path, int port_index)
 
 }
 
+static void print_histogram(const char *name, MSTP_HISTOGRAM *histogram)
+{
+    if (histogram->count == 0) {
+        return;
+    }
+    printf("%s n=%u p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms \n", name,
+        histogram->count,
+        dlmstp_histogram_percentile(histogram, 50) / 1000.0,
+        dlmstp_histogram_percentile(histogram, 90) / 1000.0,
+        dlmstp_histogram_percentile(histogram, 99) / 1000.0,
+        histogram->max / 1000.0);
+}
+
 void get_mstpstats()
 {
     port_info_t *port_info_ptr;
+    mstp_stats_t stats;
     int i;
+    int j;
 
     for (i=0;i<MAX_PORTS;i++){
         port_info_ptr = &port_info_array[i];
-        if(port_info_ptr->in_use == 0){
+        if (port_stats(i, &stats, sizeof(stats)) < 0) {
             continue;
         }
         printf("device=%s \n",port_info_ptr->dev_name);
-        printf("TokensRcvd=%d RcvErrors=%d InvalidFrames=%d ",
-            port_info_ptr->mstp_port.rt_recvd_token,
-            port_info_ptr->mstp_port.rt_recv_errors,
-            port_info_ptr->mstp_port.rt_invalid_frames);
-        printf("BytesXmitted=%d BytesRcvd=%d \n",
-            port_info_ptr->mstp_port.bytes_xmit,
-            port_info_ptr->mstp_port.bytes_rcvd
-        );
+        printf("TokensRcvd=%u RcvErrors=%u InvalidFrames=%u ",
+            stats.tokens_rcvd, stats.recv_errors, stats.invalid_frames);
+        printf("BytesXmitted=%u BytesRcvd=%u \n",
+            stats.bytes_xmit, stats.bytes_rcvd);
+        printf("FramesRcvd=");
+        for (j = 0; j < MSTP_STAT_FRAME_TYPES; j++) {
+            printf("%s%u", j ? "/" : "", stats.frames_rcvd[j]);
+        }
+        printf(" FramesSent=");
+        for (j = 0; j < MSTP_STAT_FRAME_TYPES; j++) {
+            printf("%s%u", j ? "/" : "", stats.frames_sent[j]);
+        }
+        printf(" \n");
+        printf("TokenRetries=%u LostTokens=%u ReplyTimeouts=%u ",
+            stats.token_retries, stats.lost_tokens, stats.reply_timeouts);
+        printf("RxDropped=%u TxDropped=%u \n",
+            stats.rx_dropped, stats.tx_dropped);
+        printf("PDUQueue=%u/%u HighWater=%u Full=%u \n",
+            stats.pdu_queue_length, stats.pdu_queue_depth,
+            stats.pdu_queue_high_water, stats.pdu_queue_full);
+        printf("LaneSent=");
+        for (j = 0; j < MSTP_PDU_LANES; j++) {
+            printf("%s%u", j ? "/" : "", stats.lane_sent[j]);
+        }
+        printf(" \n");
+        if (port_info_ptr->ipc_mode == MSTP_IPC_RING) {
+            printf("RxRingFull=%u RxRingWakeups=%u ",
+                stats.rx_ring_full, stats.rx_ring_wakeups);
+            printf("TxRingFull=%u TxRingWakeups=%u \n",
+                stats.tx_ring_full, stats.tx_ring_wakeups);
+        }
+        if (stats.capture_active) {
+            printf("CaptureFrames=%u CaptureDropped=%u CaptureFiles=%u \n",
+                stats.capture_frames, stats.capture_dropped,
+                stats.capture_files);
+        }
+        print_histogram("TokenRotation", &stats.token_rotation);
+        print_histogram("TokenHold", &stats.token_hold);
+        for (j = 0; j < MSTP_BROADCAST_ADDRESS; j++) {
+            MSTP_HISTOGRAM reply;
+            char name[32];
+
+            if (port_reply_latency(i, j, &reply, sizeof(reply)) > 0) {
+                snprintf(name, sizeof(name), "ReplyLatency[%d]", j);
+                print_histogram(name, &reply);
+            }
+        }
     }
 
 }
@@ -193,6 +304,7 @@ int set_interface_params(unsigned char *buf, char *dev_name, int port_index)
     log_printf("max master = %d \n", p->max_master);
     log_printf("baud rate = %d \n", p->baud_rate);
     log_printf("max info frames = %d \n", p->max_info_frames);
+    log_printf("pdu queue depth = %d \n", p->pdu_queue_depth);
 
     port_info_ptr = &port_info_array[port_index];
     port_info_ptr->mstp_port.UserData =
@@ -210,22 +322,26 @@ int set_interface_params(unsigned char *buf, char *dev_name, int port_index)
         port_info_ptr->shared_port_data.Tusage_timeout = 50;
         port_info_ptr->shared_port_data.RS485MOD = 0;
         port_info_ptr->shared_port_data.RS485MOD = CS8;
+        port_info_ptr->shared_port_data.PDU_Queue_Depth = p->pdu_queue_depth;
 
         debug_printf("device opened '%s' \n", dev_name);
 
         if (!dlmstp_init(&port_info_ptr->mstp_port, dev_name)) {
             debug_printf("MSTP %s init failed. Stop.\n", dev_name);
+            return (-1);
         }
 
-        sprintf(port_info_ptr->mstp_client_path, "%s%s",
-                port_info_ptr->server_info.LEADING_PART, path);
-        log_printf("mstp_path=%s \n", port_info_ptr->mstp_client_path);
+        if (port_info_ptr->ipc_mode == MSTP_IPC_SOCKET) {
+            sprintf(port_info_ptr->mstp_client_path, "%s%s",
+                    port_info_ptr->server_info.LEADING_PART, path);
+            log_printf("mstp_path=%s \n", port_info_ptr->mstp_client_path);
 
-        memset(&port_info_ptr->claddr, 0, sizeof(struct sockaddr_un));
-        port_info_ptr->claddr.sun_family = AF_UNIX;
-        strncpy(port_info_ptr->claddr.sun_path,
-                port_info_ptr->mstp_client_path,
-                sizeof(port_info_ptr->claddr.sun_path) - 1);
+            memset(&port_info_ptr->claddr, 0, sizeof(struct sockaddr_un));
+            port_info_ptr->claddr.sun_family = AF_UNIX;
+            strncpy(port_info_ptr->claddr.sun_path,
+                    port_info_ptr->mstp_client_path,
+                    sizeof(port_info_ptr->claddr.sun_path) - 1);
+        }
 
         strcpy(port_info_ptr->dev_name, dev_name);
         strcpy(port_info_ptr->path, path);
@@ -240,14 +356,321 @@ int set_interface_params(unsigned char *buf, char *dev_name, int port_index)
     return (0);
 }
 
+/* put a frame into the PDU queue of the state machines */
+static void queue_frame(port_info_t *port_info_ptr, unsigned char *buf, int numbytes)
+{
+    BACNET_ADDRESS target_address;
+    unsigned char dest;
+    unsigned char lane;
+
+    dest = (unsigned char) buf[0];
+    lane = (unsigned char) buf[1];
+
+    if (dest == 0xff) {
+        dlmstp_get_broadcast_address(&target_address);
+    } else {
+        target_address.mac[0] = dest;
+        target_address.mac_len = 1;
+    }
+
+    debug_printf("sending a mstp packet on %s\n", port_info_ptr->path);
+    debug_print_packet((unsigned char *) buf, numbytes);
+
+    if (dlmstp_send_pdu_lane(&port_info_ptr->mstp_port, &target_address,
+                             (uint8_t *) & buf[MSTP_FRAME_HEADER],
+                             numbytes - MSTP_FRAME_HEADER, lane) <= 0) {
+        port_info_ptr->tx_dropped++;
+    }
+}
+
+/*
+move the held frames into the lanes that have room again, the first lane
+first, returns the number of frames still held
+*/
+static int transmit_held(port_info_t *port_info_ptr)
+{
+    SHARED_MSTP_DATA *shared = &port_info_ptr->shared_port_data;
+    int held = 0;
+    int lane;
+
+    for (lane = 0; lane < MSTP_PDU_LANES; lane++) {
+        if (port_info_ptr->held_len[lane] == 0) {
+            continue;
+        }
+        if (dlmstp_pdu_lane_full(shared, lane)) {
+            held++;
+            continue;
+        }
+        queue_frame(port_info_ptr, port_info_ptr->held[lane],
+                    port_info_ptr->held_len[lane]);
+        port_info_ptr->held_len[lane] = 0;
+    }
+
+    return (held);
+}
+
+/*
+sleep until the state machines take a PDU from the queue, or until fd has
+something to read when it is not -1, returns 1 when fd is readable
+*/
+static int transmit_wait(port_info_t *port_info_ptr, int fd)
+{
+    SHARED_MSTP_DATA *shared = &port_info_ptr->shared_port_data;
+    struct pollfd pfd[2];
+    uint8_t drain[16];
+    int nfds = 1;
+    int lane;
+
+    pfd[0].fd = shared->Room_Pipe[0];
+    pfd[0].events = POLLIN;
+    pfd[0].revents = 0;
+    if (fd >= 0) {
+        pfd[1].fd = fd;
+        pfd[1].events = POLLIN;
+        pfd[1].revents = 0;
+        nfds = 2;
+    }
+
+    /* a PDU may have left before the state machines were asked to say so */
+    shared->Room_Wanted = true;
+    for (lane = 0; lane < MSTP_PDU_LANES; lane++) {
+        if (port_info_ptr->held_len[lane] &&
+            !dlmstp_pdu_lane_full(shared, lane)) {
+            shared->Room_Wanted = false;
+            return (0);
+        }
+    }
+
+    if (poll(pfd, nfds, PDU_QUEUE_FULL_WAIT) < 0 && errno != EINTR) {
+        perror("poll failed");
+    }
+    shared->Room_Wanted = false;
+    while (read(shared->Room_Pipe[0], drain, sizeof(drain)) > 0) {
+        /* one wakeup is as good as many */
+    }
+
+    return ((nfds == 2) && (pfd[1].revents & POLLIN) ? 1 : 0);
+}
+
+/*
+frame is the destination mac and the priority lane followed by the npdu, a
+frame for a lane that is full is held and the frames of the other lanes go
+on, the socket or the ring only backs up to python when a second frame
+comes for a lane that still holds one
+*/
+void transmit_frame(port_info_t *port_info_ptr, unsigned char *buf, int numbytes)
+{
+    SHARED_MSTP_DATA *shared;
+    unsigned char lane;
+
+    if (numbytes < MSTP_FRAME_HEADER) {
+        port_info_ptr->tx_dropped++;
+        log_printf("Dropping a short frame \n");
+        return;
+    }
+    lane = (unsigned char) buf[1];
+    if (lane >= MSTP_PDU_LANES) {
+        lane = MSTP_PDU_LANES - 1;
+        buf[1] = lane;
+    }
+
+    shared = &port_info_ptr->shared_port_data;
+    transmit_held(port_info_ptr);
+
+    /* the frames of a lane keep their order */
+    if (port_info_ptr->held_len[lane]) {
+        shared->PDU_Queue_Full++;
+        while (transmit_held(port_info_ptr) &&
+               port_info_ptr->held_len[lane] && port_info_ptr->in_use) {
+            transmit_wait(port_info_ptr, -1);
+        }
+        if (port_info_ptr->held_len[lane]) {
+            port_info_ptr->tx_dropped++;
+            return;
+        }
+    }
+
+    if (!dlmstp_pdu_lane_full(shared, lane)) {
+        queue_frame(port_info_ptr, buf, numbytes);
+    } else if (numbytes > MSTP_HELD_FRAME_SIZE) {
+        port_info_ptr->tx_dropped++;
+    } else {
+        shared->PDU_Queue_Full++;
+        memcpy(port_info_ptr->held[lane], buf, numbytes);
+        port_info_ptr->held_len[lane] = numbytes;
+    }
+}
+
+/*
+fill stats with the counters of the port, size is the size of the structure
+python has, returns the size that was filled or -1 for a port not in use
+*/
+int port_stats(int port_index, mstp_stats_t *stats, int size)
+{
+    mstp_stats_t s;
+    port_info_t *port_info_ptr;
+    struct mstp_port_struct_t *mstp_port;
+    SHARED_MSTP_DATA *shared;
+    int i;
+
+    if (port_index < 0 || port_index >= MAX_PORTS ||
+        port_info_array[port_index].in_use == 0 || size < 0) {
+        return (-1);
+    }
+    port_info_ptr = &port_info_array[port_index];
+    mstp_port = &port_info_ptr->mstp_port;
+    shared = &port_info_ptr->shared_port_data;
+
+    memset(&s, 0, sizeof(s));
+    s.tokens_rcvd = mstp_port->rt_recvd_token;
+    s.recv_errors = mstp_port->rt_recv_errors;
+    s.invalid_frames = mstp_port->rt_invalid_frames;
+    s.bytes_xmit = mstp_port->bytes_xmit;
+    s.bytes_rcvd = mstp_port->bytes_rcvd;
+    for (i = 0; i < MSTP_STAT_FRAME_TYPES; i++) {
+        s.frames_rcvd[i] = mstp_port->rt_frames_rcvd[i];
+        s.frames_sent[i] = mstp_port->rt_frames_sent[i];
+    }
+    s.token_retries = mstp_port->rt_token_retries;
+    s.lost_tokens = mstp_port->rt_lost_tokens;
+    s.reply_timeouts = mstp_port->rt_reply_timeouts;
+
+    s.pdu_queue_depth = shared->PDU_Queue_Depth;
+    s.pdu_queue_length = dlmstp_pdu_queue_count(shared);
+    s.pdu_queue_high_water = shared->PDU_Queue_High_Water;
+    s.pdu_queue_full = shared->PDU_Queue_Full;
+    for (i = 0; i < MSTP_PDU_LANES; i++) {
+        s.lane_sent[i] = shared->PDU_Lane_Sent[i];
+    }
+
+    s.rx_dropped = port_info_ptr->rx_dropped;
+    s.tx_dropped = port_info_ptr->tx_dropped;
+#ifdef MSTP_RING
+    if (port_info_ptr->ipc_mode == MSTP_IPC_RING) {
+        s.rx_ring_full = port_info_ptr->rx_ring->full;
+        s.rx_ring_wakeups = port_info_ptr->rx_ring->wakeups;
+        s.tx_ring_full = port_info_ptr->tx_ring->full;
+        s.tx_ring_wakeups = port_info_ptr->tx_ring->wakeups;
+    }
+#endif
+    s.token_rotation = shared->Token_Rotation;
+    s.token_hold = shared->Token_Hold;
+    s.capture_active = port_info_ptr->capture.active;
+    s.capture_frames = port_info_ptr->capture.frames;
+    s.capture_dropped = port_info_ptr->capture.dropped;
+    s.capture_files = port_info_ptr->capture.files;
+    s.capture_write_errors = port_info_ptr->capture.write_errors;
+
+    /* an older python gets the counters it knows about */
+    if (size > (int) sizeof(s)) {
+        size = sizeof(s);
+    }
+    memcpy(stats, &s, size);
+
+    return (size);
+}
+
+/*
+copies the reply latency histogram of a station to python, returns the
+number of replies in it or -1 when the port is not in use
+*/
+int port_reply_latency(int port_index, int mac, MSTP_HISTOGRAM *histogram, int size)
+{
+    MSTP_HISTOGRAM h;
+
+    if (port_index < 0 || port_index >= MAX_PORTS ||
+        port_info_array[port_index].in_use == 0 ||
+        mac < 0 || mac >= MSTP_BROADCAST_ADDRESS || size < 0) {
+        return (-1);
+    }
+    h = port_info_array[port_index].shared_port_data.Reply_Latency[mac];
+
+    if (size > (int) sizeof(h)) {
+        size = sizeof(h);
+    }
+    memcpy(histogram, &h, size);
+
+    return (h.count);
+}
+
+/*
+copies the reply latency histograms of the stations that replied to python
+in one call, the MAC address of each in macs, at most count of them and
+size is the size of the structure python has, returns the number copied or
+-1 when the port is not in use
+*/
+int port_reply_latencies(int port_index, unsigned char *macs,
+    unsigned char *histograms, int count, int size)
+{
+    SHARED_MSTP_DATA *shared;
+    int copied = 0;
+    int mac;
+
+    if (port_index < 0 || port_index >= MAX_PORTS ||
+        port_info_array[port_index].in_use == 0 || count < 0 || size < 0) {
+        return (-1);
+    }
+    shared = &port_info_array[port_index].shared_port_data;
+
+    for (mac = 0; mac < MSTP_BROADCAST_ADDRESS && copied < count; mac++) {
+        if (shared->Reply_Latency[mac].count == 0) {
+            continue;
+        }
+        macs[copied] = mac;
+        /* an older python gets the part of the histogram it knows about */
+        memcpy(histograms + copied * size, &shared->Reply_Latency[mac],
+            size < (int) sizeof(MSTP_HISTOGRAM) ? size : (int) sizeof(MSTP_HISTOGRAM));
+        copied++;
+    }
+
+    return (copied);
+}
+
+/*
+starts writing the frames of the port to a pcap file, a capture that is
+running is stopped first, the file is rotated when it gets to max_bytes
+and max_files are kept, 0 for the defaults
+*/
+int port_capture_start(int port_index, char *path, unsigned max_bytes, unsigned max_files)
+{
+    port_info_t *port_info_ptr;
+
+    if (port_index < 0 || port_index >= MAX_PORTS ||
+        port_info_array[port_index].in_use == 0 || !path) {
+        return (-1);
+    }
+    port_info_ptr = &port_info_array[port_index];
+
+    if (mstp_capture_start(&port_info_ptr->capture, path, max_bytes,
+            max_files) < 0) {
+        return (-1);
+    }
+    log_printf("capture of %s to %s \n", port_info_ptr->dev_name, path);
+
+    /* the hook stays, the capture checks whether it is running */
+    port_info_ptr->shared_port_data.Capture_Context = &port_info_ptr->capture;
+    port_info_ptr->shared_port_data.Capture_Frame = mstp_capture_frame;
+
+    return (0);
+}
+
+int port_capture_stop(int port_index)
+{
+    if (port_index < 0 || port_index >= MAX_PORTS ||
+        port_info_array[port_index].in_use == 0) {
+        return (-1);
+    }
+    mstp_capture_stop(&port_info_array[port_index].capture);
+
+    return (0);
+}
+
 void *transmit_thread(void *ptr)
 {
     unsigned int len;
     int numbytes;
     unsigned char buf[1024]; /* more than one MSTP Frame */
     struct sockaddr_un recv_addr;
-    BACNET_ADDRESS target_address;
-    unsigned char dest;
     thread_args_t *targ;
     port_info_t *port_info_ptr;
 
@@ -256,8 +679,15 @@ void *transmit_thread(void *ptr)
 
     debug_printf("Transmit thread started on port_index=%d \n",
             targ->port_index);
+    port_thread_ready(port_info_ptr);
 
     while (1) {
+        /* frames held for a full lane go as soon as there is room */
+        while (transmit_held(port_info_ptr) &&
+               !transmit_wait(port_info_ptr, port_info_ptr->server_info.fd)) {
+            /* nothing to read yet */
+        }
+
         len = sizeof(struct sockaddr_un);
 
         numbytes = recvfrom(port_info_ptr->server_info.fd, buf, sizeof(buf), 0,
@@ -274,22 +704,7 @@ void *transmit_thread(void *ptr)
             continue;
         }
 
-        dest = (unsigned char) buf[0];
-
-        if (dest == 0xff) {
-            dlmstp_get_broadcast_address(&target_address);
-        } else {
-            target_address.mac[0] = dest;
-            target_address.mac_len = 1;
-        }
-
-        debug_printf("sending a mstp packet on %s\n", port_info_ptr->path);
-        debug_print_packet((unsigned char *) buf, numbytes);
-
-        dlmstp_send_pdu(&port_info_ptr->mstp_port, &target_address,
-                        (uint8_t *) & buf[1], numbytes - 1);
-
-
+        transmit_frame(port_info_ptr, buf, numbytes);
     }
 
     return (NULL);
@@ -335,10 +750,16 @@ void start_server(char *dir_path, int port_index)
 }
 
 // mstp_lib.init(buf, interface_devname, mstp_dir)
-void init(unsigned char *buf, char *dev_name, char *mstp_dir)
+int init(unsigned char *buf, char *dev_name, char *mstp_dir)
 {
     int pindex=g_port_index;
 
+    if (pindex >= MAX_PORTS) {
+        log_printf("no ports left for %s\n", dev_name);
+        return (-1);
+    }
+    port_ready_init(&port_info_array[pindex]);
+
     /*
     start a Unix Domain Server(datagram) on mstp_dir/mstp_server
     setup a transmit thread that takes anything received on mstp_server
@@ -351,11 +772,170 @@ void init(unsigned char *buf, char *dev_name, char *mstp_dir)
     receive thread that picksup everything on the dev_name and pass it
     to mstp_dir/mstp{dev_name} which python bacpypes is listening/bound on
     */
-    set_interface_params(buf, dev_name, pindex);
+    if (set_interface_params(buf, dev_name, pindex) < 0) {
+        return (-1);
+    }
+
+    g_port_index ++;
+
+    /*
+    the server socket is bound and the port is open, return once the
+    threads are taking frames so python can start sending right away
+    */
+    if (port_wait_ready(&port_info_array[pindex], PORT_THREADS,
+                        PORT_READY_TIMEOUT) < 0) {
+        log_printf("threads did not start for %s\n", dev_name);
+        return (-1);
+    }
+
+    return (pindex);
+}
+
+#ifdef MSTP_RING
+
+void *ring_transmit_thread(void *ptr)
+{
+    int numbytes;
+    unsigned char buf[MSTP_RING_FRAME_SIZE];
+    thread_args_t *targ;
+    port_info_t *port_info_ptr;
+
+    targ = (thread_args_t *)ptr;
+    port_info_ptr = &port_info_array[targ->port_index];
+
+    debug_printf("Ring transmit thread started on port_index=%d \n",
+            targ->port_index);
+    port_thread_ready(port_info_ptr);
+
+    while (1) {
+        /* sleep until python puts a frame into an empty ring, or until
+           there is room for a frame that is held */
+        if (transmit_held(port_info_ptr)) {
+            if (transmit_wait(port_info_ptr, port_info_ptr->tx_ring->efd)) {
+                mstp_ring_wait(port_info_ptr->tx_ring, 0);
+            }
+        } else {
+            mstp_ring_wait(port_info_ptr->tx_ring, 1000);
+        }
+
+        while ((numbytes = mstp_ring_get(port_info_ptr->tx_ring, buf,
+                                         sizeof(buf))) > 0) {
+            transmit_frame(port_info_ptr, buf, numbytes);
+        }
+    }
+
+    return (NULL);
+}
+
+// mstp_lib.init_ring(buf, interface_devname, slots)
+int init_ring(unsigned char *buf, char *dev_name, int slots)
+{
+    pthread_t thread_id;
+    thread_args_t *targ;
+    int pindex=g_port_index;
+    port_info_t *port_info_ptr;
+
+    if (pindex >= MAX_PORTS) {
+        log_printf("no ports left for %s\n", dev_name);
+        return (-1);
+    }
+    port_info_ptr = &port_info_array[pindex];
+    port_ready_init(port_info_ptr);
+
+    /*
+    instead of the sockets, frames go through a pair of rings in shared
+    memory, the eventfd of the receive ring wakes up python and the one
+    of the transmit ring wakes up the transmit thread, slots only sizes
+    the receive ring
+    */
+    port_info_ptr->rx_ring = mstp_ring_create(slots);
+    port_info_ptr->tx_ring = mstp_ring_create(MSTP_RING_TX_SLOTS);
+    if (!port_info_ptr->rx_ring || !port_info_ptr->tx_ring) {
+        log_printf("ring setup failed for %s\n", dev_name);
+        return (-1);
+    }
+    port_info_ptr->ipc_mode = MSTP_IPC_RING;
+    log_printf("Initialized the rings\n");
+
+    targ = malloc(sizeof(thread_args_t));
+    targ->port_index = pindex;
+    pthread_create(&thread_id, NULL, ring_transmit_thread, targ);
+
+    if (set_interface_params(buf, dev_name, pindex) < 0) {
+        return (-1);
+    }
 
     g_port_index ++;
+
+    if (port_wait_ready(port_info_ptr, PORT_THREADS, PORT_READY_TIMEOUT) < 0) {
+        log_printf("threads did not start for %s\n", dev_name);
+        return (-1);
+    }
+
+    return (pindex);
+}
+
+/* file descriptor that is readable when frames are waiting for python */
+int ring_rx_fd(int port_index)
+{
+    return (port_info_array[port_index].rx_ring->efd);
 }
 
+/* file descriptor that is readable when the transmit ring that was full
+   has room again */
+int ring_tx_room_fd(int port_index)
+{
+    return (port_info_array[port_index].tx_ring->room_efd);
+}
+
+/* frames the transmit ring has room for, when it has none the room eventfd
+   is signalled once it does */
+int ring_tx_room(int port_index)
+{
+    return (mstp_ring_room(port_info_array[port_index].tx_ring));
+}
+
+/* copy the next frame, source mac and npdu, into buf and return the length
+   of it or 0 when there is none */
+int ring_recv(int port_index, unsigned char *buf, int size)
+{
+    return (mstp_ring_get(port_info_array[port_index].rx_ring, buf, size));
+}
+
+/* copy as many as count frames into buf, one every size octets with its
+   length in lens, and return the number of frames */
+int ring_recv_many(int port_index, unsigned char *buf, int size,
+                   unsigned short *lens, int count)
+{
+    return (mstp_ring_get_many(port_info_array[port_index].rx_ring, buf, size,
+                               lens, count));
+}
+
+/* queue a frame for dest in a priority lane, returns -1 when the ring is
+   full */
+int ring_send(int port_index, int dest, int lane, unsigned char *pdu,
+              int pdu_len)
+{
+    uint8_t header[MSTP_FRAME_HEADER];
+
+    header[0] = dest;
+    header[1] = lane;
+    return (mstp_ring_put_header(port_info_array[port_index].tx_ring, header,
+                                 sizeof(header), pdu, pdu_len));
+}
+
+/* queue as many as count frames that follow each other in buf, each one
+   the dest and lane octets and the npdu with its length in lens, and return
+   the number of frames the ring took, frames that are too big are dropped */
+int ring_send_many(int port_index, unsigned char *buf, unsigned short *lens,
+                   int count)
+{
+    return (mstp_ring_put_many(port_info_array[port_index].tx_ring, buf, lens,
+                               count));
+}
+
+#endif
+
 #if TEST_BIN
 
 void usage(char **argv)
@@ -405,7 +985,9 @@ int main(int argc, char **argv)
     param.max_master = 127;
     param.baud_rate = baudrate;
     param.max_info_frames = 1;
+    param.pdu_queue_depth = 0;
 
+    port_ready_init(&port_info_array[pindex]);
     set_interface_params((unsigned char *)&param, interface, pindex);
 
     while(1){
@@ -6,17 +6,24 @@ All rights reserved.
 #ifndef MSTP_AGENT_H
 #define MSTP_AGENT_H
 
+#include <pthread.h>
+
 #include "bacdef.h"
 #include "npdu.h"
 
 #include "dlmstp_linux.h"
 #include "ringbuf.h"
+#include "mstp_capture.h"
+#ifdef MSTP_RING
+#include "mstp_ring.h"
+#endif
 
 struct set_params {
     int mac_address;
     int max_master;
     int baud_rate;
     int max_info_frames;
+    int pdu_queue_depth;    /* 0 for MSTP_PDU_PACKET_COUNT */
 };
 
 typedef struct mstp_data {
@@ -27,6 +34,61 @@ typedef struct mstp_data {
 
 #define MAX_PORTS 10
 
+/* threads of a port that init waits for, the receiver and the transmitter */
+#define PORT_THREADS 2
+
+/* milliseconds init waits for the threads of a port to start */
+#define PORT_READY_TIMEOUT 5000
+
+/* milliseconds the transmitter sleeps at most while it waits for room in
+   a lane, it is woken up as soon as a PDU leaves the queue */
+#define PDU_QUEUE_FULL_WAIT 100
+
+/* octets in front of the npdu of a frame to send, the mac and the lane */
+#define MSTP_FRAME_HEADER 2
+
+/* octets of a frame held for a lane that is full */
+#define MSTP_HELD_FRAME_SIZE (MAX_MPDU + MSTP_FRAME_HEADER)
+
+/* how frames are passed between the agent and python */
+#define MSTP_IPC_SOCKET 0
+#define MSTP_IPC_RING 1
+
+/*
+the counters of a port as python reads them, MSTPStats in stats.py has the
+same layout, new counters go at the end
+*/
+typedef struct mstp_stats {
+    uint32_t tokens_rcvd;
+    uint32_t recv_errors;
+    uint32_t invalid_frames;
+    uint32_t bytes_xmit;
+    uint32_t bytes_rcvd;
+    uint32_t frames_rcvd[MSTP_STAT_FRAME_TYPES];
+    uint32_t frames_sent[MSTP_STAT_FRAME_TYPES];
+    uint32_t token_retries;
+    uint32_t lost_tokens;
+    uint32_t reply_timeouts;
+    uint32_t pdu_queue_depth;
+    uint32_t pdu_queue_length;
+    uint32_t pdu_queue_high_water;
+    uint32_t pdu_queue_full;
+    uint32_t lane_sent[MSTP_PDU_LANES];
+    uint32_t rx_dropped;        /* frames python did not take */
+    uint32_t tx_dropped;        /* frames from python that were not queued */
+    uint32_t rx_ring_full;
+    uint32_t rx_ring_wakeups;
+    uint32_t tx_ring_full;
+    uint32_t tx_ring_wakeups;
+    MSTP_HISTOGRAM token_rotation;
+    MSTP_HISTOGRAM token_hold;
+    uint32_t capture_active;
+    uint32_t capture_frames;
+    uint32_t capture_dropped;   /* frames that found the capture ring full */
+    uint32_t capture_files;
+    uint32_t capture_write_errors;
+} mstp_stats_t;
+
 typedef struct server_information {
     int fd;
     char LEADING_PART[1024];
@@ -42,10 +104,35 @@ typedef struct port_info {
     char mstp_client_path[1024];
     uint8_t data_element[sizeof(MSTP_DATA)];
     server_info_t server_info;
+    int ipc_mode;
+    /* the threads of the port check in here once they are running */
+    pthread_mutex_t ready_lock;
+    pthread_cond_t ready_cond;
+    int threads_ready;
+    /* frames dropped on the way to and from python */
+    unsigned rx_dropped;
+    unsigned tx_dropped;
+    /* a frame for each lane that found it full, held while the frames of
+       the other lanes go on */
+    unsigned char held[MSTP_PDU_LANES][MSTP_HELD_FRAME_SIZE];
+    int held_len[MSTP_PDU_LANES];
+    /* pcap capture of the frames on the wire */
+    mstp_capture_t capture;
+#ifdef MSTP_RING
+    mstp_ring_t *rx_ring;   /* agent to python */
+    mstp_ring_t *tx_ring;   /* python to agent */
+#endif
 } port_info_t;
 
 
 
 // Proto types
 void *transmit_thread(void *ptr);
+void transmit_frame(port_info_t *port_info_ptr, unsigned char *buf, int numbytes);
+int port_stats(int port_index, mstp_stats_t *stats, int size);
+int port_reply_latency(int port_index, int mac, MSTP_HISTOGRAM *histogram, int size);
+int port_reply_latencies(int port_index, unsigned char *macs,
+    unsigned char *histograms, int count, int size);
+int port_capture_start(int port_index, char *path, unsigned max_bytes, unsigned max_files);
+int port_capture_stop(int port_index);
 #endif
@@ -0,0 +1,261 @@
+/*
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+*/
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <time.h>
+#include <unistd.h>
+
+#include "mstp_capture.h"
+
+/*
+The threads of the state machine only copy the frame into the ring, the
+clock is read with clock_gettime() and nothing in mstp_capture_frame()
+makes a system call, so a capture does not move the turnaround of the
+port.  The writer publishes tail after it has written a record and the
+producers publish head after they have filled one.
+*/
+
+static uint64_t capture_clock(clockid_t clock)
+{
+    struct timespec now;
+
+    clock_gettime(clock, &now);
+    return ((uint64_t) now.tv_sec * 1000000000) + now.tv_nsec;
+}
+
+static int capture_write(mstp_capture_t * capture, const void *data,
+    size_t size)
+{
+    if (fwrite(data, size, 1, capture->file) != 1) {
+        capture->write_errors++;
+        return (-1);
+    }
+    capture->file_bytes += size;
+
+    return (0);
+}
+
+static int capture_open(mstp_capture_t * capture)
+{
+    uint32_t magic_number = PCAP_MAGIC_NSEC;
+    uint16_t version_major = 2;
+    uint16_t version_minor = 4;
+    int32_t thiszone = 0;
+    uint32_t sigfigs = 0;
+    uint32_t snaplen = MSTP_CAPTURE_FRAME_SIZE;
+    uint32_t network = DLT_BACNET_MS_TP;
+
+    capture->file = fopen(capture->path, "wb");
+    if (!capture->file) {
+        fprintf(stderr, "capture: failed to open %s: %s\n", capture->path,
+            strerror(errno));
+        return (-1);
+    }
+    capture->file_bytes = 0;
+    capture->files++;
+
+    capture_write(capture, &magic_number, sizeof(magic_number));
+    capture_write(capture, &version_major, sizeof(version_major));
+    capture_write(capture, &version_minor, sizeof(version_minor));
+    capture_write(capture, &thiszone, sizeof(thiszone));
+    capture_write(capture, &sigfigs, sizeof(sigfigs));
+    capture_write(capture, &snaplen, sizeof(snaplen));
+    capture_write(capture, &network, sizeof(network));
+
+    return (0);
+}
+
+/* the file being written is path, the older ones path.1 to path.N-1 */
+static int capture_rotate(mstp_capture_t * capture)
+{
+    char older[sizeof(capture->path) + 16];
+    char newer[sizeof(capture->path) + 16];
+    unsigned i;
+
+    fclose(capture->file);
+    capture->file = NULL;
+
+    for (i = capture->max_files - 1; i > 0; i--) {
+        snprintf(older, sizeof(older), "%s.%u", capture->path, i);
+        if (i == 1) {
+            snprintf(newer, sizeof(newer), "%s", capture->path);
+        } else {
+            snprintf(newer, sizeof(newer), "%s.%u", capture->path, i - 1);
+        }
+        rename(newer, older);
+    }
+
+    return capture_open(capture);
+}
+
+static void capture_write_record(mstp_capture_t * capture,
+    mstp_capture_record_t * record)
+{
+    uint64_t nsec = record->nsec + capture->realtime_offset;
+    uint32_t header[4];
+
+    if (!capture->file) {
+        return;
+    }
+    if (capture->file_bytes + sizeof(header) + record->length >
+        capture->max_bytes && capture->file_bytes > 24) {
+        if (capture_rotate(capture) < 0) {
+            return;
+        }
+    }
+
+    header[0] = (uint32_t) (nsec / 1000000000);
+    header[1] = (uint32_t) (nsec % 1000000000);
+    header[2] = record->length;
+    header[3] = record->original_length;
+    if (capture_write(capture, header, sizeof(header)) == 0) {
+        capture_write(capture, record->frame, record->length);
+    }
+}
+
+static void *capture_writer_thread(void *arg)
+{
+    mstp_capture_t *capture = (mstp_capture_t *) arg;
+    struct timespec interval;
+    uint32_t head, tail;
+    int stopping;
+
+    interval.tv_sec = 0;
+    interval.tv_nsec = MSTP_CAPTURE_FLUSH_MS * 1000000L;
+
+    for (;;) {
+        /* once stopping is seen the producers are done, empty the ring */
+        stopping = __atomic_load_n(&capture->stopping, __ATOMIC_ACQUIRE);
+
+        head = __atomic_load_n(&capture->head, __ATOMIC_ACQUIRE);
+        tail = capture->tail;
+        while (tail != head) {
+            capture_write_record(capture,
+                &capture->records[tail & (MSTP_CAPTURE_SLOTS - 1)]);
+            tail++;
+            __atomic_store_n(&capture->tail, tail, __ATOMIC_RELEASE);
+        }
+        if (capture->file) {
+            fflush(capture->file);
+        }
+
+        if (stopping) {
+            break;
+        }
+        nanosleep(&interval, NULL);
+    }
+
+    return NULL;
+}
+
+int mstp_capture_start(mstp_capture_t * capture, const char *path,
+    unsigned max_bytes, unsigned max_files)
+{
+    mstp_capture_stop(capture);
+
+    /* the ring is allocated the first time and kept */
+    if (!capture->records) {
+        capture->records =
+            calloc(MSTP_CAPTURE_SLOTS, sizeof(mstp_capture_record_t));
+        if (!capture->records) {
+            perror("capture: calloc failed");
+            return (-1);
+        }
+        pthread_mutex_init(&capture->put_lock, NULL);
+    }
+
+    snprintf(capture->path, sizeof(capture->path), "%s", path);
+    capture->max_bytes = max_bytes ? max_bytes : MSTP_CAPTURE_MAX_BYTES;
+    capture->max_files = max_files ? max_files : MSTP_CAPTURE_MAX_FILES;
+    capture->files = 0;
+    if (capture_open(capture) < 0) {
+        return (-1);
+    }
+
+    pthread_mutex_lock(&capture->put_lock);
+    capture->head = 0;
+    capture->tail = 0;
+    capture->frames = 0;
+    capture->dropped = 0;
+    capture->write_errors = 0;
+    capture->stopping = 0;
+    capture->realtime_offset =
+        (int64_t) capture_clock(CLOCK_REALTIME) -
+        (int64_t) capture_clock(CLOCK_MONOTONIC);
+    pthread_mutex_unlock(&capture->put_lock);
+
+    if (pthread_create(&capture->writer, NULL, capture_writer_thread,
+            capture) != 0) {
+        perror("capture: pthread_create failed");
+        fclose(capture->file);
+        capture->file = NULL;
+        return (-1);
+    }
+    __atomic_store_n(&capture->active, 1, __ATOMIC_RELEASE);
+
+    return (0);
+}
+
+void mstp_capture_stop(mstp_capture_t * capture)
+{
+    if (!__atomic_load_n(&capture->active, __ATOMIC_ACQUIRE)) {
+        return;
+    }
+    __atomic_store_n(&capture->active, 0, __ATOMIC_RELEASE);
+
+    /* wait for a frame that is being put, then let the writer finish */
+    pthread_mutex_lock(&capture->put_lock);
+    __atomic_store_n(&capture->stopping, 1, __ATOMIC_RELEASE);
+    pthread_mutex_unlock(&capture->put_lock);
+    pthread_join(capture->writer, NULL);
+
+    if (capture->file) {
+        fclose(capture->file);
+        capture->file = NULL;
+    }
+}
+
+/* the Capture_Frame hook of the port, called from the state machines */
+void mstp_capture_frame(void *context, uint8_t * frame, unsigned length,
+    unsigned original_length)
+{
+    mstp_capture_t *capture = (mstp_capture_t *) context;
+    mstp_capture_record_t *record;
+    uint64_t nsec;
+    uint32_t head;
+
+    if (!__atomic_load_n(&capture->active, __ATOMIC_ACQUIRE)) {
+        return;
+    }
+    nsec = capture_clock(CLOCK_MONOTONIC);
+    if (length > MSTP_CAPTURE_FRAME_SIZE) {
+        length = MSTP_CAPTURE_FRAME_SIZE;
+    }
+
+    pthread_mutex_lock(&capture->put_lock);
+    head = capture->head;
+    if (capture->stopping) {
+        pthread_mutex_unlock(&capture->put_lock);
+        return;
+    }
+    if (head - __atomic_load_n(&capture->tail,
+            __ATOMIC_ACQUIRE) >= MSTP_CAPTURE_SLOTS) {
+        capture->dropped++;
+        pthread_mutex_unlock(&capture->put_lock);
+        return;
+    }
+    record = &capture->records[head & (MSTP_CAPTURE_SLOTS - 1)];
+    record->nsec = nsec;
+    record->length = length;
+    record->original_length =
+        original_length > length ? original_length : length;
+    memcpy(record->frame, frame, length);
+    __atomic_store_n(&capture->head, head + 1, __ATOMIC_RELEASE);
+    capture->frames++;
+    pthread_mutex_unlock(&capture->put_lock);
+}
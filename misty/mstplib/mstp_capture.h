@@ -0,0 +1,71 @@
+/*
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+*/
+
+#ifndef MSTP_CAPTURE_H
+#define MSTP_CAPTURE_H
+
+#include <stdio.h>
+#include <stdint.h>
+#include <pthread.h>
+
+#include "bacdef.h"
+#include "dlmstp_linux.h"
+
+/* frames that can wait for the writer, a power of two */
+#define MSTP_CAPTURE_SLOTS 1024
+
+/* milliseconds the writer sleeps between passes over the ring */
+#define MSTP_CAPTURE_FLUSH_MS 100
+
+/* file size and number of files kept when they are not given */
+#define MSTP_CAPTURE_MAX_BYTES (16 * 1024 * 1024)
+#define MSTP_CAPTURE_MAX_FILES 4
+
+/* a whole frame, the preamble and header, the data and its CRC */
+#define MSTP_CAPTURE_FRAME_SIZE (MAX_HEADER + MAX_MPDU)
+
+/* pcap with nanosecond timestamps and the MS/TP link type */
+#define PCAP_MAGIC_NSEC 0xa1b23c4d
+#define DLT_BACNET_MS_TP 165
+
+typedef struct mstp_capture_record {
+    uint64_t nsec;              /* CLOCK_MONOTONIC */
+    uint16_t length;            /* octets in frame */
+    uint16_t original_length;   /* octets on the wire */
+    uint8_t frame[MSTP_CAPTURE_FRAME_SIZE];
+} mstp_capture_record_t;
+
+/*
+frames from the state machine threads go into a ring that is allocated
+once, they take turns through put_lock and never wait for the disk, a
+writer thread empties the ring into the pcap file
+*/
+typedef struct mstp_capture {
+    mstp_capture_record_t *records;
+    pthread_mutex_t put_lock;
+    uint32_t head;              /* next record to fill */
+    uint32_t tail;              /* next record to write */
+    int active;
+    int stopping;
+    pthread_t writer;
+    FILE *file;
+    char path[1024];
+    uint32_t max_bytes;
+    uint32_t max_files;
+    uint64_t file_bytes;
+    int64_t realtime_offset;    /* CLOCK_REALTIME - CLOCK_MONOTONIC in ns */
+    uint32_t frames;            /* frames put in the ring */
+    uint32_t dropped;           /* frames that found the ring full */
+    uint32_t files;             /* files started */
+    uint32_t write_errors;
+} mstp_capture_t;
+
+int mstp_capture_start(mstp_capture_t * capture, const char *path,
+    unsigned max_bytes, unsigned max_files);
+void mstp_capture_stop(mstp_capture_t * capture);
+void mstp_capture_frame(void *context, uint8_t * frame, unsigned length,
+    unsigned original_length);
+
+#endif
@@ -0,0 +1,294 @@
+/*
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+*/
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <poll.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/eventfd.h>
+
+#include "mstp_ring.h"
+
+/*
+The producer publishes head and then looks at tail, the consumer publishes
+tail and then looks at head.  Both sides go through a full fence in between
+so at least one of them sees the other, either the consumer finds the new
+frame before it goes to sleep or the producer finds the ring was empty and
+signals the eventfd.  Room works the same way the other way around, the
+producer that finds the ring full publishes room_wanted and then looks at
+tail again, the consumer publishes tail and then looks at room_wanted.  The
+producer is only woken up once half of the ring is free, so it has room for
+a batch of frames rather than one.
+*/
+
+/* the consumer took frames up to tail, wake up a producer that waits for
+   room */
+static void mstp_ring_taken(mstp_ring_t * ring, uint32_t tail)
+{
+    uint64_t one = 1;
+
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+    if (__atomic_load_n(&ring->room_wanted, __ATOMIC_ACQUIRE)
+        && (__atomic_load_n(&ring->head, __ATOMIC_ACQUIRE) - tail <= ring->slots / 2)) {
+        __atomic_store_n(&ring->room_wanted, 0, __ATOMIC_RELEASE);
+        if (write(ring->room_efd, &one, sizeof(one)) == -1 && errno != EAGAIN) {
+            perror("eventfd write failed");
+        }
+    }
+}
+
+/* the producer found the ring full, return the room there is now that the
+   consumer knows it is wanted */
+static unsigned mstp_ring_want_room(mstp_ring_t * ring, uint32_t head)
+{
+    __atomic_store_n(&ring->room_wanted, 1, __ATOMIC_RELEASE);
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+    return ring->slots - (head - __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE));
+}
+
+mstp_ring_t *mstp_ring_create(unsigned slots)
+{
+    mstp_ring_t *ring;
+    size_t size;
+    unsigned n = 1;
+
+    if (slots == 0) {
+        slots = MSTP_RING_SLOTS;
+    }
+    while (n < slots) {
+        n <<= 1;
+    }
+
+    size = sizeof(mstp_ring_t) + n * sizeof(mstp_ring_slot_t);
+    ring = mmap(NULL, size, PROT_READ | PROT_WRITE,
+        MAP_SHARED | MAP_ANONYMOUS, -1, 0);
+    if (ring == MAP_FAILED) {
+        perror("mmap failed");
+        return NULL;
+    }
+
+    ring->head = 0;
+    ring->tail = 0;
+    ring->slots = n;
+    ring->full = 0;
+    ring->wakeups = 0;
+    ring->room_wanted = 0;
+    ring->efd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    ring->room_efd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    if (ring->efd == -1 || ring->room_efd == -1) {
+        perror("eventfd failed");
+        if (ring->efd != -1) {
+            close(ring->efd);
+        }
+        if (ring->room_efd != -1) {
+            close(ring->room_efd);
+        }
+        munmap(ring, size);
+        return NULL;
+    }
+
+    return ring;
+}
+
+void mstp_ring_destroy(mstp_ring_t * ring)
+{
+    close(ring->efd);
+    close(ring->room_efd);
+    munmap(ring, sizeof(mstp_ring_t) + ring->slots * sizeof(mstp_ring_slot_t));
+}
+
+int mstp_ring_put(mstp_ring_t * ring, uint8_t mac, const uint8_t * pdu,
+    unsigned pdu_len)
+{
+    return (mstp_ring_put_header(ring, &mac, 1, pdu, pdu_len));
+}
+
+int mstp_ring_put_header(mstp_ring_t * ring, const uint8_t * header,
+    unsigned header_len, const uint8_t * pdu, unsigned pdu_len)
+{
+    uint32_t head, tail;
+    mstp_ring_slot_t *slot;
+    uint64_t one = 1;
+
+    if (header_len + pdu_len > MSTP_RING_FRAME_SIZE) {
+        ring->full++;
+        return -1;
+    }
+
+    head = ring->head;
+    tail = __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE);
+    if ((head - tail == ring->slots) && !mstp_ring_want_room(ring, head)) {
+        ring->full++;
+        return -1;
+    }
+
+    slot = &ring->slot[head & (ring->slots - 1)];
+    memcpy(&slot->frame[0], header, header_len);
+    memcpy(&slot->frame[header_len], pdu, pdu_len);
+    slot->len = header_len + pdu_len;
+
+    __atomic_store_n(&ring->head, head + 1, __ATOMIC_RELEASE);
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+
+    /* only the first frame into an empty ring wakes the consumer */
+    if (__atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE) == head) {
+        ring->wakeups++;
+        if (write(ring->efd, &one, sizeof(one)) == -1 && errno != EAGAIN) {
+            perror("eventfd write failed");
+        }
+    }
+
+    return 0;
+}
+
+int mstp_ring_get(mstp_ring_t * ring, uint8_t * buf, unsigned size)
+{
+    uint32_t head, tail;
+    mstp_ring_slot_t *slot;
+    unsigned len;
+
+    tail = ring->tail;
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+    head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+    if (head == tail) {
+        return 0;
+    }
+
+    slot = &ring->slot[tail & (ring->slots - 1)];
+    len = slot->len;
+    if (len > size) {
+        len = size;
+    }
+    memcpy(buf, slot->frame, len);
+
+    __atomic_store_n(&ring->tail, tail + 1, __ATOMIC_RELEASE);
+    mstp_ring_taken(ring, tail + 1);
+
+    return len;
+}
+
+/* copy as many as count frames into buf, each at a stride of size octets
+   with its length in lens, and return the number of frames; the consumer
+   publishes the new tail once for all of them */
+int mstp_ring_get_many(mstp_ring_t * ring, uint8_t * buf, unsigned size,
+    uint16_t * lens, unsigned count)
+{
+    uint32_t head, tail;
+    mstp_ring_slot_t *slot;
+    unsigned i, len;
+
+    tail = ring->tail;
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+    head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+    if (head - tail < count) {
+        count = head - tail;
+    }
+
+    for (i = 0; i < count; i++) {
+        slot = &ring->slot[(tail + i) & (ring->slots - 1)];
+        len = slot->len;
+        if (len > size) {
+            len = size;
+        }
+        memcpy(&buf[i * size], slot->frame, len);
+        lens[i] = len;
+    }
+
+    if (count) {
+        __atomic_store_n(&ring->tail, tail + count, __ATOMIC_RELEASE);
+        mstp_ring_taken(ring, tail + count);
+    }
+
+    return count;
+}
+
+/* put as many as count frames that follow each other in buf, with their
+   lengths in lens, and return the number of frames taken, the ones too big
+   for a slot are dropped; the producer publishes the new head and wakes the
+   consumer once for all of them */
+int mstp_ring_put_many(mstp_ring_t * ring, const uint8_t * buf,
+    const uint16_t * lens, unsigned count)
+{
+    uint32_t head, tail;
+    mstp_ring_slot_t *slot;
+    unsigned i, n, room;
+    uint64_t one = 1;
+
+    head = ring->head;
+    tail = __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE);
+    room = ring->slots - (head - tail);
+    if (room < count) {
+        room = mstp_ring_want_room(ring, head);
+    }
+    if (room < count) {
+        ring->full++;
+    }
+
+    for (i = n = 0; (i < count) && (n < room); i++) {
+        if (lens[i] > MSTP_RING_FRAME_SIZE) {
+            ring->full++;
+        } else {
+            slot = &ring->slot[(head + n) & (ring->slots - 1)];
+            memcpy(slot->frame, buf, lens[i]);
+            slot->len = lens[i];
+            n++;
+        }
+        buf += lens[i];
+    }
+    if (!n) {
+        return i;
+    }
+
+    __atomic_store_n(&ring->head, head + n, __ATOMIC_RELEASE);
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+
+    /* only frames into an empty ring wake the consumer */
+    if (__atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE) == head) {
+        ring->wakeups++;
+        if (write(ring->efd, &one, sizeof(one)) == -1 && errno != EAGAIN) {
+            perror("eventfd write failed");
+        }
+    }
+
+    return i;
+}
+
+/* return the frames the producer can put, when there is no room the
+   consumer signals the room eventfd once half of the ring is free */
+int mstp_ring_room(mstp_ring_t * ring)
+{
+    uint32_t head;
+    unsigned room;
+
+    head = ring->head;
+    room = ring->slots - (head - __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE));
+    if (room == 0) {
+        room = mstp_ring_want_room(ring, head);
+    }
+
+    return room;
+}
+
+int mstp_ring_wait(mstp_ring_t * ring, int timeout)
+{
+    struct pollfd pfd;
+    uint64_t count;
+    int ret;
+
+    pfd.fd = ring->efd;
+    pfd.events = POLLIN;
+
+    ret = poll(&pfd, 1, timeout);
+    if (ret > 0) {
+        if (read(ring->efd, &count, sizeof(count)) == -1 && errno != EAGAIN) {
+            perror("eventfd read failed");
+        }
+    }
+
+    return ret;
+}
@@ -0,0 +1,63 @@
+/*
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+*/
+
+#ifndef MSTP_RING_H
+#define MSTP_RING_H
+
+#include <stdint.h>
+
+#include "bacdef.h"
+#include "dlmstp_linux.h"
+
+/* default number of frames in each direction */
+#define MSTP_RING_SLOTS 64
+
+/* frames in the ring from python, few of them so a frame of a higher lane
+   does not wait behind many of a lower one before the agent sorts them into
+   their lanes */
+#define MSTP_RING_TX_SLOTS 8
+
+/* a frame is the mac octet, and the lane octet going to the agent,
+   followed by the npdu */
+#define MSTP_RING_FRAME_SIZE (MAX_MPDU + 2)
+
+typedef struct mstp_ring_slot {
+    uint16_t len;
+    uint8_t frame[MSTP_RING_FRAME_SIZE];
+} mstp_ring_slot_t;
+
+/*
+single producer, single consumer ring of frames in a shared mapping, the
+eventfd is signalled when the producer puts a frame into an empty ring and
+the room eventfd when the consumer takes frames out of a ring the producer
+found full
+*/
+typedef struct mstp_ring {
+    uint32_t head __attribute__ ((aligned(64)));   /* written by the producer */
+    uint32_t tail __attribute__ ((aligned(64)));   /* written by the consumer */
+    uint32_t slots __attribute__ ((aligned(64)));  /* a power of two */
+    uint32_t full;          /* puts that found no room, drops or retries */
+    uint32_t wakeups;       /* times the eventfd was signalled */
+    uint32_t room_wanted;   /* the producer waits for room */
+    int efd;
+    int room_efd;
+    mstp_ring_slot_t slot[];
+} mstp_ring_t;
+
+mstp_ring_t *mstp_ring_create(unsigned slots);
+void mstp_ring_destroy(mstp_ring_t * ring);
+int mstp_ring_put(mstp_ring_t * ring, uint8_t mac, const uint8_t * pdu,
+    unsigned pdu_len);
+int mstp_ring_put_header(mstp_ring_t * ring, const uint8_t * header,
+    unsigned header_len, const uint8_t * pdu, unsigned pdu_len);
+int mstp_ring_get(mstp_ring_t * ring, uint8_t * buf, unsigned size);
+int mstp_ring_get_many(mstp_ring_t * ring, uint8_t * buf, unsigned size,
+    uint16_t * lens, unsigned count);
+int mstp_ring_put_many(mstp_ring_t * ring, const uint8_t * buf,
+    const uint16_t * lens, unsigned count);
+int mstp_ring_room(mstp_ring_t * ring);
+int mstp_ring_wait(mstp_ring_t * ring, int timeout);
+
+#endif
@@ -0,0 +1,344 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Continuous polling of points, a property of an object of a device each, at
+an interval of their own.  The points of a device with the same interval
+are a group that is read together, and the groups wait in a heap by the
+time they are due.  Each group starts at a random phase of its interval and
+moves by a little jitter every time, so groups with the same interval on
+different devices do not come due at once.
+
+The reads of the groups of a device that are due go to the application in
+the same pass of the event loop, where they are merged into as few
+ReadPropertyMultiple requests as fit (see misty.mstplib.coalesce).  A few
+devices are read at a time and a device that is done goes to the back of
+the line, so a device with many points does not hold up the rest.  How late
+the groups are read is kept, and a warning is logged when the trunk cannot
+keep up and whole intervals are missed.
+"""
+
+from __future__ import absolute_import
+import time
+import heapq
+import random
+import itertools
+import collections
+
+from bacpypes.debugging import bacpypes_debugging, DebugContents, ModuleLogger
+from bacpypes.iocb import IOCB
+from bacpypes.task import FunctionTask
+from bacpypes.pdu import Address
+from bacpypes.apdu import ReadPropertyRequest
+from bacpypes.primitivedata import Unsigned
+from bacpypes.constructeddata import Array
+from bacpypes.object import get_datatype
+
+from .priority import LatencyStats
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# devices read at the same time
+POLL_DEVICES = 8
+
+# the most a deadline moves at random each interval, a fraction of it
+POLL_JITTER = 0.05
+
+# seconds between the warnings that the polling is behind
+POLL_WARN_INTERVAL = 60.0
+
+#
+#   PollPoint
+#
+
+class PollPoint(DebugContents):
+
+    """A property of an object of a device that is read every interval.
+    The value is the last one read, error is the error of the last read when
+    it failed, and the callback is called with the point after every read."""
+
+    _debug_contents = ('address', 'objectIdentifier', 'propertyIdentifier',
+        'propertyArrayIndex', 'interval', 'value', 'error', 'updated', 'reads', 'errors')
+
+    def __init__(self, address, obj_id, prop, interval, index=None, callback=None):
+        self.address = address
+        self.objectIdentifier = obj_id
+        self.propertyIdentifier = prop
+        self.propertyArrayIndex = index
+        self.interval = interval
+        self.callback = callback
+
+        self.value = None
+        self.error = None
+        self.updated = None
+        self.reads = 0
+        self.errors = 0
+
+        # the group the point is read with
+        self.group = None
+
+    def decode(self, apdu):
+        """Return the value of a ReadPropertyACK for the point."""
+        datatype = get_datatype(apdu.objectIdentifier[0], apdu.propertyIdentifier)
+        if not datatype:
+            return apdu.propertyValue
+
+        if issubclass(datatype, Array) and (apdu.propertyArrayIndex is not None):
+            if apdu.propertyArrayIndex == 0:
+                return apdu.propertyValue.cast_out(Unsigned)
+            return apdu.propertyValue.cast_out(datatype.subtype)
+
+        return apdu.propertyValue.cast_out(datatype)
+
+#
+#   PollGroup
+#
+
+class PollGroup(DebugContents):
+
+    """The points of a device with the same interval."""
+
+    _debug_contents = ('address', 'interval', 'due', 'outstanding', 'removed')
+
+    def __init__(self, address, interval):
+        self.address = address
+        self.interval = interval
+        self.points = []
+
+        self.due = None
+        self.outstanding = 0
+        self.removed = False
+
+#
+#   PointPoller
+#
+
+@bacpypes_debugging
+class PointPoller(DebugContents):
+
+    """Reads the points it is given at their intervals, in the poll class by
+    default.  The reads of a group are not sent again before the last ones
+    are answered, a group that is still being read when it is due again is
+    read once it is done and the cycles it missed are counted."""
+
+    _debug_contents = ('devices', 'jitter', 'priority_class', 'missed')
+
+    def __init__(self, application, devices=POLL_DEVICES, jitter=POLL_JITTER, priority_class='poll', seed=None):
+        if _debug: PointPoller._debug("__init__ %r devices=%r jitter=%r priority_class=%r", application, devices, jitter, priority_class)
+
+        self.application = application
+        self.devices = devices
+        self.jitter = jitter
+        self.priority_class = priority_class
+        self.rng = random.Random(seed)
+
+        # the groups by address and interval, and the heap of the groups
+        # by the time they are due
+        self.groups = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.task = FunctionTask(self.process)
+
+        # groups that are due by address, the addresses waiting for their
+        # turn and the reads outstanding for the addresses being read
+        self.ready = {}
+        self.waiting = collections.deque()
+        self.active = {}
+
+        # how late the groups were read and the intervals they missed
+        self.lag = LatencyStats()
+        self.missed = 0
+        self.warned = 0.0
+
+    def add(self, address, obj_id, prop, interval, index=None, callback=None):
+        """Start polling a property and return the point."""
+        if _debug: PointPoller._debug("add %r %r %r %r index=%r", address, obj_id, prop, interval, index)
+
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if not isinstance(address, Address):
+            address = Address(address)
+
+        point = PollPoint(address, obj_id, prop, float(interval), index, callback)
+
+        key = (address, point.interval)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = PollGroup(address, point.interval)
+
+            # a random phase keeps the groups with the same interval apart
+            self.schedule(group, time.time() + self.rng.uniform(0, point.interval))
+
+        group.points.append(point)
+        point.group = group
+
+        return point
+
+    def remove(self, point):
+        """Stop polling the point."""
+        if _debug: PointPoller._debug("remove %r", point)
+
+        group = point.group
+        if group is None:
+            return
+
+        group.points.remove(point)
+        point.group = None
+
+        # the heap lets go of the group when it comes up
+        if not group.points:
+            del self.groups[(group.address, group.interval)]
+            group.removed = True
+
+    def points(self):
+        """Return the points in the order of their address and interval."""
+        return [point
+            for key, group in sorted(self.groups.items(), key=lambda item: (str(item[0][0]), item[0][1]))
+            for point in group.points]
+
+    def schedule(self, group, due):
+        if _debug: PointPoller._debug("schedule %r %r", group, due)
+
+        group.due = due
+        heapq.heappush(self.heap, (due, next(self.counter), group))
+        if self.heap[0][2] is group:
+            self.task.install_task(when=due)
+
+    def process(self):
+        """Move the groups that are due to their devices and start the
+        devices that have a turn."""
+        if _debug: PointPoller._debug("process")
+
+        now = time.time()
+        while self.heap and (self.heap[0][0] <= now):
+            due, sequence, group = heapq.heappop(self.heap)
+            if group.removed or (due != group.due):
+                continue
+
+            self.ready.setdefault(group.address, []).append(group)
+            if (group.address not in self.active) and (group.address not in self.waiting):
+                self.waiting.append(group.address)
+
+        self.start_devices()
+
+        if self.heap:
+            self.task.install_task(when=self.heap[0][0])
+
+    def start_devices(self):
+        """Send the reads of the devices that are next in line while there
+        is room."""
+        now = time.time()
+        while self.waiting and (len(self.active) < self.devices):
+            address = self.waiting.popleft()
+            groups = [group for group in self.ready.pop(address, []) if not group.removed]
+
+            # count them all first, an error comes back before request_io
+            # returns when the queue of the trunk is full
+            reads = []
+            for group in groups:
+                self.late(group, now - group.due)
+                group.outstanding = len(group.points)
+                reads.extend((point, group) for point in group.points)
+            if not reads:
+                continue
+            self.active[address] = len(reads)
+
+            if _debug: PointPoller._debug("    - read %r: %r points", address, len(reads))
+            for point, group in reads:
+                self.read(point, group)
+
+    def read(self, point, group):
+        request = ReadPropertyRequest(
+            objectIdentifier=point.objectIdentifier,
+            propertyIdentifier=point.propertyIdentifier,
+            )
+        if point.propertyArrayIndex is not None:
+            request.propertyArrayIndex = point.propertyArrayIndex
+        request.pduDestination = point.address
+
+        iocb = IOCB(request)
+        iocb.add_callback(self.read_complete, point, group)
+        self.application.request_io(iocb, priority_class=self.priority_class)
+
+    def read_complete(self, iocb, point, group):
+        if _debug: PointPoller._debug("read_complete %r %r", iocb, point)
+
+        point.reads += 1
+        if iocb.ioError:
+            point.errors += 1
+            point.error = iocb.ioError
+        else:
+            try:
+                point.value = point.decode(iocb.ioResponse)
+                point.error = None
+                point.updated = time.time()
+            except Exception as err:
+                point.errors += 1
+                point.error = err
+
+        if point.callback:
+            try:
+                point.callback(point)
+            except Exception as err:
+                PointPoller._exception("callback of %r: %r", point, err)
+
+        group.outstanding -= 1
+        if not group.outstanding:
+            self.reschedule(group)
+
+        address = group.address
+        self.active[address] -= 1
+        if not self.active[address]:
+            del self.active[address]
+
+            # groups that came due while the device was read wait their turn
+            if self.ready.get(address):
+                self.waiting.append(address)
+            self.start_devices()
+
+    def reschedule(self, group):
+        """Schedule the next read of the group an interval after the last
+        one was due, skipping the intervals that have already passed."""
+        if group.removed:
+            return
+
+        now = time.time()
+        due = group.due + group.interval
+        if due < now:
+            missed = int((now - due) // group.interval) + 1
+            self.missed += missed
+            due += missed * group.interval
+
+        due += self.rng.uniform(-self.jitter, self.jitter) * group.interval
+        self.schedule(group, max(due, now))
+
+    def late(self, group, lag):
+        """Keep how late the group is read, warn now and then when it is
+        later than its interval."""
+        self.lag.record(max(lag, 0.0))
+
+        now = time.time()
+        if (lag > group.interval) and (now - self.warned > POLL_WARN_INTERVAL):
+            PointPoller._warning("polling of %s is %.1fs behind, the trunk is not keeping up", group.address, lag)
+            self.warned = now
+
+    def counters(self):
+        """Return the points, how many devices are being read and waiting,
+        the groups that are overdue, the intervals missed and how late the
+        reads were."""
+        now = time.time()
+        overdue = sum(1 for due, sequence, group in self.heap
+            if (due <= now) and (due == group.due) and not group.removed)
+        overdue += sum(len(groups) for groups in self.ready.values())
+
+        return {
+            'points': sum(len(group.points) for group in self.groups.values()),
+            'devices': len(set(address for address, interval in self.groups)),
+            'active': len(self.active),
+            'waiting': len(self.waiting),
+            'overdue': overdue,
+            'missed': self.missed,
+            'lag': self.lag.dict_contents(),
+            }
@@ -0,0 +1,185 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Priority lanes for the PDUs going out on a trunk.  A request can be given a
+priority class when it is passed to the application, the class travels down
+the stack as the user data of the PDU and picks the lane it waits in, in the
+director and in the agent.  The network priority of the NPDU can move a PDU
+into an earlier lane but never into a later one.
+"""
+
+from __future__ import absolute_import
+import time
+import collections
+import six.moves.queue as queue
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# the priority classes in the order they are sent, the index of the class
+# is the lane, MSTP_PDU_LANES in dlmstp_linux.h
+MSTP_PRIORITY_CLASSES = ('interactive', 'command', 'poll', 'bulk')
+MSTP_LANES = len(MSTP_PRIORITY_CLASSES)
+
+# class of the PDUs that are not given one, responses included
+MSTP_DEFAULT_CLASS = 'command'
+MSTP_DEFAULT_LANE = MSTP_PRIORITY_CLASSES.index(MSTP_DEFAULT_CLASS)
+
+# octet of the NPDU with the network priority in the low two bits
+NPDU_CONTROL_OCTET = 1
+
+# latencies kept for the percentiles of each class
+MSTP_LATENCY_SAMPLES = 1024
+
+#
+#   pdu_lane
+#
+
+def pdu_lane(pdu):
+    """Return the lane of the PDU from its priority class and the network
+    priority of the NPDU, life safety messages go in the first lane,
+    critical ones in at least the second and urgent ones in at least the
+    third."""
+    lane = MSTP_DEFAULT_LANE
+    if pdu.pduUserData in MSTP_PRIORITY_CLASSES:
+        lane = MSTP_PRIORITY_CLASSES.index(pdu.pduUserData)
+
+    if len(pdu.pduData) > NPDU_CONTROL_OCTET:
+        # the data of a PDU is a bytearray
+        network_priority = pdu.pduData[NPDU_CONTROL_OCTET] & 0x03
+        lane = min(lane, MSTP_LANES - 1 - network_priority)
+
+    return lane
+
+#
+#   LatencyStats
+#
+
+class LatencyStats:
+
+    def __init__(self, size=MSTP_LATENCY_SAMPLES):
+        """The latest latencies in seconds, for the percentiles."""
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Return the latency that percent of the latest ones are under."""
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def dict_contents(self):
+        return {
+            'count': self.count,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+            }
+
+#
+#   MSTPLaneQueue
+#
+
+class MSTPLaneQueue(queue.Queue):
+
+    """Bounded queue of PDUs for the agent with a FIFO for each lane, get
+    takes from the first lane that is not empty.  The time each PDU waited
+    is kept for each lane."""
+
+    def _init(self, maxsize):
+        self.queue = [collections.deque() for lane in range(MSTP_LANES)]
+        self.laneWait = [LatencyStats() for lane in range(MSTP_LANES)]
+
+    def _qsize(self):
+        return sum(len(fifo) for fifo in self.queue)
+
+    def _put(self, pdu):
+        self.queue[pdu_lane(pdu)].append((time.time(), pdu))
+
+    def _get(self):
+        for lane, fifo in enumerate(self.queue):
+            if fifo:
+                when, pdu = fifo.popleft()
+                self.laneWait[lane].record(time.time() - when)
+                return pdu
+
+    def pdus(self):
+        """Return the PDUs that are waiting, in the order they will go."""
+        with self.mutex:
+            return [pdu for fifo in self.queue for when, pdu in fifo]
+
+    def lane_counters(self):
+        """Return the PDUs waiting in each lane and how long they waited."""
+        with self.mutex:
+            return dict(
+                (MSTP_PRIORITY_CLASSES[lane], dict(self.laneWait[lane].dict_contents(), length=len(fifo)))
+                for lane, fifo in enumerate(self.queue)
+                )
+
+#
+#   MSTPPriorityMixin
+#
+
+@bacpypes_debugging
+class MSTPPriorityMixin(object):
+
+    """Application mixin that takes a priority class with each request and
+    keeps the latency of the requests of each class, from request_io to the
+    completion of the IOCB."""
+
+    def __init__(self):
+        if _debug: MSTPPriorityMixin._debug("__init__")
+
+        self.classLatency = dict(
+            (priority_class, LatencyStats()) for priority_class in MSTP_PRIORITY_CLASSES
+            )
+        self.classErrors = dict.fromkeys(MSTP_PRIORITY_CLASSES, 0)
+
+    def request_io(self, iocb, priority_class=None):
+        """Pass the IOCB along, the request goes out in the lane of the
+        priority class, MSTP_DEFAULT_CLASS when it is not given."""
+        if _debug: MSTPPriorityMixin._debug("request_io %r priority_class=%r", iocb, priority_class)
+
+        if priority_class is None:
+            priority_class = MSTP_DEFAULT_CLASS
+        elif priority_class not in MSTP_PRIORITY_CLASSES:
+            raise ValueError("unknown priority class: {}".format(priority_class))
+
+        # the user data is the only thing that goes all the way down
+        apdu = iocb.args[0]
+        if apdu.pduUserData is None:
+            apdu.pduUserData = priority_class
+
+        # requests to the same device wait in the sieve queue of the address,
+        # which goes by the priority of the IOCB
+        if not iocb.ioPriority:
+            iocb.ioPriority = MSTP_PRIORITY_CLASSES.index(priority_class)
+
+        iocb.add_callback(self._priority_complete, priority_class, time.time())
+        super(MSTPPriorityMixin, self).request_io(iocb)
+
+    def _priority_complete(self, iocb, priority_class, start):
+        if iocb.ioError:
+            self.classErrors[priority_class] += 1
+        else:
+            self.classLatency[priority_class].record(time.time() - start)
+
+    def priority_counters(self):
+        """Return the latency percentiles and the errors of each class."""
+        return dict(
+            (priority_class, dict(self.classLatency[priority_class].dict_contents(),
+                errors=self.classErrors[priority_class]))
+            for priority_class in MSTP_PRIORITY_CLASSES
+            )
@@ -0,0 +1,12 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Properties that more than one part of the stack goes by, in a module of
+their own so the parts that only need the names do not import the ones that
+keep them, like the sqlite file of the metadata cache.
+"""
+
+# properties that do not change unless the database of the device does
+STATIC_PROPERTIES = ('objectName', 'description', 'units', 'deviceType',
+    'inactiveText', 'activeText', 'numberOfStates', 'stateText')
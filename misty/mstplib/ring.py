@@ -0,0 +1,257 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Shared memory transport for the MSTP agent.  Instead of the datagram sockets
+frames go through a pair of single producer, single consumer rings that the
+agent maps.  The agent signals the eventfd of the receive ring when a frame
+lands in an empty ring, the director waits on it in the asyncore loop and
+then drains the ring, so there is no socket call per frame in either
+direction.  Frames are copied out of and into the rings a batch at a time,
+one call into the agent for each batch rather than each frame.  The
+transmit ring is short and the director only takes as many frames out of
+their lanes as it has room for, when it is full the agent signals another
+eventfd once half of it is free again.  Only on Linux, select it with 'mstp_ipc: ring' in the ini file.
+"""
+
+from __future__ import absolute_import
+import asyncore
+import ctypes
+import errno
+import six
+import six.moves.queue as queue
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.comm import Server, ServiceAccessPoint
+from bacpypes.udp import UDPActor
+
+from . import MSTPDirector, mstp_agent_library, mstp_agent_params, mstp_queue_depth
+from .bandwidth import MSTPBandwidth
+from .mmsg import FRAME_HEADER, BatchCounter, SlabPool, frame_header
+from .priority import MSTPLaneQueue
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# frames copied out of or into a ring with each call into the agent
+RING_BATCH = 64
+
+#
+#   MSTPRingRoom
+#
+
+@bacpypes_debugging
+class MSTPRingRoom(asyncore.dispatcher):
+
+    """Waits on the eventfd that says the transmit ring has room again and
+    has the director put the frames that were left over into it."""
+
+    def __init__(self, director, fd):
+        if _debug: MSTPRingRoom._debug("__init__ %r %r", director, fd)
+        asyncore.dispatcher.__init__(self)
+
+        self.director = director
+        self.set_socket(asyncore.file_wrapper(fd))
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        if _debug: MSTPRingRoom._debug("handle_read")
+
+        try:
+            self.socket.recv(8)
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        self.director.flush()
+
+    def handle_close(self):
+        self.close()
+
+#
+#   MSTPRingDirector
+#
+
+@bacpypes_debugging
+class MSTPRingDirector(MSTPDirector):
+
+    def __init__(
+        self, localDevice, address, timeout=0, reuse=False, actorClass=UDPActor,
+        sid=None, sapID=None
+    ):
+        if _debug:
+            MSTPRingDirector._debug(
+                "__init__ %r timeout=%r reuse=%r actorClass=%r sid=%r sapID=%r",
+                address, timeout, reuse, actorClass, sid, sapID
+            )
+        Server.__init__(self, sid)
+        ServiceAccessPoint.__init__(self, sapID)
+
+        # check the actor class
+        if not issubclass(actorClass, UDPActor):
+            raise TypeError("actorClass must be a subclass of UDPActor")
+        self.actorClass = actorClass
+
+        # save the timeout for actors
+        self.timeout = timeout
+
+        # save the localDevice
+        self.localDevice = localDevice
+
+        # save the address
+        self.address = address
+
+        asyncore.dispatcher.__init__(self)
+
+        # create the request queue
+        self.request = MSTPLaneQueue(mstp_queue_depth(self.localDevice))
+        self.requestHighWater = 0
+        self.requestDropped = 0
+        self.requestRefused = 0
+
+        # start with an empty peer pool
+        self.peers = {}
+
+        # frames taken from the queue that the ring would not take yet
+        self.unsent = []
+
+        # start the mstp agent on the interface with a pair of rings
+        mstp_lib = mstp_agent_library()
+        mstp_lib.ring_recv_many.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_int]
+        mstp_lib.ring_send_many.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_int]
+        self.ring_recv_many = mstp_lib.ring_recv_many
+        self.ring_send_many = mstp_lib.ring_send_many
+        self.ring_tx_room = mstp_lib.ring_tx_room
+
+        buf = mstp_agent_params(self.localDevice, self.address, mstp_lib)
+        slots = int(getattr(self.localDevice, '_mstp_ring_slots', 0) or 0)
+        self.port = mstp_lib.init_ring(buf, six.ensure_binary(self.localDevice._interface), slots)
+        if self.port < 0:
+            raise RuntimeError("MSTP agent ring setup failed")
+        if _debug: MSTPRingDirector._debug("    - port: %r", self.port)
+
+        # the dispatcher waits on the eventfd of the receive ring, and the
+        # room one on the eventfd of the transmit ring
+        self.set_socket(asyncore.file_wrapper(mstp_lib.ring_rx_fd(self.port)))
+        self.room = MSTPRingRoom(self, mstp_lib.ring_tx_room_fd(self.port))
+
+        # a batch of frames is copied out of the ring into the slabs, the
+        # lengths of a batch in each direction are kept apart since a frame
+        # that is received can send one
+        self.slabs = SlabPool(RING_BATCH, 512)
+        self._slab = (ctypes.c_char * len(self.slabs.buffer)).from_buffer(self.slabs.buffer)
+        self._slabAddress = ctypes.addressof(self._slab)
+        self._rxLengths = (ctypes.c_ushort * RING_BATCH)()
+        self._txLengths = (ctypes.c_ushort * RING_BATCH)()
+        self.batcher = None
+
+        # frames handled per wakeup
+        self.readBatches = BatchCounter(64)
+        self.writeBatches = BatchCounter(64)
+
+        # the use of the wire, from the frames and the counters of the agent
+        self.bandwidth = MSTPBandwidth(self.localDevice._baudrate, self.tokens)
+
+    def handle_read(self):
+        """The receive ring is no longer empty, drain it."""
+        if _debug: MSTPRingDirector._debug("handle_read")
+
+        # clear the eventfd before looking at the ring
+        try:
+            self.socket.recv(8)
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        # the agent only signals a ring that was empty, so a frame that
+        # fails does not stop the draining
+        count = 0
+        while True:
+            frames = self.ring_recv_many(self.port, self._slabAddress, self.slabs.size,
+                self._rxLengths, RING_BATCH)
+            count += frames
+
+            for i in range(frames):
+                try:
+                    self.receive_frame(*self.slabs.split(i, self._rxLengths[i]))
+                except Exception as e:
+                    MSTPRingDirector._error('Exception in handle_read: {}'.format(e))
+
+            # a short batch emptied the ring
+            if frames < RING_BATCH:
+                break
+
+        self.readBatches.record(count)
+
+    def writable(self):
+        """Frames are put into the ring when they are requested."""
+        return False
+
+    def handle_write(self):
+        if _debug: MSTPRingDirector._debug("handle_write")
+
+        self.flush()
+
+    def flush(self):
+        """Put the requested frames into the transmit ring, if it fills up
+        the rest go when the agent says there is room."""
+        if _debug: MSTPRingDirector._debug("flush")
+
+        # frames left over from the last pass go first, then no more from
+        # the request queue than the ring has room for, the rest stay in
+        # their lanes so a later frame of an earlier lane still goes first
+        # and the queue fills up while the ring is full
+        while self.unsent or not self.request.empty():
+            frames, self.unsent = self.unsent, []
+            room = min(self.ring_tx_room(self.port), RING_BATCH)
+            try:
+                while len(frames) < room:
+                    frames.append(self.encode_frame(self.request.get_nowait()))
+            except queue.Empty:
+                pass
+            if not frames:
+                if _debug: MSTPRingDirector._debug("    - ring full")
+                break
+
+            # the agent copies the batch into the ring before ring_send_many
+            # returns
+            parts = []
+            for i, (dest, lane, data) in enumerate(frames):
+                parts.append(frame_header(dest, lane))
+                parts.append(data)
+                self._txLengths[i] = FRAME_HEADER + len(data)
+
+            sent = self.ring_send_many(self.port, b''.join(parts), self._txLengths, len(frames))
+            if sent:
+                self.writeBatches.record(sent)
+
+            self.unsent = frames[sent:]
+            if self.unsent:
+                if _debug: MSTPRingDirector._debug("    - ring full, %d waiting", len(self.unsent))
+                break
+
+    def batch_counters(self):
+        """Return the frames per wakeup counters for each direction."""
+        counters = MSTPDirector.batch_counters(self)
+        counters['ring'] = True
+        return counters
+
+    def close_socket(self):
+        if _debug: MSTPRingDirector._debug("close_socket")
+
+        self.room.close()
+        MSTPDirector.close_socket(self)
+
+    def indication(self, pdu):
+        """Client requests go to the ring right away."""
+        if _debug: MSTPRingDirector._debug("indication %r", pdu)
+
+        MSTPDirector.indication(self, pdu)
+        self.flush()
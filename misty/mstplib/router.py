@@ -0,0 +1,274 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Router application for more than one MS/TP trunk in the same process.  Each
+trunk is a port of the MSTP agent with its own network number, they are all
+bound to one network service access point which forwards between them.  The
+application itself lives on the first trunk.
+"""
+
+from __future__ import absolute_import
+
+from bacpypes.debugging import bacpypes_debugging, DebugContents, ModuleLogger
+from bacpypes.comm import bind
+from bacpypes.pdu import Address, LocalStation, LocalBroadcast, RemoteStation
+from bacpypes.npdu import NPDU
+from bacpypes.apdu import APDU as _APDU
+from bacpypes.netservice import NetworkServiceAccessPoint, NetworkServiceElement, \
+    RouterInfoCache, ROUTER_AVAILABLE
+
+from . import MSTPSimple, MSTPMultiplexer, MSTPApplicationBase
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# ports of the MSTP agent, MAX_PORTS in mstp_agent.h
+MSTP_MAX_PORTS = 10
+
+#
+#   MSTPTrunk
+#
+
+class MSTPTrunk(DebugContents):
+
+    """The settings of one trunk, the network number and the MAC address of
+    the router on it and the interface of the port.  The MSTP agent settings
+    that are not given, like the baud rate, come from the local device."""
+
+    _debug_contents = ('network', 'address', '_interface', '_baudrate',
+        '_max_masters', '_maxinfo')
+
+    def __init__(self, localDevice, network, address, interface, **kwargs):
+        self.localDevice = localDevice
+        self.network = int(network)
+
+        if isinstance(address, Address):
+            self.address = address
+        else:
+            self.address = Address(address)
+
+        # the director looks for these on the local device
+        self._address = int(str(self.address))
+        self._interface = interface
+        for attr, value in kwargs.items():
+            setattr(self, '_' + attr, value)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') and not attr.startswith('__'):
+            return getattr(self.localDevice, attr)
+        raise AttributeError(attr)
+
+#
+#   MSTPRouterInfoCache
+#
+
+@bacpypes_debugging
+class MSTPRouterInfoCache(RouterInfoCache):
+
+    """Router information cache that counts the changes to the paths, so
+    the routing table built from it is only rebuilt when it is stale."""
+
+    def __init__(self):
+        if _debug: MSTPRouterInfoCache._debug("__init__")
+        RouterInfoCache.__init__(self)
+
+        self.generation = 0
+
+    def update_router_info(self, snet, address, dnets, status=ROUTER_AVAILABLE):
+        if _debug: MSTPRouterInfoCache._debug("update_router_info %r %r %r", snet, address, dnets)
+
+        # routed traffic keeps refreshing the same paths
+        paths = [self.path_info.get((snet, dnet)) for dnet in dnets]
+        RouterInfoCache.update_router_info(self, snet, address, dnets, status)
+        if paths != [self.path_info.get((snet, dnet)) for dnet in dnets]:
+            self.generation += 1
+
+    def delete_router_info(self, snet, address=None, dnets=None):
+        if _debug: MSTPRouterInfoCache._debug("delete_router_info %r %r %r", snet, address, dnets)
+
+        RouterInfoCache.delete_router_info(self, snet, address, dnets)
+        self.generation += 1
+
+    def update_source_network(self, old_snet, new_snet):
+        if _debug: MSTPRouterInfoCache._debug("update_source_network %r %r", old_snet, new_snet)
+
+        RouterInfoCache.update_source_network(self, old_snet, new_snet)
+        self.generation += 1
+
+#
+#   MSTPRouterServiceAccessPoint
+#
+
+@bacpypes_debugging
+class MSTPRouterServiceAccessPoint(NetworkServiceAccessPoint):
+
+    """Network service access point that keeps a routing table, the network
+    numbers that can be reached mapped to the adapter of the trunk and the
+    address of the next router, None for the trunks themselves."""
+
+    def __init__(self, router_info_cache=None, sap=None, sid=None):
+        if _debug: MSTPRouterServiceAccessPoint._debug("__init__ sap=%r sid=%r", sap, sid)
+        NetworkServiceAccessPoint.__init__(self,
+            router_info_cache or MSTPRouterInfoCache(), sap=sap, sid=sid)
+
+        # built when it is first needed
+        self.routes = None
+        self.routesGeneration = None
+
+    def bind(self, server, net=None, address=None):
+        if _debug: MSTPRouterServiceAccessPoint._debug("bind %r net=%r address=%r", server, net, address)
+        NetworkServiceAccessPoint.bind(self, server, net, address)
+
+        self.routes = None
+
+    def routing_table(self):
+        """Return the routing table, {net: (adapter, router address)}."""
+        generation = self.router_info_cache.generation
+        if (self.routes is not None) and (self.routesGeneration == generation):
+            return self.routes
+        if _debug: MSTPRouterServiceAccessPoint._debug("routing_table (rebuild)")
+
+        routes = {}
+        for net, adapter in self.adapters.items():
+            if net is not None:
+                routes[net] = (adapter, None)
+
+        # directly connected networks win over paths through other routers
+        for (snet, dnet), router_info in self.router_info_cache.path_info.items():
+            if (dnet not in routes) and (snet in self.adapters):
+                routes[dnet] = (self.adapters[snet], router_info.address)
+
+        self.routes = routes
+        self.routesGeneration = generation
+        return routes
+
+    def indication(self, pdu):
+        """Requests for one of the other trunks or a network that has a known
+        path go right to the adapter, the rest are up to the NSAP."""
+        if _debug: MSTPRouterServiceAccessPoint._debug("indication %r", pdu)
+
+        dest = pdu.pduDestination
+        if (dest.addrType != Address.remoteStationAddr) and (dest.addrType != Address.remoteBroadcastAddr):
+            return NetworkServiceAccessPoint.indication(self, pdu)
+        if (dest.addrNet == self.local_adapter.adapterNet):
+            return NetworkServiceAccessPoint.indication(self, pdu)
+
+        route = self.routing_table().get(dest.addrNet, None)
+        if not route:
+            return NetworkServiceAccessPoint.indication(self, pdu)
+        adapter, router = route
+        if _debug: MSTPRouterServiceAccessPoint._debug("    - route: %r via %r", adapter, router)
+
+        # build a generic APDU
+        apdu = _APDU(user_data=pdu.pduUserData)
+        pdu.encode(apdu)
+
+        # build an NPDU specific to where it is going
+        npdu = NPDU(user_data=pdu.pduUserData)
+        apdu.encode(npdu)
+        npdu.npduHopCount = 255
+
+        if router is None:
+            if dest.addrType == Address.remoteStationAddr:
+                npdu.pduDestination = LocalStation(dest.addrAddr)
+            else:
+                npdu.pduDestination = LocalBroadcast()
+        else:
+            npdu.pduDestination = router
+            npdu.npduDADR = dest
+
+        # replies come back to the application on the first trunk
+        if adapter is not self.local_adapter:
+            npdu.npduSADR = RemoteStation(self.local_adapter.adapterNet,
+                self.local_adapter.adapterAddr.addrAddr)
+
+        adapter.process_npdu(npdu)
+
+#
+#   MSTPRouterApplication
+#
+
+@bacpypes_debugging
+class MSTPRouterApplication(MSTPApplicationBase):
+
+    def __init__(self, localDevice, trunks, deviceInfoCache=None, aseID=None, directorClass=None):
+        if _debug: MSTPRouterApplication._debug("__init__ %r %r deviceInfoCache=%r aseID=%r directorClass=%r", localDevice, trunks, deviceInfoCache, aseID, directorClass)
+        if not trunks:
+            raise ValueError("no trunks")
+        if len(trunks) > MSTP_MAX_PORTS:
+            raise ValueError("at most {} trunks".format(MSTP_MAX_PORTS))
+        networks = [trunk.network for trunk in trunks]
+        if len(set(networks)) != len(networks):
+            raise ValueError("network numbers must be unique")
+
+        MSTPApplicationBase.__init__(self, localDevice, deviceInfoCache, aseID)
+        self.trunks = trunks
+
+        # the application is on the first trunk
+        self.localAddress = trunks[0].address
+
+        # a network service access point that routes between the trunks
+        self.nsap = MSTPRouterServiceAccessPoint()
+
+        # give the NSAP a generic network layer service element, it
+        # announces the networks on each trunk when it starts up
+        self.nse = NetworkServiceElement()
+        bind(self.nse, self.nsap)
+
+        # bind the top layers
+        bind(self, self.asap, self.smap, self.nsap)
+
+        # a generic MSTP stack and a port of the agent for each trunk
+        self.mstp = {}
+        self.mux = {}
+        for trunk in trunks:
+            if _debug: MSTPRouterApplication._debug("    - trunk: %r", trunk)
+
+            mstp = self.mstp[trunk.network] = MSTPSimple()
+            mux = self.mux[trunk.network] = MSTPMultiplexer(trunk, trunk.address, directorClass=directorClass)
+            bind(mstp, mux.annexH)
+
+            self.nsap.bind(mstp, trunk.network, trunk.address)
+
+        # every bind with an address moves the local adapter
+        self.nsap.local_adapter = self.nsap.adapters[trunks[0].network]
+
+    def mstp_directors(self):
+        """Return the directors of the trunks in the order of the trunks."""
+        return [self.mux[trunk.network].directPort for trunk in self.trunks]
+
+    def routing_table(self):
+        """Return the networks that can be reached, {net: (trunk network,
+        router address)}, the address is None for the trunks."""
+        return dict(
+            (net, (adapter.adapterNet, router))
+            for net, (adapter, router) in self.nsap.routing_table().items()
+            )
+
+    def trunk_directors(self, address):
+        """Return the directors of the trunks a PDU to the address goes out."""
+        if address.addrType in (Address.remoteStationAddr, Address.remoteBroadcastAddr):
+            route = self.nsap.routing_table().get(address.addrNet, None)
+            if route:
+                return [self.mux[route[0].adapterNet].directPort]
+        elif address.addrType == Address.globalBroadcastAddr:
+            return [mux.directPort for mux in self.mux.values()]
+
+        # local traffic and unknown networks start on the first trunk
+        return [self.mux[self.trunks[0].network].directPort]
+
+    def coalesce_baudrate(self, address):
+        """Return the baud rate of the trunk a request to the address goes
+        out, merged reads are kept short enough for it."""
+        network = self.trunks[0].network
+        if address.addrType == Address.remoteStationAddr:
+            route = self.nsap.routing_table().get(address.addrNet, None)
+            if route:
+                network = route[0].adapterNet
+
+        for trunk in self.trunks:
+            if trunk.network == network:
+                return getattr(trunk, '_baudrate', None)
+        return None
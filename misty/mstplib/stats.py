@@ -0,0 +1,392 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Counters of the MSTP agent and the directors.  The agent fills an mstp_stats_t
+for a port, MSTPStats has the same layout, and the directors add the counters
+of their own queues.  MSTPStatsServer answers every connection on a UNIX or a
+loopback socket with the counters of the trunks in the Prometheus text format.
+"""
+
+from __future__ import absolute_import
+import asyncore
+import ctypes
+import os
+import socket
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+
+from .priority import MSTP_PRIORITY_CLASSES
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# frame types counted one by one, the proprietary ones together,
+# MSTP_STAT_FRAME_TYPES in mstp.h
+MSTP_FRAME_TYPES = (
+    'token', 'poll_for_master', 'reply_to_poll_for_master', 'test_request',
+    'test_response', 'data_expecting_reply', 'data_not_expecting_reply',
+    'reply_postponed', 'proprietary',
+    )
+
+# buckets of the histograms of times in microseconds, the first values have
+# a bucket each then there are 1 << MSTP_HISTOGRAM_SUB_BITS buckets for each
+# power of two, dlmstp_linux.h
+MSTP_HISTOGRAM_SUB_BITS = 2
+MSTP_HISTOGRAM_BUCKETS = 100
+
+# stations that can be asked for a reply, MSTP_BROADCAST_ADDRESS excluded
+MSTP_STATIONS = 255
+
+# upper bounds of the Prometheus buckets, powers of two from 256us
+PROMETHEUS_BUCKET_POWERS = range(8, 27)
+
+#
+#   MSTPHistogram
+#
+
+class MSTPHistogram(ctypes.Structure):
+
+    """A histogram of times in microseconds, MSTP_HISTOGRAM in dlmstp_linux.h."""
+
+    _fields_ = [
+        ('count', ctypes.c_uint32),
+        ('max', ctypes.c_uint32),
+        ('sum', ctypes.c_uint64),
+        ('buckets', ctypes.c_uint32 * MSTP_HISTOGRAM_BUCKETS),
+        ]
+
+def histogram_bound(bucket):
+    """Return the first time in microseconds past the bucket."""
+    bucket += 1
+    if bucket < (1 << MSTP_HISTOGRAM_SUB_BITS):
+        return bucket
+    group = bucket >> MSTP_HISTOGRAM_SUB_BITS
+    sub = bucket & ((1 << MSTP_HISTOGRAM_SUB_BITS) - 1)
+    return ((1 << MSTP_HISTOGRAM_SUB_BITS) + sub) << (group - 1)
+
+def histogram_percentile(histogram, percent):
+    """Return the upper bound in seconds of the bucket of an MSTPHistogram
+    that has the given percent of the times, never more than the largest."""
+    if not histogram.count:
+        return 0.0
+
+    wanted = (histogram.count * percent + 99) // 100
+    seen = 0
+    for bucket, count in enumerate(histogram.buckets):
+        seen += count
+        if seen >= wanted:
+            break
+    if bucket >= MSTP_HISTOGRAM_BUCKETS - 1:
+        return histogram.max / 1e6
+    return min(histogram_bound(bucket), histogram.max) / 1e6
+
+def histogram_dict(histogram):
+    """Return the contents of an MSTPHistogram with a few percentiles, the
+    times in seconds."""
+    result = {
+        'count': histogram.count,
+        'sum': histogram.sum / 1e6,
+        'max': histogram.max / 1e6,
+        'buckets': list(histogram.buckets),
+        }
+    for percent in (50, 90, 99):
+        result['p{}'.format(percent)] = histogram_percentile(histogram, percent)
+
+    return result
+
+#
+#   MSTPStats
+#
+
+class MSTPStats(ctypes.Structure):
+
+    """The counters of a port of the agent, mstp_stats_t in mstp_agent.h."""
+
+    _fields_ = [
+        ('tokens_rcvd', ctypes.c_uint32),
+        ('recv_errors', ctypes.c_uint32),
+        ('invalid_frames', ctypes.c_uint32),
+        ('bytes_xmit', ctypes.c_uint32),
+        ('bytes_rcvd', ctypes.c_uint32),
+        ('frames_rcvd', ctypes.c_uint32 * len(MSTP_FRAME_TYPES)),
+        ('frames_sent', ctypes.c_uint32 * len(MSTP_FRAME_TYPES)),
+        ('token_retries', ctypes.c_uint32),
+        ('lost_tokens', ctypes.c_uint32),
+        ('reply_timeouts', ctypes.c_uint32),
+        ('pdu_queue_depth', ctypes.c_uint32),
+        ('pdu_queue_length', ctypes.c_uint32),
+        ('pdu_queue_high_water', ctypes.c_uint32),
+        ('pdu_queue_full', ctypes.c_uint32),
+        ('lane_sent', ctypes.c_uint32 * len(MSTP_PRIORITY_CLASSES)),
+        ('rx_dropped', ctypes.c_uint32),
+        ('tx_dropped', ctypes.c_uint32),
+        ('rx_ring_full', ctypes.c_uint32),
+        ('rx_ring_wakeups', ctypes.c_uint32),
+        ('tx_ring_full', ctypes.c_uint32),
+        ('tx_ring_wakeups', ctypes.c_uint32),
+        ('token_rotation', MSTPHistogram),
+        ('token_hold', MSTPHistogram),
+        ('capture_active', ctypes.c_uint32),
+        ('capture_frames', ctypes.c_uint32),
+        ('capture_dropped', ctypes.c_uint32),
+        ('capture_files', ctypes.c_uint32),
+        ('capture_write_errors', ctypes.c_uint32),
+        ]
+
+def agent_stats(mstp_lib, port, reply_latency=True):
+    """Return the counters of a port of the agent as a dict, None when the
+    port is not in use.  The reply latency histograms of the stations are
+    only copied when they are asked for."""
+    stats = MSTPStats()
+    if mstp_lib.port_stats(port, ctypes.byref(stats), ctypes.sizeof(stats)) < 0:
+        return None
+
+    result = {}
+    for name, kind in MSTPStats._fields_:
+        result[name] = getattr(stats, name)
+    result['frames_rcvd'] = dict(zip(MSTP_FRAME_TYPES, stats.frames_rcvd))
+    result['frames_sent'] = dict(zip(MSTP_FRAME_TYPES, stats.frames_sent))
+    result['lane_sent'] = dict(zip(MSTP_PRIORITY_CLASSES, stats.lane_sent))
+    result['token_rotation'] = histogram_dict(stats.token_rotation)
+    result['token_hold'] = histogram_dict(stats.token_hold)
+
+    # only the stations that replied, all in one call
+    result['reply_latency'] = {}
+    if reply_latency:
+        macs = (ctypes.c_ubyte * MSTP_STATIONS)()
+        histograms = (MSTPHistogram * MSTP_STATIONS)()
+        count = mstp_lib.port_reply_latencies(port, macs, histograms, MSTP_STATIONS, ctypes.sizeof(MSTPHistogram))
+        for i in range(max(count, 0)):
+            result['reply_latency'][macs[i]] = histogram_dict(histograms[i])
+
+    return result
+
+def agent_tokens(mstp_lib, port):
+    """Return the tokens the port of the agent was passed, one for each
+    rotation of the ring, None when the port is not in use."""
+    stats = MSTPStats()
+    if mstp_lib.port_stats(port, ctypes.byref(stats), ctypes.sizeof(stats)) < 0:
+        return None
+
+    return stats.tokens_rcvd
+
+#
+#   Prometheus text format
+#
+
+def _by(key, label):
+    """Return a function that splits the dict of a counter by a label."""
+    return lambda agent: [({label: name}, value) for name, value in sorted(agent[key].items())]
+
+def _one(key):
+    return lambda agent: [({}, agent[key])]
+
+# the metrics from the counters of the agent, name, type, help and a
+# function that returns the extra labels and the value of each sample
+AGENT_METRICS = [
+    ('mstp_tokens_received_total', 'counter', "Tokens received", _one('tokens_rcvd')),
+    ('mstp_receive_errors_total', 'counter', "Invalid frames received while idle", _one('recv_errors')),
+    ('mstp_invalid_frames_total', 'counter', "Frames that were not completed", _one('invalid_frames')),
+    ('mstp_sent_octets_total', 'counter', "Octets written to the port", _one('bytes_xmit')),
+    ('mstp_received_octets_total', 'counter', "Octets read from the port", _one('bytes_rcvd')),
+    ('mstp_frames_received_total', 'counter', "Valid frames for this station", _by('frames_rcvd', 'type')),
+    ('mstp_frames_sent_total', 'counter', "Frames sent", _by('frames_sent', 'type')),
+    ('mstp_token_retries_total', 'counter', "Tokens sent again to the next station", _one('token_retries')),
+    ('mstp_lost_tokens_total', 'counter', "Times the token was lost", _one('lost_tokens')),
+    ('mstp_reply_timeouts_total', 'counter', "Requests that got no reply in time", _one('reply_timeouts')),
+    ('mstp_agent_queue_depth', 'gauge', "PDUs the agent queue holds", _one('pdu_queue_depth')),
+    ('mstp_agent_queue_length', 'gauge', "PDUs waiting in the agent queue", _one('pdu_queue_length')),
+    ('mstp_agent_queue_high_water', 'gauge', "Most PDUs that waited in the agent queue", _one('pdu_queue_high_water')),
+    ('mstp_agent_queue_full_total', 'counter', "PDUs that found the agent queue full", _one('pdu_queue_full')),
+    ('mstp_lane_sent_total', 'counter', "PDUs sent from each priority lane", _by('lane_sent', 'class')),
+    ('mstp_dropped_total', 'counter', "Frames dropped between the agent and python",
+        lambda agent: [({'direction': 'receive'}, agent['rx_dropped']), ({'direction': 'transmit'}, agent['tx_dropped'])]),
+    ('mstp_ring_full_total', 'counter', "Frames that found a shared memory ring full",
+        lambda agent: [({'ring': 'receive'}, agent['rx_ring_full']), ({'ring': 'transmit'}, agent['tx_ring_full'])]),
+    ('mstp_capture_active', 'gauge', "1 while the frames are written to a pcap file", _one('capture_active')),
+    ('mstp_capture_frames_total', 'counter', "Frames given to the capture", _one('capture_frames')),
+    ('mstp_capture_dropped_total', 'counter', "Frames that found the capture ring full", _one('capture_dropped')),
+    ('mstp_capture_files_total', 'counter', "Capture files started", _one('capture_files')),
+    ('mstp_ring_wakeups_total', 'counter', "Wakeups through the shared memory rings",
+        lambda agent: [({'ring': 'receive'}, agent['rx_ring_wakeups']), ({'ring': 'transmit'}, agent['tx_ring_wakeups'])]),
+    ]
+
+# the metrics from the queue of a director
+QUEUE_METRICS = [
+    ('mstp_queue_depth', 'gauge', "PDUs the director queue holds", 'depth'),
+    ('mstp_queue_length', 'gauge', "PDUs waiting in the director queue", 'length'),
+    ('mstp_queue_high_water', 'gauge', "Most PDUs that waited in the director queue", 'high_water'),
+    ('mstp_queue_refused_total', 'counter', "Requests refused with the queue full", 'refused'),
+    ('mstp_queue_dropped_total', 'counter', "PDUs dropped with the queue full", 'dropped'),
+    ]
+
+# the histograms from the agent, name, help and a function that returns the
+# extra labels and the histogram of each series
+HISTOGRAM_METRICS = [
+    ('mstp_token_rotation_seconds', "Time from a token to the next one",
+        lambda agent: [({}, agent['token_rotation'])]),
+    ('mstp_token_hold_seconds', "Time from a token to passing it on",
+        lambda agent: [({}, agent['token_hold'])]),
+    ('mstp_reply_latency_seconds', "Time from a data expecting reply frame to the reply of the station",
+        lambda agent: [({'station': mac}, histogram) for mac, histogram in sorted(agent['reply_latency'].items())]),
+    ]
+
+def _cumulative(histogram):
+    """Return the upper bounds in seconds and the cumulative counts of the
+    Prometheus buckets, the bounds are the first bucket of a power of two."""
+    buckets = histogram['buckets']
+    return [
+        (str((1 << power) / 1e6), sum(buckets[:(power - 1) << MSTP_HISTOGRAM_SUB_BITS]))
+        for power in PROMETHEUS_BUCKET_POWERS
+        ] + [('+Inf', histogram['count'])]
+
+def _labels(labels):
+    return ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items())
+        )
+
+def prometheus_text(trunks):
+    """Return the counters of the trunks in the Prometheus text format, the
+    trunks are the stats of the directors."""
+    lines = []
+
+    def metric(name, kind, text, samples):
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            lines.append('{}{{{}}} {}'.format(name, _labels(labels), value))
+
+    for name, kind, text, fn in AGENT_METRICS:
+        metric(name, kind, text, [
+            (dict(trunk['labels'], **labels), value)
+            for trunk in trunks if trunk['agent']
+            for labels, value in fn(trunk['agent'])
+            ])
+
+    for name, text, fn in HISTOGRAM_METRICS:
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} histogram'.format(name))
+        for trunk in trunks:
+            if not trunk['agent']:
+                continue
+            for labels, histogram in fn(trunk['agent']):
+                labels = dict(trunk['labels'], **labels)
+                for le, count in _cumulative(histogram):
+                    lines.append('{}_bucket{{{}}} {}'.format(name, _labels(dict(labels, le=le)), count))
+                lines.append('{}_sum{{{}}} {}'.format(name, _labels(labels), histogram['sum']))
+                lines.append('{}_count{{{}}} {}'.format(name, _labels(labels), histogram['count']))
+
+    for name, kind, text, key in QUEUE_METRICS:
+        metric(name, kind, text, [(trunk['labels'], trunk['queue'][key]) for trunk in trunks])
+
+    return '\n'.join(lines) + '\n'
+
+def stats_response(directors):
+    """Return the HTTP response with the counters of the directors, the
+    request itself does not matter."""
+    body = prometheus_text([director.stats() for director in directors]).encode('utf-8')
+    header = (
+        "HTTP/1.0 200 OK\r\n"
+        "Content-Type: text/plain; version=0.0.4\r\n"
+        "Content-Length: {}\r\n"
+        "Connection: close\r\n\r\n"
+        ).format(len(body)).encode('ascii')
+    return header + body
+
+def stats_address(address):
+    """Return the family and the address of the socket for the value of
+    mstp_stats, a path for a UNIX socket or a port on the loopback address
+    with an optional host."""
+    address = str(address)
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+
+    host, sep, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+#
+#   MSTPStatsHandler
+#
+
+@bacpypes_debugging
+class MSTPStatsHandler(asyncore.dispatcher_with_send):
+
+    def __init__(self, sock, directors):
+        if _debug: MSTPStatsHandler._debug("__init__ %r", sock)
+        asyncore.dispatcher_with_send.__init__(self, sock)
+        self.directors = directors
+        self.request = b''
+        self.answered = False
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if self.answered:
+            return
+        self.request += data
+
+        # answer once the request is in or the peer stopped sending
+        if (not data) or (b'\r\n\r\n' in self.request) or (b'\n\n' in self.request):
+            self.answered = True
+            self.send(stats_response(self.directors()))
+
+    def writable(self):
+        return (not self.connected) or bool(self.out_buffer)
+
+    def handle_write(self):
+        asyncore.dispatcher_with_send.handle_write(self)
+        if self.answered and not self.out_buffer:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+#
+#   MSTPStatsServer
+#
+
+@bacpypes_debugging
+class MSTPStatsServer(asyncore.dispatcher):
+
+    """Serve the counters of the directors returned by the directors
+    function on a UNIX socket, or a TCP port that is only bound to the
+    loopback address unless another host is given."""
+
+    def __init__(self, directors, address):
+        if _debug: MSTPStatsServer._debug("__init__ %r %r", directors, address)
+        asyncore.dispatcher.__init__(self)
+
+        self.directors = directors
+        family, self.address = stats_address(address)
+
+        self.create_socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+        else:
+            self.set_reuse_addr()
+        self.bind(self.address)
+        self.listen(5)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        if _debug: MSTPStatsServer._debug("handle_accept %r", addr)
+
+        MSTPStatsHandler(sock, self.directors)
+
+    def close_socket(self):
+        if _debug: MSTPStatsServer._debug("close_socket")
+
+        self.close()
+        if isinstance(self.address, str):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
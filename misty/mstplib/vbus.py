@@ -0,0 +1,982 @@
+#!/usr/bin/env python
+
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Virtual MS/TP bus.  Agents attach to pseudo terminals of the bus the same way
+they attach to a serial port, simulated master stations live inside the bus
+itself, and between them the bus plays the part of the wire: a frame takes
+the time its octets take at the baud rate, frames that overlap on the wire
+collide and reach everybody corrupted, and each receiver can lose a frame to
+noise with some probability.  The bus watches every frame and reports the
+token rotation time, the requests and replies and the use of the wire.
+
+    $ python -m misty.mstplib.vbus --pty /var/tmp/vbus/client --pty /var/tmp/vbus/server \\
+        --stations 2-59 --duration 60
+
+The agents are then started with the pseudo terminals as their interface, the
+simulated stations answer Who-Is, ReadProperty and ReadPropertyMultiple for a
+device object and a number of analog values.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import tty
+import json
+import fcntl
+import heapq
+import errno
+import random
+import select
+import argparse
+from collections import deque
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.pdu import PDU, Address, LocalBroadcast
+from bacpypes.npdu import NPDU
+from bacpypes.apdu import APDU as _APDU, apdu_types, confirmed_request_types, \
+    unconfirmed_request_types, ConfirmedRequestPDU, UnconfirmedRequestPDU, \
+    ComplexAckPDU, ErrorPDU, RejectPDU, AbortPDU
+from bacpypes.errors import RejectException, AbortException
+from bacpypes.app import Application
+from bacpypes.object import AnalogValueObject
+from bacpypes.local.device import LocalDeviceObject
+from bacpypes.service.device import WhoIsIAmServices
+from bacpypes.service.object import ReadWritePropertyServices, ReadWritePropertyMultipleServices
+
+from .stats import MSTP_FRAME_TYPES
+
+try:
+    from time import monotonic as _clock
+except ImportError:
+    from time import time as _clock
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# frame types, mstpdef.h
+FRAME_TYPE_TOKEN = 0
+FRAME_TYPE_POLL_FOR_MASTER = 1
+FRAME_TYPE_REPLY_TO_POLL_FOR_MASTER = 2
+FRAME_TYPE_TEST_REQUEST = 3
+FRAME_TYPE_TEST_RESPONSE = 4
+FRAME_TYPE_BACNET_DATA_EXPECTING_REPLY = 5
+FRAME_TYPE_BACNET_DATA_NOT_EXPECTING_REPLY = 6
+FRAME_TYPE_REPLY_POSTPONED = 7
+
+MSTP_BROADCAST = 255
+MSTP_MAX_MASTER = 127
+
+# timing of the simulated stations in seconds, mstpdef.h and mstp.c, the
+# usage timeout is shorter than the 95 ms of mstp.c, which would take 12
+# seconds to poll the whole address range, but above the 20 ms minimum
+Tno_token = 0.500
+Tslot = 0.010
+Tusage_timeout = 0.030
+Treply_timeout = 0.295
+Npoll = 50
+Nretry_token = 1
+
+# bits on the wire for each octet, a start bit, eight data bits and a stop bit
+BITS_PER_OCTET = 10
+
+# seconds between the writes of the octets of a frame to the pseudo
+# terminals while it is on the wire
+STREAM_INTERVAL = 0.005
+
+# rotations and reply latencies kept for the percentiles
+SAMPLES_KEPT = 10000
+
+def frame_type_name(frame_type):
+    """Return the name of the frame type, the names of the counters."""
+    return MSTP_FRAME_TYPES[min(frame_type, len(MSTP_FRAME_TYPES) - 1)]
+
+#
+#   CRC
+#
+
+def header_crc(octets):
+    """Return the header CRC to send for the octets, clause G.1."""
+    crc = 0xFF
+    for octet in bytearray(octets):
+        crc ^= octet
+        crc = crc ^ (crc << 1) ^ (crc << 2) ^ (crc << 3) \
+            ^ (crc << 4) ^ (crc << 5) ^ (crc << 6) ^ (crc << 7)
+        crc = (crc & 0xFE) ^ ((crc >> 8) & 1)
+    return ~crc & 0xFF
+
+def data_crc(octets):
+    """Return the data CRC to send for the octets, clause G.2."""
+    crc = 0xFFFF
+    for octet in bytearray(octets):
+        low = (crc & 0xFF) ^ octet
+        crc = (crc >> 8) ^ (low << 8) ^ (low << 3) ^ (low << 12) \
+            ^ (low >> 4) ^ (low & 0x0F) ^ ((low & 0x0F) << 7)
+        crc &= 0xFFFF
+    return ~crc & 0xFFFF
+
+def encode_frame(frame_type, destination, source, data=b''):
+    """Return the octets of a frame, preamble to data CRC."""
+    header = bytearray([frame_type, destination, source, len(data) >> 8, len(data) & 0xFF])
+    octets = bytearray([0x55, 0xFF]) + header + bytearray([header_crc(header)])
+    if data:
+        crc = data_crc(data)
+        octets += bytearray(data) + bytearray([crc & 0xFF, crc >> 8])
+    return bytes(octets)
+
+#
+#   MSTPFrame
+#
+
+class MSTPFrame(object):
+
+    __slots__ = ('frame_type', 'destination', 'source', 'data')
+
+    def __init__(self, frame_type, destination, source, data=b''):
+        self.frame_type = frame_type
+        self.destination = destination
+        self.source = source
+        self.data = data
+
+    def __repr__(self):
+        return "<MSTPFrame {} {}->{} {} octets>".format(
+            frame_type_name(self.frame_type),
+            self.source, self.destination, len(self.data))
+
+#
+#   MSTPFrameParser
+#
+
+class MSTPFrameParser(object):
+
+    """Split a stream of octets into frames, octets that are not part of a
+    frame with good CRCs are skipped."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, octets):
+        """Add the octets and return a list of (octets, frame) tuples for the
+        frames that are complete."""
+        self.buffer += octets
+        frames = []
+
+        while True:
+            start = self.buffer.find(b'\x55\xff')
+            if start < 0:
+                # keep a trailing 0x55, it may start the next preamble
+                del self.buffer[:len(self.buffer) - 1 if self.buffer[-1:] == b'\x55' else len(self.buffer)]
+                break
+            del self.buffer[:start]
+            if len(self.buffer) < 8:
+                break
+
+            header = self.buffer[2:7]
+            if header_crc(header) != self.buffer[7]:
+                del self.buffer[:2]
+                continue
+
+            length = (header[3] << 8) + header[4]
+            size = 8 + (length + 2 if length else 0)
+            if len(self.buffer) < size:
+                break
+
+            data = bytes(self.buffer[8:8 + length])
+            if length and data_crc(data) != self.buffer[8 + length] + (self.buffer[9 + length] << 8):
+                del self.buffer[:2]
+                continue
+
+            frames.append((bytes(self.buffer[:size]), MSTPFrame(header[0], header[1], header[2], data)))
+            del self.buffer[:size]
+
+        return frames
+
+    def pending(self):
+        """Octets of a frame that is not complete yet."""
+        return len(self.buffer)
+
+#
+#   Transmission
+#
+
+class Transmission(object):
+
+    __slots__ = ('port', 'octets', 'frame', 'start', 'end', 'collided', 'streamed')
+
+    def __init__(self, port, octets, frame, start, end):
+        self.port = port
+        self.octets = octets
+        self.frame = frame
+        self.start = start
+        self.end = end
+        self.collided = False
+        self.streamed = 0
+
+def corrupt(octets, rng, collided=False):
+    """Return the octets as a receiver sees them through noise, one bit
+    flipped, or through a collision, every octet garbled."""
+    octets = bytearray(octets)
+    if collided:
+        for i in range(len(octets)):
+            octets[i] ^= rng.randrange(1, 256)
+    else:
+        i = rng.randrange(len(octets))
+        octets[i] ^= 1 << rng.randrange(8)
+    return bytes(octets)
+
+def percentile(samples, fraction):
+    """Return the value below which the fraction of the samples are."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+#
+#   BusStatistics
+#
+
+@bacpypes_debugging
+class BusStatistics(object):
+
+    """What went over the wire: frames, token rotation and requests."""
+
+    def __init__(self, start):
+        self.start = start
+        self.frames = {}
+        self.octets = 0
+        self.busy = 0.0
+        self.collisions = 0
+        self.lost = 0
+        self.stations = set()
+
+        # the time each station last passed the token
+        self.last_token = {}
+        self.rotations = deque(maxlen=SAMPLES_KEPT)
+
+        # requests waiting for a reply by (requester, responder)
+        self.waiting = {}
+        self.requests = 0
+        self.replies = 0
+        self.postponed = 0
+        self.latencies = deque(maxlen=SAMPLES_KEPT)
+
+    def observe(self, transmission):
+        """Count a transmission when it is complete."""
+        self.octets += len(transmission.octets)
+        self.busy += transmission.end - transmission.start
+        if transmission.collided:
+            self.collisions += 1
+            return
+
+        frame = transmission.frame
+        if frame is None:
+            return
+        name = frame_type_name(frame.frame_type)
+        self.frames[name] = self.frames.get(name, 0) + 1
+        self.stations.add(frame.source)
+
+        if frame.frame_type == FRAME_TYPE_TOKEN:
+            last = self.last_token.get(frame.source)
+            if last is not None:
+                self.rotations.append(transmission.end - last)
+            self.last_token[frame.source] = transmission.end
+
+        elif frame.frame_type == FRAME_TYPE_BACNET_DATA_EXPECTING_REPLY:
+            self.requests += 1
+            self.waiting[(frame.source, frame.destination)] = transmission.end
+
+        elif frame.frame_type in (FRAME_TYPE_BACNET_DATA_NOT_EXPECTING_REPLY, FRAME_TYPE_REPLY_POSTPONED):
+            sent = self.waiting.pop((frame.destination, frame.source), None)
+            if sent is not None and transmission.start - sent <= Treply_timeout:
+                if frame.frame_type == FRAME_TYPE_REPLY_POSTPONED:
+                    self.postponed += 1
+                else:
+                    self.replies += 1
+                    self.latencies.append(transmission.start - sent)
+
+    def summary(self, now):
+        """Return a dict of the statistics so far."""
+        elapsed = max(now - self.start, 1e-9)
+        rotations = list(self.rotations)
+        latencies = list(self.latencies)
+
+        def ms(value):
+            return None if value is None else round(value * 1000.0, 3)
+
+        return {
+            'elapsed': round(elapsed, 3),
+            'stations': len(self.stations),
+            'frames': dict(self.frames),
+            'octets': self.octets,
+            'utilization': round(min(self.busy / elapsed, 1.0), 4),
+            'collisions': self.collisions,
+            'lost': self.lost,
+            'token_rotation_ms': {
+                'samples': len(rotations),
+                'mean': ms(sum(rotations) / len(rotations)) if rotations else None,
+                'p50': ms(percentile(rotations, 0.50)),
+                'p95': ms(percentile(rotations, 0.95)),
+                'max': ms(max(rotations)) if rotations else None,
+                },
+            'requests': {
+                'sent': self.requests,
+                'replies': self.replies,
+                'postponed': self.postponed,
+                'per_second': round(self.replies / elapsed, 2),
+                'latency_mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+                'latency_p95_ms': ms(percentile(latencies, 0.95)),
+                },
+            }
+
+#
+#   VirtualBus
+#
+
+@bacpypes_debugging
+class VirtualBus(object):
+
+    """The wire between the ports, which are pseudo terminals for agents and
+    simulated stations."""
+
+    def __init__(self, baudrate=38400, loss=0.0, seed=None):
+        if _debug: VirtualBus._debug("__init__ baudrate=%r loss=%r seed=%r", baudrate, loss, seed)
+
+        self.baudrate = baudrate
+        self.octet_time = float(BITS_PER_OCTET) / baudrate
+        self.loss = loss
+        self.rng = random.Random(seed)
+
+        self.ports = []
+        self.events = []
+        self.sequence = 0
+
+        # transmissions still on the wire and the end of the last one
+        self.on_wire = []
+        self.last_activity = _clock()
+
+        self.statistics = BusStatistics(_clock())
+
+    def now(self):
+        return _clock()
+
+    def add_pty(self, link):
+        """Add a pseudo terminal for an agent, link is the path to give it."""
+        port = PtyPort(self, link)
+        self.ports.append(port)
+        return port
+
+    def add_station(self, mac, **kwargs):
+        """Add a simulated master station."""
+        station = SimulatedStation(self, mac, **kwargs)
+        self.ports.append(station)
+        return station
+
+    def call_at(self, when, fn, *args):
+        """Call the function at the time."""
+        self.sequence += 1
+        heapq.heappush(self.events, (when, self.sequence, fn, args))
+
+    def transmit(self, port, octets, frame, when):
+        """Put a frame on the wire from the port, no sooner than when and not
+        before the port has finished the frame before it."""
+        start = max(when, port.transmit_end)
+        end = start + len(octets) * self.octet_time
+        port.transmit_end = end
+
+        transmission = Transmission(port, octets, frame, start, end)
+        self.on_wire = [other for other in self.on_wire if other.end > start]
+        for other in self.on_wire:
+            if other.start < end:
+                if _debug: VirtualBus._debug("    - collision %r %r", frame, other.frame)
+                other.collided = True
+                transmission.collided = True
+        self.on_wire.append(transmission)
+
+        if start + STREAM_INTERVAL < end:
+            self.call_at(start + STREAM_INTERVAL, self.stream, transmission)
+        self.call_at(end, self.deliver, transmission)
+        return end
+
+    def stream(self, transmission):
+        """The agents get the octets that are on the wire so far, like from a
+        serial port, so a long frame keeps their receive state machines busy
+        instead of arriving after their timers have run out.  The last octet
+        waits for the end of the frame."""
+        now = self.now()
+        count = min(int((now - transmission.start) / self.octet_time), len(transmission.octets) - 1)
+        if count > transmission.streamed:
+            octets = transmission.octets[transmission.streamed:count]
+            transmission.streamed = count
+            for port in self.ports:
+                if isinstance(port, PtyPort) and (port is not transmission.port):
+                    port.receive(octets, None)
+
+        if now + STREAM_INTERVAL < transmission.end:
+            self.call_at(now + STREAM_INTERVAL, self.stream, transmission)
+
+    def busy_until(self, port, now):
+        """Return the end of the frame that another port has started to
+        send, the receivers see its first octets long before it is delivered,
+        or None when the wire is quiet."""
+        ends = [other.end for other in self.on_wire
+            if other.port is not port and other.start <= now < other.end]
+        return max(ends) if ends else None
+
+    def deliver(self, transmission):
+        """The last octet of the transmission is on the wire, every other port
+        gets it, garbled when it collided or lost to noise.  The agents get
+        the octets that were not streamed to them yet, which always include
+        the CRC, so a garbled frame fails its check."""
+        self.statistics.observe(transmission)
+        self.last_activity = max(self.last_activity, transmission.end)
+
+        for port in self.ports:
+            if port is transmission.port:
+                continue
+            octets = transmission.octets
+            if isinstance(port, PtyPort):
+                octets = octets[transmission.streamed:]
+            if transmission.collided:
+                port.receive(corrupt(octets, self.rng, True), None)
+            elif self.loss and self.rng.random() < self.loss:
+                self.statistics.lost += 1
+                port.receive(corrupt(octets, self.rng), None)
+            else:
+                port.receive(octets, transmission.frame)
+
+    def run(self, duration=None, interval=None, report=None, warmup=0.0):
+        """Run the bus for the duration in seconds, forever when None, and call
+        report with the statistics every interval seconds.  The statistics
+        start over after the warmup, when the ring has formed."""
+        if _debug: VirtualBus._debug("run duration=%r interval=%r warmup=%r", duration, interval, warmup)
+
+        for port in self.ports:
+            port.start()
+
+        stop_at = None if duration is None else self.now() + warmup + duration
+        next_report = None if not interval else self.now() + warmup + interval
+        warmup_end = self.now() + warmup if warmup else None
+
+        while True:
+            now = self.now()
+            if stop_at is not None and now >= stop_at:
+                break
+            if warmup_end is not None and now >= warmup_end:
+                self.statistics = BusStatistics(now)
+                warmup_end = None
+            if next_report is not None and now >= next_report:
+                report(self.statistics.summary(now))
+                next_report += interval
+
+            # sleep until the next event, the next report or octets from an agent
+            deadlines = [when for when in (stop_at, next_report, warmup_end) if when is not None]
+            if self.events:
+                deadlines.append(self.events[0][0])
+            timeout = max(0.0, min(deadlines) - now) if deadlines else None
+
+            fds = [port.fd for port in self.ports if isinstance(port, PtyPort)]
+            if fds:
+                readable = select.select(fds, [], [], timeout)[0]
+            else:
+                readable = []
+                if timeout:
+                    select.select([], [], [], timeout)
+
+            now = self.now()
+            for port in self.ports:
+                if isinstance(port, PtyPort) and port.fd in readable:
+                    port.read(now)
+
+            while self.events and self.events[0][0] <= self.now():
+                when, sequence, fn, args = heapq.heappop(self.events)
+                fn(*args)
+
+        return self.statistics.summary(self.now())
+
+    def close(self):
+        for port in self.ports:
+            port.close()
+
+#
+#   PtyPort
+#
+
+@bacpypes_debugging
+class PtyPort(object):
+
+    """A pseudo terminal for an agent."""
+
+    def __init__(self, bus, link):
+        if _debug: PtyPort._debug("__init__ %r", link)
+
+        self.bus = bus
+        self.link = link
+        self.parser = MSTPFrameParser()
+        self.transmit_end = 0.0
+        self.frame_start = None
+        self.overruns = 0
+
+        # keep the slave open so reads do not fail while no agent has it open
+        self.fd, self.slave = os.openpty()
+        tty.setraw(self.fd)
+        tty.setraw(self.slave)
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(os.ttyname(self.slave), link)
+
+    def start(self):
+        pass
+
+    def read(self, now):
+        """Octets from the agent, the frames go on the wire from the time the
+        first octet of each one was read."""
+        try:
+            octets = os.read(self.fd, 4096)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EIO):
+                return
+            raise
+
+        if self.frame_start is None:
+            self.frame_start = now
+        for raw, frame in self.parser.feed(octets):
+            if _debug: PtyPort._debug("    - frame %r", frame)
+            self.bus.transmit(self, raw, frame, self.frame_start)
+            self.frame_start = now
+        if not self.parser.pending():
+            self.frame_start = None
+
+    def receive(self, octets, frame):
+        """Octets on the wire go to the agent."""
+        try:
+            os.write(self.fd, octets)
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+            self.overruns += 1
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.slave)
+        if os.path.islink(self.link):
+            os.remove(self.link)
+
+#
+#   SimulatedApplication
+#
+
+@bacpypes_debugging
+class SimulatedApplication(ReadWritePropertyServices, ReadWritePropertyMultipleServices,
+        WhoIsIAmServices, Application):
+
+    """The objects of a simulated station, requests come from the station and
+    the responses and requests go back to it."""
+
+    _startup_disabled = True
+
+    def __init__(self, station, localDevice):
+        Application.__init__(self, localDevice)
+        self.station = station
+
+    def request(self, apdu):
+        self.station.send_apdu(apdu, expecting_reply=False)
+
+    def response(self, apdu):
+        self.station.send_apdu(apdu, expecting_reply=False)
+
+#
+#   SimulatedStation
+#
+
+@bacpypes_debugging
+class SimulatedStation(object):
+
+    """A master node of clause 9 that passes the token, answers polls and
+    serves the objects of its application."""
+
+    def __init__(self, bus, mac, max_master=MSTP_MAX_MASTER, max_info_frames=1,
+            device_base=1000, objects=1, reply_delay=0.002):
+        if _debug: SimulatedStation._debug("__init__ %r", mac)
+
+        self.bus = bus
+        self.mac = mac
+        self.max_master = max_master
+        self.max_info_frames = max_info_frames
+        self.reply_delay = max(reply_delay, 40.0 / bus.baudrate)
+        self.transmit_end = 0.0
+
+        # token passing state
+        self.next_station = mac
+        self.poll_station = mac
+        self.token_count = 0
+        self.waiting = None
+        self.wait_id = 0
+
+        # frames to send when the token comes
+        self.queue = deque()
+        self.reply_to = None
+
+        device = LocalDeviceObject(
+            objectName='Station {}'.format(mac),
+            objectIdentifier=('device', device_base + mac),
+            maxApduLengthAccepted=480,
+            segmentationSupported='noSegmentation',
+            vendorIdentifier=15,
+            databaseRevision=1,
+            )
+        self.application = SimulatedApplication(self, device)
+        for instance in range(1, objects + 1):
+            self.application.add_object(AnalogValueObject(
+                objectIdentifier=('analogValue', instance),
+                objectName='AV {}'.format(instance),
+                presentValue=float(mac),
+                statusFlags=[0, 0, 0, 0],
+                units='noUnits',
+                ))
+
+    def __repr__(self):
+        return "<SimulatedStation {}>".format(self.mac)
+
+    def start(self):
+        self.watch_token()
+
+    def close(self):
+        pass
+
+    def send(self, frame_type, destination, data=b'', delay=None):
+        """Put a frame on the wire after the turnaround."""
+        frame = MSTPFrame(frame_type, destination, self.mac, data)
+        when = self.bus.now() + (self.reply_delay if delay is None else delay)
+        return self.bus.transmit(self, encode_frame(frame_type, destination, self.mac, data), frame, when)
+
+    def wait_for(self, kind, station, end, retries=0):
+        """Wait for the station to use the token or answer a poll."""
+        self.wait_id += 1
+        self.waiting = (kind, station, retries, self.wait_id)
+        self.bus.call_at(end + Tusage_timeout, self.usage_timeout, self.wait_id)
+
+    #   receiving
+
+    def receive(self, octets, frame):
+        """A frame on the wire, None when it was garbled."""
+        if self.waiting:
+            if frame and frame.frame_type == FRAME_TYPE_REPLY_TO_POLL_FOR_MASTER and \
+                    frame.destination == self.mac and frame.source == self.waiting[1]:
+                # a successor, closer than the one before
+                self.waiting = None
+                self.next_station = frame.source
+                self.token_count = 0
+                self.pass_token()
+                return
+
+            # anything else on the wire, garbled or not, means that some other
+            # station has the token, the successor when it was passed
+            if _debug: SimulatedStation._debug("    - %r saw token user, %r", self.mac, self.waiting)
+            self.waiting = None
+
+        if frame is None:
+            return
+
+        if frame.destination == self.mac:
+            if frame.frame_type == FRAME_TYPE_TOKEN:
+                self.waiting = None
+                self.use_token()
+            elif frame.frame_type == FRAME_TYPE_POLL_FOR_MASTER:
+                self.send(FRAME_TYPE_REPLY_TO_POLL_FOR_MASTER, frame.source)
+            elif frame.frame_type == FRAME_TYPE_TEST_REQUEST:
+                self.send(FRAME_TYPE_TEST_RESPONSE, frame.source, frame.data)
+            elif frame.frame_type == FRAME_TYPE_BACNET_DATA_EXPECTING_REPLY:
+                self.receive_npdu(frame, expecting_reply=True)
+            elif frame.frame_type == FRAME_TYPE_BACNET_DATA_NOT_EXPECTING_REPLY:
+                self.receive_npdu(frame, expecting_reply=False)
+        elif frame.destination == MSTP_BROADCAST and \
+                frame.frame_type == FRAME_TYPE_BACNET_DATA_NOT_EXPECTING_REPLY:
+            self.receive_npdu(frame, expecting_reply=False)
+
+    def receive_npdu(self, frame, expecting_reply):
+        """Decode the request in the frame and give it to the application."""
+        try:
+            npdu = NPDU()
+            npdu.decode(PDU(frame.data, source=Address(frame.source)))
+            if npdu.npduNetMessage is not None:
+                return
+            if npdu.npduDADR and npdu.npduDADR.addrType != Address.globalBroadcastAddr:
+                return
+
+            apdu = _APDU()
+            apdu.decode(npdu)
+            xpdu = apdu_types[apdu.apduType]()
+            xpdu.decode(apdu)
+        except Exception as err:
+            if _debug: SimulatedStation._debug("    - decoding error: %r", err)
+            return
+
+        if isinstance(xpdu, ConfirmedRequestPDU):
+            service = confirmed_request_types.get(xpdu.apduService)
+        elif isinstance(xpdu, UnconfirmedRequestPDU):
+            service = unconfirmed_request_types.get(xpdu.apduService)
+        else:
+            return
+
+        self.reply_to = (frame.source, npdu.npduSADR, expecting_reply)
+        try:
+            if not service:
+                if isinstance(xpdu, ConfirmedRequestPDU):
+                    self.send_apdu(RejectPDU(reason='unrecognizedService', context=xpdu))
+                return
+            request = service()
+            request.decode(xpdu)
+            self.application.indication(request)
+        except RejectException as err:
+            self.send_apdu(RejectPDU(reason=err.rejectReason, context=xpdu))
+        except AbortException as err:
+            self.send_apdu(AbortPDU(reason=err.abortReason, context=xpdu))
+        finally:
+            self.reply_to = None
+
+    def send_apdu(self, apdu, expecting_reply=False):
+        """Send a response right away as the reply to a request that expects
+        one, anything else waits for the token."""
+        if isinstance(apdu, ComplexAckPDU):
+            xpdu = ComplexAckPDU()
+            apdu.encode(xpdu)
+        elif isinstance(apdu, ErrorPDU):
+            xpdu = ErrorPDU()
+            apdu.encode(xpdu)
+        elif isinstance(apdu, UnconfirmedRequestPDU):
+            xpdu = UnconfirmedRequestPDU()
+            apdu.encode(xpdu)
+        else:
+            xpdu = apdu
+
+        generic = _APDU()
+        xpdu.encode(generic)
+        npdu = NPDU()
+        generic.encode(npdu)
+
+        if isinstance(apdu, UnconfirmedRequestPDU) or not self.reply_to:
+            destination = MSTP_BROADCAST
+            if isinstance(apdu.pduDestination, Address) and \
+                    apdu.pduDestination.addrType == Address.localStationAddr:
+                destination = apdu.pduDestination.addrAddr[0]
+            npdu.pduDestination = LocalBroadcast()
+        else:
+            destination, sadr, reply = self.reply_to
+            if sadr:
+                npdu.npduDADR = sadr
+                npdu.npduHopCount = 255
+
+        pdu = PDU()
+        npdu.encode(pdu)
+        data = bytes(pdu.pduData)
+
+        if self.reply_to and self.reply_to[2] and not isinstance(apdu, UnconfirmedRequestPDU):
+            self.send(FRAME_TYPE_BACNET_DATA_NOT_EXPECTING_REPLY, destination, data)
+        else:
+            self.queue.append((destination, data))
+
+    #   token passing
+
+    def use_token(self):
+        """Send what is waiting, then pass the token on."""
+        for i in range(self.max_info_frames):
+            if not self.queue:
+                break
+            destination, data = self.queue.popleft()
+            self.send(FRAME_TYPE_BACNET_DATA_NOT_EXPECTING_REPLY, destination, data)
+        self.done_with_token()
+
+    def done_with_token(self):
+        self.token_count += 1
+
+        if self.next_station == self.mac:
+            # no successor yet, look for one
+            self.poll_station = self.mac
+            self.poll_for_successor()
+            return
+
+        if self.token_count >= Npoll:
+            # every Npoll tokens poll one address between this and the next station
+            self.token_count = 0
+            station = (self.poll_station + 1) % (self.max_master + 1)
+            if not self.between(station):
+                station = (self.mac + 1) % (self.max_master + 1)
+            if station != self.next_station:
+                self.poll_station = station
+                end = self.send(FRAME_TYPE_POLL_FOR_MASTER, station)
+                self.wait_for('gap', station, end)
+                return
+
+        self.pass_token()
+
+    def between(self, station):
+        """True when the station is after this one and before the next."""
+        size = self.max_master + 1
+        return 0 < (station - self.mac) % size < (self.next_station - self.mac) % size
+
+    def pass_token(self, retries=0):
+        end = self.send(FRAME_TYPE_TOKEN, self.next_station)
+        self.wait_for('pass', self.next_station, end, retries)
+
+    def poll_for_successor(self):
+        """Poll the next address after the last one polled, when it comes
+        around to this station it is the sole master."""
+        self.poll_station = (self.poll_station + 1) % (self.max_master + 1)
+        if self.poll_station == self.mac:
+            if _debug: SimulatedStation._debug("    - sole master %r", self.mac)
+            self.next_station = self.mac
+            self.wait_for('sole', self.mac, self.bus.now())
+            return
+        end = self.send(FRAME_TYPE_POLL_FOR_MASTER, self.poll_station)
+        self.wait_for('successor', self.poll_station, end)
+
+    def usage_timeout(self, wait_id):
+        """Nobody used the token or answered the poll."""
+        if not self.waiting or self.waiting[3] != wait_id:
+            return
+
+        # some station is using the wire, look again once its frame is in
+        busy = self.bus.busy_until(self, self.bus.now())
+        if busy is not None:
+            self.bus.call_at(busy, self.usage_timeout, wait_id)
+            return
+
+        kind, station, retries, wait_id = self.waiting
+        self.waiting = None
+        if _debug: SimulatedStation._debug("usage_timeout %r %r %r", self.mac, kind, station)
+
+        if kind == 'pass':
+            if retries < Nretry_token:
+                self.pass_token(retries + 1)
+            else:
+                # the successor is gone, find a new one
+                self.next_station = self.mac
+                self.poll_station = self.mac
+                self.poll_for_successor()
+        elif kind == 'gap':
+            self.pass_token()
+        elif kind == 'successor':
+            self.poll_for_successor()
+        elif kind == 'sole':
+            self.use_token()
+
+    def watch_token(self):
+        """Generate a token when the bus has been silent for Tno_token plus
+        a slot for each station below this one."""
+        now = self.bus.now()
+        silence = now - max(self.bus.last_activity, self.transmit_end)
+        if self.bus.busy_until(self, now) is not None:
+            silence = 0.0
+        quiet = Tno_token + Tslot * self.mac
+        if silence >= quiet and not self.waiting:
+            if _debug: SimulatedStation._debug("    - lost token, %r generates one", self.mac)
+            self.next_station = self.mac
+            self.poll_station = self.mac
+            self.poll_for_successor()
+            self.bus.call_at(now + quiet, self.watch_token)
+        else:
+            self.bus.call_at(now + max(quiet - silence, Tslot), self.watch_token)
+
+#
+#   parse_stations
+#
+
+def parse_stations(value):
+    """Return the MAC addresses in a list like '2-59,100'."""
+    stations = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            stations.extend(range(int(first), int(last) + 1))
+        else:
+            stations.append(int(part))
+    for mac in stations:
+        if not 0 <= mac <= MSTP_MAX_MASTER:
+            raise ValueError("not a master station address: {}".format(mac))
+    return stations
+
+#
+#   __main__
+#
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pty', action='append', default=[],
+        help="path of a pseudo terminal for an agent, once for each agent")
+    parser.add_argument('--stations', default='',
+        help="MAC addresses of simulated stations, like 2-59,100")
+    parser.add_argument('--baudrate', type=int, default=38400)
+    parser.add_argument('--loss', type=float, default=0.0,
+        help="probability that a receiver loses a frame to noise")
+    parser.add_argument('--max-master', type=int, default=MSTP_MAX_MASTER)
+    parser.add_argument('--max-info-frames', type=int, default=1)
+    parser.add_argument('--objects', type=int, default=1,
+        help="analog values in each simulated station")
+    parser.add_argument('--device-base', type=int, default=1000,
+        help="device instance of a simulated station is this plus its MAC")
+    parser.add_argument('--reply-delay', type=float, default=2.0,
+        help="milliseconds a simulated station takes to answer")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--duration', type=float, default=None,
+        help="seconds to run, forever when not given")
+    parser.add_argument('--warmup', type=float, default=0.0,
+        help="seconds to let the ring form before the statistics start")
+    parser.add_argument('--interval', type=float, default=5.0,
+        help="seconds between reports")
+    parser.add_argument('--json', action='store_true',
+        help="print the reports as JSON")
+    args = parser.parse_args(argv)
+
+    stations = parse_stations(args.stations)
+    if not args.pty and not stations:
+        parser.error("nothing on the bus, give --pty or --stations")
+
+    bus = VirtualBus(args.baudrate, loss=args.loss, seed=args.seed)
+    for link in args.pty:
+        bus.add_pty(link)
+    for mac in stations:
+        bus.add_station(mac,
+            max_master=args.max_master,
+            max_info_frames=args.max_info_frames,
+            device_base=args.device_base,
+            objects=args.objects,
+            reply_delay=args.reply_delay / 1000.0,
+            )
+
+    def report(summary):
+        if args.json:
+            print(json.dumps(summary, sort_keys=True))
+        else:
+            rotation = summary['token_rotation_ms']
+            requests = summary['requests']
+            print("{:8.1f}s  stations={} util={:.1%} token p50={} p95={} max={} ms  "
+                "requests={} replies={} ({}/s) collisions={} lost={}".format(
+                summary['elapsed'], summary['stations'], summary['utilization'],
+                rotation['p50'], rotation['p95'], rotation['max'],
+                requests['sent'], requests['replies'], requests['per_second'],
+                summary['collisions'], summary['lost']))
+        sys.stdout.flush()
+
+    try:
+        summary = bus.run(args.duration, args.interval, report, args.warmup)
+        report(summary)
+    except KeyboardInterrupt:
+        report(bus.statistics.summary(bus.now()))
+    finally:
+        bus.close()
+
+
+if __name__ == "__main__":
+    main()
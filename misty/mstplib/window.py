@@ -0,0 +1,263 @@
+"""
+Copyright (c) 2018 by Riptide I/O
+All rights reserved.
+
+Windows of confirmed requests for each device.  Most MS/TP controllers take
+one confirmed request at a time, more of them only bring aborts and retries
+that waste token passes, so by default a device has one request out at a
+time like the sieve queue of bacpypes.  A device that takes more can be
+given a larger window and the requests waiting for it go out as the window
+allows, the responses are matched to the requests by invoke ID.
+
+The window is learned between one and the limit of the device: it grows by
+one for every window of answered requests and is halved by an abort that
+says the device is busy or by a request that got no response.  A device that
+does not answer with a window of one is left alone for a while, doubled
+every time, so the requests for it do not hold the trunk.  The next request
+goes down the stack as soon as a response comes in, and since each device
+has no more than its window of requests in the lanes of the trunk, one that
+has a lot to do does not starve the others.
+"""
+
+from __future__ import absolute_import
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.iocb import IOController, IOQueue, COMPLETED, ABORTED
+from bacpypes.task import FunctionTask
+from bacpypes.apdu import UnconfirmedRequestPDU, SimpleAckPDU, ComplexAckPDU, \
+    ErrorPDU, RejectPDU, AbortPDU, AbortReason
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# requests a device has out at a time unless it is given more
+MSTP_WINDOW = 1
+
+# aborts that say the device had too much to do, with no response
+WINDOW_ABORT_REASONS = (
+    AbortReason.other, AbortReason.preemptedByHigherPriorityTask,
+    AbortReason.outOfResources, AbortReason.noResponse,
+    )
+
+# seconds a device that does not answer is left alone the first time, and
+# the most it is left alone
+WINDOW_BACKOFF = 1.0
+WINDOW_MAX_BACKOFF = 30.0
+
+#
+#   WindowQueue
+#
+
+@bacpypes_debugging
+class WindowQueue(IOController):
+
+    """The requests for a device, waiting in the order of their priority,
+    and the ones that are out by invoke ID."""
+
+    def __init__(self, request_fn, address, limit=MSTP_WINDOW):
+        if _debug: WindowQueue._debug("__init__ %r %r limit=%r", request_fn, address, limit)
+        IOController.__init__(self, str(address))
+
+        self.request_fn = request_fn
+        self.address = address
+
+        # the most requests out, and the window learned below that
+        self.limit = limit
+        self.window = float(limit)
+
+        self.ioQueue = IOQueue(str(address))
+        self.active = {}
+
+        # seconds the device is left alone after it did not answer
+        self.backoff = 0.0
+        self.resumeTask = FunctionTask(self.trigger)
+
+        # requests answered, aborts that closed the window and requests
+        # that got no response
+        self.answered = 0
+        self.aborts = 0
+        self.timeouts = 0
+
+    def process_io(self, iocb):
+        if _debug: WindowQueue._debug("process_io %r", iocb)
+
+        self.ioQueue.put(iocb)
+        self.trigger()
+
+    def trigger(self):
+        """Send the requests that fit in the window."""
+        if _debug: WindowQueue._debug("trigger")
+
+        if self.resumeTask.isScheduled:
+            return
+
+        while self.ioQueue.queue and (len(self.active) < int(self.window)):
+            iocb = self.ioQueue.get()
+            apdu = iocb.args[0]
+
+            try:
+                self.request_fn(apdu)
+            except Exception as err:
+                IOController.abort_io(self, iocb, err)
+                continue
+
+            # an unconfirmed request is done when it is sent
+            if isinstance(apdu, UnconfirmedRequestPDU):
+                IOController.complete_io(self, iocb, None)
+            else:
+                self.active[apdu.apduInvokeID] = iocb
+
+    def response(self, apdu):
+        """Complete the request of the response and send the next one."""
+        if _debug: WindowQueue._debug("response %r", apdu)
+
+        iocb = self.active.pop(apdu.apduInvokeID, None)
+        if not iocb:
+            if _debug: WindowQueue._debug("    - no request for %r", apdu.apduInvokeID)
+            return
+
+        if isinstance(apdu, AbortPDU) and (apdu.apduAbortRejectReason in WINDOW_ABORT_REASONS):
+            self.close(apdu.apduAbortRejectReason == AbortReason.noResponse)
+        else:
+            self.answered += 1
+            self.backoff = 0.0
+            self.window = min(self.window + 1.0 / self.window, float(self.limit))
+
+        if isinstance(apdu, (SimpleAckPDU, ComplexAckPDU)):
+            IOController.complete_io(self, iocb, apdu)
+        elif isinstance(apdu, (ErrorPDU, RejectPDU, AbortPDU)):
+            IOController.abort_io(self, iocb, apdu)
+        else:
+            raise RuntimeError("unrecognized APDU type")
+
+        self.trigger()
+
+    def close(self, timeout):
+        """Halve the window, leave the device alone for a while when it did
+        not answer with a window of one."""
+        if _debug: WindowQueue._debug("close timeout=%r", timeout)
+
+        if timeout:
+            self.timeouts += 1
+        else:
+            self.aborts += 1
+
+        if timeout and (self.window <= 1.0):
+            self.backoff = min(max(self.backoff * 2, WINDOW_BACKOFF), WINDOW_MAX_BACKOFF)
+            if _debug: WindowQueue._debug("    - backoff %r", self.backoff)
+            self.resumeTask.install_task(delta=self.backoff)
+
+        self.window = max(self.window / 2, 1.0)
+
+    def abort_io(self, iocb, err):
+        """A request that is aborted before it is answered lets go of its
+        place, the response is dropped when it comes."""
+        if _debug: WindowQueue._debug("abort_io %r %r", iocb, err)
+
+        if iocb.ioState in (COMPLETED, ABORTED):
+            return
+
+        if iocb.ioQueue:
+            iocb.ioQueue.remove(iocb)
+        for invoke_id, active in list(self.active.items()):
+            if active is iocb:
+                del self.active[invoke_id]
+
+        IOController.abort_io(self, iocb, err)
+        self.trigger()
+
+    def idle(self):
+        """Return true when there is nothing out or waiting and nothing has
+        been learned about the device."""
+        return (not self.active) and (not self.ioQueue.queue) \
+            and (not self.backoff) and (self.window >= self.limit)
+
+    def dict_contents(self):
+        return {
+            'limit': self.limit,
+            'window': self.window,
+            'active': len(self.active),
+            'waiting': len(self.ioQueue.queue),
+            'backoff': self.backoff,
+            'answered': self.answered,
+            'aborts': self.aborts,
+            'timeouts': self.timeouts,
+            }
+
+#
+#   MSTPWindowMixin
+#
+
+@bacpypes_debugging
+class MSTPWindowMixin(object):
+
+    """Application mixin that goes before MSTPCoalesceMixin and puts the
+    requests for each device in a window queue instead of a sieve queue, the
+    merged reads of a device go out as its window allows.  The limit is the
+    window of the devices that are not given one."""
+
+    def __init__(self, limit=MSTP_WINDOW):
+        if _debug: MSTPWindowMixin._debug("__init__ limit=%r", limit)
+
+        self.windowLimit = limit
+        self.windowLimits = {}
+
+    def set_window(self, address, limit=None):
+        """Set the window of the device, back to the one of the application
+        without a limit."""
+        if _debug: MSTPWindowMixin._debug("set_window %r %r", address, limit)
+
+        if limit is None:
+            self.windowLimits.pop(address, None)
+            limit = self.windowLimit
+        elif limit < 1:
+            raise ValueError("window must be at least one")
+        else:
+            self.windowLimits[address] = limit
+
+        queue = self.queue_by_address.get(address)
+        if queue:
+            queue.limit = limit
+            queue.window = min(queue.window, float(limit))
+            queue.trigger()
+
+    def coalesce_window(self, address):
+        """Return the window of the device, the reads waiting for it are
+        merged into as many requests (see misty.mstplib.coalesce)."""
+        queue = self.queue_by_address.get(address)
+        if queue:
+            return int(queue.window)
+        return self.windowLimits.get(address, self.windowLimit)
+
+    def process_io(self, iocb):
+        if _debug: MSTPWindowMixin._debug("process_io %r", iocb)
+
+        address = iocb.args[0].pduDestination
+        queue = self.queue_by_address.get(address)
+        if not queue:
+            queue = self.queue_by_address[address] = WindowQueue(self._app_request, address,
+                self.windowLimits.get(address, self.windowLimit))
+
+        queue.request_io(iocb)
+
+    def _app_complete(self, address, apdu):
+        if _debug: MSTPWindowMixin._debug("_app_complete %r %r", address, apdu)
+
+        queue = self.queue_by_address.get(address)
+        if not queue:
+            if _debug: MSTPWindowMixin._debug("    - no queue for %r", address)
+            return
+
+        # unconfirmed requests are completed by the queue
+        if apdu is not None:
+            queue.response(apdu)
+
+        # forget the queue unless there is something to remember
+        if queue.idle():
+            del self.queue_by_address[address]
+
+    def window_counters(self):
+        """Return the windows of the devices that have requests out or
+        waiting, or a window below their limit."""
+        return dict((address, queue.dict_contents()) for address, queue in self.queue_by_address.items())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+This application reads a property from a list of objects on the same device
+concurrently, each read is a coroutine running on a standard asyncio event
+loop instead of the bacpypes run() loop.
+"""
+
+import sys
+import asyncio
+
+from bacpypes.debugging import ModuleLogger
+from bacpypes.consolelogging import ConfigArgumentParser
+
+from bacpypes.iocb import IOCB
+
+from bacpypes.pdu import Address
+from bacpypes.apdu import ReadPropertyRequest, ReadPropertyACK
+from bacpypes.primitivedata import ObjectIdentifier
+
+from misty.mstplib.aio import MSTPAsyncApplication
+from bacpypes.object import get_datatype
+from bacpypes.local.device import LocalDeviceObject
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+
+async def read_property(app, addr, obj_id, prop_id):
+    """Read a property and return the value."""
+    if _debug: _log.debug("read_property %r %r %r", addr, obj_id, prop_id)
+
+    # build a request
+    request = ReadPropertyRequest(
+        objectIdentifier=obj_id,
+        propertyIdentifier=prop_id,
+        )
+    request.pduDestination = Address(addr)
+
+    # give it to the application and wait for it to complete
+    iocb = await app.request_io_async(IOCB(request))
+
+    # do something for error/reject/abort
+    if iocb.ioError:
+        return iocb.ioError
+
+    apdu = iocb.ioResponse
+    if not isinstance(apdu, ReadPropertyACK):
+        return None
+
+    datatype = get_datatype(apdu.objectIdentifier[0], apdu.propertyIdentifier)
+    return apdu.propertyValue.cast_out(datatype)
+
+
+async def read_all(args):
+    mstp_args = {
+        '_address': int(args.ini.address),
+        '_interface':str(args.ini.interface),
+        '_max_masters': int(args.ini.max_masters),
+        '_baudrate': int(args.ini.baudrate),
+        '_maxinfo': int(args.ini.maxinfo),
+    }
+    # make a device object
+    this_device = LocalDeviceObject(ini=args.ini, **mstp_args)
+    if _debug: _log.debug("    - this_device: %r", this_device)
+
+    # make an application on the running loop
+    this_application = MSTPAsyncApplication(this_device, args.ini.address)
+    await this_application.wait_ready()
+
+    obj_ids = [ObjectIdentifier(obj_id).value for obj_id in args.objects]
+    values = await asyncio.gather(*[
+        read_property(this_application, args.addr, obj_id, args.property)
+        for obj_id in obj_ids
+        ])
+
+    for obj_id, value in zip(obj_ids, values):
+        sys.stdout.write("{} {}\n".format(obj_id, value))
+    sys.stdout.flush()
+
+    this_application.close_socket()
+
+#
+#   __main__
+#
+
+def main():
+    # parse the command line arguments
+    parser = ConfigArgumentParser(description=__doc__)
+    parser.add_argument('addr', help='device address')
+    parser.add_argument('property', help='property identifier')
+    parser.add_argument('objects', nargs='+', help='object identifiers, <type>:<inst>')
+    args = parser.parse_args()
+
+    if _debug: _log.debug("initialization")
+    if _debug: _log.debug("    - args: %r", args)
+
+    asyncio.run(read_all(args))
+
+    _log.debug("fini")
+
+if __name__ == "__main__":
+    main()
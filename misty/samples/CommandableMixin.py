@@ -52,6 +52,8 @@ def main():
         '_baudrate': int(args.ini.baudrate),
         '_maxinfo': int(args.ini.maxinfo),
     }
+    if hasattr(args.ini, 'mstp_response_cache'):
+        mstp_args['_mstp_response_cache'] = int(args.ini.mstp_response_cache)
     # make a device object
     this_device = LocalDeviceObject(ini=args.ini, **mstp_args)
     if _debug:
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+This application routes between several MS/TP trunks in one process.  The
+trunks are listed in the ini file, one per line with the network number, the
+MAC address of the router and the interface, optionally followed by the baud
+rate of the trunk:
+
+    trunks: 1 25 /dev/ttyS0
+            2 25 /dev/ttyS1 76800
+
+The device object of the router is on the first trunk.  The console has
+commands to look at the routing table and the counters of the agent.
+"""
+
+from __future__ import absolute_import
+import os
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from bacpypes.consolelogging import ConfigArgumentParser
+from bacpypes.consolecmd import ConsoleCmd
+
+from bacpypes.core import run, enable_sleeping
+
+from misty.mstplib.router import MSTPTrunk, MSTPRouterApplication
+from misty.mstplib.priority import MSTP_PRIORITY_CLASSES
+from bacpypes.local.device import LocalDeviceObject
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# globals
+this_device = None
+this_application = None
+
+#
+#   MSTPRouterConsoleCmd
+#
+
+@bacpypes_debugging
+class MSTPRouterConsoleCmd(ConsoleCmd):
+
+    def do_routes(self, args):
+        """routes"""
+        if _debug: MSTPRouterConsoleCmd._debug("do_routes %r", args)
+
+        routes = this_application.routing_table()
+        for net in sorted(routes):
+            snet, router = routes[net]
+            if router is None:
+                print("{:>5}  direct".format(net))
+            else:
+                print("{:>5}  via {} on {}".format(net, router, snet))
+
+    def do_mstpstat(self, args):
+        """mstpstat"""
+        if _debug: MSTPRouterConsoleCmd._debug("do_mstpstat %r", args)
+
+        # the agent prints the counters of every port
+        directPort = this_application.mux[this_application.trunks[0].network].directPort
+        directPort.mstp_lib.get_mstpstats()
+
+        # PDUs waiting for each trunk
+        for trunk in this_application.trunks:
+            counters = this_application.mux[trunk.network].directPort.queue_counters()
+            print("{:>5}  queue: depth={} length={} high_water={} refused={} dropped={}".format(
+                trunk.network, counters['depth'], counters['length'],
+                counters['high_water'], counters['refused'], counters['dropped']))
+            lanes = this_application.mux[trunk.network].directPort.lane_counters()
+            print("{:>5}  sent: {}".format(trunk.network, " ".join(
+                "{}={}".format(priority_class, lanes[priority_class].get('sent', 0))
+                for priority_class in MSTP_PRIORITY_CLASSES)))
+
+#
+#   parse_trunks
+#
+
+def parse_trunks(localDevice, value):
+    """Return the trunks from the value of the trunks option."""
+    trunks = []
+    for line in value.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) not in (3, 4):
+            raise ValueError("trunk needs network, address and interface: {!r}".format(line))
+
+        kwargs = {}
+        if len(fields) == 4:
+            kwargs['baudrate'] = int(fields[3])
+        trunks.append(MSTPTrunk(localDevice, int(fields[0]), int(fields[1]), fields[2], **kwargs))
+
+    return trunks
+
+#
+#   __main__
+#
+
+def main():
+    global this_device, this_application
+
+    # parse the command line arguments
+    args = ConfigArgumentParser(description=__doc__).parse_args()
+
+    if _debug: _log.debug("initialization")
+    if _debug: _log.debug("    - args: %r", args)
+
+    # make a device object, the defaults for the trunks
+    mstp_args = {
+        '_max_masters': int(args.ini.max_masters),
+        '_baudrate': int(args.ini.baudrate),
+        '_maxinfo': int(args.ini.maxinfo),
+    }
+    if hasattr(args.ini, 'mstp_ipc'):
+        mstp_args['_mstp_ipc'] = str(args.ini.mstp_ipc)
+    if hasattr(args.ini, 'mstp_queue_depth'):
+        mstp_args['_mstp_queue_depth'] = int(args.ini.mstp_queue_depth)
+    if hasattr(args.ini, 'mstp_pdu_queue'):
+        mstp_args['_mstp_pdu_queue'] = int(args.ini.mstp_pdu_queue)
+    if hasattr(args.ini, 'mstp_stats'):
+        mstp_args['_mstp_stats'] = str(args.ini.mstp_stats)
+    if hasattr(args.ini, 'mstp_capture_size'):
+        mstp_args['_mstp_capture_size'] = int(args.ini.mstp_capture_size)
+    if hasattr(args.ini, 'mstp_capture_files'):
+        mstp_args['_mstp_capture_files'] = int(args.ini.mstp_capture_files)
+    if hasattr(args.ini, 'device_cache'):
+        mstp_args['_mstp_device_cache'] = str(args.ini.device_cache)
+
+    if hasattr(args.ini, 'mstp_coalesce'):
+        mstp_args['_mstp_coalesce'] = int(args.ini.mstp_coalesce)
+    if hasattr(args.ini, 'mstp_bandwidth_budget'):
+        mstp_args['_mstp_bandwidth_budget'] = float(args.ini.mstp_bandwidth_budget)
+    if hasattr(args.ini, 'mstp_window'):
+        mstp_args['_mstp_window'] = int(args.ini.mstp_window)
+    if hasattr(args.ini, 'mstp_response_cache'):
+        mstp_args['_mstp_response_cache'] = int(args.ini.mstp_response_cache)
+    this_device = LocalDeviceObject(ini=args.ini, **mstp_args)
+    if _debug: _log.debug("    - this_device: %r", this_device)
+
+    trunks = parse_trunks(this_device, args.ini.trunks)
+    if _debug: _log.debug("    - trunks: %r", trunks)
+
+    # each trunk is captured to its own file in the capture directory
+    if hasattr(args.ini, 'mstp_capture'):
+        for trunk in trunks:
+            trunk._mstp_capture = os.path.join(str(args.ini.mstp_capture), 'trunk{}.pcap'.format(trunk.network))
+
+    # make a router
+    this_application = MSTPRouterApplication(this_device, trunks)
+
+    # make a console
+    this_console = MSTPRouterConsoleCmd()
+    if _debug: _log.debug("    - this_console: %r", this_console)
+
+    # enable sleeping will help with threads
+    enable_sleeping()
+
+    _log.debug("running")
+
+    run()
+
+    _log.debug("fini")
+
+
+if __name__ == "__main__":
+    main()
@@ -105,6 +105,12 @@ def main():
         '_baudrate': int(args.ini.baudrate),
         '_maxinfo': int(args.ini.maxinfo),
     }
+
+    # set this to 0 to encode every response instead of keeping the ones
+    # of the properties that rarely change
+    if hasattr(args.ini, 'mstp_response_cache'):
+        mstp_args['_mstp_response_cache'] = int(args.ini.mstp_response_cache)
+
     this_device = LocalDeviceObject(ini=args.ini, **mstp_args)
     if _debug: _log.debug("    - this_device: %r", this_device)
 
@@ -16,8 +16,7 @@ from bacpypes.debugging import bacpypes_debugging, ModuleLogger
 from bacpypes.consolelogging import ConfigArgumentParser
 from bacpypes.consolecmd import ConsoleCmd
 
-from bacpypes.core import deferred
-from bacpypes.core import run, enable_sleeping
+from bacpypes.core import run, deferred, enable_sleeping
 from bacpypes.iocb import IOCB
 
 from bacpypes.pdu import Address, GlobalBroadcast
@@ -33,9 +32,14 @@ from bacpypes.primitivedata import Null, Atomic, Boolean, Integer, \
     Real, Double, OctetString, CharacterString, BitString, Date, Time
 from bacpypes.constructeddata import Any, AnyAtomic
 
-from misty.mstplib import MSTPSimpleApplication
+from misty.mstplib import MSTPSimpleApplication, mstp_debug, MSTP_DEBUG_LEVELS, MSTP_DEBUG_CATEGORIES
+from misty.mstplib.priority import MSTP_PRIORITY_CLASSES
+from misty.mstplib.discover import ObjectDiscovery
+from misty.mstplib.devices import DeviceScan, WHOIS_MAX_INSTANCE
+from misty.mstplib.metadata import MSTPMetadataStore
+from misty.mstplib.poll import PointPoller
+from misty.mstplib.cov import COVSubscriptionManager, COV_LIFETIME
 from bacpypes.local.device import LocalDeviceObject
-from six.moves import range
 
 # some debugging
 _debug = 0
@@ -44,6 +48,9 @@ _log = ModuleLogger(globals())
 # globals
 this_device = None
 this_application = None
+this_discovery = None
+this_poller = None
+this_cov = None
 
 #
 #   WhoIsIAmApplication
@@ -129,6 +136,34 @@ class BacnetClientConsoleCmd(ConsoleCmd):
         except Exception as err:
             BacnetClientConsoleCmd._exception("exception: %r", err)
 
+    def do_scan(self, args):
+        """scan [ <lolimit> <hilimit> ] [ <ranges> ]"""
+        args = args.split()
+        if _debug: BacnetClientConsoleCmd._debug("do_scan %r", args)
+
+        try:
+            kwargs = {}
+            if len(args) >= 2:
+                kwargs['low'], kwargs['high'] = int(args[0]), int(args[1])
+                del args[:2]
+            if args:
+                kwargs['ranges'] = int(args[0])
+
+            start_scan(**kwargs)
+
+        except Exception as err:
+            BacnetClientConsoleCmd._exception("exception: %r", err)
+
+    def do_devices(self, args):
+        """devices"""
+        if _debug: BacnetClientConsoleCmd._debug("do_devices %r", args)
+
+        for device_info in this_application.deviceInfoCache.devices():
+            sys.stdout.write('device:{} at {} maxAPDU={} segmentation={} vendor={}\n'.format(
+                device_info.deviceIdentifier, device_info.address, device_info.maxApduLengthAccepted,
+                device_info.segmentationSupported, device_info.vendorID))
+        sys.stdout.flush()
+
     def do_write(self, args):
         """write <addr> <type>:<inst> <prop> <value> [ <indx> ] [ <priority> ]"""
         args = args.split()
@@ -227,7 +262,7 @@ class BacnetClientConsoleCmd(ConsoleCmd):
             if _debug: BacnetClientConsoleCmd._debug("    - iocb: %r", iocb)
 
             # give it to the application
-            this_application.request_io(iocb)
+            this_application.request_io(iocb, priority_class='interactive')
 
             # wait for it to complete
             iocb.wait()
@@ -304,7 +339,7 @@ class BacnetClientConsoleCmd(ConsoleCmd):
             if _debug: BacnetClientConsoleCmd._debug("    - iocb: %r", iocb)
 
             # give it to the application
-            this_application.request_io(iocb)
+            this_application.request_io(iocb, priority_class='interactive')
 
             # wait for it to complete
             iocb.wait()
@@ -353,8 +388,84 @@ class BacnetClientConsoleCmd(ConsoleCmd):
     def do_mstpstat(self, args):
         """discover <addr> <device-id>"""
         args = args.split()
-        mstp_lib=this_application.mux.directPort.mstp_lib
-        mstp_lib.get_mstpstats()
+        directPort=this_application.mux.directPort
+        directPort.mstp_lib.get_mstpstats()
+
+        # datagrams per wakeup between the agent and the director
+        if hasattr(directPort, 'batch_counters'):
+            counters = directPort.batch_counters()
+            for direction in ('read', 'write'):
+                batches = counters[direction]
+                print("{}: wakeups={} datagrams={} largest={} average={:.2f}".format(
+                    direction, batches['wakeups'], batches['datagrams'],
+                    batches['largest'], batches['average']))
+
+        # PDUs waiting for the agent and in the agent
+        if hasattr(directPort, 'queue_counters'):
+            counters = directPort.queue_counters()
+            print("queue: depth={} length={} high_water={} refused={} dropped={}".format(
+                counters['depth'], counters['length'], counters['high_water'],
+                counters['refused'], counters['dropped']))
+            if 'agent' in counters:
+                agent = counters['agent']
+                print("agent queue: depth={} length={} high_water={} full={}".format(
+                    agent['depth'], agent['length'], agent['high_water'], agent['full']))
+
+        # the lanes of the priority classes and the latency of the requests
+        if hasattr(directPort, 'lane_counters'):
+            lanes = directPort.lane_counters()
+            latency = this_application.priority_counters()
+            for priority_class in MSTP_PRIORITY_CLASSES:
+                lane = lanes[priority_class]
+                request = latency[priority_class]
+                print("{}: sent={} waiting={} requests={} errors={} p50={:.3f}s p99={:.3f}s max={:.3f}s".format(
+                    priority_class, lane.get('sent', 0), lane.get('length', 0),
+                    request['count'], request['errors'], request['p50'],
+                    request['p99'], request['max']))
+
+        # reads that went out together
+        counters = this_application.coalesceCounters
+        print("coalesce: reads={} requests={} refused={}".format(
+            counters['reads'], counters['requests'], len(this_application.coalesceRefused)))
+
+        # the use of the wire and the background requests held for it
+        counters = this_application.bandwidth_counters()
+        for trunk in counters['trunks']:
+            print("bandwidth: utilization={:.1%} own={:.1%} others={:.1%} requests={:.1%} tokens={:.1%} rotation={:.3f}s idle={:.3f}s waiting={}".format(
+                trunk['utilization'], trunk['own'], trunk['others'], trunk['requests'],
+                trunk['tokens'], trunk['rotation'], trunk['idle_rotation'], trunk['waiting']))
+        print("admission: budget={:.0%} admitted={} deferred={} shed={}".format(
+            counters['budget'], counters['admitted'], counters['deferred'], counters['shed']))
+
+        # the devices with requests out or waiting, or a window below its limit
+        for address, window in sorted(this_application.window_counters().items(), key=lambda item: str(item[0])):
+            print("window {}: limit={} window={:.2f} active={} waiting={} answered={} aborts={} timeouts={} backoff={:g}s".format(
+                address, window['limit'], window['window'], window['active'], window['waiting'],
+                window['answered'], window['aborts'], window['timeouts'], window['backoff']))
+
+        # the reads of the local device answered from the encoded responses
+        counters = this_application.response_cache_counters()
+        if counters:
+            print("response cache: acks={} values={} hits={} misses={} invalidated={}".format(
+                counters['acks'], counters['values'], counters['hits'], counters['misses'],
+                counters['invalidated']))
+
+    def do_capture(self, args):
+        """capture [ <file> [ <max-bytes> [ <max-files> ] ] | off ]"""
+        args = args.split()
+        directPort = this_application.mux.directPort
+
+        if not args:
+            print(self.do_capture.__doc__)
+        elif args[0] == 'off':
+            directPort.capture()
+            print("capture stopped")
+        else:
+            try:
+                directPort.capture(*[args[0]] + [int(arg) for arg in args[1:3]])
+                print("capturing to {}".format(args[0]))
+            except (ValueError, RuntimeError) as err:
+                print(err)
 
     def _is_writable(self, fname):
         try:
@@ -366,16 +477,28 @@ class BacnetClientConsoleCmd(ConsoleCmd):
         return False
 
     def do_mstpdbg(self, args):
-        """mstpdbg <enable|disable|status> [filename]"""
+        """mstpdbg <enable|disable|status|level|categories> [filename|level|categories]"""
 
         if len(args) == 0:
             print("mstpdbg <enable|disable|status> <filename>")
+            print("mstpdbg level <error|info|debug>")
+            print("mstpdbg categories <all|general,receive,data,master>")
             return
 
         args = args.split()
         dbg_type = args[0]
-        if dbg_type not in ("enable", "disable", "status"):
-            print("mstpdbg <enable|disable|status> <filename>")
+        if dbg_type not in ("enable", "disable", "status", "level", "categories"):
+            print("mstpdbg <enable|disable|status|level|categories> <filename>")
+            return
+        if dbg_type in ("level", "categories"):
+            if len(args) != 2:
+                print("mstpdbg {} <{}>".format(dbg_type, "|".join(
+                    MSTP_DEBUG_LEVELS if dbg_type == "level" else ["all"] + list(MSTP_DEBUG_CATEGORIES))))
+                return
+            try:
+                mstp_debug(this_application.mux.directPort.mstp_lib, **{dbg_type: args[1]})
+            except (KeyError, ValueError) as err:
+                print("invalid {}: {}".format(dbg_type, err))
             return
         if dbg_type == 'enable':
             if len(args) != 2:
@@ -406,111 +529,171 @@ class BacnetClientConsoleCmd(ConsoleCmd):
             print("mstpdbg <enable|disable|status> <filename>")
 
     def do_discover(self, args):
-        """discover <addr> <device-id>"""
+        """discover <addr> <device-id> [ <addr> <device-id> ... ]"""
         args = args.split()
+        if _debug: BacnetClientConsoleCmd._debug("do_discover %r", args)
+
         try:
+            if not args or (len(args) % 2):
+                raise ValueError('Expected pairs of address and device identifier')
 
-            if len(args) != 2:
-                raise ValueError('Expected 2 arguments')
+            # the devices are read at the same time, each one prints its
+            # objects when they are all in
+            for addr, device_id in zip(args[0::2], args[1::2]):
+                iocb = this_discovery.discover(Address(addr), int(device_id))
+                iocb.add_callback(self._discovery_complete, addr, int(device_id))
+
+        except Exception as error:
+            BacnetClientConsoleCmd._exception("exception: %r", error)
 
-            addr, device_id = args[:2]
+    def _discovery_complete(self, iocb, addr, device_id):
+        if _debug: BacnetClientConsoleCmd._debug("_discovery_complete %r %r %r", iocb, addr, device_id)
 
-            addr = int(addr)
-            device_id = int(device_id)
+        if iocb.ioError:
+            sys.stdout.write('device:{} at {}: {}\n'.format(device_id, addr, iocb.ioError))
+        else:
+            sys.stdout.write('device:{} at {}: {} objects\n'.format(device_id, addr, len(iocb.ioResponse)))
+            for obj_id, properties in iocb.ioResponse:
+                line = '    {}:{}'.format(*obj_id)
+                if 'objectName' in properties:
+                    line += ' {!r}'.format(properties['objectName'])
+                if 'units' in properties:
+                    line += ' ({})'.format(properties['units'])
+                sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+    def do_poll(self, args):
+        """poll [ <addr> <type>:<inst> <prop> <interval> [ <indx> ] ]"""
+        args = args.split()
+        if _debug: BacnetClientConsoleCmd._debug("do_poll %r", args)
 
-            # used across requests
-            self._instance_list = [0]
-            self._first_req = True
-            self._addr = addr
-            self._device_id = device_id
+        try:
+            # the points with their last values and how the polling keeps up
+            if not args:
+                for point in this_poller.points():
+                    index = '' if point.propertyArrayIndex is None else '[{}]'.format(point.propertyArrayIndex)
+                    value = point.error if point.error is not None else point.value
+                    print("{} {}:{} {}{} every {:g}s: {} ({} reads, {} errors)".format(
+                        point.address, point.objectIdentifier[0], point.objectIdentifier[1],
+                        point.propertyIdentifier, index, point.interval, value, point.reads, point.errors))
+
+                counters = this_poller.counters()
+                lag = counters['lag']
+                print("points={} devices={} active={} waiting={} overdue={} missed={} lag p50={:.3f}s p99={:.3f}s max={:.3f}s".format(
+                    counters['points'], counters['devices'], counters['active'], counters['waiting'],
+                    counters['overdue'], counters['missed'], lag['p50'], lag['p99'], lag['max']))
+                return
+
+            addr, obj_id, prop_id, interval = args[:4]
+            obj_id = ObjectIdentifier(obj_id).value
+            if not get_datatype(obj_id[0], prop_id):
+                raise ValueError("invalid property for object type")
 
-            self._discovery()
+            index = int(args[4]) if len(args) == 5 else None
+            this_poller.add(Address(addr), obj_id, prop_id, float(interval), index)
 
         except Exception as error:
             BacnetClientConsoleCmd._exception("exception: %r", error)
 
-    def _discovery(self):
-        global device_address
+    def do_unpoll(self, args):
+        """unpoll <addr> [ <type>:<inst> [ <prop> ] ]"""
+        args = args.split()
+        if _debug: BacnetClientConsoleCmd._debug("do_unpoll %r", args)
 
-        # build a request
-        obj_type, prop_id = ('device', 'objectList')
+        try:
+            if not args:
+                raise ValueError("address expected")
+            addr = Address(args[0])
+            obj_id = ObjectIdentifier(args[1]).value if len(args) > 1 else None
+            prop_id = args[2] if len(args) > 2 else None
 
-        # build a request
-        request = ReadPropertyRequest(
-            objectIdentifier=(obj_type, self._device_id),
-            propertyIdentifier=prop_id,
-        )
-        request.pduSource = Address(this_device._address)
-        request.pduDestination = Address(int(self._addr))
-        request.propertyArrayIndex = self._instance_list.pop(0)
+            for point in this_poller.points():
+                if (point.address == addr) and (obj_id in (None, point.objectIdentifier)) \
+                        and (prop_id in (None, point.propertyIdentifier)):
+                    this_poller.remove(point)
 
-        if _debug:
-            BacnetClientConsoleCmd._debug("    - request: %r", request)
+        except Exception as error:
+            BacnetClientConsoleCmd._exception("exception: %r", error)
 
-        # make an IOCB
-        iocb = IOCB(request)
+    def do_subscribe(self, args):
+        """subscribe [ <addr> <type>:<inst> [ <prop> ] [ <lifetime> ] [ confirmed ] ]"""
+        args = args.split()
+        if _debug: BacnetClientConsoleCmd._debug("do_subscribe %r", args)
 
-        # set a callback for the response
-        iocb.add_callback(self._discovery_response)
-        if _debug:
-            BacnetClientConsoleCmd._debug("    - iocb: %r", iocb)
+        try:
+            # the subscriptions with their last values and the traffic saved
+            if not args:
+                for subscription in sorted(this_cov.subscriptions.values(), key=lambda item: str(item.key())):
+                    print("{} {}:{} {} {}: {} ({} notifications)".format(
+                        subscription.address, subscription.objectIdentifier[0], subscription.objectIdentifier[1],
+                        subscription.propertyIdentifier or '*', subscription.state, subscription.value,
+                        subscription.notifications))
+
+                counters = this_cov.counters()
+                print("subscriptions={} active={} polled={} retrying={} cov_frames={} polling_frames={} saved={} ({:.1f}%)".format(
+                    counters['subscriptions'], counters['active'], counters['polled'], counters['retrying'],
+                    counters['cov_frames'], counters['polling_frames'], counters['saved_frames'], counters['saved_percent']))
+                return
 
-        # send the request
-        this_application.request_io(iocb)
+            addr, obj_id = args[:2]
+            obj_id = ObjectIdentifier(obj_id).value
 
-    def _discovery_response(self, iocb):
-        if _debug:
-            BacnetClientConsoleCmd._debug("complete_request %r", iocb)
+            prop_id = None
+            lifetime = COV_LIFETIME
+            confirmed = False
+            for arg in args[2:]:
+                if arg == 'confirmed':
+                    confirmed = True
+                elif arg.isdigit():
+                    lifetime = int(arg)
+                elif get_datatype(obj_id[0], arg):
+                    prop_id = arg
+                else:
+                    raise ValueError("invalid property for object type")
 
-        if iocb.ioResponse:
-            apdu = iocb.ioResponse
+            this_cov.subscribe(Address(addr), obj_id, prop_id, lifetime, confirmed)
 
-            # should be an ack
-            if not isinstance(apdu, ReadPropertyACK):
-                if _debug:
-                    BacnetClientConsoleCmd._debug("    - not an ack")
-                return
+        except Exception as error:
+            BacnetClientConsoleCmd._exception("exception: %r", error)
 
-            # find the datatype
-            datatype = get_datatype(
-                apdu.objectIdentifier[0], apdu.propertyIdentifier
-            )
-            if _debug:
-                BacnetClientConsoleCmd._debug("    - datatype: %r", datatype)
-            if not datatype:
-                raise TypeError("unknown datatype")
-
-            # special case for array parts, others are managed by cast_out
-            if (
-                (issubclass(datatype, Array)) and
-                (apdu.propertyArrayIndex is not None)
-            ):
-                if apdu.propertyArrayIndex == 0:
-                    value = apdu.propertyValue.cast_out(Unsigned)
-                else:
-                    value = apdu.propertyValue.cast_out(datatype.subtype)
-            else:
-                value = apdu.propertyValue.cast_out(datatype)
-            if _debug:
-                BacnetClientConsoleCmd._debug("    - value: %r", value)
+    def do_unsubscribe(self, args):
+        """unsubscribe <addr> [ <type>:<inst> [ <prop> ] ]"""
+        args = args.split()
+        if _debug: BacnetClientConsoleCmd._debug("do_unsubscribe %r", args)
 
-            sys.stdout.write(str(value) + '\n')
+        try:
+            if not args:
+                raise ValueError("address expected")
+            addr = Address(args[0])
+            obj_id = ObjectIdentifier(args[1]).value if len(args) > 1 else None
+            prop_id = args[2] if len(args) > 2 else None
 
-            if hasattr(value, 'debug_contents'):
-                value.debug_contents(file=sys.stdout)
-            sys.stdout.flush()
+            for subscription in list(this_cov.subscriptions.values()):
+                if (subscription.address == addr) and (obj_id in (None, subscription.objectIdentifier)) \
+                        and (prop_id in (None, subscription.propertyIdentifier)):
+                    this_cov.cancel(subscription)
+
+        except Exception as error:
+            BacnetClientConsoleCmd._exception("exception: %r", error)
 
-            if self._first_req:
-                self._instance_list = list(range(1, value+1))
-                self._first_req = False
+    def do_window(self, args):
+        """window [ <addr> [ <limit> ] ]"""
+        args = args.split()
+        if _debug: BacnetClientConsoleCmd._debug("do_window %r", args)
 
-                # fire off another request
-                deferred(self._discovery)
+        try:
+            # the limits given to devices and the one of the rest
+            if not args:
+                for address, limit in sorted(this_application.windowLimits.items(), key=lambda item: str(item[0])):
+                    print("{}: {}".format(address, limit))
+                print("default: {}".format(this_application.windowLimit))
                 return
 
-            if self._instance_list:
-                # fire off another request
-                deferred(self._discovery)
+            limit = int(args[1]) if len(args) > 1 else None
+            this_application.set_window(Address(args[0]), limit)
+
+        except Exception as error:
+            BacnetClientConsoleCmd._exception("exception: %r", error)
 
     def do_rtn(self, args):
         """rtn <addr> <net> ... """
@@ -525,12 +708,36 @@ class BacnetClientConsoleCmd(ConsoleCmd):
         this_application.nsap.add_router_references(None, router_address, network_list)
 
 
+#
+#   start_scan
+#
+
+def start_scan(low=0, high=WHOIS_MAX_INSTANCE, **kwargs):
+    """Sweep the device instances and print what changed."""
+    if _debug: _log.debug("start_scan %r %r %r", low, high, kwargs)
+
+    def scan_complete(iocb):
+        if iocb.ioError:
+            sys.stdout.write('scan {}-{}: {}\n'.format(low, high, iocb.ioError))
+            sys.stdout.flush()
+            return
+
+        changes = iocb.ioResponse
+        sys.stdout.write('scan {}-{}: {} devices\n'.format(low, high, len(changes['seen'])))
+        for change in ('added', 'moved', 'changed', 'missing'):
+            if changes[change]:
+                sys.stdout.write('    {}: {}\n'.format(change, ' '.join(str(instance) for instance in changes[change])))
+        sys.stdout.flush()
+
+    iocb = DeviceScan(this_application, low, high, **kwargs).start()
+    iocb.add_callback(scan_complete)
+
 #
 #   main
 #
 
 def main():
-    global this_device, this_application
+    global this_device, this_application, this_discovery, this_poller, this_cov
 
     # parse the command line arguments
     args = ConfigArgumentParser(description=__doc__).parse_args()
@@ -549,6 +756,49 @@ def main():
 
     if hasattr(args.ini, 'mstpdbgfile'):
         mstp_args['_mstpdbgfile'] = str(args.ini.mstpdbgfile)
+    if hasattr(args.ini, 'mstpdbglevel'):
+        mstp_args['_mstpdbglevel'] = str(args.ini.mstpdbglevel)
+    if hasattr(args.ini, 'mstpdbgcategories'):
+        mstp_args['_mstpdbgcategories'] = str(args.ini.mstpdbgcategories)
+
+    if hasattr(args.ini, 'mstp_batch'):
+        mstp_args['_mstp_batch'] = int(args.ini.mstp_batch)
+
+    if hasattr(args.ini, 'mstp_ipc'):
+        mstp_args['_mstp_ipc'] = str(args.ini.mstp_ipc)
+
+    if hasattr(args.ini, 'mstp_queue_depth'):
+        mstp_args['_mstp_queue_depth'] = int(args.ini.mstp_queue_depth)
+
+    if hasattr(args.ini, 'mstp_pdu_queue'):
+        mstp_args['_mstp_pdu_queue'] = int(args.ini.mstp_pdu_queue)
+
+    if hasattr(args.ini, 'mstp_stats'):
+        mstp_args['_mstp_stats'] = str(args.ini.mstp_stats)
+
+    if hasattr(args.ini, 'mstp_capture'):
+        mstp_args['_mstp_capture'] = str(args.ini.mstp_capture)
+
+    if hasattr(args.ini, 'mstp_capture_size'):
+        mstp_args['_mstp_capture_size'] = int(args.ini.mstp_capture_size)
+
+    if hasattr(args.ini, 'mstp_capture_files'):
+        mstp_args['_mstp_capture_files'] = int(args.ini.mstp_capture_files)
+
+    if hasattr(args.ini, 'device_cache'):
+        mstp_args['_mstp_device_cache'] = str(args.ini.device_cache)
+
+    if hasattr(args.ini, 'mstp_coalesce'):
+        mstp_args['_mstp_coalesce'] = int(args.ini.mstp_coalesce)
+
+    if hasattr(args.ini, 'mstp_bandwidth_budget'):
+        mstp_args['_mstp_bandwidth_budget'] = float(args.ini.mstp_bandwidth_budget)
+
+    if hasattr(args.ini, 'mstp_window'):
+        mstp_args['_mstp_window'] = int(args.ini.mstp_window)
+
+    if hasattr(args.ini, 'mstp_response_cache'):
+        mstp_args['_mstp_response_cache'] = int(args.ini.mstp_response_cache)
 
     this_device = LocalDeviceObject(ini=args.ini, **mstp_args)
     if _debug: _log.debug("    - this_device: %r", this_device)
@@ -559,6 +809,26 @@ def main():
         )
     if _debug: _log.debug("    - this_application: %r", this_application)
 
+    # object lists and names are kept between runs when there is a file
+    store = None
+    if hasattr(args.ini, 'metadata_cache'):
+        store = MSTPMetadataStore(str(args.ini.metadata_cache))
+
+    # objects of devices are read in the bulk lane
+    this_discovery = ObjectDiscovery(this_application, store=store, properties=('objectName', 'units'))
+
+    # points are read in the poll lane
+    this_poller = PointPoller(this_application)
+
+    # points are subscribed to, and polled by the same poller when the
+    # device does not do COV
+    this_cov = COVSubscriptionManager(this_application, poller=this_poller)
+
+    # the devices from the last run are ready to use, check them against
+    # the trunk in the background
+    if this_application.deviceInfoCache.devices():
+        deferred(start_scan)
+
     # make a console
     this_console = BacnetClientConsoleCmd()
     if _debug: _log.debug("    - this_console: %r", this_console)
@@ -570,6 +840,12 @@ def main():
 
     run()
 
+    # keep the devices for the next run
+    if getattr(this_application.deviceInfoCache, 'path', None):
+        this_application.deviceInfoCache.save()
+    if store:
+        store.close()
+
     _log.debug("fini")
 
 
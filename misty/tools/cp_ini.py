@@ -20,6 +20,38 @@ foreignBBMD: 128.253.109.254
 foreignTTL: 30
 ; enable this to see the mstp debug logs
 ; mstpdbgfile:/home/riptide/abcd.log
+; and this to choose what goes in them, error, info or debug and a list of
+; general, receive, data and master
+; mstpdbglevel:info
+; mstpdbgcategories:receive,master
+; enable this to drain up to this many frames per wakeup
+; mstp_batch:16
+; enable this to pass frames to the agent through shared memory rings
+; mstp_ipc:ring
+; enable this to change how many PDUs wait for the agent, and for the trunk
+; mstp_queue_depth:64
+; mstp_pdu_queue:64
+; enable this to serve the MSTP counters to Prometheus, a socket path or a port
+; mstp_stats:/var/tmp/bac_client.stats
+; enable this to write the frames to a pcap file, rotated at mstp_capture_size
+; mstp_capture:/var/tmp/bac_client.pcap
+; mstp_capture_size:16777216
+; mstp_capture_files:4
+; enable this to keep the devices seen between runs
+; device_cache:/var/tmp/bac_client.devices
+; enable this to keep the object lists and names of devices between runs
+; metadata_cache:/var/tmp/bac_client.metadata
+; set this to 0 to send every read on its own instead of merging them
+; mstp_coalesce:1
+; share of the wire the data frames may take before polls and bulk reads
+; wait, 0 to send them whatever the load
+; mstp_bandwidth_budget:0.5
+; confirmed requests each device has out at a time, a device that takes
+; more can be given its own with the window command
+; mstp_window:1
+; set this to 0 to encode every response instead of keeping the ones of
+; the properties that rarely change
+; mstp_response_cache:1
 """
 
 bac_server_ini="""[BACpypes]
@@ -36,6 +68,9 @@ vendorIdentifier: 15
 foreignPort: 0
 foreignBBMD: 128.253.109.254
 foreignTTL: 30
+; set this to 0 to encode every response instead of keeping the ones of
+; the properties that rarely change
+; mstp_response_cache:1
 """
 
 
@@ -44,6 +44,7 @@ def setup_packages():
             'bin/WhoIsIAm',
             'bin/bc',
             'bin/bs',
+            'bin/MSTPRouter',
             'bin/cp_ini'
         ],
         long_description=long_description,